@@ -0,0 +1 @@
+"""Benchmark suite (fake upstream + load generator) -> python -m benchmarks.run --help"""
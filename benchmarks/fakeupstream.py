@@ -0,0 +1,136 @@
+import json
+import os
+import random
+import shutil
+import stat
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+from loguru import logger
+from pydantic import BaseModel
+
+
+class FakePackage(BaseModel):
+    package_name: str
+    repo_name: str  # "<owner>/<name>" like on github
+    bare_repo: Path
+    files: List[str]  # paths relative to the repo root
+
+
+class FakeUpstream(BaseModel):
+    """Local bare git repositories with synthetic micropython packages -> serves as GITHUB_REPO_URL_BASE"""
+
+    root: Path
+    owner: str
+    packages: List[FakePackage]
+
+    @property
+    def url_base(self) -> str:
+        return f"file://{self.root}"
+
+    def package_name_to_repo(self) -> Dict[str, str]:
+        return {p.package_name: p.repo_name for p in self.packages}
+
+
+def _git(*args: str, cwd: Path | None = None) -> str:
+    env: Dict[str, str] = dict(
+        os.environ,
+        GIT_AUTHOR_NAME="bench",
+        GIT_AUTHOR_EMAIL="bench@localhost",
+        GIT_COMMITTER_NAME="bench",
+        GIT_COMMITTER_EMAIL="bench@localhost",
+    )
+    res = subprocess.run(["git", *args], cwd=cwd, capture_output=True, text=True, env=env, check=True)
+    return res.stdout.strip()
+
+
+def synthetic_module(index: int, size: int, rnd: random.Random) -> str:
+    """Valid micropython source of roughly size bytes (real mpy-cross has to compile it)"""
+    lines: List[str] = [f'"""synthetic module {index}"""', ""]
+    n: int = 0
+    while sum(len(line) + 1 for line in lines) < size:
+        k: int = rnd.randint(0, 1_000_000)
+        lines.append(f"def f{index}_{n}(x):")
+        lines.append(f"    return (x * {k} + {n}) % 65521")
+        lines.append("")
+        n += 1
+    return "\n".join(lines) + "\n"
+
+
+def create_fake_upstream(
+    root: Path, packages: int, files_per_package: int, file_size: int, seed: int = 42, owner: str = "bench"
+) -> FakeUpstream:
+    """Creates <root>/<owner>/<package>.git bare repos (branch main) with a mip package.json each"""
+    rnd: random.Random = random.Random(seed)
+    work: Path = root / ".work"
+    ret: List[FakePackage] = []
+
+    for p in range(packages):
+        package_name: str = f"benchpkg{p}"
+        checkout: Path = work / package_name
+        checkout.mkdir(parents=True, exist_ok=True)
+
+        files: List[str] = []
+        for f in range(files_per_package):
+            rel: str = f"{package_name}/mod{f}.py"
+            (checkout / package_name).mkdir(exist_ok=True)
+            (checkout / rel).write_text(synthetic_module(f, file_size, rnd))
+            files.append(rel)
+
+        (checkout / "package.json").write_text(
+            json.dumps({"urls": [[rel, rel] for rel in files], "version": "0.0.1"}, indent=2)
+        )
+
+        _git("init", "-q", "-b", "main", cwd=checkout)
+        _git("add", "-A", cwd=checkout)
+        _git("commit", "-q", "-m", "initial", cwd=checkout)
+
+        bare: Path = root / owner / f"{package_name}.git"
+        bare.parent.mkdir(parents=True, exist_ok=True)
+        _git("clone", "-q", "--bare", str(checkout), str(bare))
+
+        ret.append(
+            FakePackage(package_name=package_name, repo_name=f"{owner}/{package_name}", bare_repo=bare, files=files)
+        )
+
+    logger.info(f"created {packages} fake upstream repos with {files_per_package} files of ~{file_size} bytes")
+    return FakeUpstream(root=root, owner=owner, packages=ret)
+
+
+def push_new_commit(upstream: FakeUpstream, package: FakePackage) -> str:
+    """Changes one file of package upstream -> the next revalidation has to rebuild; returns the new commit"""
+    checkout: Path = upstream.root / ".work" / package.package_name
+    target: Path = checkout / package.files[0]
+    target.write_text(target.read_text() + f"\nCHANGED = {random.randint(0, 1_000_000)}\n")
+    _git("commit", "-q", "-am", "change", cwd=checkout)
+    _git("push", "-q", str(package.bare_repo), "main", cwd=checkout)
+    return _git("rev-parse", "HEAD", cwd=checkout)
+
+
+_STUB_MPY_CROSS: str = """#!{python}
+# stand-in for mpy-cross: "compiles" by prefixing a header (same cli as the real one)
+import sys
+
+args = sys.argv[1:]
+src = next(a for i, a in enumerate(args) if not a.startswith("-") and (i == 0 or args[i - 1] not in ("-o", "-s")))
+out = args[args.index("-o") + 1]
+with open(src, "rb") as fin, open(out, "wb") as fout:
+    fout.write(b"M\\x06\\x00\\x1f")
+    fout.write(fin.read())
+"""
+
+
+def ensure_mpy_cross(bin_dir: Path, force_stub: bool = False) -> str:
+    """Returns the mpy-cross that will be used -> installs a stub (and prepends it to PATH) if none is available"""
+    existing: str | None = shutil.which("mpy-cross") or shutil.which("mpy-cross-static")
+    if existing and not force_stub:
+        return existing
+
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    stub: Path = bin_dir / "mpy-cross"
+    stub.write_text(_STUB_MPY_CROSS.format(python=sys.executable))
+    stub.chmod(stub.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ["PATH"] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    return str(stub)
@@ -0,0 +1,131 @@
+"""Small objects: one file per object vs. pack files with a memory mapped index
+
+python -m benchmarks.packstore --objects 100000 --lookups 20000 --out packstore.json
+"""
+
+import argparse
+import hashlib
+import os
+import platform
+import random
+import sys
+import tempfile
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+
+os.environ.setdefault("LOGURU_LEVEL", "WARNING")
+
+from benchmarks.run import LatencyStats, _git_version  # noqa: E402
+from benchmarks.serialization import measure  # noqa: E402
+
+
+class StoreFootprint(BaseModel):
+    files: int = 0  # inodes
+    allocated_bytes: int = 0  # st_blocks, i.e. including the partially used last block of every file
+
+
+class PackStoreResult(BaseModel):
+    version: str
+    python: str
+    platform: str
+    objects: int
+    object_bytes: int
+    lookups: int
+    pack_seconds: float = 0.0
+    footprint: Dict[str, StoreFootprint] = Field(default_factory=dict)  # "loose" / "packed"
+    results: Dict[str, LatencyStats] = Field(default_factory=dict)  # "<scenario>_<store>"
+
+
+def footprint(root: Path) -> StoreFootprint:
+    ret = StoreFootprint()
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            st: os.stat_result = os.lstat(os.path.join(dirpath, name))
+            ret.files += 1
+            ret.allocated_bytes += st.st_blocks * 512
+    return ret
+
+
+def run_packstore(objects: int, object_bytes: int, lookups: int, workdir: Path) -> PackStoreResult:
+    from mipserver.config import Packs
+    from mipserver.internal.locks import LockManager
+    from mipserver.internal.objectstore import LooseObjectStore
+    from mipserver.internal.packstore import PackStore
+
+    result = PackStoreResult(
+        version=_git_version(),
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        objects=objects,
+        object_bytes=object_bytes,
+        lookups=lookups,
+    )
+    rnd = random.Random(42)
+    loose = LooseObjectStore(workdir / "loose")
+    packed_loose = LooseObjectStore(workdir / "packed-loose")
+    hashes: List[str] = []
+    for i in range(objects):
+        data: bytes = i.to_bytes(8, "big") + rnd.randbytes(max(0, rnd.randint(object_bytes // 2, object_bytes) - 8))
+        h: str = hashlib.sha256(data).hexdigest()
+        loose.put_bytes(data, h)
+        packed_loose.put_bytes(data, h)
+        hashes.append(h)
+
+    packs = PackStore(workdir / "packs", Packs(enabled=True), LockManager(workdir))
+    report = packs.maintain(
+        ((h, packed_loose.path_for(h), st.st_size) for h, st in packed_loose.iter_loose()), timeout=None
+    )
+    result.pack_seconds = report.duration_seconds
+    result.footprint["loose"] = footprint(workdir / "loose")
+    result.footprint["packed"] = footprint(workdir / "packs")
+
+    sample: List[str] = [rnd.choice(hashes) for _ in range(lookups)]
+    missing: List[str] = [hashlib.sha256(f"missing{i}".encode()).hexdigest() for i in range(lookups)]
+
+    def read_loose(obj_hash: str) -> bytes:
+        with open(loose.path_for(obj_hash), "rb") as f:
+            return f.read()
+
+    scenarios: Dict[str, Tuple[List[str], Callable[[str], object]]] = {
+        "lookup_loose": (sample, loose.has),
+        "lookup_packed": (sample, packs.has),
+        "miss_loose": (missing, loose.has),
+        "miss_packed": (missing, packs.has),
+        "read_loose": (sample, read_loose),
+        "read_packed": (sample, lambda h: bytes(packs.read(h) or b"")),
+    }
+    for name, (items, fn) in scenarios.items():
+        it: Iterator[str] = iter(items)
+        result.results[name] = measure(lambda: fn(next(it)), len(items))
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(
+        prog="benchmarks.packstore", description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    ap.add_argument("--objects", type=int, default=100_000)
+    ap.add_argument("--object-bytes", type=int, default=2048, help="upper bound, sizes are uniform in [n/2, n]")
+    ap.add_argument("--lookups", type=int, default=20_000)
+    ap.add_argument("--workdir", type=Path, default=None, help="on the volume to measure (default: a temp dir)")
+    ap.add_argument("--out", type=Path, default=None, help="write the json result here (default: stdout)")
+    args = ap.parse_args(sys.argv[1:] if argv is None else argv)
+
+    with tempfile.TemporaryDirectory(prefix="mipserver-bench-", dir=args.workdir) as tmp:
+        result: PackStoreResult = run_packstore(args.objects, args.object_bytes, args.lookups, Path(tmp))
+
+    for store, fp in result.footprint.items():
+        print(f"{store:<8} {fp.files:>8} files {fp.allocated_bytes / 2**20:10.1f} MiB allocated", file=sys.stderr)
+    for name, stats in result.results.items():
+        print(f"{name:<16} p50 {stats.p50_ms * 1000:8.1f} us  p99 {stats.p99_ms * 1000:8.1f} us", file=sys.stderr)
+    payload: str = result.model_dump_json(indent=2)
+    if args.out is not None:
+        args.out.write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
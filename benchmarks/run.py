@@ -0,0 +1,327 @@
+"""Benchmark suite: fake local upstream, in-process server, concurrent clients -> JSON results
+
+python -m benchmarks.run --packages 5 --files 20 --devices 1000 --out bench-$(git rev-parse --short HEAD).json
+python -m benchmarks.run compare bench-old.json bench-new.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import functools
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+# the server modules log on DEBUG by default and resolve their cache root from the cwd at import time
+os.environ.setdefault("LOGURU_LEVEL", "WARNING")
+
+
+class LatencyStats(BaseModel):
+    count: int = 0
+    errors: int = 0
+    duration_seconds: float = 0.0
+    throughput_rps: float = 0.0
+    mean_ms: float = 0.0
+    p50_ms: float = 0.0
+    p90_ms: float = 0.0
+    p99_ms: float = 0.0
+    max_ms: float = 0.0
+
+    @classmethod
+    def from_samples(cls, samples: List[float], errors: int, duration_seconds: float) -> "LatencyStats":
+        ordered: List[float] = sorted(samples)
+
+        def pct(p: float) -> float:
+            if not ordered:
+                return 0.0
+            # nearest rank
+            return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))] * 1000
+
+        return cls(
+            count=len(ordered),
+            errors=errors,
+            duration_seconds=duration_seconds,
+            throughput_rps=len(ordered) / duration_seconds if duration_seconds > 0 else 0.0,
+            mean_ms=(sum(ordered) / len(ordered) * 1000) if ordered else 0.0,
+            p50_ms=pct(50),
+            p90_ms=pct(90),
+            p99_ms=pct(99),
+            max_ms=(ordered[-1] * 1000) if ordered else 0.0,
+        )
+
+
+class BenchmarkParams(BaseModel):
+    packages: int = 3
+    files: int = 10
+    file_size: int = 4096
+    clients: int = 50
+    requests: int = 500
+    devices: int = 200
+    mpy_version: str = "6"
+    stub_mpy_cross: bool = False
+    seed: int = 42
+
+
+class BenchmarkResult(BaseModel):
+    version: str
+    python: str
+    platform: str
+    created_at: str
+    mpy_cross: str
+    params: BenchmarkParams
+    results: Dict[str, LatencyStats] = Field(default_factory=dict)
+
+
+def _git_version() -> str:
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return int(s.getsockname()[1])
+
+
+async def run_concurrent(jobs: List[Callable[[], Awaitable[bool]]], concurrency: int) -> LatencyStats:
+    """Runs jobs with at most concurrency in flight -> latency of every job"""
+    samples: List[float] = []
+    errors: int = 0
+    queue: asyncio.Queue[Callable[[], Awaitable[bool]]] = asyncio.Queue()
+    for j in jobs:
+        queue.put_nowait(j)
+
+    async def worker() -> None:
+        nonlocal errors
+        while True:
+            try:
+                job = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            started: float = time.perf_counter()
+            try:
+                ok: bool = await job()
+            except Exception:
+                ok = False
+            samples.append(time.perf_counter() - started)
+            errors += int(not ok)
+
+    started: float = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(jobs))))))
+    return LatencyStats.from_samples(samples, errors, time.perf_counter() - started)
+
+
+def run_suite(params: BenchmarkParams, workdir: Path) -> BenchmarkResult:
+    workdir.mkdir(parents=True, exist_ok=True)
+    previous_cwd: str = os.getcwd()
+    os.chdir(workdir)  # -> server cache root is <workdir>/.cache/repos
+    try:
+        return _run_suite(params, workdir)
+    finally:
+        os.chdir(previous_cwd)
+
+
+def _run_suite(params: BenchmarkParams, workdir: Path) -> BenchmarkResult:
+    import httpx
+    import uvicorn
+
+    from benchmarks.fakeupstream import create_fake_upstream, ensure_mpy_cross, push_new_commit
+
+    mpy_cross: str = ensure_mpy_cross(workdir / "bin", force_stub=params.stub_mpy_cross)
+    upstream = create_fake_upstream(
+        workdir / "upstream", params.packages, params.files, params.file_size, seed=params.seed
+    )
+
+    import mipserver.app as appmod
+    from mipserver.config import AdmissionControl
+    from mipserver.Helper import MIPServerHelper
+    from mipserver.internal.admission import AdmissionController
+
+    MIPServerHelper.GITHUB_REPO_URL_BASE = upstream.url_base
+    package_map: Dict[str, str] = upstream.package_name_to_repo()
+    appmod.app.dependency_overrides[appmod.get_package_name_to_repo] = lambda: package_map
+    # all benchmark clients come from 127.0.0.1 -> no per-client budget
+    admission = AdmissionController(AdmissionControl(client_budget=10**9))
+    appmod.app.dependency_overrides[appmod.get_admission_controller] = lambda: admission
+
+    port: int = _free_port()
+    server = uvicorn.Server(uvicorn.Config(appmod.app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    result = BenchmarkResult(
+        version=_git_version(),
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        created_at=datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        mpy_cross=mpy_cross,
+        params=params,
+    )
+
+    async def scenarios() -> None:
+        limits = httpx.Limits(max_connections=params.clients, max_keepalive_connections=params.clients)
+        async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=600) as client:
+
+            def get(path: str) -> Callable[[], Awaitable[bool]]:
+                async def job() -> bool:
+                    r = await client.get(path)
+                    return r.status_code == 200
+
+                return job
+
+            json_paths: List[str] = [
+                f"/package/{params.mpy_version}/{p.package_name}/latest.json" for p in upstream.packages
+            ]
+
+            # clone + compile + hash + store, one package after the other
+            result.results["cold_build"] = await run_concurrent([get(p) for p in json_paths], 1)
+
+            # freshness over, upstream unchanged -> fetch + commit comparison only
+            def expire() -> None:
+                for p in upstream.packages:
+                    appmod.METADATA_STORE.mark_checked(p.package_name, params.mpy_version, "latest", at=0.0)
+
+            expire()
+            result.results["revalidate"] = await run_concurrent([get(p) for p in json_paths], 1)
+
+            # upstream moved on -> fetch + full rebuild
+            for p in upstream.packages:
+                push_new_commit(upstream, p)
+            expire()
+            result.results["warm_build"] = await run_concurrent([get(p) for p in json_paths], 1)
+
+            hashes: List[str] = []
+            for json_path in json_paths:
+                hashes += [h[1] for h in (await client.get(json_path)).json()["hashes"]]
+            file_paths: List[str] = [f"/file/{h[:2]}/{h}" for h in hashes]
+
+            result.results["package_json"] = await run_concurrent(
+                [get(json_paths[i % len(json_paths)]) for i in range(params.requests)], params.clients
+            )
+            result.results["file"] = await run_concurrent(
+                [get(file_paths[i % len(file_paths)]) for i in range(params.requests)], params.clients
+            )
+
+            # every device runs "mip install <package>" at the same time: package json, then all its files
+            async def device(index: int) -> bool:
+                path: str = json_paths[index % len(json_paths)]
+                r = await client.get(path)
+                if r.status_code != 200:
+                    return False
+                for h in r.json()["hashes"]:
+                    if (await client.get(f"/file/{h[1][:2]}/{h[1]}")).status_code != 200:
+                        return False
+                return True
+
+            result.results["reboot_storm"] = await run_concurrent(
+                [functools.partial(device, i) for i in range(params.devices)], params.clients
+            )
+
+    try:
+        asyncio.run(scenarios())
+    finally:
+        server.should_exit = True
+        thread.join(timeout=10)
+        appmod.app.dependency_overrides.clear()
+
+    return result
+
+
+def compare(old: BenchmarkResult, new: BenchmarkResult) -> List[str]:
+    """Human readable comparison (new relative to old) of p50/p99/throughput per scenario"""
+    lines: List[str] = [f"{'scenario':<14} {'p50 ms':>22} {'p99 ms':>22} {'rps':>22}"]
+
+    def fmt(a: float, b: float) -> str:
+        change: str = f"{(b - a) / a * 100:+.0f}%" if a else "n/a"
+        return f"{a:.1f} -> {b:.1f} ({change})"
+
+    for name, o in old.results.items():
+        n: Optional[LatencyStats] = new.results.get(name)
+        if n is None:
+            continue
+        lines.append(
+            f"{name:<14} {fmt(o.p50_ms, n.p50_ms):>22} {fmt(o.p99_ms, n.p99_ms):>22} "
+            f"{fmt(o.throughput_rps, n.throughput_rps):>22}"
+        )
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv[:1] == ["compare"]:
+        cp = argparse.ArgumentParser(prog="benchmarks.run compare")
+        cp.add_argument("old", type=Path)
+        cp.add_argument("new", type=Path)
+        cargs = cp.parse_args(argv[1:])
+        old = BenchmarkResult.model_validate_json(cargs.old.read_text())
+        new = BenchmarkResult.model_validate_json(cargs.new.read_text())
+        print(f"{old.version} -> {new.version}")
+        print("\n".join(compare(old, new)))
+        return
+
+    ap = argparse.ArgumentParser(
+        prog="benchmarks.run", description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    defaults = BenchmarkParams()
+    ap.add_argument("--packages", type=int, default=defaults.packages)
+    ap.add_argument("--files", type=int, default=defaults.files, help="files per package")
+    ap.add_argument("--file-size", type=int, default=defaults.file_size, help="approx. bytes per .py file")
+    ap.add_argument("--clients", type=int, default=defaults.clients, help="concurrent connections")
+    ap.add_argument("--requests", type=int, default=defaults.requests, help="requests per throughput scenario")
+    ap.add_argument("--devices", type=int, default=defaults.devices, help="devices in the reboot storm")
+    ap.add_argument("--mpy-version", default=defaults.mpy_version)
+    ap.add_argument("--stub-mpy-cross", action="store_true", help="use the stub even if mpy-cross is installed")
+    ap.add_argument("--seed", type=int, default=defaults.seed)
+    ap.add_argument("--workdir", type=Path, default=None, help="default: a temporary directory")
+    ap.add_argument("--out", type=Path, default=None, help="write the json result here (default: stdout)")
+    args = ap.parse_args(argv)
+
+    params = BenchmarkParams(
+        packages=args.packages,
+        files=args.files,
+        file_size=args.file_size,
+        clients=args.clients,
+        requests=args.requests,
+        devices=args.devices,
+        mpy_version=args.mpy_version,
+        stub_mpy_cross=args.stub_mpy_cross,
+        seed=args.seed,
+    )
+
+    out: Optional[Path] = args.out.resolve() if args.out else None
+    if args.workdir is not None:
+        result = run_suite(params, args.workdir.resolve())
+    else:
+        with tempfile.TemporaryDirectory(prefix="mipserver-bench-") as tmp:
+            result = run_suite(params, Path(tmp))
+
+    payload: str = result.model_dump_json(indent=2)
+    if out is not None:
+        out.write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
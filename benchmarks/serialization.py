@@ -0,0 +1,125 @@
+"""Package json serialization: per-file pydantic models vs. precomputed response bytes
+
+python -m benchmarks.serialization --entries 100 500 1000 --repeat 200 --out serialization.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, Field
+
+os.environ.setdefault("LOGURU_LEVEL", "WARNING")
+
+from benchmarks.run import LatencyStats, _git_version  # noqa: E402
+
+
+class SerializationResult(BaseModel):
+    version: str
+    python: str
+    platform: str
+    entries: List[int]
+    repeat: int
+    body_bytes: Dict[str, int] = Field(default_factory=dict)  # "<style>@<entries>" -> size of one package json
+    results: Dict[str, LatencyStats] = Field(default_factory=dict)  # "<scenario>@<entries>"
+
+
+def measure(fn: Callable[[], object], repeat: int) -> LatencyStats:
+    samples: List[float] = []
+    started: float = time.perf_counter()
+    for _ in range(repeat):
+        t: float = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - t)
+    return LatencyStats.from_samples(samples, 0, time.perf_counter() - started)
+
+
+def run_serialization(entries: List[int], repeat: int, workdir: Path) -> SerializationResult:
+    from mipserver.datastructures.models import MIPServerFileL, MIPServerPackageJson
+    from mipserver.internal.metadata import BuildRecord, MetadataStore
+    from mipserver.internal.packagebodies import PackageBodyCache, render_package_json
+
+    result = SerializationResult(
+        version=_git_version(),
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        entries=entries,
+        repeat=repeat,
+    )
+    metadata = MetadataStore(workdir / "metadata.sqlite3", workdir)
+    bodies = PackageBodyCache(max_bytes=1 << 30)
+    try:
+        for n in entries:
+            hashes: List[Tuple[str, str]] = [(f"pkg/sub{i % 7}/module_{i}.mpy", f"{i:064x}") for i in range(n)]
+
+            def models() -> bytes:
+                # per build before: one model per file, custom model_serializer, indented dump
+                mpj = MIPServerPackageJson(hashes=[MIPServerFileL(path=p, hash=h) for p, h in hashes])
+                return mpj.model_dump_json(indent=4).encode()
+
+            indented: bytes = models()
+            compact: bytes = render_package_json(hashes)
+            target: Path = workdir / "6" / f"pkg{n}" / "latest.json"
+            target.parent.mkdir(parents=True, exist_ok=True)
+            target.write_bytes(compact)
+            build = BuildRecord(
+                package_name=f"pkg{n}",
+                mpy_version="6",
+                pversion="latest",
+                json_path=f"6/pkg{n}/latest.json",
+                built_at=time.time(),
+                checked_at=time.time(),
+            )
+            bodies.get(metadata, build)
+
+            def validated_response() -> bytes:
+                # per request through the response_model: read, parse into models, serialize again
+                data = json.loads(target.read_bytes())
+                mpj = MIPServerPackageJson(hashes=[MIPServerFileL(path=p, hash=h) for p, h in data["hashes"]])
+                return mpj.model_dump_json().encode()
+
+            scenarios: Dict[str, Callable[[], object]] = {
+                "build_models": models,
+                "build_compact": lambda: render_package_json(hashes),
+                "serve_validated": validated_response,
+                "serve_file": target.read_bytes,
+                "serve_precomputed": lambda: bodies.get(metadata, build),
+            }
+            result.body_bytes[f"indented@{n}"] = len(indented)
+            result.body_bytes[f"compact@{n}"] = len(compact)
+            for name, fn in scenarios.items():
+                result.results[f"{name}@{n}"] = measure(fn, repeat)
+    finally:
+        metadata.close()
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(
+        prog="benchmarks.serialization", description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    ap.add_argument("--entries", type=int, nargs="+", default=[100, 500, 1000], help="files per package json")
+    ap.add_argument("--repeat", type=int, default=200)
+    ap.add_argument("--out", type=Path, default=None, help="write the json result here (default: stdout)")
+    args = ap.parse_args(sys.argv[1:] if argv is None else argv)
+
+    with tempfile.TemporaryDirectory(prefix="mipserver-bench-") as tmp:
+        result: SerializationResult = run_serialization(args.entries, args.repeat, Path(tmp))
+
+    for name, stats in result.results.items():
+        print(f"{name:<24} p50 {stats.p50_ms:8.3f} ms  p99 {stats.p99_ms:8.3f} ms", file=sys.stderr)
+    payload: str = result.model_dump_json(indent=2)
+    if args.out is not None:
+        args.out.write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Cold start: import time per entry point, lifespan startup and the first request, each in a fresh interpreter
+
+python -m benchmarks.startup --runs 10 --out startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+os.environ.setdefault("LOGURU_LEVEL", "WARNING")
+
+from benchmarks.run import LatencyStats, _git_version  # noqa: E402
+
+REPO_ROOT: Path = Path(__file__).resolve().parent.parent
+# only needed for the features that use them -> must not be loaded by a plain import of the server
+OPTIONAL_MODULES: List[str] = ["redis", "paho", "opentelemetry.sdk"]
+
+_CHILD: str = """
+import json, os, sys, time
+t0 = time.perf_counter()
+import {module}
+out = {{"import_seconds": time.perf_counter() - t0, "optional": sorted(m for m in {optional!r} if m in sys.modules)}}
+out["cache_created"] = os.path.exists(".cache")
+if {serve!r}:
+    from fastapi.testclient import TestClient
+    from mipserver.app import app
+    t1 = time.perf_counter()
+    with TestClient(app) as client:
+        t2 = time.perf_counter()
+        status = client.get("/").status_code
+        out.update(startup_seconds=t2 - t1, first_request_seconds=time.perf_counter() - t2, status=status)
+print(json.dumps(out))
+"""
+
+
+class StartupResult(BaseModel):
+    version: str
+    python: str
+    platform: str
+    runs: int
+    process: Dict[str, LatencyStats] = Field(default_factory=dict)  # module -> interpreter start + import + exit
+    imports: Dict[str, LatencyStats] = Field(default_factory=dict)  # module -> import only
+    startup: LatencyStats = Field(default_factory=LatencyStats)  # lifespan of mipserver.app
+    first_request: LatencyStats = Field(default_factory=LatencyStats)
+    optional_loaded: Dict[str, List[str]] = Field(default_factory=dict)  # module -> optional deps it pulled in
+    cache_created: Dict[str, bool] = Field(default_factory=dict)  # module -> created .cache at import time
+    top_imports_ms: Dict[str, float] = Field(default_factory=dict)  # top level package -> cumulated self time
+
+
+def _child_env() -> Dict[str, str]:
+    env: Dict[str, str] = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(p for p in (str(REPO_ROOT), env.get("PYTHONPATH", "")) if p)
+    env["LOGURU_LEVEL"] = "WARNING"
+    return env
+
+
+def _run_child(module: str, serve: bool, workdir: Path, extra: Optional[List[str]] = None) -> tuple[dict, str, float]:
+    code: str = _CHILD.format(module=module, optional=OPTIONAL_MODULES, serve=serve)
+    t: float = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, *(extra or []), "-c", code],
+        cwd=workdir,
+        env=_child_env(),
+        capture_output=True,
+        text=True,
+        timeout=120,
+        check=True,
+    )
+    elapsed: float = time.perf_counter() - t
+    return json.loads(proc.stdout.strip().splitlines()[-1]), proc.stderr, elapsed
+
+
+def import_costs(stderr: str, top: int = 15) -> Dict[str, float]:
+    """-X importtime output -> self time in ms per top level package, most expensive first"""
+    costs: Dict[str, float] = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = (part.strip() for part in line[len("import time:") :].split("|"))
+        pkg: str = name.split(".")[0]
+        costs[pkg] = costs.get(pkg, 0.0) + int(self_us) / 1000
+    return dict(sorted(costs.items(), key=lambda kv: -kv[1])[:top])
+
+
+def run_startup(runs: int, modules: List[str], workdir: Path) -> StartupResult:
+    result = StartupResult(
+        version=_git_version(), python=sys.version.split()[0], platform=platform.platform(), runs=runs
+    )
+    startup: List[float] = []
+    first_request: List[float] = []
+    for module in modules:
+        process: List[float] = []
+        imports: List[float] = []
+        started: float = time.perf_counter()
+        for i in range(runs):
+            cwd: Path = workdir / f"{module}-{i}"  # fresh directory -> nothing cached from an earlier run
+            cwd.mkdir(parents=True)
+            out, _, elapsed = _run_child(module, False, cwd)
+            process.append(elapsed)
+            imports.append(out["import_seconds"])
+            result.optional_loaded[module] = out["optional"]
+            result.cache_created[module] = result.cache_created.get(module, False) or out["cache_created"]
+        duration: float = time.perf_counter() - started
+        result.process[module] = LatencyStats.from_samples(process, 0, duration)
+        result.imports[module] = LatencyStats.from_samples(imports, 0, sum(imports))
+
+    started = time.perf_counter()
+    for i in range(runs):
+        cwd = workdir / f"serve-{i}"
+        cwd.mkdir(parents=True)
+        out, _, _ = _run_child("mipserver.app", True, cwd)
+        startup.append(out["startup_seconds"])
+        first_request.append(out["first_request_seconds"])
+    duration = time.perf_counter() - started
+    result.startup = LatencyStats.from_samples(startup, 0, duration)
+    result.first_request = LatencyStats.from_samples(first_request, 0, duration)
+
+    cwd = workdir / "importtime"
+    cwd.mkdir(parents=True)
+    _, stderr, _ = _run_child("mipserver.app", False, cwd, ["-X", "importtime"])
+    result.top_imports_ms = import_costs(stderr)
+    return result
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    ap = argparse.ArgumentParser(
+        prog="benchmarks.startup", description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    ap.add_argument("--runs", type=int, default=10, help="fresh interpreters per measurement")
+    ap.add_argument("--modules", nargs="+", default=["mipserver.app", "snapshot", "builder"])
+    ap.add_argument("--out", type=Path, default=None, help="write the json result here (default: stdout)")
+    args = ap.parse_args(sys.argv[1:] if argv is None else argv)
+
+    with tempfile.TemporaryDirectory(prefix="mipserver-bench-") as tmp:
+        result: StartupResult = run_startup(args.runs, args.modules, Path(tmp))
+
+    for module, stats in result.imports.items():
+        proc: LatencyStats = result.process[module]
+        print(f"{module:<16} import p50 {stats.p50_ms:8.1f} ms  process p50 {proc.p50_ms:8.1f} ms", file=sys.stderr)
+    print(f"{'startup':<16} p50 {result.startup.p50_ms:8.1f} ms", file=sys.stderr)
+    print(f"{'first request':<16} p50 {result.first_request.p50_ms:8.1f} ms", file=sys.stderr)
+    for pkg, ms in result.top_imports_ms.items():
+        print(f"  {pkg:<24} {ms:8.1f} ms", file=sys.stderr)
+    payload: str = result.model_dump_json(indent=2)
+    if args.out is not None:
+        args.out.write_text(payload)
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+import argparse
+import signal
+import sys
+import threading
+from types import FrameType
+from typing import List, Optional
+
+from loguru import logger
+
+from mipserver.config import settings
+from mipserver.dependencies import (
+    BUILD_NOTIFIER,
+    BUILD_TRACER,
+    CACHE_MANAGER,
+    INVALIDATION_BUS,
+    METADATA_STORE,
+    PACKAGE_REGISTRY,
+    PEER_CACHE,
+    SERVER_CACHE_ROOT,
+    SHARED_REVISIONS,
+)
+from mipserver.internal.builder import BuildWorker
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="run queued package builds (BUILDER.mode: queue) next to the http workers on the same cache"
+    )
+    parser.add_argument("--concurrency", type=int, default=None, help="builds at a time (default: BUILDER)")
+    parser.add_argument("--once", action="store_true", help="run the queued jobs, then exit")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    cfg = settings.builder
+    if args.concurrency is not None:
+        cfg = cfg.model_copy(update={"concurrency": args.concurrency})
+    worker = BuildWorker(
+        cfg,
+        SERVER_CACHE_ROOT,
+        PACKAGE_REGISTRY,
+        CACHE_MANAGER,
+        METADATA_STORE,
+        BUILD_TRACER,
+        INVALIDATION_BUS,
+        BUILD_NOTIFIER,
+        SHARED_REVISIONS,
+        settings.coordination.build_lock_timeout_seconds,
+        settings.metadata.freshness_seconds,
+        PEER_CACHE if PEER_CACHE.enabled else None,
+    )
+
+    try:
+        BUILD_NOTIFIER.start()
+    except Exception as e:  # notifications are optional -> build anyway
+        logger.opt(exception=e).error("cannot start mqtt build notifications")
+
+    if args.once:
+        try:
+            while worker.run_once():
+                pass
+        finally:
+            BUILD_NOTIFIER.stop()
+            METADATA_STORE.flush()
+        return
+
+    stop: threading.Event = threading.Event()
+
+    def _stop(signum: int, _frame: Optional[FrameType]) -> None:
+        logger.info(f"signal {signum} -> finishing the running builds")
+        stop.set()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    try:
+        worker.serve(stop)
+    finally:
+        BUILD_NOTIFIER.stop()
+        METADATA_STORE.flush()
+
+
+if __name__ == "__main__":
+    main()
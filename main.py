@@ -9,12 +9,18 @@ from loguru import logger
 
 def main() -> None:
     logger.info(f"{__file__}::MAIN")
+    reload: bool = settings.uvicorn.reload
+    if settings.uvicorn.workers > 1 and reload:
+        logger.warning(f"{settings.uvicorn.workers} workers requested -> reload disabled")
+        reload = False
+
     uvicorn.run(
         app=settings.uvicorn.app,
         host=settings.uvicorn.host,
         port=settings.uvicorn.port,
         log_level=settings.uvicorn.log_level,
-        reload=settings.uvicorn.reload,
+        reload=reload,
+        workers=settings.uvicorn.workers,
     )
 
 
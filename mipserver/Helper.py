@@ -1,31 +1,52 @@
 import datetime
 import json
 import os
+import posixpath
+import re
 import shutil
 import subprocess
+import tempfile
+import time
 import traceback
 import uuid
 from enum import Enum
 from os import stat_result
 from pathlib import Path
-from typing import Any, Dict, List, Union, Literal
+from typing import Any, Dict, List, Optional, Tuple, Union, Literal
 
 import hashlib
 
 
-import requests
+from fastapi.concurrency import run_in_threadpool
 from loguru import logger
 
+from mipserver.config import settings
 from mipserver.datastructures.datatypes import MPYPath
+from mipserver.internal.metrics import (
+    COMPILE_DURATION,
+    COMPILE_FAILURES,
+    GIT_DURATION,
+    GIT_FAILURES,
+    HASH_DURATION,
+    HASHED_BYTES,
+)
+from mipserver.internal.objectstore import LooseObjectStore
+from mipserver.internal.packagebodies import render_package_json
+from mipserver.internal.rawdownload import DownloadStatus, RawDownloader
+from mipserver.internal.tracing import span
 from mipserver.datastructures.models import (
-    MIPServerFile,
-    MIPServerPackageJson,
     MIPSRCPackageJson,
     MIPSRCPackageURLEntry,
-    MIPServerFileL,
 )
 
 
+def is_in_cluster() -> bool:
+    sa: Path = Path("/var/run/secrets/kubernetes.io/serviceaccount")
+    if sa.exists() and sa.is_dir():
+        return os.getenv("KUBERNETES_SERVICE_HOST") is not None
+    return False
+
+
 def get_sha256_hash(srcfile: Path) -> str:
     buf_size: int = 65_536
 
@@ -37,12 +58,18 @@ def get_sha256_hash(srcfile: Path) -> str:
 
     sha256 = hashlib.sha256()
 
-    with open(srcfile, "rb") as f:
+    started: float = time.perf_counter()
+    hashed: int = 0
+    with span("hash", file=srcfile.name), open(srcfile, "rb") as f:
         while True:
             data: bytes = f.read(buf_size)
             if not data:
                 break
             sha256.update(data)
+            hashed += len(data)
+
+    HASH_DURATION.observe(time.perf_counter() - started)
+    HASHED_BYTES.inc(hashed)
 
     ret: str = sha256.hexdigest()
     logger.debug(f"SHA256({srcfile.resolve().absolute()}): {ret}")
@@ -67,6 +94,18 @@ def copy_file(srcfile: Path, tgtfile: Path) -> None:
                 fout.write(data)
 
 
+def atomic_write(target: Path, data: bytes) -> None:
+    """Temp file next to target + rename -> readers (other threads/workers) never see a partially written file"""
+    fd, tmpname = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as fout:
+            fout.write(data)
+        os.replace(tmpname, target)
+    except BaseException:
+        Path(tmpname).unlink(missing_ok=True)
+        raise
+
+
 class ComplexEncoder(json.JSONEncoder):
     def default(self, obj: Any) -> Any:
         if hasattr(obj, "repr_json"):
@@ -147,16 +186,66 @@ def get_exception_tb_as_string(exc: Exception) -> str:
     return tbs
 
 
+class RefNotFoundError(Exception):
+    """The requested branch/version does not exist in the package source"""
+
+    def __init__(self, repo_name: str, branch: str):
+        super().__init__(f"ref {branch!r} not found in {repo_name!r}")
+        self.repo_name = repo_name
+        self.branch = branch
+
+
+class GitRefNotFoundError(RefNotFoundError):
+    """The requested branch does not exist upstream"""
+
+
+class PackageBuildError(Exception):
+    """Generating the package json from a checkout failed (e.g. mpy-cross error)"""
+
+    def __init__(self, message: str, commit: str | None = None):
+        super().__init__(message)
+        self.commit = commit
+
+
+# stderr snippets git emits when the requested branch does not exist in the remote
+_GIT_MISSING_REF_MARKERS: tuple[str, ...] = ("not found in upstream", "couldn't find remote ref")
+# below the server cache root: compile cache key -> sha256 of the .mpy (see generate_package_json_from_local_repo)
+COMPILED_DIR: str = "compiled"
+# globbing characters of gitignore style sparse checkout patterns
+_SPARSE_SPECIAL: re.Pattern = re.compile(r"[\\*?\[\]!#]")
+
+
+def _run_git(cmd: List[str], operation: str, timeout: int, stdin: str | None = None) -> subprocess.CompletedProcess:
+    """subprocess.run for git commands -> duration and failures end up in the metrics per operation"""
+    try:
+        with GIT_DURATION.labels(operation=operation).time(), span(f"git.{operation}"):
+            res = subprocess.run(cmd, input=stdin, capture_output=True, text=True, timeout=timeout)
+    except Exception:
+        GIT_FAILURES.labels(operation=operation).inc()
+        raise
+    if res.returncode != 0:
+        GIT_FAILURES.labels(operation=operation).inc()
+    return res
+
+
 class MIPServerHelper:
     logger = logger.bind(classname=__qualname__)
 
-    GITHUB_REPO_URL_BASE = "https://github.com"  # /micropython/micropython-lib.git"
-    GITHUB_DEFAULT_BRANCH = "main"
-    GITHUB_RAW_BASE = "https://raw.githubusercontent.com"  # /micropython/micropython-lib/refs/heads/master/"
+    # defaults for packages without an explicit source url -> UPSTREAM in the config
+    GITHUB_REPO_URL_BASE: str = settings.upstream.git_base_url  # /micropython/micropython-lib.git"
+    GITHUB_DEFAULT_BRANCH: str = settings.upstream.default_branch
+    GITHUB_RAW_BASE: str = settings.upstream.raw_base_url  # /micropython/micropython-lib/refs/heads/master/"
 
-    def __init__(self, server_cache_root: Path, package_name_to_repo: Dict[str, str]):
+    def __init__(
+        self,
+        server_cache_root: Path,
+        package_name_to_repo: Dict[str, str],
+        object_store: Optional[LooseObjectStore] = None,
+    ):
         self.server_cache_root = server_cache_root
         self.package_name_to_repo = package_name_to_repo
+        # the store of the cache manager (packs, gc bookkeeping) -> a plain one below the cache root otherwise
+        self.object_store: LooseObjectStore = object_store or LooseObjectStore(Path(server_cache_root, "files"))
 
         self.logger.debug(f"MIPServerHelper::__init__::{server_cache_root=} {package_name_to_repo=}")
 
@@ -179,21 +268,36 @@ class MIPServerHelper:
         return self.package_name_to_repo.get(package_name)
 
     @staticmethod
+    def compile_cache_key(source_hash: str, py_src_name: str, mpy_version: MPYPath) -> str | None:
+        """Same source, name and mpy-cross binary -> same .mpy, no matter which package (or build) asks"""
+        mpy_cross = shutil.which("mpy-cross") or shutil.which("mpy-cross-static")
+        if not mpy_cross:
+            return None
+        st: stat_result = os.stat(mpy_cross)
+        key: str = f"{source_hash}\0{py_src_name}\0{mpy_version.value}\0{mpy_cross}\0{st.st_size}\0{st.st_mtime_ns}"
+        return hashlib.sha256(key.encode()).hexdigest()
+
     def generate_package_json_from_local_repo(
-        gitrepopath: Path, target_pkgjson: Path, mpy_version: MPYPath = MPYPath.six
+        self, gitrepopath: Path, target_pkgjson: Path, mpy_version: MPYPath = MPYPath.six, subpath: str = ""
     ) -> Path:
-        src_pkgjson: Path = Path(gitrepopath, "package.json")
+        """subpath: directory of the package.json in the repo (monorepos), its urls may reference files outside"""
+        src_pkgjson: Path = Path(gitrepopath, subpath, "package.json")
         assert gitrepopath.exists() and gitrepopath.is_dir() and src_pkgjson.exists()
+        repo_root: Path = gitrepopath.resolve()
 
         srcdata: dict
-        with open(src_pkgjson, "r") as fin:
-            srcdata = json.load(fin)
+        with span("package_json.parse"):
+            with open(src_pkgjson, "r") as fin:
+                srcdata = json.load(fin)
 
-        mr: MIPSRCPackageJson = MIPSRCPackageJson(**srcdata)
+            mr: MIPSRCPackageJson = MIPSRCPackageJson(**srcdata)
 
         # package_version: str = mr.version
-        myfiles: List[MIPServerFile] = []
-        myhashes: List[MIPServerFileL] = []
+        # (path, sha256) -> rendered into the final (compact) response bytes once per build, see packagebodies
+        myhashes: List[Tuple[str, str]] = []
+        object_store: LooseObjectStore = self.object_store
+        # compile key -> hash of the .mpy, shared by all packages (and builds) on this cache root
+        compiled: Path = Path(gitrepopath.parent, COMPILED_DIR)
 
         srcu: MIPSRCPackageURLEntry
         for srcu in mr.urls:
@@ -201,21 +305,35 @@ class MIPServerHelper:
             src_target: str = srcu.url_to
 
             # TODO check if src_from is a local file and that file exist...
-            src_from_file: Path = Path(gitrepopath, src_from).resolve()
+            src_from_file: Path = Path(gitrepopath, subpath, src_from).resolve()
             return_file: Path = src_from_file
             # return_file: Path = Path(target_pkgjson.parent, src_from_file.name)
 
             return_target: str = src_target
 
-            if not src_from_file.is_relative_to(gitrepopath):
+            if not src_from_file.is_relative_to(repo_root):
                 logger.debug(f"{src_from=} => {src_from_file=}  ==> not in {gitrepopath=}")
                 continue
 
             if src_from_file.name.endswith(".py") and mpy_version.value != "py":
-                return_target = src_from[:-2] + "mpy"
+                # url_to decides where it ends up on the device (src_from may be ../shared/x.py in a monorepo)
+                return_target = (src_target[:-2] if src_target.endswith(".py") else src_from[:-2]) + "mpy"
                 return_file = Path(src_from_file.parent, src_from_file.stem + ".mpy")
                 # return_file = Path(target_pkgjson.parent, src_from_file.stem + ".mpy")
 
+                cache_key: str | None = MIPServerHelper.compile_cache_key(
+                    get_sha256_hash(src_from_file), src_from, mpy_version
+                )
+                cache_entry: Path | None = Path(compiled, cache_key[:2], cache_key) if cache_key else None
+                try:
+                    cached: str | None = cache_entry.read_text().strip() if cache_entry else None
+                except OSError:
+                    cached = None
+                if cached and object_store.reuse(cached):
+                    logger.debug(f"{src_from} compiled before -> {cached}")
+                    myhashes.append((return_target, cached))
+                    continue
+
                 logger.debug(f"Compile on the fly from {src_from_file.absolute()} to {return_file.absolute()}")
                 logger.debug(f"\tsetting {src_from=} to {return_target=}")
 
@@ -228,31 +346,24 @@ class MIPServerHelper:
 
                 logger.debug(f"Compilation OK for {return_file=}")
 
-            myhash: str = get_sha256_hash(return_file)
-            mysize: int = return_file.stat().st_size
-
-            # move into proper file structure...
-            return_file_in_index_dir: Path = Path(gitrepopath.parent, "files")
-            return_file_in_index_dir = Path(return_file_in_index_dir, myhash[0:2])
-            return_file_in_index_dir.mkdir(parents=True, exist_ok=True)
-            return_file_in_index_dir = Path(return_file_in_index_dir, myhash)
-
-            copy_file(return_file, return_file_in_index_dir)
-
-            msf: MIPServerFile = MIPServerFile(path=return_target, hash=myhash, size=mysize)
-            myfiles.append(msf)
+                myhash: str = get_sha256_hash(return_file)
+                object_store.put_file(return_file, myhash)
+                if cache_entry is not None:
+                    cache_entry.parent.mkdir(parents=True, exist_ok=True)
+                    atomic_write(cache_entry, myhash.encode())
+            else:
+                myhash = get_sha256_hash(return_file)
 
-            msfl: MIPServerFileL = MIPServerFileL(path=return_target, hash=myhash)
-            myhashes.append(msfl)
+                # move into proper file structure...
+                object_store.put_file(return_file, myhash)
 
-        # TODO not really nexessary to include "files" here -> there was some "irritating" documentation floating around...
-        # mpj: MIPServerPackageJson = MIPServerPackageJson(files=myfiles, hashes=myhashes)
-        mpj: MIPServerPackageJson = MIPServerPackageJson(hashes=myhashes)
+            myhashes.append((return_target, myhash))
 
-        target_pkgjson.parent.mkdir(parents=True, exist_ok=True)
+        # TODO not really nexessary to include "files" (MIPServerFile incl. size) here -> there was some "irritating" documentation floating around...
+        with span("package_json.write", files=len(myhashes)):
+            target_pkgjson.parent.mkdir(parents=True, exist_ok=True)
 
-        with open(target_pkgjson, "w") as fout:
-            fout.write(mpj.model_dump_json(indent=4))
+            atomic_write(target_pkgjson, render_package_json(myhashes))
 
         fstat: stat_result = target_pkgjson.stat()
         logger.debug(f"Written {fstat.st_size} bytes to {target_pkgjson.resolve().absolute()}")
@@ -260,19 +371,37 @@ class MIPServerHelper:
         return target_pkgjson
 
     @staticmethod
-    def download_from_github(repo_name: str, raw_rel_path: str) -> bytes | None:
-        """Simple raw HTTP download fallback for a given relative path inside the repo."""
-        url = f"{MIPServerHelper.GITHUB_RAW_BASE}/{repo_name}/{raw_rel_path.lstrip('/')}"
-        logger.debug(f"Downloading from GitHub: {url}")
-        try:
-            resp = requests.get(url, timeout=30)
-        except Exception as e:
-            logger.opt(exception=e).warning("GitHub raw fetch exception")
-            return None
-        if resp.status_code == 200:
-            return resp.content
-        logger.warning(f"GitHub fetch failed {resp.status_code} for {url}")
-        return None
+    def get_raw_url(repo_name: str, raw_rel_path: str, branch: str = "latest") -> str:
+        git_branch: str = MIPServerHelper.get_git_branch(branch)
+        return f"{MIPServerHelper.GITHUB_RAW_BASE}/{repo_name}/refs/heads/{git_branch}/{raw_rel_path.lstrip('/')}"
+
+    async def download_raw_files(
+        self, downloader: RawDownloader, repo_name: str, raw_rel_paths: List[str], branch: str = "latest"
+    ) -> Dict[str, Path | None]:
+        """Raw HTTP download of files of the repo (in parallel, conditional for already cached ones)
+
+        -> local path per requested path, None if it could not be downloaded (and is not cached either)
+        """
+        cache_root: Path = self.get_server_cache_root().resolve()
+        ret: Dict[str, Path | None] = {}
+        downloads: List[tuple[str, str, Path]] = []  # (raw_rel_path, url, target)
+        for raw_rel_path in raw_rel_paths:
+            target: Path = self.get_local_path_for(raw_rel_path).resolve()
+            if not target.is_relative_to(cache_root):
+                logger.warning(f"Rejected path outside cache root: {raw_rel_path}")
+                ret[raw_rel_path] = None
+                continue
+            downloads.append((raw_rel_path, self.get_raw_url(repo_name, raw_rel_path, branch), target))
+
+        statuses: List[DownloadStatus] = await downloader.fetch_many([(url, target) for _, url, target in downloads])
+        for (raw_rel_path, url, target), status in zip(downloads, statuses):
+            # upstream unreachable -> a cached copy is better than nothing, gone upstream -> gone
+            if status == DownloadStatus.missing or (status == DownloadStatus.failed and not target.is_file()):
+                logger.warning(f"Raw download of {url} failed: {status.value}")
+                ret[raw_rel_path] = None
+            else:
+                ret[raw_rel_path] = target
+        return ret
 
     @staticmethod
     def compile_mpy(py_path: Path, mpy_out: Path, py_src_name: str) -> bool:
@@ -287,8 +416,12 @@ class MIPServerHelper:
             # Basic compile, optimization level 2
             cmd = [mpy_cross, "-O2", str(py_path), "-o", str(mpy_out), "-s", py_src_name]
             logger.debug(f"compile_mpy::{cmd=}")
-            res = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+            with COMPILE_DURATION.time(), span("compile", file=py_src_name) as compile_span:
+                res = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
             if res.returncode != 0:
+                COMPILE_FAILURES.inc()
+                if compile_span is not None:
+                    compile_span.error = f"mpy-cross rc={res.returncode}"
                 logger.error(f"mpy-cross failed: rc={res.returncode} stderr={res.stderr}")
                 return False
             return True
@@ -296,36 +429,186 @@ class MIPServerHelper:
             logger.opt(exception=e).error("mpy-cross execution error")
             return False
 
+    @staticmethod
+    def get_repo_url(repo_name: str) -> str:
+        return f"{MIPServerHelper.GITHUB_REPO_URL_BASE}/{repo_name}.git"
+
+    @staticmethod
+    def get_checkout_dirname(repo_name: str, branch: str) -> str:
+        """Name of the checkout directory of repo_name@branch below the server cache root"""
+        return Path(repo_name).name + f"@{branch.replace('/', '')}"
+
+    @staticmethod
+    def get_git_branch(branch: str) -> str:
+        """Maps the mip version ("latest" or a branch name) to the upstream branch"""
+        branch = branch.replace("/", "")  # cleanup against possible path traversals etc.
+        if branch == "latest":
+            return MIPServerHelper.GITHUB_DEFAULT_BRANCH
+        return branch
+
+    @staticmethod
+    def get_checkout_commit(checkout_dir: Path) -> str | None:
+        """Commit id of HEAD in checkout_dir or None if it cannot be determined"""
+        git_bin = shutil.which("git")
+        if not git_bin:
+            return None
+
+        cmd = [git_bin, "-C", str(checkout_dir), "rev-parse", "HEAD"]
+        try:
+            res = _run_git(cmd, "rev-parse", timeout=30)
+        except Exception as e:
+            logger.opt(exception=e).warning("git rev-parse failed")
+            return None
+
+        if res.returncode != 0:
+            return None
+        return res.stdout.strip() or None
+
+    def get_remote_commit(
+        self, repo_name: str, branch: str = GITHUB_DEFAULT_BRANCH, repo_url: str | None = None
+    ) -> str | None:
+        """Cheap upstream change detection via ls-remote -> commit id of branch or None if unknown/missing"""
+        git_bin = shutil.which("git")
+        if not git_bin:
+            return None
+
+        repo_url = repo_url or self.get_repo_url(repo_name)
+        cmd = [git_bin, "ls-remote", repo_url, f"refs/heads/{self.get_git_branch(branch)}"]
+        logger.debug(f"EXEC {cmd}")
+        try:
+            res = _run_git(cmd, "ls-remote", timeout=60)
+        except Exception as e:
+            logger.opt(exception=e).warning("git ls-remote failed")
+            return None
+
+        if res.returncode != 0 or not res.stdout.strip():
+            return None
+        return res.stdout.split()[0]
+
     def ensure_files_in_structure_from_repo(self, repo_name: str, branch: str = GITHUB_DEFAULT_BRANCH) -> Path | None:
         ...
 
         # 1.
 
-    def ensure_git_repo_up_to_date(self, repo_name: str, branch: str = GITHUB_DEFAULT_BRANCH) -> Path | None:
+    @staticmethod
+    def package_files(package_json: str, root: str = "") -> List[str]:
+        """Repo relative paths of the files referenced by the urls of the package.json in directory root
+
+        Raises ValueError if it is no mip package.json.
+        """
+        mr: MIPSRCPackageJson = MIPSRCPackageJson(**json.loads(package_json))
+        ret: List[str] = []
+        for srcu in mr.urls:
+            path: str = posixpath.normpath(posixpath.join(root, srcu.url_from))
+            if "://" in srcu.url_from or posixpath.isabs(path) or path.split("/")[0] in (".", ".."):
+                continue  # not a file of the repo -> skipped by generate_package_json_from_local_repo as well
+            ret.append(path)
+        return ret
+
+    @staticmethod
+    def sparse_checkout_patterns(manifests: Dict[str, str]) -> List[str] | None:
+        """Sparse checkout patterns for the package.json files (path -> content) and what they reference
+
+        None -> full checkout (no package.json or the one in the repo root cannot be parsed).
+        """
+        patterns: set[str] = set()
+        for path, content in manifests.items():
+            root: str = posixpath.dirname(path)
+            try:
+                files: List[str] = MIPServerHelper.package_files(content, root)
+            except ValueError as e:
+                if root:
+                    logger.debug(f"{path} is no mip package.json: {e}")
+                    continue
+                logger.opt(exception=e).warning("cannot parse package.json -> full checkout")
+                return None
+            # anchored, globbing escaped
+            patterns.update("/" + _SPARSE_SPECIAL.sub(r"\\\g<0>", f) for f in [path, *files])
+        return sorted(patterns) if patterns else None
+
+    @staticmethod
+    def sync_sparse_checkout(git_bin: str, checkout_dir: Path, enabled: bool = True) -> bool:
+        """Limits the working tree of checkout_dir to the package.json files of HEAD and what they reference
+
+        Every package.json of the tree counts (monorepos -> one checkout for the packages in its subdirectories).
+        Only rewrites the sparse checkout if the set changed -> blobs of newly referenced files get fetched then.
+        """
+        base: List[str] = [git_bin, "-C", str(checkout_dir)]
+        patterns: List[str] | None = None
+        if enabled:
+            manifests: Dict[str, str] = {}
+            res = _run_git(base + ["ls-tree", "-r", "-z", "--name-only", "HEAD"], "ls-tree", timeout=120)
+            for path in res.stdout.split("\0") if res.returncode == 0 else []:
+                if posixpath.basename(path) == "package.json":
+                    shown = _run_git(base + ["show", f"HEAD:{path}"], "show", timeout=120)
+                    if shown.returncode == 0:
+                        manifests[path] = shown.stdout
+            patterns = MIPServerHelper.sparse_checkout_patterns(manifests)
+
+        current = _run_git(base + ["sparse-checkout", "list"], "sparse-checkout", timeout=30)
+        if patterns is None:
+            if current.returncode != 0:
+                return True  # not sparse
+            logger.info(f"full checkout of {checkout_dir}")
+            res = _run_git(base + ["sparse-checkout", "disable"], "sparse-checkout", timeout=300)
+        elif current.returncode == 0 and current.stdout.splitlines() == patterns:
+            return True
+        else:
+            logger.info(f"sparse checkout of {checkout_dir}: {len(patterns)} paths")
+            cmd: List[str] = base + ["sparse-checkout", "set", "--no-cone", "--stdin"]
+            res = _run_git(cmd, "sparse-checkout", timeout=300, stdin="\n".join(patterns) + "\n")
+
+        if res.returncode != 0:
+            logger.error(f"git sparse-checkout failed: rc={res.returncode} stderr={res.stderr}")
+            return False
+        return True
+
+    @staticmethod
+    def get_tree_revision(checkout_dir: Path, paths: List[str]) -> str | None:
+        """Digest over the git object ids of paths (trees or files) at HEAD -> changes only if one of them changed"""
+        git_bin = shutil.which("git")
+        if not git_bin:
+            return None
+
+        cmd = [git_bin, "-C", str(checkout_dir), "rev-parse", *(f"HEAD:{p}" for p in paths)]
+        try:
+            res = _run_git(cmd, "rev-parse", timeout=30)
+        except Exception as e:
+            logger.opt(exception=e).warning("git rev-parse failed")
+            return None
+
+        ids: List[str] = res.stdout.split()
+        if res.returncode != 0 or len(ids) != len(paths):
+            return None
+        return hashlib.sha256("".join(f"{p}\0{i}\n" for p, i in zip(paths, ids)).encode()).hexdigest()
+
+    def ensure_git_repo_up_to_date(
+        self, repo_name: str, branch: str = GITHUB_DEFAULT_BRANCH, repo_url: str | None = None
+    ) -> Path | None:
         """Ensure a local checkout of repo_url@branch exists and is up to date.
 
+        repo_url defaults to GITHUB_REPO_URL_BASE/<repo_name>.git
         Returns the path to the working tree, or None on failure.
+        Raises GitRefNotFoundError if the branch does not exist upstream.
         """
 
         assert repo_name in self.package_name_to_repo.values()
 
-        repo_url: str = f"{MIPServerHelper.GITHUB_REPO_URL_BASE}/{repo_name}.git"
+        repo_url = repo_url or self.get_repo_url(repo_name)
 
         git_bin = shutil.which("git")
         if not git_bin:
-            logger.warning("git not found in PATH; falling back to raw HTTP")
+            logger.warning("git not found in PATH")
             return None
 
         cache_root = self.get_server_cache_root()
 
         branch = branch.replace("/", "")  # cleanup against possible path traversals etc.
+        git_branch: str = self.get_git_branch(branch)
 
-        git_branch: str = "main"
-        if branch != "latest":
-            git_branch = branch
-
-        checkout_dir = cache_root / (Path(repo_url).stem + f"@{branch}")
-        logger.debug(f"_ensure_git_repo_up_to_date({repo_name=}, {git_branch=}) {checkout_dir=}")
+        checkout_dir = cache_root / self.get_checkout_dirname(repo_name, branch)
+        sparse: bool = settings.upstream.sparse_checkout
+        logger.debug(f"_ensure_git_repo_up_to_date({repo_name=}, {git_branch=}, {sparse=}) {checkout_dir=}")
 
         try:
             cache_root.mkdir(parents=True, exist_ok=True)
@@ -341,11 +624,27 @@ class MIPServerHelper:
                 checkout_dir.parent.mkdir(parents=True, exist_ok=True)
 
                 cmd = [git_bin, "clone", "--depth", "1", "--branch", git_branch, repo_url, str(checkout_dir)]
+                if sparse:
+                    # blobless + no checkout -> only package.json and the files it references get downloaded
+                    cmd[2:2] = ["--filter=blob:none", "--no-checkout"]
                 logger.debug(f"EXEC {cmd}")
-                res = subprocess.run(cmd, capture_output=True, text=True, timeout=300)
+                res = _run_git(cmd, "clone", timeout=300)
                 if res.returncode != 0:
                     logger.error(f"git clone failed: {res.returncode} stderr={res.stderr}")
+                    if any(m in res.stderr for m in _GIT_MISSING_REF_MARKERS):
+                        raise GitRefNotFoundError(repo_name=repo_name, branch=branch)
                     return None
+
+                if sparse:
+                    ok: bool = self.sync_sparse_checkout(git_bin, checkout_dir)
+                    if ok:
+                        cmd = [git_bin, "-C", str(checkout_dir), "checkout", git_branch]
+                        res = _run_git(cmd, "checkout", timeout=120)
+                        ok = res.returncode == 0
+                    if not ok:
+                        logger.error(f"sparse checkout of {checkout_dir} failed")
+                        shutil.rmtree(checkout_dir, ignore_errors=True)  # -> cloned again next time
+                        return None
             else:
                 # Fetch and reset to the remote branch
                 logger.debug(f"Updating repo {checkout_dir}")
@@ -356,22 +655,33 @@ class MIPServerHelper:
                 ]
                 for cmd in cmds:
                     logger.debug(f"EXEC: {cmd}")
-                    res = subprocess.run(cmd, capture_output=True, text=True, timeout=120)
+                    res = _run_git(cmd, cmd[3], timeout=120)
                     if res.returncode != 0:
                         logger.error(f"git command failed: {cmd} rc={res.returncode} stderr={res.stderr}")
+                        if any(m in res.stderr for m in _GIT_MISSING_REF_MARKERS):
+                            raise GitRefNotFoundError(repo_name=repo_name, branch=branch)
                         return None
+
+                # package.json may reference other files now
+                if (sparse or Path(checkout_dir, ".git", "info", "sparse-checkout").exists()) and not (
+                    self.sync_sparse_checkout(git_bin, checkout_dir, enabled=sparse)
+                ):
+                    return None
+        except GitRefNotFoundError:
+            raise
         except Exception as e:
             logger.opt(exception=e).error("git operations failed")
             return None
 
         return checkout_dir
 
-    def ensure_local_file(
+    async def ensure_local_file(
         self,
         repo_name: str,
         raw_rel_path: str,
         branch: str = GITHUB_DEFAULT_BRANCH,
         allow_https_download_fallback: bool = False,
+        downloader: RawDownloader | None = None,
     ) -> Path | None:
         """Ensure a file relative to repository root exists locally under server-root.
 
@@ -391,7 +701,7 @@ class MIPServerHelper:
             return target
 
         # First, try via git checkout
-        checkout = self.ensure_git_repo_up_to_date(repo_name=repo_name, branch=branch)
+        checkout = await run_in_threadpool(self.ensure_git_repo_up_to_date, repo_name=repo_name, branch=branch)
         if checkout is not None:
             repo_file = (checkout / raw_rel_path.lstrip("/")).resolve()
             try:
@@ -411,20 +721,12 @@ class MIPServerHelper:
                 except Exception as e:
                     logger.opt(exception=e).warning("Failed to copy file from git checkout; will try HTTP")
 
-        if not allow_https_download_fallback:
+        if not allow_https_download_fallback or downloader is None:
             return None
             # raise Exception("NOT FOUND EXCEPTION ")
 
         # Fallback: raw HTTP download
-        http_data = self.download_from_github(repo_name=repo_name, raw_rel_path=raw_rel_path)
-        if http_data is None:
-            return None
-
-        target.parent.mkdir(parents=True, exist_ok=True)
-
-        try:
-            target.write_bytes(http_data)
-        except Exception as e:
-            logger.opt(exception=e).error("Failed to write downloaded file")
-            return None
-        return target
+        downloaded: Dict[str, Path | None] = await self.download_raw_files(
+            downloader, repo_name=repo_name, raw_rel_paths=[raw_rel_path], branch=branch
+        )
+        return downloaded[raw_rel_path]
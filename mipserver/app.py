@@ -1,66 +1,112 @@
+import asyncio
 import os
+import time
 from contextlib import asynccontextmanager, contextmanager
 
-from os import stat_result
 from pathlib import Path
-from typing import Annotated, List, Any, Dict, Union, AsyncGenerator, Generator, Optional
+from typing import Annotated, List, Any, Dict, AsyncGenerator, Generator, Optional
 
-from mipserver.config import settings
+from mipserver.config import settings, PackageNameGithubRepo
 
 import datetime
-from fastapi import FastAPI, Header, Query, Body, Depends
+from fastapi import FastAPI, Depends
 
 # fastapi. used here is only a wrapper to starlette.
-from fastapi.exception_handlers import http_exception_handler, request_validation_exception_handler
+from fastapi.exception_handlers import request_validation_exception_handler
 from fastapi.exceptions import RequestValidationError
 
-from fastapi.background import BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from fastapi.datastructures import Headers
 
 from fastapi.requests import Request
-from fastapi.responses import JSONResponse, PlainTextResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse
 from fastapi import Response
 
-from fastapi import FastAPI, Path as FPath, Query
-
-from starlette.exceptions import HTTPException as StarletteHTTPException
+from fastapi import Path as FPath
 
 from loguru import logger
 
 from mipserver import Helper
-from mipserver.Helper import MIPServerHelper
-from mipserver.datastructures.datatypes import SensorType, MPYPath
-from mipserver.datastructures.models import MIPServerPackageJson, MIPServerFile, ErrorResponse
-
-# Defaults for upstream repository that hosts MicroPython packages
-GITHUB_REPO_URL_BASE = "https://github.com"  # /micropython/micropython-lib.git"
-GITHUB_DEFAULT_BRANCH = "main"
-GITHUB_RAW_BASE = "https://raw.githubusercontent.com"  # /micropython/micropython-lib/refs/heads/master/"
+from mipserver.Helper import MIPServerHelper, RefNotFoundError, PackageBuildError
+from mipserver.internal.admission import AdmissionController, AdmissionDenied
+from mipserver.internal.negativecache import NegativeEntry, NegativeKey, NegativeReason, NegativeResultCache
+from mipserver.internal.cachemanager import CacheManager
+from mipserver.internal.builder import PackageBuild, job_output, wait_for_build_job
+from mipserver.internal.coordination import (
+    EVENT_MIRROR_SYNCED,
+    EVENT_NEW_REVISION,
+    EVENT_REGISTRY_CHANGED,
+    InvalidationBus,
+)
+from mipserver.internal.indexmirror import IndexMirror, MirrorSyncReport
+from mipserver.internal.locks import LockTimeout
+from mipserver.internal.metadata import BuildJob, BuildRecord, MetadataStore
+from mipserver.internal.notify import BuildNotifier
+from mipserver.internal.objectresponse import object_response, packed_object_response
+from mipserver.internal.packagebodies import PackageBody, PackageBodyCache, package_json_response
+from mipserver.internal.packstore import PackStore
+from mipserver.internal.peers import PEER_HEADER, PeerCache
+from mipserver.internal.profiling import LoopLagMonitor
+from mipserver.internal.redisstate import SharedRevisions
+from mipserver.internal.registry import PackageRegistry, RegistryDiff
+from mipserver.internal.metrics import (
+    FILE_REQUESTS,
+    PACKAGE_BUILD_DURATION,
+    PACKAGE_JSON_REQUESTS,
+    RequestMetricsMiddleware,
+)
+from mipserver.internal.sources import SourceBackend, source_for
+from mipserver.internal.tracing import BuildTracer
+from mipserver.dependencies import (
+    SERVER_CACHE_ROOT,
+    PACKAGE_REGISTRY,
+    NEGATIVE_CACHE,
+    CACHE_MANAGER,
+    METADATA_STORE,
+    INDEX_MIRROR,
+    INVALIDATION_BUS,
+    BUILD_NOTIFIER,
+    get_package_name_to_repo,
+    get_package_configs,
+    get_admission_controller,
+    get_negative_cache,
+    get_cache_manager,
+    get_metadata_store,
+    get_build_tracer,
+    get_index_mirror,
+    get_invalidation_bus,
+    get_peer_cache,
+    get_shared_revisions,
+    get_build_notifier,
+    get_package_bodies,
+    get_pack_store,
+)
+from mipserver.routers import admin, metrics, peer
+from mipserver.datastructures.datatypes import MPYPath
+from mipserver.datastructures.models import MIPServerPackageJson, ErrorResponse
 
-SERVER_CACHE_ROOT: Path = Path(os.getcwd(), ".cache") / "repos"
-SERVER_CACHE_ROOT.mkdir(parents=True, exist_ok=True)
 
 # git@github.com:vroomfondel/micropysensorbase.git
 # https://github.com/vroomfondel/micropysensorbase.git
 
 
-def error_response(error_msg: str, status_code: int = 500) -> JSONResponse:
+def error_response(error_msg: str, status_code: int = 500, headers: Optional[Dict[str, str]] = None) -> JSONResponse:
     """Helper um ErrorResponse Models als JSONResponse zurückzugeben"""
     error = ErrorResponse(error=error_msg)
-    return JSONResponse(content=error.model_dump(), status_code=status_code)
+    return JSONResponse(content=error.model_dump(), status_code=status_code, headers=headers)
 
 
-PACKAGE_NAME_TO_REPO: Dict[str, str] = {
-    # "micropysensorbase": "vroomfondel/micropysensorbase"
-    png.packagename: png.githubrepo
-    for png in settings.packagename_to_github_repo.root
-}
+def admission_denied_response(ad: AdmissionDenied) -> JSONResponse:
+    headers: Dict[str, str] | None = None
+    if ad.retry_after is not None:
+        headers = {"Retry-After": str(ad.retry_after)}
+    return error_response(f"cannot generate package -> {ad.reason}", status_code=ad.status_code, headers=headers)
 
 
-def get_package_name_to_repo() -> Dict[str, str]:
-    """Dependency function to inject package_name_to_repo dictionary"""
-    logger.debug("app::get_package_name_to_repo")
-    return PACKAGE_NAME_TO_REPO
+def negative_response(entry: NegativeEntry) -> JSONResponse:
+    return error_response(
+        entry.message, status_code=entry.status_code, headers={"Retry-After": str(entry.retry_after())}
+    )
 
 
 # from .datastructures.models import Sensor, Location
@@ -110,13 +156,127 @@ def mylifespan_sync(_app: FastAPI) -> Generator[None, None]:
     logger.debug(f"{title}::mylifespan::AFTER yield -> cleanup...")
 
 
+async def periodic_cache_gc(cache_manager: CacheManager, interval_seconds: int) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await run_in_threadpool(cache_manager.collect_garbage, 0)
+        except LockTimeout:
+            logger.debug("cache gc already running in another worker")
+        except Exception as e:
+            logger.opt(exception=e).error("periodic cache gc failed")
+
+
+async def periodic_pack_maintenance(cache_manager: CacheManager, interval_seconds: int) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await run_in_threadpool(cache_manager.maintain_packs, 0)
+        except LockTimeout:
+            logger.debug("pack maintenance or cache gc already running in another worker")
+        except Exception as e:
+            logger.opt(exception=e).error("periodic pack maintenance failed")
+
+
+async def periodic_metadata_flush(metadata: MetadataStore, interval_seconds: float) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await run_in_threadpool(metadata.flush)
+        except Exception as e:
+            logger.opt(exception=e).error("flushing metadata failed")
+
+
+async def periodic_invalidation_poll(bus: InvalidationBus, interval_seconds: float) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await run_in_threadpool(bus.poll)
+        except Exception as e:
+            logger.opt(exception=e).error("polling invalidations failed")
+
+
+async def periodic_registry_watch(registry: PackageRegistry, bus: InvalidationBus, interval_seconds: float) -> None:
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            diff: RegistryDiff | None = await run_in_threadpool(registry.reload_if_changed)
+            if diff:
+                bus.publish(EVENT_REGISTRY_CHANGED, **diff.model_dump())
+        except Exception as e:
+            logger.opt(exception=e).error("reloading the package registry failed")
+
+
+async def periodic_index_mirror_sync(index_mirror: IndexMirror, bus: InvalidationBus, interval_seconds: int) -> None:
+    while True:
+        try:
+            await run_in_threadpool(index_mirror.sync)
+            bus.publish(EVENT_MIRROR_SYNCED)
+        except Exception as e:
+            logger.opt(exception=e).error("index mirror sync failed")
+        await asyncio.sleep(interval_seconds)
+
+
 @asynccontextmanager
 async def mylifespan(_app: FastAPI) -> AsyncGenerator[None, None]:
     """Async wrapper für den synchronen Context-Manager"""
+
     # also, mypy does not know, FastAPI can also digest sync-contextmanager... BLARGH!
+    def import_existing_cache() -> None:
+        with CACHE_MANAGER.locks.lock("import"):  # every worker starts at the same time
+            if METADATA_STORE.is_empty():
+                # cache populated by an older version (or by hand) -> index what is there
+                METADATA_STORE.import_from_filesystem(CACHE_MANAGER.object_store)
+
+    await run_in_threadpool(import_existing_cache)
+
+    try:
+        BUILD_NOTIFIER.start()
+    except Exception as e:  # notifications are optional -> serve anyway
+        logger.opt(exception=e).error("cannot start mqtt build notifications")
+
+    tasks: List[asyncio.Task] = [
+        asyncio.create_task(periodic_metadata_flush(METADATA_STORE, settings.metadata.flush_interval_seconds)),
+        asyncio.create_task(
+            periodic_invalidation_poll(INVALIDATION_BUS, settings.coordination.invalidation_poll_seconds)
+        ),
+    ]
+    if settings.cache.gc_interval_seconds > 0:
+        tasks.append(asyncio.create_task(periodic_cache_gc(CACHE_MANAGER, settings.cache.gc_interval_seconds)))
+    if CACHE_MANAGER.packs is not None and settings.cache.packs.maintenance_interval_seconds > 0:
+        tasks.append(
+            asyncio.create_task(
+                periodic_pack_maintenance(CACHE_MANAGER, settings.cache.packs.maintenance_interval_seconds)
+            )
+        )
+    if settings.registry.watch_interval_seconds > 0:
+        tasks.append(
+            asyncio.create_task(
+                periodic_registry_watch(PACKAGE_REGISTRY, INVALIDATION_BUS, settings.registry.watch_interval_seconds)
+            )
+        )
+    if settings.index_mirror.enabled and settings.index_mirror.sync_interval_seconds > 0:
+        tasks.append(
+            asyncio.create_task(
+                periodic_index_mirror_sync(INDEX_MIRROR, INVALIDATION_BUS, settings.index_mirror.sync_interval_seconds)
+            )
+        )
+
+    loop_monitor: LoopLagMonitor | None = None
+    if settings.profiling.loop_lag_threshold_ms > 0:
+        loop_monitor = LoopLagMonitor(settings.profiling)
+        loop_monitor.start()
+
     with mylifespan_sync(_app):
         yield
 
+    if loop_monitor is not None:
+        loop_monitor.stop()
+    for task in tasks:
+        task.cancel()
+    BUILD_NOTIFIER.stop()
+    METADATA_STORE.flush()
+
 
 app = FastAPI(
     lifespan=mylifespan,
@@ -136,19 +296,19 @@ app = FastAPI(
     openapi_tags=__app_tags_metadata,
 )
 
+# has to be included before the catch-all route below
+app.include_router(admin.router)
+app.include_router(peer.router)
+if settings.metrics.enabled:
+    app.include_router(metrics.router)
+    app.add_middleware(RequestMetricsMiddleware)
+
 # @app.exception_handler(RequestValidationError)
 # async def validation_exception_handler(request, exc):
 #     print(f"OMG! The client sent invalid data!: {exc}")
 #     return await request_validation_exception_handler(request, exc)
 
 
-def is_in_cluster() -> bool:
-    sa: Path = Path("/var/run/secrets/kubernetes.io/serviceaccount")
-    if sa.exists() and sa.is_dir():
-        return os.getenv("KUBERNETES_SERVICE_HOST") is not None
-    return False
-
-
 @app.get("/")
 async def root() -> Dict:
     return {"message": "Hello World"}
@@ -246,6 +406,71 @@ async def echo(request: Request) -> Dict:
     return ret
 
 
+async def mirrored_package_json(
+    index_mirror: IndexMirror,
+    metadata: MetadataStore,
+    negative_cache: NegativeResultCache,
+    package_bodies: PackageBodyCache,
+    request: Request,
+    package_name: str,
+    mpy_version: str,
+    pversion: str,
+) -> Response:
+    """Package of the mirrored index -> kept up to date by the sync, fetched on demand if it is not in the cache"""
+    negkey: NegativeKey = (package_name, pversion, mpy_version)
+    negative: NegativeEntry | None = negative_cache.get(negkey)
+    if negative is not None and not negative.is_expired():
+        PACKAGE_JSON_REQUESTS.labels(result="negative").inc()
+        return negative_response(negative)
+
+    build: BuildRecord | None = metadata.get_build(package_name, mpy_version, pversion)
+    if build is None or not metadata.absolute_json_path(build).is_file():
+        # collected by the gc or not the current version of the package
+        report: MirrorSyncReport = await run_in_threadpool(
+            index_mirror.sync_package, package_name, mpy_version, pversion
+        )
+        if report.failures:  # upstream not reachable, corrupt objects, ... -> not a (cacheable) missing package
+            metadata.count_request(package_name, failure=True)
+            PACKAGE_JSON_REQUESTS.labels(result="failed").inc()
+            return error_response(f"cannot mirror package -> {report.failures[0]}", status_code=502)
+        build = metadata.get_build(package_name, mpy_version, pversion)
+
+    body: PackageBody | None = package_bodies.get(metadata, build) if build is not None else None
+    if body is None:
+        metadata.count_request(package_name, failure=True)
+        PACKAGE_JSON_REQUESTS.labels(result="missing_ref").inc()
+        msg: str = f"cannot mirror package -> {package_name}@{pversion} ({mpy_version}) not available upstream"
+        missing: NegativeEntry | None = negative_cache.put(negkey, NegativeReason.missing_ref, msg)
+        return negative_response(missing) if missing else error_response(msg, status_code=404)
+
+    metadata.touch_build(package_name, mpy_version, pversion)
+    metadata.count_request(package_name, cache_hit=True)
+    PACKAGE_JSON_REQUESTS.labels(result="mirror").inc()
+    return package_json_response(body, request)
+
+
+def offline_package_json(
+    metadata: MetadataStore,
+    package_bodies: PackageBodyCache,
+    request: Request,
+    package_name: str,
+    mpy_version: str,
+    pversion: str,
+) -> Response:
+    """Offline node -> whatever the index has (imported snapshots), configured source or not"""
+    build: BuildRecord | None = metadata.get_build(package_name, mpy_version, pversion)
+    body: PackageBody | None = package_bodies.get(metadata, build) if build is not None else None
+    if body is None:
+        metadata.count_request(package_name, failure=True)
+        PACKAGE_JSON_REQUESTS.labels(result="missing_ref").inc()
+        return error_response(f"{package_name}@{pversion} ({mpy_version}) not in the imported snapshots", 404)
+
+    metadata.touch_build(package_name, mpy_version, pversion)
+    metadata.count_request(package_name, cache_hit=True)
+    PACKAGE_JSON_REQUESTS.labels(result="hit").inc()
+    return package_json_response(body, request)
+
+
 # package = "{}/package/{}/{}/{}.json".format(index, mpy_version, package, version)
 # return _install_json(package, index, target, version, mpy)
 
@@ -253,13 +478,32 @@ async def echo(request: Request) -> Dict:
 @app.get(
     "/package/{mpy_version:str}/{package_name:str}/{pversion}.json",
     response_model=MIPServerPackageJson,
-    responses={500: {"model": ErrorResponse}},
+    responses={
+        403: {"model": ErrorResponse},
+        404: {"model": ErrorResponse},
+        422: {"model": ErrorResponse},
+        429: {"model": ErrorResponse},
+        500: {"model": ErrorResponse},
+        503: {"model": ErrorResponse},
+    },
 )
 async def get_package_json(
     mpy_version: Annotated[MPYPath, FPath(...)],
     package_name: Annotated[str, FPath(..., min_length=3, max_length=100)],
     pversion: Annotated[str, FPath(..., min_length=3, max_length=64)],
     package_name_to_repo: Annotated[Dict[str, str], Depends(get_package_name_to_repo)],
+    package_configs: Annotated[Dict[str, PackageNameGithubRepo], Depends(get_package_configs)],
+    admission: Annotated[AdmissionController, Depends(get_admission_controller)],
+    negative_cache: Annotated[NegativeResultCache, Depends(get_negative_cache)],
+    cache_manager: Annotated[CacheManager, Depends(get_cache_manager)],
+    metadata: Annotated[MetadataStore, Depends(get_metadata_store)],
+    tracer: Annotated[BuildTracer, Depends(get_build_tracer)],
+    index_mirror: Annotated[IndexMirror, Depends(get_index_mirror)],
+    invalidation_bus: Annotated[InvalidationBus, Depends(get_invalidation_bus)],
+    peer_cache: Annotated[PeerCache, Depends(get_peer_cache)],
+    shared_revisions: Annotated[SharedRevisions | None, Depends(get_shared_revisions)],
+    notifier: Annotated[BuildNotifier, Depends(get_build_notifier)],
+    package_bodies: Annotated[PackageBodyCache, Depends(get_package_bodies)],
     request: Request,
 ) -> MIPServerPackageJson | Response:
 
@@ -279,12 +523,33 @@ async def get_package_json(
         logger.debug(f"{k=} => {v=}")
 
     msh: MIPServerHelper = MIPServerHelper(
-        server_cache_root=SERVER_CACHE_ROOT, package_name_to_repo=package_name_to_repo
+        server_cache_root=SERVER_CACHE_ROOT,
+        package_name_to_repo=package_name_to_repo,
+        object_store=cache_manager.object_store,
     )
 
+    if settings.offline.enabled:
+        return offline_package_json(metadata, package_bodies, request, package_name, mpy_version.value, pversion)
+
     reponame: str | None = msh.get_reponame_by_packagename(package_name)
+    if not reponame and index_mirror.serves(package_name):
+        return await mirrored_package_json(
+            index_mirror, metadata, negative_cache, package_bodies, request, package_name, mpy_version.value, pversion
+        )
+
     if not reponame:
-        return error_response("cannot generate package -> invalid packagename")
+        unknown_key: NegativeKey = (package_name, NegativeResultCache.ANY_TARGET, NegativeResultCache.ANY_TARGET)
+        unknown: NegativeEntry | None = negative_cache.get(unknown_key)
+        if unknown is None or unknown.is_expired():
+            unknown = negative_cache.put(
+                unknown_key,
+                NegativeReason.unknown_package,
+                "cannot generate package -> invalid packagename",
+            )
+        PACKAGE_JSON_REQUESTS.labels(result="negative").inc()
+        if unknown is None:
+            return error_response("cannot generate package -> invalid packagename", status_code=404)
+        return negative_response(unknown)
 
     logger.debug(f'MIP::get_package_json request for "/package/{mpy_version}/{package_name}/{pversion}.json"')
 
@@ -293,29 +558,154 @@ async def get_package_json(
         mpy_version=mpy_version, package_name=package_name, pversion=pversion
     )
 
-    thirty_minutes_ago: datetime.datetime = datetime.datetime.now() - datetime.timedelta(minutes=30)
-
-    if local_json.exists():
-        lms: stat_result = local_json.stat()
-
-        if lms.st_ctime >= thirty_minutes_ago.timestamp():
-            logger.debug(
-                f"\tReturning {local_json=} from {datetime.datetime.fromtimestamp(lms.st_ctime, settings.timezone)}"
+    build: BuildRecord | None = metadata.get_build(package_name, mpy_version.value, pversion)
+    body: PackageBody | None = None
+    if build is not None and build.checked_at >= time.time() - settings.metadata.freshness_seconds:
+        body = package_bodies.get(metadata, build)  # None if the json is gone
+    if build is not None and body is not None:
+        logger.debug(
+            f"\tReturning {build.json_path=} checked {datetime.datetime.fromtimestamp(build.checked_at, settings.timezone)}"
+        )
+        metadata.touch_build(package_name, mpy_version.value, pversion)
+        metadata.count_request(package_name, cache_hit=True)
+        PACKAGE_JSON_REQUESTS.labels(result="hit").inc()
+        return package_json_response(body, request)
+
+    pkgcfg: PackageNameGithubRepo = package_configs.get(package_name) or PackageNameGithubRepo(
+        packagename=package_name, githubrepo=reponame
+    )
+    source: SourceBackend = source_for(pkgcfg, msh)
+
+    # known failure for this package/version/target ?
+    negkey: NegativeKey = (package_name, pversion, mpy_version.value)
+    negative: NegativeEntry | None = negative_cache.get(negkey)
+    if negative is not None:
+        if not negative.is_expired():
+            PACKAGE_JSON_REQUESTS.labels(result="negative").inc()
+            return negative_response(negative)
+
+        if negative.commit is not None:
+            # ttl is over -> only rebuild if upstream actually moved on
+            remote_commit: str | None = await run_in_threadpool(source.remote_revision, pversion, mpy_version)
+            if remote_commit == negative.commit:
+                rearmed: NegativeEntry | None = negative_cache.rearm(negkey, negative)
+                if rearmed is not None:
+                    PACKAGE_JSON_REQUESTS.labels(result="negative").inc()
+                    return negative_response(rearmed)
+            elif remote_commit is not None:
+                negative_cache.invalidate_on_new_commit(package_name, pversion, remote_commit)
+
+    if settings.builder.mode == "queue" and build is not None:
+        stale: PackageBody | None = package_bodies.get(metadata, build)
+        if stale is not None:
+            # a builder revalidates it in the background -> no request waits for upstream while there is a build
+            metadata.enqueue_build_job(package_name, mpy_version.value, pversion)
+            metadata.touch_build(package_name, mpy_version.value, pversion)
+            metadata.count_request(package_name, cache_hit=True)
+            PACKAGE_JSON_REQUESTS.labels(result="stale").inc()
+            return package_json_response(stale, request)
+
+    # from here on it gets expensive (clone/fetch + compile) -> admission control
+    client_ip: str = request.client.host if request.client else "unknown"
+
+    queued: bool = settings.builder.mode == "queue"
+
+    try:
+        admission.check_branch(pkgcfg, pversion)
+        # builds ahead: jobs of the builders (queue mode), otherwise the ones waiting for a slot in this worker
+        if queued:
+            admission.check_backpressure(
+                package_name,
+                client_ip,
+                metadata.build_job_counts().get("queued", 0),
+                settings.builder.concurrency * settings.builder.processes,
             )
-            return FileResponse(local_json, media_type="application/json")
-
-    logger.debug(f"Have to check for updates on git...")
-    gitrepopath: Path | None = msh.ensure_git_repo_up_to_date(
-        repo_name=reponame, branch=pversion
-    )  # pversion sollte meist "latest" sein
-
-    if not gitrepopath:
-        return error_response("cannot generate package -> git pull failed")
-
-    logger.debug(f"Trying to generate package_json from locally existing github...")
-    local_json = msh.generate_package_json_from_local_repo(
-        gitrepopath=gitrepopath, target_pkgjson=local_json, mpy_version=mpy_version
+        else:
+            admission.check_backpressure(package_name, client_ip)
+        admission.consume_client_budget(client_ip)
+    except AdmissionDenied as ad:
+        PACKAGE_JSON_REQUESTS.labels(result="denied").inc()
+        return admission_denied_response(ad)
+
+    # what devices have installed so far -> number of changed files in the notification
+    previous: BuildRecord | None = (
+        metadata.get_build(package_name, mpy_version.value, pversion, with_files=True) if notifier.enabled else None
+    )
+    ask_peers: bool = peer_cache.enabled and PEER_HEADER not in request.headers  # peers never ask further peers
+    package_build = PackageBuild(
+        source,
+        local_json,
+        package_name,
+        mpy_version,
+        pversion,
+        build,
+        cache_manager,
+        metadata,
+        tracer,
+        peer_cache if ask_peers else None,
+        shared_revisions,
+        settings.coordination.build_lock_timeout_seconds,
+        settings.metadata.freshness_seconds,
+        slot=admission.build_slot,
     )
+
+    build_started: float = time.perf_counter()
+    try:
+        with admission.pending_build(package_name):
+            if queued:
+                # a builder process does the work (and announces new revisions) -> this worker only waits for it
+                job: BuildJob = metadata.enqueue_build_job(package_name, mpy_version.value, pversion)
+                job = await wait_for_build_job(
+                    metadata, job, settings.builder.wait_seconds, settings.builder.poll_interval_seconds
+                )
+                package_build.result = job.result or "queued"
+                if job.result == "built" and job.started_at is not None and job.finished_at is not None:
+                    admission.observe_build(package_name, job.finished_at - job.started_at)
+                built_json, built_commit = job_output(job, metadata, admission.retry_after(package_name, client_ip))
+            else:
+                built_json, built_commit = await run_in_threadpool(package_build.run)
+                if package_build.build_seconds is not None:
+                    admission.observe_build(package_name, package_build.build_seconds)
+        metadata.count_request(package_name, build=True, failure=built_json is None)
+    except RefNotFoundError:
+        metadata.count_request(package_name, failure=True)
+        msg: str = f"cannot generate package -> ref {pversion} not found"
+        missing: NegativeEntry | None = negative_cache.put(
+            (package_name, pversion, NegativeResultCache.ANY_TARGET), NegativeReason.missing_ref, msg
+        )
+        return negative_response(missing) if missing else error_response(msg, status_code=404)
+    except AdmissionDenied as ad:
+        return admission_denied_response(ad)
+    except PackageBuildError as pbe:
+        metadata.count_request(package_name, failure=True)
+        msg = f"cannot generate package -> build failed: {pbe}"
+        failed: NegativeEntry | None = negative_cache.put(negkey, NegativeReason.build_failed, msg, pbe.commit)
+        return negative_response(failed) if failed else error_response(msg, status_code=422)
+    finally:
+        PACKAGE_BUILD_DURATION.labels(result=package_build.result).observe(time.perf_counter() - build_started)
+        PACKAGE_JSON_REQUESTS.labels(result=package_build.result).inc()
+
+    if not built_json:
+        return error_response(f"cannot generate package -> {pkgcfg.source.kind.value} pull failed")
+
+    if built_commit is not None:
+        negative_cache.invalidate_on_new_commit(package_name, pversion, built_commit)
+        if package_build.result in ("built", "peer") and not queued:
+            invalidation_bus.publish(
+                EVENT_NEW_REVISION, package_name=package_name, pversion=pversion, commit=built_commit
+            )
+            if notifier.enabled:
+                current: BuildRecord | None = metadata.get_build(package_name, mpy_version.value, pversion, True)
+                if current is not None:
+                    notifier.build_changed(current, previous)
+
+    local_json = built_json
+    current_build: BuildRecord | None = metadata.get_build(package_name, mpy_version.value, pversion)
+    if current_build is not None and metadata.absolute_json_path(current_build) == local_json:
+        body = package_bodies.get(metadata, current_build)
+        if body is not None:
+            logger.debug(f"\tReturning freshly created {local_json=}")
+            return package_json_response(body, request)
     if local_json.exists():
         logger.debug(f"\tReturning freshly created {local_json=}")
         return FileResponse(local_json, media_type="application/json")
@@ -325,17 +715,30 @@ async def get_package_json(
 
 # file_url = "{}/file/{}/{}".format(index, short_hash[:2], short_hash)
 @app.get("/file/{short_hash_2:str}/{short_hash:str}")
+@app.head("/file/{short_hash_2:str}/{short_hash:str}", include_in_schema=False)  # same handler, no 2nd operation
 async def get_file(
     request: Request,
-    short_hash_2: Annotated[str, FPath(..., min_length=2, max_length=2)],  # pattern="^[a-fA-F0-9]{2}$"),
-    short_hash: Annotated[str, FPath(..., min_length=64, max_length=64)],
+    short_hash_2: Annotated[str, FPath(..., min_length=2, max_length=2, pattern="^[a-fA-F0-9]{2}$")],
+    short_hash: Annotated[str, FPath(..., min_length=64, max_length=64, pattern="^[a-fA-F0-9]{64}$")],
     package_name_to_repo: Annotated[Dict[str, str], Depends(get_package_name_to_repo)],
+    metadata: Annotated[MetadataStore, Depends(get_metadata_store)],
+    peer_cache: Annotated[PeerCache, Depends(get_peer_cache)],
+    packs: Annotated[PackStore | None, Depends(get_pack_store)],
 ) -> Response:
 
     ret: Dict = do_request_log(request, short_hash_2=short_hash_2, short_hash=short_hash)
 
+    # the store, the packs, the peers and the index only know lower case hashes
+    short_hash_2, short_hash = short_hash_2.lower(), short_hash.lower()
     assert short_hash_2 == short_hash[:2]
 
+    if packs is not None:
+        view: memoryview | None = packs.read(short_hash)
+        if view is not None:  # small object -> a slice of the mapped pack, no open/stat
+            FILE_REQUESTS.labels(result="hit").inc()
+            metadata.touch_object(short_hash)
+            return packed_object_response(view, short_hash, request)
+
     # logger.debug(Helper.get_pretty_dict_json_no_sort(ret))
 
     msh: MIPServerHelper = MIPServerHelper(
@@ -350,11 +753,21 @@ async def get_file(
         return error_response(f"File error (not pathable): {rel}")
 
     if not (retfile.exists() and retfile.is_file()):
-        return error_response(f"File not found {rel}")
-
-    mime: str = "application/octet-stream"
+        # collected here (or never built here) -> a sibling replica may still have it
+        if not (
+            peer_cache.enabled
+            and PEER_HEADER not in request.headers
+            and await run_in_threadpool(peer_cache.fetch_object, short_hash)
+        ):
+            FILE_REQUESTS.labels(result="miss").inc()
+            return error_response(f"File not found {rel}")
+        FILE_REQUESTS.labels(result="peer").inc()
+    else:
+        FILE_REQUESTS.labels(result="hit").inc()
+    metadata.touch_object(short_hash)
 
-    return FileResponse(retfile, media_type=mime)
+    # whole object, a part of it (Range) or the rest of an interrupted download (If-Range)
+    return object_response(retfile, short_hash, retfile.stat(), request)
 
 
 @app.get("/{whatever:path}")
@@ -3,6 +3,7 @@ import datetime
 # https://docs.pydantic.dev/latest/concepts/pydantic_settings/
 
 import os
+import posixpath
 import sys
 from enum import StrEnum, auto
 from functools import partial
@@ -38,6 +39,8 @@ _CONFIGPATH = Path(os.getenv("CONFIG_PATH", _CONFIGPATH))
 _CONFIGLOCALPATH: Path = Path(_CONFIGDIRPATH, "config.local.yaml")
 _CONFIGLOCALPATH = Path(os.getenv("CONFIG_LOCAL_PATH", _CONFIGLOCALPATH))
 
+CONFIG_FILES: List[Path] = [_CONFIGPATH, _CONFIGLOCALPATH]  # later files override earlier ones
+
 # _tzberlin: datetime.tzinfo = pytz.timezone("Europe/Berlin")
 
 from pydantic import (
@@ -46,6 +49,7 @@ from pydantic import (
     AliasPath,
     AliasChoices,
     field_validator,
+    model_validator,
     RootModel,
     AfterValidator,
     BeforeValidator,
@@ -135,9 +139,17 @@ from pydantic_settings import (
 
 
 class Redis(BaseModel):
+    # optional coordination of pods/hosts: build locks, negative cache, upstream commits, invalidation pub/sub
+    ENABLED: bool = Field(default=False)
     HOST: str = Field(default="127.0.0.1")
     HOST_IN_CLUSTER: Optional[str] = Field(default=None)
     PORT: int = Field(default=6379)
+    DB: int = Field(default=0, ge=0)
+    PASSWORD: Optional[str] = Field(default=None)
+    KEY_PREFIX: str = Field(default="mipserver:")
+    # locks expire this long after their holder died; renewed while the holder is alive
+    LOCK_TTL_SECONDS: int = Field(default=30, ge=1)
+    SOCKET_TIMEOUT_SECONDS: float = Field(default=5.0, gt=0)
 
 
 class Gotify(BaseModel):
@@ -153,21 +165,251 @@ class UVICORN(BaseModel):
     host: str = Field(default="0.0.0.0")
     log_level: str = Field(default="info")
     reload: bool = Field(default=True)
+    # > 1: that many worker processes (reload is switched off then) -> see COORDINATION
+    workers: int = Field(default=1, ge=1)
 
 
 class GotifyList(RootModel):
     root: List[Gotify]
 
 
+class SourceKind(StrEnum):
+    git = "git"  # any git url: https, ssh, file://, internal gitea, ...
+    local = "local"  # a directory on this host (lab builds)
+    tarball = "tarball"  # release archives (.tar.gz/.tar.bz2/.tar.xz/.tar) via http(s), file:// or path
+    mirror = "mirror"  # another mip index (e.g. a mipserver or micropython.org) -> no compilation
+
+
+class Source(BaseModel):
+    kind: SourceKind = Field(default=SourceKind.git)
+    # git: clone url (default: UPSTREAM.git_base_url/<githubrepo>.git)
+    # tarball: url or path, "{ref}" is replaced by the branch/version ("latest" -> UPSTREAM.default_branch)
+    # mirror: base url of the index (package name on the index: githubrepo)
+    url: Optional[str] = Field(default=None)
+    # local: directory containing the package.json
+    path: Optional[str] = Field(default=None)
+    # git: directory of the package.json inside the repo (monorepos: packages of one repo share its checkout,
+    # a package is only rebuilt if its directory or the files it references outside of it changed)
+    subpath: Optional[str] = Field(default=None)
+
+
 class PackageNameGithubRepo(BaseModel):
     packagename: str
     githubrepo: str
+    # if neither is set, every branch is buildable; "latest" is always buildable
+    allowed_branches: Optional[List[str]] = Field(default=None)
+    branch_pattern: Optional[str] = Field(default=None)
+    source: Source = Field(default_factory=Source)
+
+    @model_validator(mode="after")
+    def check_source(self) -> "PackageNameGithubRepo":
+        if self.source.kind == SourceKind.local and not self.source.path:
+            raise ValueError(f"{self.packagename}: source.path is required for local sources")
+        if self.source.kind in (SourceKind.tarball, SourceKind.mirror) and not self.source.url:
+            raise ValueError(f"{self.packagename}: source.url is required for {self.source.kind.value} sources")
+        if self.source.subpath is not None:
+            if self.source.kind != SourceKind.git:
+                raise ValueError(f"{self.packagename}: source.subpath is only supported for git sources")
+            subpath: str = posixpath.normpath(self.source.subpath.strip("/"))
+            if subpath.split("/")[0] in (".", ".."):
+                raise ValueError(f"{self.packagename}: source.subpath has to be a directory inside the repo")
+            self.source.subpath = subpath
+        return self
 
 
 class PackageNameGithubRepoList(RootModel):
     root: List[PackageNameGithubRepo]
 
 
+class Upstream(BaseModel):
+    git_base_url: str = Field(default="https://github.com")
+    raw_base_url: str = Field(default="https://raw.githubusercontent.com")
+    default_branch: str = Field(default="main")  # what "latest" maps to
+    http_timeout_seconds: int = Field(default=60, ge=1)
+    # shared (keep-alive) http client for raw file downloads
+    max_connections: int = Field(default=20, ge=1)
+    parallel_downloads_per_package: int = Field(default=4, ge=1)
+    retries: int = Field(default=3, ge=0)
+    retry_backoff_seconds: float = Field(default=0.5, ge=0)
+    # an upstream Retry-After is honoured up to this long (the package request waits meanwhile)
+    max_retry_after_seconds: float = Field(default=30.0, ge=0)
+    # git: blobless partial clone + sparse checkout of package.json and the files its urls reference
+    sparse_checkout: bool = Field(default=True)
+
+
+class AdmissionControl(BaseModel):
+    max_concurrent_builds: int = Field(default=2, ge=1)
+    client_budget: int = Field(default=10, ge=1)  # cold builds per client-ip per window
+    client_budget_window_seconds: int = Field(default=600, ge=1)
+    # backpressure: 503 + Retry-After instead of holding requests open while builds pile up (0 -> no limit)
+    max_pending_per_package: int = Field(default=16, ge=0)  # requests already waiting for a build of the package
+    max_wait_seconds: float = Field(default=60.0, ge=0)  # estimated wait for a free build slot
+    default_build_seconds: float = Field(default=30.0, gt=0)  # estimate until builds have been measured
+    # Retry-After = expected build time + up to this share of it, fixed per client -> retries spread out
+    retry_jitter_ratio: float = Field(default=0.5, ge=0)
+    max_retry_after_seconds: int = Field(default=300, ge=1)
+
+
+class NegativeCache(BaseModel):
+    # a ttl of 0 disables caching for that kind of failure
+    unknown_package_ttl_seconds: int = Field(default=300, ge=0)
+    missing_ref_ttl_seconds: int = Field(default=900, ge=0)
+    build_failed_ttl_seconds: int = Field(default=300, ge=0)
+    max_entries: int = Field(default=10_000, ge=1)
+
+
+def _parse_size(v: Any) -> Any:
+    """Accepts plain byte counts as well as "512M", "8G", "100k" etc."""
+    if not isinstance(v, str):
+        return v
+
+    units: Dict[str, int] = {"k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+    vs: str = v.strip().lower().removesuffix("b").removesuffix("i")
+    if vs and vs[-1] in units:
+        return int(float(vs[:-1]) * units[vs[-1]])
+    return int(vs)
+
+
+ByteSize = Annotated[int, BeforeValidator(_parse_size)]
+
+
+class CacheQuota(BaseModel):
+    # None -> unlimited
+    git_max_bytes: Optional[ByteSize] = Field(default=None)  # checkouts of the upstream repositories
+    build_max_bytes: Optional[ByteSize] = Field(default=None)  # compiled .mpy left in the checkouts
+    objects_max_bytes: Optional[ByteSize] = Field(default=None)  # content addressed files/<h2>/<hash>
+    json_max_bytes: Optional[ByteSize] = Field(default=None)  # <mpy>/<pkg>/<version>.json
+    total_max_bytes: Optional[ByteSize] = Field(default=None)
+
+
+class Packs(BaseModel):
+    # small objects in a few append-only pack files (+ memory mapped index) instead of one file each
+    enabled: bool = Field(default=False)
+    max_object_bytes: int = Field(default=256 * 1024, ge=1)  # larger objects stay loose files
+    max_pack_bytes: int = Field(default=64 * 1024 * 1024, ge=1)
+    # how often loose objects are moved into packs and the index is compacted (0 -> never)
+    maintenance_interval_seconds: int = Field(default=300, ge=0)
+    # packs whose deleted objects make up this share are rewritten by the maintenance
+    rewrite_dead_ratio: float = Field(default=0.3, gt=0, le=1)
+
+
+class CacheManagement(BaseModel):
+    quotas: CacheQuota = Field(default_factory=CacheQuota)
+    gc_interval_seconds: int = Field(default=3600, ge=0)  # 0 -> no periodic gc
+    grace_period_seconds: int = Field(default=600, ge=0)  # never collect anything younger than this
+    pinned: List[str] = Field(default_factory=list)  # "package@version" -> json, objects and checkout are kept
+    # final response bytes of the package jsons kept in memory (per worker), least recently served are dropped
+    json_body_cache_bytes: int = Field(default=32 * 1024 * 1024, ge=0)
+    packs: Packs = Field(default_factory=Packs)
+
+
+class Metadata(BaseModel):
+    # sqlite index of builds/objects/request counters; relative paths are relative to the server cache root
+    db_path: str = Field(default="metadata.sqlite3")
+    flush_interval_seconds: float = Field(default=2.0, gt=0)
+    max_pending: int = Field(default=10_000, ge=1)
+    # a package json is served without asking upstream for this long after the last check
+    freshness_seconds: int = Field(default=1800, ge=0)
+
+
+class Metrics(BaseModel):
+    # prometheus /metrics endpoint and request latency middleware
+    enabled: bool = Field(default=True)
+
+
+class Tracing(BaseModel):
+    # spans per package build (lock wait, git, compile, hash, store, ...) -> GET /admin/builds/timelines
+    enabled: bool = Field(default=True)
+    timelines_per_package: int = Field(default=20, ge=1)
+    max_packages: int = Field(default=500, ge=1)
+    # append every build as OTLP/JSON line to this file (None: keep in memory only)
+    export_path: Optional[str] = Field(default=None)
+
+
+class Profiling(BaseModel):
+    # POST /admin/profile samples all threads and asyncio tasks of the worker -> collapsed stacks (flamegraph)
+    max_seconds: float = Field(default=60.0, gt=0)
+    # log the event loop's stack when a coroutine blocks it longer than this (0: no watchdog)
+    loop_lag_threshold_ms: float = Field(default=500.0, ge=0)
+    loop_lag_check_ms: float = Field(default=100.0, gt=0)
+
+
+class Coordination(BaseModel):
+    # several workers/pods on one cache root: builds of the same checkout are serialized via file locks
+    build_lock_timeout_seconds: int = Field(default=600, ge=0)
+    # how often a worker applies invalidations (new upstream revisions, mirror syncs) published by the others
+    invalidation_poll_seconds: float = Field(default=1.0, gt=0)
+    event_retention_seconds: int = Field(default=86400, ge=60)
+
+
+class Registry(BaseModel):
+    # PACKAGENAME_TO_GITHUB_REPO is re-read when config.yaml/config.local.yaml change (mtime poll, 0: off)
+    # -> packages are added/removed/changed without a restart (POST /admin/registry/reload does the same)
+    watch_interval_seconds: float = Field(default=5.0, ge=0)
+
+
+class IndexMirror(BaseModel):
+    # mirror packages of another mip v2 index (micropython-lib on micropython.org) -> served next to the own ones
+    enabled: bool = Field(default=False)
+    url: str = Field(default="https://micropython.org/pi/v2")
+    # None: every package of the index; otherwise these packages plus their dependencies
+    packages: Optional[List[str]] = Field(default=None)
+    mpy_versions: List[str] = Field(default=["6", "py"])
+    # 0: no periodic sync (POST /admin/mirror/sync, or on demand when a mirrored json is missing)
+    sync_interval_seconds: int = Field(default=86400, ge=0)
+    parallel_downloads: int = Field(default=8, ge=1)
+    retries: int = Field(default=3, ge=0)
+    retry_backoff_seconds: float = Field(default=0.5, ge=0)
+
+
+class Offline(BaseModel):
+    # air-gapped node populated with snapshots (python snapshot.py import ...): package jsons are served from the
+    # index only, upstream is never asked -> neither git nor mpy-cross are needed
+    enabled: bool = Field(default=False)
+
+
+class Builder(BaseModel):
+    # inline: builds run inside the http workers; queue: the http workers only queue build jobs (in the metadata
+    # index) and separate builder processes (python builder.py) run them -> a crashing mpy-cross/git or an OOM
+    # never takes the api down, a build interrupted by a restart is picked up again
+    mode: Literal["inline", "queue"] = Field(default="inline")
+    concurrency: int = Field(default=2, ge=1)  # builds per builder process
+    processes: int = Field(default=1, ge=1)  # builder processes that run the queue -> estimated wait of a new job
+    poll_interval_seconds: float = Field(default=0.5, gt=0)
+    # a request for a package that was never built waits this long for its job, then 503 + Retry-After
+    wait_seconds: float = Field(default=20.0, ge=0)
+    # a running job whose builder vanished is handed to another builder after this long (at most max_attempts);
+    # the builder renews it every lease_seconds / 3 while the build runs
+    lease_seconds: float = Field(default=900.0, gt=0)
+    max_attempts: int = Field(default=3, ge=1)
+    job_retention_seconds: int = Field(default=86400, ge=60)
+
+
+class Peers(BaseModel):
+    # sibling mipserver replicas (e.g. "http://mipserver.site-b:18791") asked before upstream for objects and
+    # package jsons they already built; everything received is verified against its sha256
+    urls: List[str] = Field(default_factory=list)
+    timeout_seconds: float = Field(default=5.0, gt=0)
+    # how long to wait for the owning replica to build a package (clone + compile)
+    build_timeout_seconds: float = Field(default=300.0, gt=0)
+    # consistent hashing over urls + self_url assigns each package to one replica that builds it, the others
+    # fetch the result from there (falls back to a local build if the owner is not reachable)
+    build_ownership: bool = Field(default=False)
+    self_url: Optional[str] = Field(default=None)  # how the peers reach this replica -> required for build_ownership
+    virtual_nodes: int = Field(default=64, ge=1)
+
+    @model_validator(mode="after")
+    def check_self_url(self) -> "Peers":
+        if self.build_ownership and not self.self_url:
+            raise ValueError("PEERS.build_ownership requires PEERS.self_url")
+        return self
+
+
+class Admin(BaseModel):
+    # bearer token for the /admin endpoints; None disables them
+    TOKEN: Optional[str] = Field(default=None)
+
+
 class Telegram(BaseModel):
     BOT_TOKEN: str
     BOT_CHATID: str
@@ -179,6 +421,14 @@ class Mqtt(BaseModel):
     PORT: int = Field(default=1883)
     USERNAME: str = Field()
     PASSWORD: str = Field()
+    # retained message per package/target on <TOPIC_PREFIX>/package/<mpy>/<package>/<version> when a build changes
+    # -> devices subscribe instead of polling latest.json (pip install paho-mqtt)
+    NOTIFY_ENABLED: bool = Field(default=False)
+    TOPIC_PREFIX: str = Field(default="mipserver")
+    QOS: int = Field(default=1, ge=0, le=2)
+    CLIENT_ID: Optional[str] = Field(default=None)  # None -> mipserver-<host>-<pid>
+    TLS: bool = Field(default=False)
+    KEEPALIVE_SECONDS: int = Field(default=60, ge=5)
     # guggle: Optional[str] = Field(default_factory=lambda: os.getenv("guggle"), validation_alias=AliasChoices("gummybear", "guggle"))
 
     # @field_validator('guggle', mode="before")
@@ -257,18 +507,33 @@ class Settings(BaseSettings):
         #     validation_alias=to_camel,
         #     serialization_alias=to_pascal,
         # )
-        yaml_file=[_CONFIGPATH, _CONFIGLOCALPATH],
+        yaml_file=CONFIG_FILES,
     )
 
     timezone: datetime.tzinfo = Field(
         alias="TIMEZONE"
     )  # Annotated[datetime.tzinfo, BeforeValidator(lambda v: pytz.timezone(v))]
 
-    # redis: Redis = Field(alias="REDIS")
+    redis: Redis = Field(alias="REDIS", default_factory=Redis)
     mqtt: Mqtt = Field(alias="MQTT")
     gotifylist: GotifyList = Field(alias="GOTIFY")
     uvicorn: UVICORN = Field(alias="UVICORN")
     packagename_to_github_repo: PackageNameGithubRepoList = Field(alias="PACKAGENAME_TO_GITHUB_REPO")
+    registry: Registry = Field(alias="REGISTRY", default_factory=Registry)
+    upstream: Upstream = Field(alias="UPSTREAM", default_factory=Upstream)
+    admission: AdmissionControl = Field(alias="ADMISSION", default_factory=AdmissionControl)
+    negative_cache: NegativeCache = Field(alias="NEGATIVE_CACHE", default_factory=NegativeCache)
+    cache: CacheManagement = Field(alias="CACHE", default_factory=CacheManagement)
+    admin: Admin = Field(alias="ADMIN", default_factory=Admin)
+    metadata: Metadata = Field(alias="METADATA", default_factory=Metadata)
+    metrics: Metrics = Field(alias="METRICS", default_factory=Metrics)
+    tracing: Tracing = Field(alias="TRACING", default_factory=Tracing)
+    profiling: Profiling = Field(alias="PROFILING", default_factory=Profiling)
+    index_mirror: IndexMirror = Field(alias="INDEX_MIRROR", default_factory=IndexMirror)
+    coordination: Coordination = Field(alias="COORDINATION", default_factory=Coordination)
+    peers: Peers = Field(alias="PEERS", default_factory=Peers)
+    offline: Offline = Field(alias="OFFLINE", default_factory=Offline)
+    builder: Builder = Field(alias="BUILDER", default_factory=Builder)
 
     # HttpUrlString = Annotated[HttpUrl, AfterValidator(lambda v: str(v))]
 
@@ -300,7 +565,40 @@ class Settings(BaseSettings):
         return init_settings, env_settings, YamlConfigSettingsSource(settings_cls)
 
 
-settings: Settings = Settings()  # type: ignore
+_loaded_settings: Dict[Tuple[Tuple[int, int, int] | None, ...], Settings] = {}
+
+
+def _config_files_state() -> Tuple[Tuple[int, int, int] | None, ...]:
+    ret: List[Tuple[int, int, int] | None] = []
+    for p in CONFIG_FILES:
+        try:
+            st: os.stat_result = p.stat()
+            ret.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except OSError:
+            ret.append(None)
+    return tuple(ret)
+
+
+def load_settings() -> Settings:
+    """Settings as configured right now -> the yaml files are parsed and validated again only after they changed"""
+    state = _config_files_state()
+    loaded: Settings | None = _loaded_settings.get(state)
+    if loaded is None:
+        loaded = Settings()  # type: ignore[call-arg]
+        _loaded_settings.clear()
+        _loaded_settings[state] = loaded
+    return loaded
+
+
+settings: Settings  # loaded on first access (see __getattr__) -> importing the config models alone parses nothing
+
+
+def __getattr__(name: str) -> Any:
+    if name == "settings":
+        globals()["settings"] = loaded = load_settings()  # from now on a plain module attribute
+        return loaded
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
-    pprint(settings.model_dump())
+    pprint(load_settings().model_dump())
@@ -0,0 +1,193 @@
+import os
+import secrets
+from pathlib import Path
+from typing import Annotated, Dict, Optional
+
+from fastapi import Header, HTTPException
+from loguru import logger
+
+from mipserver.config import CONFIG_FILES, settings, PackageNameGithubRepo
+from mipserver.internal.admission import AdmissionController
+from mipserver.internal.cachemanager import CacheManager
+from mipserver.internal.coordination import (
+    EVENT_MIRROR_SYNCED,
+    EVENT_NEW_REVISION,
+    EVENT_REGISTRY_CHANGED,
+    InvalidationBus,
+)
+from mipserver.internal.indexmirror import IndexMirror
+from mipserver.internal.metadata import MetadataStore
+from mipserver.internal.metrics import CacheCollector, register_cache_collector
+from mipserver.internal.negativecache import NegativeResultCache
+from mipserver.internal.notify import BuildNotifier
+from mipserver.internal.packagebodies import PackageBodyCache
+from mipserver.internal.packstore import PackStore
+from mipserver.internal.peers import PeerCache
+from mipserver.internal.profiling import SamplingProfiler
+from mipserver.internal.redisstate import (
+    RedisInvalidationBus,
+    RedisLockManager,
+    RedisNegativeCache,
+    SharedRevisions,
+    redis_client,
+)
+from mipserver.internal.registry import PackageRegistry, RegistryDiff
+from mipserver.internal.tracing import BuildTracer
+
+# created on first write (metadata index, checkouts, objects) -> importing has no side effects on the filesystem
+SERVER_CACHE_ROOT: Path = Path(os.getcwd(), ".cache") / "repos"
+
+# "micropysensorbase" -> "vroomfondel/micropysensorbase" (+ source/branch config), reloadable at runtime
+PACKAGE_REGISTRY: PackageRegistry = PackageRegistry(settings.packagename_to_github_repo.root, CONFIG_FILES)
+
+# several pods without a shared (flock-capable) cache volume -> coordinated via redis
+REDIS = redis_client(settings.redis) if settings.redis.ENABLED else None
+
+ADMISSION_CONTROLLER: AdmissionController = AdmissionController(settings.admission)
+NEGATIVE_CACHE: NegativeResultCache = (
+    RedisNegativeCache(settings.negative_cache, REDIS, settings.redis)
+    if REDIS is not None
+    else NegativeResultCache(settings.negative_cache)
+)
+METADATA_STORE: MetadataStore = MetadataStore(
+    Path(SERVER_CACHE_ROOT, settings.metadata.db_path), SERVER_CACHE_ROOT, max_pending=settings.metadata.max_pending
+)
+CACHE_MANAGER: CacheManager = CacheManager(
+    SERVER_CACHE_ROOT, settings.cache, PACKAGE_REGISTRY.name_to_repo, METADATA_STORE
+)
+PACKAGE_BODIES: PackageBodyCache = PackageBodyCache(settings.cache.json_body_cache_bytes)
+BUILD_TRACER: BuildTracer = BuildTracer(settings.tracing)
+PROFILER: SamplingProfiler = SamplingProfiler(settings.profiling)
+INDEX_MIRROR: IndexMirror = IndexMirror(
+    settings.index_mirror, SERVER_CACHE_ROOT, METADATA_STORE, CACHE_MANAGER.object_store
+)
+BUILD_NOTIFIER: BuildNotifier = BuildNotifier(settings.mqtt)
+PEER_CACHE: PeerCache = PeerCache(settings.peers, METADATA_STORE, CACHE_MANAGER.object_store)
+
+SHARED_REVISIONS: SharedRevisions | None = None
+INVALIDATION_BUS: InvalidationBus
+if REDIS is not None:
+    CACHE_MANAGER.locks = INDEX_MIRROR.locks = RedisLockManager(REDIS, settings.redis)
+    if CACHE_MANAGER.packs is not None:
+        CACHE_MANAGER.packs.locks = CACHE_MANAGER.locks
+    SHARED_REVISIONS = SharedRevisions(REDIS, settings.redis)
+    INVALIDATION_BUS = RedisInvalidationBus(METADATA_STORE, REDIS, settings.redis)
+else:
+    INVALIDATION_BUS = InvalidationBus(METADATA_STORE, settings.coordination.event_retention_seconds)
+INVALIDATION_BUS.subscribe(
+    EVENT_NEW_REVISION,
+    lambda e: NEGATIVE_CACHE.invalidate_on_new_commit(e["package_name"], e["pversion"], e["commit"]),
+)
+INVALIDATION_BUS.subscribe(EVENT_MIRROR_SYNCED, lambda e: INDEX_MIRROR.reload())
+INVALIDATION_BUS.subscribe(EVENT_REGISTRY_CHANGED, lambda e: PACKAGE_REGISTRY.reload())
+
+
+def invalidate_registry_changes(diff: RegistryDiff) -> None:
+    """Only the packages of the diff: failures (e.g. "unknown package") are forgotten, builds of changed or
+    removed packages are rebuilt from their (new) source on the next request"""
+    CACHE_MANAGER.package_name_to_repo = PACKAGE_REGISTRY.name_to_repo
+    for package_name in diff.affected:
+        NEGATIVE_CACHE.invalidate(package_name)
+    for package_name in diff.changed + diff.removed:
+        METADATA_STORE.invalidate_package(package_name)
+        if SHARED_REVISIONS is not None:
+            SHARED_REVISIONS.forget(package_name)
+
+
+PACKAGE_REGISTRY.subscribe(invalidate_registry_changes)
+
+CACHE_COLLECTOR: CacheCollector | None = None
+if settings.metrics.enabled:
+    CACHE_COLLECTOR = register_cache_collector(METADATA_STORE, NEGATIVE_CACHE)
+
+
+def get_package_name_to_repo() -> Dict[str, str]:
+    """Dependency function to inject package_name_to_repo dictionary"""
+    logger.debug("app::get_package_name_to_repo")
+    return PACKAGE_REGISTRY.name_to_repo
+
+
+def get_package_configs() -> Dict[str, PackageNameGithubRepo]:
+    """Dependency function to inject the full per-package configuration (branch restrictions etc.)"""
+    return PACKAGE_REGISTRY.configs
+
+
+def get_package_registry() -> PackageRegistry:
+    """Dependency function to inject the (reloadable) registry of served packages"""
+    return PACKAGE_REGISTRY
+
+
+def get_admission_controller() -> AdmissionController:
+    """Dependency function to inject the (process-wide) admission controller"""
+    return ADMISSION_CONTROLLER
+
+
+def get_negative_cache() -> NegativeResultCache:
+    """Dependency function to inject the (process-wide) cache of failed lookups/builds"""
+    return NEGATIVE_CACHE
+
+
+def get_cache_manager() -> CacheManager:
+    """Dependency function to inject the cache manager (size accounting, lru bookkeeping, gc)"""
+    return CACHE_MANAGER
+
+
+def get_metadata_store() -> MetadataStore:
+    """Dependency function to inject the metadata index (builds, objects, request counters)"""
+    return METADATA_STORE
+
+
+def get_pack_store() -> PackStore | None:
+    """Dependency function to inject the pack files of small objects (None: every object is a loose file)"""
+    return CACHE_MANAGER.packs
+
+
+def get_package_bodies() -> PackageBodyCache:
+    """Dependency function to inject the precomputed package json response bodies"""
+    return PACKAGE_BODIES
+
+
+def get_build_tracer() -> BuildTracer:
+    """Dependency function to inject the build tracer (timelines of the last builds)"""
+    return BUILD_TRACER
+
+
+def get_profiler() -> SamplingProfiler:
+    """Dependency function to inject the sampling profiler of this worker (POST /admin/profile)"""
+    return PROFILER
+
+
+def get_index_mirror() -> IndexMirror:
+    """Dependency function to inject the mirror of the upstream mip index (micropython-lib)"""
+    return INDEX_MIRROR
+
+
+def get_peer_cache() -> PeerCache:
+    """Dependency function to inject the cache fill from sibling replicas"""
+    return PEER_CACHE
+
+
+def get_shared_revisions() -> SharedRevisions | None:
+    """Dependency function to inject the upstream commits seen by all pods (None without redis)"""
+    return SHARED_REVISIONS
+
+
+def get_build_notifier() -> BuildNotifier:
+    """Dependency function to inject the mqtt publisher of changed builds"""
+    return BUILD_NOTIFIER
+
+
+def get_invalidation_bus() -> InvalidationBus:
+    """Dependency function to inject the bus sharing cache invalidations between worker processes"""
+    return INVALIDATION_BUS
+
+
+def require_admin(authorization: Annotated[Optional[str], Header()] = None) -> None:
+    """Dependency guarding the /admin endpoints -> "Authorization: Bearer <ADMIN.TOKEN>" """
+    token: str | None = settings.admin.TOKEN
+    if not token:
+        raise HTTPException(status_code=403, detail="admin api disabled (no ADMIN.TOKEN configured)")
+
+    scheme, _, presented = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not secrets.compare_digest(presented.encode(), token.encode()):
+        raise HTTPException(status_code=401, detail="invalid admin token", headers={"WWW-Authenticate": "Bearer"})
@@ -0,0 +1,191 @@
+import hashlib
+import math
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Generator, Optional
+
+from loguru import logger
+
+from mipserver.config import AdmissionControl, PackageNameGithubRepo
+from mipserver.internal.metrics import BUILD_BACKPRESSURE, BUILD_SLOT_WAIT, BUILDS_IN_FLIGHT, BUILDS_WAITING
+from mipserver.internal.tracing import span
+
+
+class AdmissionDenied(Exception):
+    """Raised when a (cold) build request is not admitted -> carries the http status to answer with"""
+
+    def __init__(self, reason: str, status_code: int, retry_after: Optional[int] = None):
+        super().__init__(reason)
+        self.reason = reason
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """Guards the expensive part (clone/fetch + compile) of package-json generation.
+
+    - global cap on concurrently running builds
+    - per-client-ip budget of cold builds within a sliding window
+    - allow-list/regex of buildable branches per package
+    - backpressure: once too many requests wait for the same build or the builds ahead would take too long,
+      503 + Retry-After (measured build time + a per-client share of jitter) instead of holding the request open
+
+    refs that do not exist upstream are handled by the NegativeResultCache
+    """
+
+    EWMA_WEIGHT: float = 0.3  # of the newest build duration
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, cfg: AdmissionControl):
+        self.cfg = cfg
+        # builds run in worker threads -> a threading semaphore is independent of the (test-)event-loop
+        self._build_slots: threading.BoundedSemaphore = threading.BoundedSemaphore(cfg.max_concurrent_builds)
+        self._lock: threading.Lock = threading.Lock()
+        self._client_builds: Dict[str, Deque[float]] = {}
+        self._waiting: int = 0  # builds waiting for a slot
+        self._pending: Dict[str, int] = {}  # package -> requests waiting for (or running) its build
+        self._pending_since: Dict[str, float] = {}
+        self._build_seconds: Dict[str, float] = {}  # package -> ewma of measured build durations
+        self._build_seconds_all: float | None = None
+
+    @staticmethod
+    def is_branch_allowed(pkgcfg: PackageNameGithubRepo, branch: str) -> bool:
+        if branch == "latest":
+            return True
+
+        if pkgcfg.allowed_branches is None and pkgcfg.branch_pattern is None:
+            return True
+
+        if pkgcfg.allowed_branches is not None and branch in pkgcfg.allowed_branches:
+            return True
+
+        if pkgcfg.branch_pattern is not None and re.fullmatch(pkgcfg.branch_pattern, branch):
+            return True
+
+        return False
+
+    def check_branch(self, pkgcfg: PackageNameGithubRepo, branch: str) -> None:
+        if not self.is_branch_allowed(pkgcfg, branch):
+            raise AdmissionDenied(f"branch {branch!r} is not buildable for package {pkgcfg.packagename!r}", 403)
+
+    def consume_client_budget(self, client_ip: str) -> None:
+        """Books one cold build for client_ip or raises AdmissionDenied (429) if its budget is exhausted"""
+        with self._lock:
+            self._consume_client_budget(client_ip)
+
+    def _consume_client_budget(self, client_ip: str) -> None:
+        now: float = time.monotonic()
+        window: int = self.cfg.client_budget_window_seconds
+
+        # drop stale clients so that the dict does not grow with every ip ever seen
+        for ip in [ip for ip, dq in self._client_builds.items() if not dq or dq[-1] <= now - window]:
+            del self._client_builds[ip]
+
+        dq: Deque[float] = self._client_builds.setdefault(client_ip, deque())
+        while dq and dq[0] <= now - window:
+            dq.popleft()
+
+        if len(dq) >= self.cfg.client_budget:
+            retry_after: int = int(dq[0] + window - now) + 1
+            self.logger.warning(f"build budget exhausted for {client_ip=} ({len(dq)} builds in {window}s)")
+            raise AdmissionDenied(f"build budget exhausted for {client_ip}", 429, retry_after)
+
+        dq.append(now)
+
+    # ---- backpressure
+
+    def observe_build(self, package_name: str, seconds: float) -> None:
+        """Duration of a build that actually ran (fetch + compile) -> basis of the wait estimates"""
+        w: float = self.EWMA_WEIGHT
+        with self._lock:
+            previous: float | None = self._build_seconds.get(package_name)
+            self._build_seconds[package_name] = seconds if previous is None else w * seconds + (1 - w) * previous
+            everything: float | None = self._build_seconds_all
+            self._build_seconds_all = seconds if everything is None else w * seconds + (1 - w) * everything
+
+    def expected_build_seconds(self, package_name: str) -> float:
+        with self._lock:
+            return self._build_seconds.get(package_name) or self._build_seconds_all or self.cfg.default_build_seconds
+
+    def estimated_wait(self, waiting: int | None = None, slots: int | None = None) -> float:
+        """Until a build queued now would get a slot: the builds ahead of it, slots (default: max_concurrent_builds)
+        at a time"""
+        with self._lock:
+            ahead: int = self._waiting if waiting is None else waiting
+            average: float = self._build_seconds_all or self.cfg.default_build_seconds
+        return math.ceil(ahead / (slots or self.cfg.max_concurrent_builds)) * average
+
+    def retry_after(self, package_name: str, client_ip: str, wait: float = 0.0) -> int:
+        """Seconds until the build is probably done, plus jitter that is fixed per client (and package) -> clients
+        that were turned away together come back spread over the jitter window instead of all at once"""
+        expected: float = self.expected_build_seconds(package_name)
+        with self._lock:
+            since: float | None = self._pending_since.get(package_name)
+        remaining: float = max(1.0, expected - (time.monotonic() - since)) if since is not None else expected
+        digest: bytes = hashlib.blake2b(f"{client_ip}\0{package_name}".encode(), digest_size=8).digest()
+        share: float = int.from_bytes(digest, "big") / 2**64
+        seconds: float = wait + remaining + share * self.cfg.retry_jitter_ratio * expected
+        return max(1, min(self.cfg.max_retry_after_seconds, math.ceil(seconds)))
+
+    def check_backpressure(
+        self, package_name: str, client_ip: str, waiting: int | None = None, slots: int | None = None
+    ) -> None:
+        """AdmissionDenied (503 + Retry-After) if this request would only pile up; waiting: builds queued ahead
+        (default: the ones waiting for a slot in this process), slots: builds that run at a time for them"""
+        with self._lock:
+            pending: int = self._pending.get(package_name, 0)
+        limit: int = self.cfg.max_pending_per_package
+        if limit and pending >= limit:
+            BUILD_BACKPRESSURE.labels(reason="package").inc()
+            raise AdmissionDenied(
+                f"{pending} requests already wait for the build of {package_name}",
+                503,
+                self.retry_after(package_name, client_ip),
+            )
+        wait: float = self.estimated_wait(waiting, slots)
+        if self.cfg.max_wait_seconds and wait > self.cfg.max_wait_seconds:
+            BUILD_BACKPRESSURE.labels(reason="queue").inc()
+            raise AdmissionDenied(
+                f"build queue saturated (about {wait:.0f}s until a build slot is free)",
+                503,
+                self.retry_after(package_name, client_ip, wait),
+            )
+
+    @contextmanager
+    def pending_build(self, package_name: str) -> Generator[None, None, None]:
+        """Counts the request as waiting for the build of package_name until it got its answer"""
+        with self._lock:
+            if not self._pending.get(package_name):
+                self._pending_since[package_name] = time.monotonic()
+            self._pending[package_name] = self._pending.get(package_name, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._pending[package_name] -= 1
+                if not self._pending[package_name]:
+                    del self._pending[package_name]
+                    del self._pending_since[package_name]
+
+    @contextmanager
+    def build_slot(self) -> Generator[None, None, None]:
+        """Limits the number of concurrently running clones/compiles (blocks the calling worker thread)"""
+        waiting_since: float = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+        try:
+            with BUILDS_WAITING.track_inprogress(), span("build_slot.wait"):
+                self._build_slots.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        BUILD_SLOT_WAIT.observe(time.perf_counter() - waiting_since)
+        try:
+            with BUILDS_IN_FLIGHT.track_inprogress():
+                yield
+        finally:
+            self._build_slots.release()
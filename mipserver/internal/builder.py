@@ -0,0 +1,393 @@
+import asyncio
+import os
+import socket
+import threading
+import time
+from contextlib import ExitStack, contextmanager, nullcontext
+from pathlib import Path
+from typing import Callable, ContextManager, Generator, List, Optional, Tuple
+
+from loguru import logger
+
+from mipserver.config import Builder as BuilderConfig
+from mipserver.config import PackageNameGithubRepo
+from mipserver.datastructures.datatypes import MPYPath
+from mipserver.Helper import MIPServerHelper, PackageBuildError, RefNotFoundError
+from mipserver.internal.admission import AdmissionDenied
+from mipserver.internal.cachemanager import CacheManager
+from mipserver.internal.coordination import EVENT_NEW_REVISION, InvalidationBus
+from mipserver.internal.locks import LockTimeout
+from mipserver.internal.metadata import BuildJob, BuildRecord, MetadataStore, build_record_from_package_json
+from mipserver.internal.notify import BuildNotifier
+from mipserver.internal.peers import PeerCache
+from mipserver.internal.redisstate import SharedRevision, SharedRevisions
+from mipserver.internal.registry import PackageRegistry
+from mipserver.internal.sources import PreparedSource, SourceBackend, source_for
+from mipserver.internal.tracing import BuildTracer, span
+
+# (package json, commit) of a build; (None, None) if the source could not be fetched
+BuildOutput = Tuple[Optional[Path], Optional[str]]
+
+
+@contextmanager
+def checkout_lock(cache_manager: CacheManager, checkout_dirname: str, timeout: int) -> Generator[None, None, None]:
+    """Serializes updates/builds of one checkout across threads and worker processes"""
+    with ExitStack() as stack:
+        try:
+            with span("build_lock.wait"):
+                stack.enter_context(cache_manager.locks.lock(CacheManager.build_lock_name(checkout_dirname), timeout))
+        except LockTimeout as e:
+            raise AdmissionDenied(f"build of {checkout_dirname} still running", 503, retry_after=30) from e
+        yield
+
+
+class PackageBuild:
+    """One check (and build if upstream moved on) of package@pversion for one target
+
+    Runs in an http worker (builder mode "inline") or in a builder process (mode "queue"). result tells what
+    happened: built, unchanged, peer, git_failed, missing_ref, failed or denied.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(
+        self,
+        source: SourceBackend,
+        local_json: Path,
+        package_name: str,
+        mpy_version: MPYPath,
+        pversion: str,
+        build: BuildRecord | None,  # what is in the index right now
+        cache_manager: CacheManager,
+        metadata: MetadataStore,
+        tracer: BuildTracer,
+        peer_cache: PeerCache | None,  # None -> do not ask peers
+        shared_revisions: SharedRevisions | None,
+        lock_timeout: int,
+        freshness_seconds: int,
+        slot: Callable[[], ContextManager[None]] = nullcontext,
+    ):
+        self.source = source
+        self.local_json = local_json
+        self.package_name = package_name
+        self.mpy_version = mpy_version
+        self.pversion = pversion
+        self.build = build
+        self.cache_manager = cache_manager
+        self.metadata = metadata
+        self.tracer = tracer
+        self.peer_cache = peer_cache
+        self.shared_revisions = shared_revisions
+        self.lock_timeout = lock_timeout
+        self.freshness_seconds = freshness_seconds
+        self.slot = slot
+        self.requested_at: float = time.time()
+        self.result: str = "git_failed"
+        self.build_seconds: float | None = None  # fetch + compile, without waiting for slot and lock (if built)
+
+    def _fill_from_peers(self, shared: SharedRevision | None) -> BuildOutput:
+        assert self.peer_cache is not None
+        package_name, pversion, build = self.package_name, self.pversion, self.build
+        with span("peer.fill"):
+            upstream_commit: str | None = (
+                shared.commit if shared else self.source.remote_revision(pversion, self.mpy_version)
+            )
+            if upstream_commit is None:
+                return None, None
+            if shared is None and self.shared_revisions is not None:
+                self.shared_revisions.put(package_name, pversion, upstream_commit)
+
+            if (
+                build is not None
+                and build.commit == upstream_commit
+                and self.metadata.absolute_json_path(build).is_file()
+            ):
+                self.metadata.mark_checked(package_name, self.mpy_version.value, pversion)
+                self.result = "unchanged"
+                return self.metadata.absolute_json_path(build), upstream_commit
+
+            args = (package_name, self.mpy_version.value, pversion)
+            record: BuildRecord | None = self.peer_cache.fetch_package_json(*args, upstream_commit, self.local_json)
+            owner: str | None = self.peer_cache.owned_by_peer(package_name)
+            if record is None and owner is not None and self.peer_cache.request_build(owner, *args):
+                record = self.peer_cache.fetch_package_json(*args, upstream_commit, self.local_json)
+            if record is None:
+                return None, None
+            self.result = "peer"
+            return self.metadata.absolute_json_path(record), record.commit
+
+    def _run(self) -> BuildOutput:
+        package_name, pversion, build, metadata = self.package_name, self.pversion, self.build, self.metadata
+        mpy_version: MPYPath = self.mpy_version
+        with self.slot(), checkout_lock(self.cache_manager, self.source.workdir(pversion).name, self.lock_timeout):
+            started: float = time.perf_counter()
+            # another worker (or thread) may have checked/built it while this one waited for the lock
+            fresh: BuildRecord | None = metadata.get_build(package_name, mpy_version.value, pversion)
+            if (
+                fresh is not None
+                and fresh.checked_at >= self.requested_at
+                and metadata.absolute_json_path(fresh).is_file()
+            ):
+                self.logger.debug(f"{package_name}@{pversion} was just checked by another worker -> {fresh.json_path}")
+                self.result = "unchanged"
+                return metadata.absolute_json_path(fresh), fresh.commit
+
+            # another pod checked upstream moments ago -> its commit instead of an own fetch/ls-remote
+            shared: SharedRevision | None = None
+            if self.shared_revisions is not None:
+                shared = self.shared_revisions.get(package_name, pversion, self.freshness_seconds)
+            if shared is not None and build is not None and build.commit == shared.commit:
+                if metadata.absolute_json_path(build).is_file():
+                    self.logger.debug(f"{package_name}@{pversion} at {shared.commit} according to another pod -> kept")
+                    metadata.mark_checked(package_name, mpy_version.value, pversion)
+                    self.result = "unchanged"
+                    return metadata.absolute_json_path(build), build.commit
+
+            if self.peer_cache is not None:
+                peer_json, peer_commit = self._fill_from_peers(shared)
+                if peer_json is not None:
+                    return peer_json, peer_commit
+
+            self.logger.debug(f"Have to check for updates on {self.source.pkgcfg.source.kind.value} source...")
+            prepared: PreparedSource | None = self.source.prepare(pversion, mpy_version)
+
+            if not prepared:
+                return None, None
+
+            self.cache_manager.touch(prepared.path)
+
+            commit: str | None = prepared.revision
+            if commit is not None and self.shared_revisions is not None:
+                self.shared_revisions.put(package_name, pversion, commit)
+
+            if build is not None and commit is not None and build.commit == commit:
+                existing_json: Path = metadata.absolute_json_path(build)
+                if existing_json.is_file():
+                    self.logger.debug(f"upstream unchanged at {commit=} -> keeping {existing_json}")
+                    metadata.mark_checked(package_name, mpy_version.value, pversion)
+                    self.result = "unchanged"
+                    return existing_json, commit
+
+            self.logger.debug(f"Trying to generate package_json from {prepared.path}...")
+            try:
+                generated: Path = self.source.build(prepared, self.local_json, mpy_version)
+                with span("metadata.record_build"):
+                    metadata.record_build(
+                        build_record_from_package_json(
+                            metadata,
+                            self.cache_manager.object_store,
+                            generated,
+                            package_name,
+                            mpy_version.value,
+                            pversion,
+                            commit,
+                        )
+                    )
+                self.result = "built"
+                self.build_seconds = time.perf_counter() - started
+                return generated, commit
+            except Exception as e:
+                self.logger.opt(exception=e).error(f"generating package json for {package_name}@{pversion} failed")
+                raise PackageBuildError(str(e) or type(e).__name__, commit=commit) from e
+
+    def run(self) -> BuildOutput:
+        """Blocking (git, mpy-cross) -> call it in a thread"""
+        with self.tracer.trace_build(self.package_name, self.mpy_version.value, self.pversion) as root:
+            try:
+                return self._run()
+            except RefNotFoundError:
+                self.result = "missing_ref"
+                raise
+            except PackageBuildError:
+                self.result = "failed"
+                raise
+            except AdmissionDenied:
+                self.result = "denied"
+                raise
+            finally:
+                if root is not None:
+                    root.attributes["result"] = self.result
+
+
+async def wait_for_build_job(metadata: MetadataStore, job: BuildJob, timeout: float, poll_interval: float) -> BuildJob:
+    """Polls the job until a builder finished it or timeout is over -> the last state seen"""
+    deadline: float = time.monotonic() + timeout
+    while job.state != "done" and time.monotonic() < deadline:
+        await asyncio.sleep(min(poll_interval, max(0.0, deadline - time.monotonic())))
+        job = metadata.get_build_job(job.id) or job
+    return job
+
+
+def job_output(job: BuildJob, metadata: MetadataStore, retry_after: int) -> BuildOutput:
+    """What PackageBuild.run() would have returned/raised in this process"""
+    if job.state != "done":
+        raise AdmissionDenied(f"build of {job.package_name}@{job.pversion} queued", 503, retry_after=retry_after)
+    if job.result == "missing_ref":
+        raise RefNotFoundError(repo_name=job.package_name, branch=job.pversion)
+    if job.result == "failed":
+        raise PackageBuildError(job.error or "build failed", commit=job.commit)
+    if job.result in ("denied", "lost"):
+        raise AdmissionDenied(job.error or f"build of {job.package_name} not finished", 503, retry_after=retry_after)
+    current: BuildRecord | None = metadata.get_build(job.package_name, job.mpy_version, job.pversion)
+    if job.result == "git_failed" or current is None:
+        return None, None
+    return metadata.absolute_json_path(current), current.commit
+
+
+class BuildWorker:
+    """Runs the queued build jobs (python builder.py) -> builds never share a process with the api
+
+    Each job is one PackageBuild; its result (package json, objects, index entry) is published into the cache
+    root exactly as an inline build would, the http workers only see it once it is complete.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(
+        self,
+        cfg: BuilderConfig,
+        server_cache_root: Path,
+        registry: PackageRegistry,
+        cache_manager: CacheManager,
+        metadata: MetadataStore,
+        tracer: BuildTracer,
+        bus: InvalidationBus,
+        notifier: BuildNotifier,
+        shared_revisions: SharedRevisions | None,
+        lock_timeout: int,
+        freshness_seconds: int,
+        peer_cache: PeerCache | None = None,
+    ):
+        self.cfg = cfg
+        self.server_cache_root = server_cache_root
+        self.registry = registry
+        self.cache_manager = cache_manager
+        self.metadata = metadata
+        self.tracer = tracer
+        self.bus = bus
+        self.notifier = notifier
+        self.shared_revisions = shared_revisions
+        self.lock_timeout = lock_timeout
+        self.freshness_seconds = freshness_seconds
+        self.peer_cache = peer_cache
+        self.worker_id: str = f"{socket.gethostname()}:{os.getpid()}"
+
+    def run_job(self, job: BuildJob) -> None:
+        package_name, pversion = job.package_name, job.pversion
+        mpy_version: MPYPath = MPYPath(job.mpy_version)
+        pkgcfg: PackageNameGithubRepo | None = self.registry.configs.get(package_name)
+        if pkgcfg is None:
+            self.metadata.finish_build_job(
+                job.id, self.worker_id, "missing_ref", None, f"unknown package {package_name!r}"
+            )
+            return
+
+        msh: MIPServerHelper = MIPServerHelper(
+            server_cache_root=self.server_cache_root,
+            package_name_to_repo=self.registry.name_to_repo,
+            object_store=self.cache_manager.object_store,
+        )
+        previous: BuildRecord | None = self.metadata.get_build(
+            package_name, mpy_version.value, pversion, with_files=self.notifier.enabled
+        )
+        build = PackageBuild(
+            source_for(pkgcfg, msh),
+            msh.get_local_path_for_package_json_by_package_and_version(
+                mpy_version=mpy_version, package_name=package_name, pversion=pversion
+            ),
+            package_name,
+            mpy_version,
+            pversion,
+            previous,
+            self.cache_manager,
+            self.metadata,
+            self.tracer,
+            self.peer_cache,
+            self.shared_revisions,
+            self.lock_timeout,
+            self.freshness_seconds,
+        )
+        commit: str | None = None
+        error: str | None = None
+        try:
+            with self._lease(job):
+                _, commit = build.run()
+        except PackageBuildError as e:
+            commit, error = e.commit, str(e)
+        except (RefNotFoundError, AdmissionDenied) as e:
+            error = str(e)
+        except Exception as e:
+            self.logger.opt(exception=e).error(f"build job {job.id} ({package_name}@{pversion}) failed")
+            build.result, error = "failed", str(e) or type(e).__name__
+        if not self.metadata.finish_build_job(job.id, self.worker_id, build.result, commit, error):
+            self.logger.warning(f"job {job.id}: lease lost during the build -> left to the builder holding it")
+            return
+        self.logger.info(f"job {job.id}: {package_name}@{pversion} ({mpy_version.value}) -> {build.result}")
+
+        if build.result == "built" and commit is not None:
+            self.bus.publish(EVENT_NEW_REVISION, package_name=package_name, pversion=pversion, commit=commit)
+            if self.notifier.enabled:
+                current: BuildRecord | None = self.metadata.get_build(package_name, mpy_version.value, pversion, True)
+                if current is not None:
+                    self.notifier.build_changed(current, previous)
+
+    @contextmanager
+    def _lease(self, job: BuildJob) -> Generator[None, None, None]:
+        """Renews the lease of job while the build runs -> a long cold build is not handed to a second builder"""
+        done: threading.Event = threading.Event()
+
+        def heartbeat() -> None:
+            while not done.wait(self.cfg.lease_seconds / 3):
+                try:
+                    if not self.metadata.renew_build_job(job.id, self.worker_id, self.cfg.lease_seconds):
+                        self.logger.warning(f"job {job.id}: lease was lost (expired while building)")
+                        return
+                except Exception as e:
+                    self.logger.warning(f"job {job.id}: renewing the lease failed: {e}")
+
+        renewer: threading.Thread = threading.Thread(target=heartbeat, name=f"lease-{job.id}", daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            done.set()
+            renewer.join()
+
+    def run_once(self) -> bool:
+        """Claims and runs one job -> False if the queue was empty"""
+        job: BuildJob | None = self.metadata.claim_build_job(
+            self.worker_id, self.cfg.lease_seconds, self.cfg.max_attempts
+        )
+        if job is None:
+            return False
+        self.run_job(job)
+        return True
+
+    def _work(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            try:
+                if self.run_once():
+                    continue
+            except Exception as e:
+                self.logger.opt(exception=e).error("claiming a build job failed")
+            stop.wait(self.cfg.poll_interval_seconds)
+
+    def serve(self, stop: threading.Event, housekeeping_interval: float = 5.0) -> None:
+        """cfg.concurrency build threads; this thread keeps registry, invalidations and the queue tidy"""
+        threads: List[threading.Thread] = [
+            threading.Thread(target=self._work, args=(stop,), name=f"builder-{i}", daemon=True)
+            for i in range(self.cfg.concurrency)
+        ]
+        for t in threads:
+            t.start()
+        self.logger.info(f"builder {self.worker_id} running {self.cfg.concurrency} builds at a time")
+        while not stop.wait(housekeeping_interval):
+            try:
+                self.registry.reload_if_changed()
+                self.bus.poll()
+                self.metadata.flush()
+                self.metadata.prune_build_jobs(older_than=time.time() - self.cfg.job_retention_seconds)
+            except Exception as e:
+                self.logger.opt(exception=e).error("builder housekeeping failed")
+        for t in threads:
+            t.join()
@@ -0,0 +1,324 @@
+import os
+import shutil
+import threading
+import time
+from enum import StrEnum
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from mipserver.config import CacheManagement
+from mipserver.datastructures.datatypes import MPYPath
+from mipserver.Helper import MIPServerHelper
+from mipserver.internal.locks import LockManager, LockTimeout
+from mipserver.internal.metadata import BuildRecord, MetadataStore
+from mipserver.internal.objectstore import LooseObjectStore
+from mipserver.internal.packstore import PackReport, PackStore
+
+
+class CacheArea(StrEnum):
+    git = "git"  # checkouts of the upstream repositories
+    build = "build"  # compiled .mpy left in the checkouts
+    objects = "objects"  # content addressed files/<h2>/<hash>
+    json = "json"  # <mpy>/<pkg>/<version>.json
+    other = "other"
+
+
+class AreaUsage(BaseModel):
+    bytes: int = 0
+    files: int = 0
+
+
+class GCReport(BaseModel):
+    duration_seconds: float = 0.0
+    usage_before: Dict[CacheArea, AreaUsage] = Field(default_factory=dict)
+    usage_after: Dict[CacheArea, AreaUsage] = Field(default_factory=dict)
+    removed_build_outputs: int = 0
+    removed_checkouts: int = 0
+    removed_json: int = 0
+    removed_objects: int = 0
+    freed_bytes: int = 0
+
+
+class _CheckoutEntry(BaseModel):
+    path: Path
+    last_access: float
+    git_bytes: int
+    build_bytes: int
+
+
+class CacheManager:
+    """Size accounting, quotas and garbage collection for SERVER_CACHE_ROOT.
+
+    GC order (cheapest to regenerate first):
+    1. strip compiled outputs from least recently used checkouts (build quota)
+    2. evict least recently used checkouts (git/total quota)
+    3. evict least recently used package jsons (json quota)
+    4. sweep objects no build references any more (refcounts in the metadata index); if still over the
+       objects/total quota, evict more package jsons (lru) together with the objects only they referenced
+
+    Pinned builds ("package@version") and everything younger than grace_period_seconds is never collected.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    OBJECTS_DIR: str = "files"
+    PACKS_DIR: str = "packs"
+    BUILD_OUTPUT_SUFFIX: str = ".mpy"
+
+    def __init__(
+        self, cache_root: Path, cfg: CacheManagement, package_name_to_repo: Dict[str, str], metadata: MetadataStore
+    ):
+        self.cache_root = cache_root
+        self.cfg = cfg
+        self.package_name_to_repo = package_name_to_repo
+        self.metadata = metadata
+        self.locks: LockManager = LockManager(cache_root)
+
+        self.packs: PackStore | None = (
+            PackStore(Path(cache_root, self.PACKS_DIR), cfg.packs, self.locks) if cfg.packs.enabled else None
+        )
+        self.object_store: LooseObjectStore = LooseObjectStore(Path(cache_root, self.OBJECTS_DIR), self.packs)
+        self.object_store.on_reuse = self._reuse_object
+
+        self._last_access: Dict[str, float] = {}
+        self._gc_lock: threading.Lock = threading.Lock()
+
+    def _reuse_object(self, obj_hash: str) -> None:
+        self.metadata.reuse_object(obj_hash)
+
+    def touch(self, path: Path) -> None:
+        """Records an access of a checkout (lru bookkeeping) -> independent of noatime mounts
+
+        the mtime is bumped as well so the gc of other workers sees the access (once per build, not per request);
+        accesses of package jsons and objects are recorded in the metadata store
+        """
+        self._last_access[str(path)] = time.time()
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def last_access(self, path: Path, st: os.stat_result) -> float:
+        return max(self._last_access.get(str(path), 0.0), st.st_mtime)
+
+    def _forget(self, path: Path) -> None:
+        self._last_access.pop(str(path), None)
+
+    # ---- layout
+
+    @staticmethod
+    def _is_checkout_dir(name: str) -> bool:
+        return "@" in name
+
+    @staticmethod
+    def _is_json_dir(name: str) -> bool:
+        return name in {m.value for m in MPYPath}
+
+    def is_pinned(self, package_name: str, version: str) -> bool:
+        return f"{package_name}@{version}" in self.cfg.pinned
+
+    def pinned_checkouts(self) -> Set[str]:
+        ret: Set[str] = set()
+        for pin in self.cfg.pinned:
+            package_name, _, version = pin.partition("@")
+            repo_name: str | None = self.package_name_to_repo.get(package_name)
+            if repo_name:
+                ret.add(MIPServerHelper.get_checkout_dirname(repo_name, version or "latest"))
+        return ret
+
+    @staticmethod
+    def _walk_files(root: str) -> Iterator[Tuple[str, os.stat_result]]:
+        stack: List[str] = [root]
+        while stack:
+            current: str = stack.pop()
+            try:
+                with os.scandir(current) as it:
+                    for e in it:
+                        if e.is_dir(follow_symlinks=False):
+                            stack.append(e.path)
+                        elif e.is_file(follow_symlinks=False):
+                            yield e.path, e.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+
+    def _scan_checkouts(self) -> List[_CheckoutEntry]:
+        ret: List[_CheckoutEntry] = []
+        if not self.cache_root.is_dir():
+            return ret
+
+        for e in list(os.scandir(self.cache_root)):
+            if not (e.is_dir(follow_symlinks=False) and self._is_checkout_dir(e.name)):
+                continue
+
+            git_bytes: int = 0
+            build_bytes: int = 0
+            for fpath, st in self._walk_files(e.path):
+                if fpath.endswith(self.BUILD_OUTPUT_SUFFIX):
+                    build_bytes += st.st_size
+                else:
+                    git_bytes += st.st_size
+
+            p: Path = Path(e.path)
+            ret.append(
+                _CheckoutEntry(
+                    path=p, last_access=self.last_access(p, e.stat()), git_bytes=git_bytes, build_bytes=build_bytes
+                )
+            )
+        return ret
+
+    def usage(self) -> Dict[CacheArea, AreaUsage]:
+        """Objects and package jsons are taken from the metadata index, only checkouts & co. are walked"""
+        ret: Dict[CacheArea, AreaUsage] = {a: AreaUsage() for a in CacheArea}
+
+        ret[CacheArea.objects].files, ret[CacheArea.objects].bytes = self.metadata.object_totals()
+        ret[CacheArea.json].files, ret[CacheArea.json].bytes = self.metadata.json_totals()
+
+        if not self.cache_root.is_dir():
+            return ret
+
+        for e in list(os.scandir(self.cache_root)):
+            if e.is_file(follow_symlinks=False):
+                ret[CacheArea.other].bytes += e.stat(follow_symlinks=False).st_size
+                ret[CacheArea.other].files += 1
+                continue
+
+            if e.name in (self.OBJECTS_DIR, self.PACKS_DIR) or self._is_json_dir(e.name):
+                continue
+
+            area: CacheArea = CacheArea.git if self._is_checkout_dir(e.name) else CacheArea.other
+            for fpath, st in self._walk_files(e.path):
+                a: CacheArea = area
+                if area == CacheArea.git and fpath.endswith(self.BUILD_OUTPUT_SUFFIX):
+                    a = CacheArea.build
+                ret[a].bytes += st.st_size
+                ret[a].files += 1
+
+        return ret
+
+    @staticmethod
+    def total_bytes(usage: Dict[CacheArea, AreaUsage]) -> int:
+        return sum(u.bytes for u in usage.values())
+
+    # ---- gc
+
+    @staticmethod
+    def build_lock_name(checkout_dirname: str) -> str:
+        """Lock held while a checkout is updated/built -> the gc never evicts it underneath a build"""
+        return f"build-{checkout_dirname}"
+
+    def collect_garbage(self, lock_timeout: Optional[float] = None) -> GCReport:
+        """lock_timeout=0 -> LockTimeout right away if another worker is collecting"""
+        with self._gc_lock, self.locks.lock("gc", timeout=lock_timeout):
+            return self._collect_garbage()
+
+    def maintain_packs(self, lock_timeout: Optional[float] = None) -> PackReport:
+        """Moves small loose objects into packs and compacts them -> excluded with the gc, which deletes objects"""
+        assert self.packs is not None
+        with self._gc_lock, self.locks.lock("gc", timeout=lock_timeout):
+            loose: Iterator[Tuple[str, Path, int]] = (
+                (h, self.object_store.path_for(h), st.st_size) for h, st in self.object_store.iter_loose()
+            )
+            return self.packs.maintain(loose, timeout=lock_timeout)
+
+    def _collect_garbage(self) -> GCReport:
+        started: float = time.monotonic()
+        now: float = time.time()
+        grace_border: float = now - self.cfg.grace_period_seconds
+        quotas = self.cfg.quotas
+
+        usage: Dict[CacheArea, AreaUsage] = self.usage()
+        report: GCReport = GCReport(usage_before={a: u.model_copy() for a, u in usage.items()})
+
+        def over(area: CacheArea, quota: Optional[int]) -> bool:
+            return quota is not None and usage[area].bytes > quota
+
+        def over_total() -> bool:
+            return quotas.total_max_bytes is not None and self.total_bytes(usage) > quotas.total_max_bytes
+
+        def account(area: CacheArea, freed: int, files: int = 1) -> None:
+            usage[area].bytes -= freed
+            usage[area].files -= files
+            report.freed_bytes += freed
+
+        # 1. + 2. checkouts (regenerable via git + compile)
+        pinned_checkouts: Set[str] = self.pinned_checkouts()
+        checkouts: List[_CheckoutEntry] = sorted(
+            [c for c in self._scan_checkouts() if c.path.name not in pinned_checkouts and c.last_access < grace_border],
+            key=lambda c: c.last_access,
+        )
+
+        for c in checkouts:
+            if not over(CacheArea.build, quotas.build_max_bytes):
+                break
+            removed: int = 0
+            for fpath, st in self._walk_files(str(c.path)):
+                if fpath.endswith(self.BUILD_OUTPUT_SUFFIX):
+                    Path(fpath).unlink(missing_ok=True)
+                    account(CacheArea.build, st.st_size)
+                    removed += 1
+            c.build_bytes = 0
+            report.removed_build_outputs += removed
+
+        for c in checkouts:
+            if not (over(CacheArea.git, quotas.git_max_bytes) or over_total()):
+                break
+            try:
+                with self.locks.lock(self.build_lock_name(c.path.name), timeout=0):
+                    self.logger.info(f"evicting checkout {c.path.name} (last access {time.ctime(c.last_access)})")
+                    shutil.rmtree(c.path, ignore_errors=True)
+            except LockTimeout:
+                self.logger.debug(f"not evicting {c.path.name} -> build in progress")
+                continue
+            self._forget(c.path)
+            account(CacheArea.git, c.git_bytes, 0)
+            account(CacheArea.build, c.build_bytes, 0)
+            report.removed_checkouts += 1
+
+        # 3. + 4. package jsons and the objects they reference (indexed -> no directory walks)
+        evictable: List[BuildRecord] = [
+            b
+            for b in self.metadata.list_builds()
+            if not self.is_pinned(b.package_name, b.pversion) and b.last_access < grace_border
+        ]
+
+        def delete_object(obj_hash: str, older_than: float) -> None:
+            # only if no build started to use it meanwhile (refcount or reuse since older_than)
+            freed: int | None = self.metadata.delete_object(obj_hash, older_than, self.object_store.delete)
+            if freed is None:
+                self.logger.debug(f"object {obj_hash} is in use again -> kept")
+                return
+            account(CacheArea.objects, freed)
+            report.removed_objects += 1
+
+        def evict_build(b: BuildRecord, collect_objects: bool) -> None:
+            self.logger.info(f"evicting package json {b.mpy_version}/{b.package_name}/{b.pversion}.json")
+            self.metadata.absolute_json_path(b).unlink(missing_ok=True)
+            unreferenced: List[str] = self.metadata.delete_build(b.package_name, b.mpy_version, b.pversion)
+            account(CacheArea.json, b.json_size)
+            report.removed_json += 1
+            if collect_objects:
+                for h in unreferenced:
+                    delete_object(h, grace_border)
+
+        while evictable and over(CacheArea.json, quotas.json_max_bytes):
+            evict_build(evictable.pop(0), collect_objects=False)
+
+        # sweep
+        for o in self.metadata.unreferenced_objects(older_than=grace_border):
+            delete_object(o.hash, grace_border)
+
+        while evictable and (over(CacheArea.objects, quotas.objects_max_bytes) or over_total()):
+            evict_build(evictable.pop(0), collect_objects=True)
+
+        report.usage_after = usage
+        report.duration_seconds = time.monotonic() - started
+        self.logger.info(
+            f"gc done in {report.duration_seconds:.2f}s: freed {report.freed_bytes} bytes "
+            f"({report.removed_checkouts} checkouts, {report.removed_build_outputs} build outputs, "
+            f"{report.removed_json} jsons, {report.removed_objects} objects)"
+        )
+
+        return report
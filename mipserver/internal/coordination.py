@@ -0,0 +1,68 @@
+import os
+import socket
+import time
+import uuid
+from typing import Any, Callable, Dict, List
+
+from loguru import logger
+
+from mipserver.internal.metadata import MetadataStore
+
+EventHandler = Callable[[Dict[str, Any]], object]  # return value is ignored
+
+# upstream of package@pversion moved on (payload: package_name, pversion, commit)
+EVENT_NEW_REVISION: str = "new_revision"
+# the index mirror finished a sync -> reload the list of mirrored packages
+EVENT_MIRROR_SYNCED: str = "mirror_synced"
+# PACKAGENAME_TO_GITHUB_REPO changed (admin reload or config file) -> reload the package registry
+EVENT_REGISTRY_CHANGED: str = "registry_changed"
+
+
+class InvalidationBus:
+    """Shares invalidations of process-local caches between workers (and hosts) using the same metadata index
+
+    publish() appends an event to the index, poll() applies the events of the other processes since the last
+    poll. Local caches are invalidated by the caller directly -> own events are skipped.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, metadata: MetadataStore, retention_seconds: int = 86_400):
+        self.metadata = metadata
+        self.retention_seconds = retention_seconds
+        self.origin: str = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._handlers: Dict[str, List[EventHandler]] = {}
+        # what happened before this process started is on disk already -> skipped by the first poll()
+        self._started: float = time.time()
+        self._last_id: int | None = None  # set by the first poll() -> constructing it does not open the index
+        self._last_prune: float = 0.0
+
+    def subscribe(self, kind: str, handler: EventHandler) -> None:
+        self._handlers.setdefault(kind, []).append(handler)
+
+    def _dispatch(self, kind: str, payload: Dict[str, Any]) -> None:
+        for handler in self._handlers.get(kind, []):
+            try:
+                handler(payload)
+            except Exception as e:
+                self.logger.opt(exception=e).error(f"handling {kind} {payload} failed")
+
+    def publish(self, kind: str, **payload: Any) -> None:
+        self.metadata.publish_event(self.origin, kind, payload)
+
+    def poll(self) -> int:
+        """Applies the events of the other processes -> number of events applied"""
+        if self._last_id is None:
+            self._last_id = self.metadata.last_event_id(before=self._started)
+
+        applied: int = 0
+        for event_id, kind, payload in self.metadata.events_after(self._last_id, exclude_origin=self.origin):
+            self._last_id = max(self._last_id, event_id)
+            self._dispatch(kind, payload)
+            applied += 1
+
+        now: float = time.time()
+        if now - self._last_prune > 600:
+            self._last_prune = now
+            self.metadata.prune_events(older_than=now - self.retention_seconds)
+        return applied
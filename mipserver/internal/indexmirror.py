@@ -0,0 +1,341 @@
+import hashlib
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+import requests
+from loguru import logger
+from pydantic import BaseModel, Field
+from requests.adapters import HTTPAdapter
+
+from mipserver.config import IndexMirror as IndexMirrorConfig
+from mipserver.Helper import atomic_write, get_sha256_hash
+from mipserver.internal.locks import LockManager
+from mipserver.internal.metadata import BuildRecord, MetadataStore, build_record_from_package_json
+from mipserver.internal.metrics import MIRROR_DOWNLOADED_BYTES, MIRROR_DOWNLOADED_OBJECTS
+from mipserver.internal.objectstore import SHORT_HASH, LooseObjectStore
+from mipserver.internal.packagebodies import compact_json
+
+MirrorTarget = Tuple[str, str, str]  # (package_name, mpy_version, pversion)
+
+
+class MirrorSyncReport(BaseModel):
+    index_unchanged: bool = False
+    packages: int = 0
+    package_jsons_updated: int = 0
+    package_jsons_unchanged: int = 0
+    objects_downloaded: int = 0
+    objects_present: int = 0
+    bytes_downloaded: int = 0
+    failures: List[str] = Field(default_factory=list)
+    duration_seconds: float = 0.0
+
+
+class _Fetched(BaseModel):
+    target: MirrorTarget
+    revision: str  # sha256 of the upstream json
+    data: Dict[str, Any]
+    short_hashes: List[str] = Field(default_factory=list)  # of data["hashes"], validated and lower case
+
+
+class IndexMirror:
+    """Incremental mirror of (a part of) a mip v2 index into the own cache
+
+    index.json is fetched conditionally (ETag) -> nothing to do while it is unchanged. Package jsons whose content
+    did not change since the last sync are skipped, objects already in the store are not downloaded again.
+    Objects are downloaded in parallel into mirror/partial/ (resumed via Range after an interruption), verified
+    against the (shortened) hash of the index and published under their full sha256; the package jsons are
+    rewritten to full hashes -> served by get_package_json like the own builds.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(
+        self, cfg: IndexMirrorConfig, cache_root: Path, metadata: MetadataStore, object_store: LooseObjectStore
+    ):
+        self.cfg = cfg
+        self.cache_root = cache_root
+        self.metadata = metadata
+        self.object_store = object_store
+
+        self.state_dir: Path = Path(cache_root, "mirror")
+        self.partial_dir: Path = Path(self.state_dir, "partial")
+
+        self._session: requests.Session = requests.Session()
+        adapter: HTTPAdapter = HTTPAdapter(pool_connections=2, pool_maxsize=cfg.parallel_downloads)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self.locks: LockManager = LockManager(cache_root)  # one sync at a time, also across workers
+        self._packages: Dict[str, str] = {}  # name -> current version according to the index
+        self._wanted: Set[str] = set(cfg.packages or [])  # configured packages plus their dependencies
+        self._pending_etag: str | None = None
+        self._load_index()
+
+    @property
+    def base_url(self) -> str:
+        return self.cfg.url.rstrip("/")
+
+    def serves(self, package_name: str) -> bool:
+        return self.cfg.enabled and package_name in self._packages
+
+    def package_names(self) -> List[str]:
+        return sorted(self._packages)
+
+    # ---- index
+
+    def reload(self) -> None:
+        """Re-reads the mirrored package list from disk (another worker completed a sync)"""
+        self._load_index()
+
+    def _load_index(self) -> None:
+        try:
+            self._wanted |= set(json.loads(Path(self.state_dir, "packages.json").read_bytes()))
+            self._set_index(json.loads(Path(self.state_dir, "index.json").read_bytes()))
+        except (OSError, ValueError):
+            pass
+
+    def _set_index(self, index: Dict[str, Any]) -> None:
+        packages: Dict[str, str] = {p["name"]: str(p.get("version", "")) for p in index.get("packages", [])}
+        if self.cfg.packages is not None:
+            packages = {name: version for name, version in packages.items() if name in self._wanted}
+        self._packages = packages
+
+    def _fetch_index(self) -> Dict[str, Any] | None:
+        """Current index.json or None if it did not change since the last complete sync"""
+        etag_file: Path = Path(self.state_dir, "index.etag")
+        headers: Dict[str, str] = {}
+        if etag_file.is_file():
+            headers["If-None-Match"] = etag_file.read_text().strip()
+
+        resp = self._get(f"{self.base_url}/index.json", headers=headers)
+        if resp.status_code == 304:
+            return None
+        resp.raise_for_status()
+
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        atomic_write(Path(self.state_dir, "index.json"), resp.content)
+        etag_file.unlink(missing_ok=True)  # written again once the sync of this index completed
+        self._pending_etag = resp.headers.get("ETag")
+        return json.loads(resp.content)
+
+    # ---- sync
+
+    def sync(self, force: bool = False) -> MirrorSyncReport:
+        """Brings every mirrored package json (all configured mpy versions, "latest" and the current version) and
+        the objects it references up to date"""
+        report: MirrorSyncReport = MirrorSyncReport()
+        started: float = time.perf_counter()
+        with self.locks.lock("mirror"):
+            if force:
+                Path(self.state_dir, "index.etag").unlink(missing_ok=True)
+            self._pending_etag = None
+            index: Dict[str, Any] | None = self._fetch_index()
+            if index is None:
+                report.index_unchanged = True
+                report.packages = len(self._packages)
+            else:
+                versions: Dict[str, str] = {p["name"]: str(p.get("version", "")) for p in index.get("packages", [])}
+                names: List[str] = sorted(versions) if self.cfg.packages is None else list(self.cfg.packages)
+                self._wanted = set(self._sync(names, versions, report, follow_deps=self.cfg.packages is not None))
+                atomic_write(Path(self.state_dir, "packages.json"), json.dumps(sorted(self._wanted)).encode())
+                self._set_index(index)
+                report.packages = len(self._packages)
+                if not report.failures and self._pending_etag:
+                    Path(self.state_dir, "index.etag").write_text(self._pending_etag)
+
+        report.duration_seconds = time.perf_counter() - started
+        self.logger.info(
+            f"mirror sync of {self.base_url}: {report.packages} packages, {report.package_jsons_updated} jsons updated, "
+            f"{report.objects_downloaded} objects ({report.bytes_downloaded} bytes) downloaded, "
+            f"{len(report.failures)} failures in {report.duration_seconds:.1f}s"
+        )
+        return report
+
+    def sync_package(self, package_name: str, mpy_version: str, pversion: str) -> MirrorSyncReport:
+        """Mirrors a single package json (e.g. evicted by the gc or a version that is not the current one)"""
+        report: MirrorSyncReport = MirrorSyncReport()
+        with self.locks.lock("mirror"):
+            self._sync_targets([(package_name, mpy_version, pversion)], report)
+        return report
+
+    def _sync(
+        self, names: List[str], versions: Dict[str, str], report: MirrorSyncReport, follow_deps: bool
+    ) -> List[str]:
+        """Syncs names (and, with follow_deps, everything they depend on) -> all synced names"""
+        seen: List[str] = []
+        todo: List[str] = list(names)
+        while todo:
+            batch: List[str] = [n for n in dict.fromkeys(todo) if n not in seen]
+            seen += batch
+            targets: List[MirrorTarget] = []
+            for name in batch:
+                for ref in dict.fromkeys(["latest", versions.get(name) or "latest"]):
+                    targets += [(name, mpy_version, ref) for mpy_version in self.cfg.mpy_versions]
+
+            fetched: List[_Fetched] = self._sync_targets(targets, report)
+            todo = []
+            if follow_deps:
+                for f in fetched:
+                    for dep in f.data.get("deps", []):
+                        # ["name", "version"] of the same index; "github:..." & co. are resolved by mip itself
+                        if dep and ":" not in dep[0] and dep[0] not in seen:
+                            todo.append(dep[0])
+        return seen
+
+    def _sync_targets(self, targets: List[MirrorTarget], report: MirrorSyncReport) -> List[_Fetched]:
+        with ThreadPoolExecutor(max_workers=self.cfg.parallel_downloads, thread_name_prefix="mirror") as pool:
+            fetched: List[_Fetched] = [f for f in pool.map(lambda t: self._fetch_package(t, report), targets) if f]
+
+            changed: List[_Fetched] = []
+            for f in fetched:
+                build: BuildRecord | None = self.metadata.get_build(*f.target)
+                if (
+                    build is not None
+                    and build.commit == f.revision
+                    and self.metadata.absolute_json_path(build).is_file()
+                ):
+                    self.metadata.mark_checked(*f.target)
+                    report.package_jsons_unchanged += 1
+                else:
+                    changed.append(f)
+
+            short_hashes: List[str] = list(dict.fromkeys(h for f in changed for h in f.short_hashes))
+            resolved: Dict[str, str] = {}
+            missing: List[str] = []
+            for short_hash in short_hashes:
+                full: str | None = self.object_store.find_by_prefix(short_hash)
+                if full is not None and self.object_store.reuse(full):
+                    resolved[short_hash] = full
+                    report.objects_present += 1
+                else:
+                    missing.append(short_hash)
+
+            for short_hash, full_or_error in zip(missing, pool.map(self._download_object_safe, missing)):
+                if isinstance(full_or_error, Exception):
+                    report.failures.append(f"object {short_hash}: {full_or_error}")
+                    continue
+                full, size = full_or_error
+                resolved[short_hash] = full
+                report.objects_downloaded += 1
+                report.bytes_downloaded += size
+
+        for f in changed:
+            try:
+                self._publish_package(f, resolved)
+                report.package_jsons_updated += 1
+            except Exception as e:
+                report.failures.append(f"{'/'.join(f.target)}: {e}")
+        return fetched
+
+    def _fetch_package(self, target: MirrorTarget, report: MirrorSyncReport) -> _Fetched | None:
+        package_name, mpy_version, pversion = target
+        url: str = f"{self.base_url}/package/{mpy_version}/{package_name}/{pversion}.json"
+        try:
+            resp = self._get(url)
+            if resp.status_code == 404:  # e.g. a package without compiled variant
+                self.logger.debug(f"{url} not on the index")
+                return None
+            resp.raise_for_status()
+            fetched = _Fetched(target=target, revision=hashlib.sha256(resp.content).hexdigest(), data=resp.json())
+            fetched.short_hashes = self._short_hashes(fetched.data)
+            return fetched
+        except (requests.RequestException, ValueError) as e:
+            report.failures.append(f"{url}: {e}")
+            return None
+
+    @staticmethod
+    def _short_hashes(data: Dict[str, Any]) -> List[str]:
+        """Hashes of a package json -> ValueError if one is no hex (prefix of a) sha256, they become file names"""
+        ret: List[str] = []
+        for entry in data.get("hashes", []):
+            h: Any = entry[1] if isinstance(entry, list) and len(entry) == 2 else None
+            if not isinstance(h, str) or not SHORT_HASH.fullmatch(h.lower()):
+                raise ValueError(f"invalid hash entry {entry!r}")
+            ret.append(h.lower())
+        return ret
+
+    def _publish_package(self, fetched: _Fetched, resolved: Dict[str, str]) -> None:
+        package_name, mpy_version, pversion = fetched.target
+        data: Dict[str, Any] = dict(fetched.data)
+        # deps, urls, version, ... are passed through as they are
+        data["hashes"] = [
+            [path, resolved[short_hash]]
+            for (path, _), short_hash in zip(fetched.data.get("hashes", []), fetched.short_hashes)
+        ]
+
+        target: Path = Path(self.cache_root, mpy_version, package_name, f"{pversion}.json")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(target, compact_json(data))
+        self.metadata.record_build(
+            build_record_from_package_json(
+                self.metadata, self.object_store, target, package_name, mpy_version, pversion, fetched.revision
+            )
+        )
+
+    # ---- objects
+
+    def _download_object_safe(self, short_hash: str) -> Tuple[str, int] | Exception:
+        try:
+            return self.download_object(short_hash)
+        except Exception as e:
+            self.logger.opt(exception=e).warning(f"mirroring object {short_hash} failed")
+            return e
+
+    def download_object(self, short_hash: str) -> Tuple[str, int]:
+        """Streams /file/<h[:2]>/<h> into the store -> (full sha256, size); retried with backoff, resumed via Range"""
+        short_hash = short_hash.lower()
+        if not SHORT_HASH.fullmatch(short_hash):
+            raise ValueError(f"invalid object hash {short_hash!r}")
+        url: str = f"{self.base_url}/file/{short_hash[:2]}/{short_hash}"
+        self.partial_dir.mkdir(parents=True, exist_ok=True)
+        part: Path = Path(self.partial_dir, f"{short_hash}.part")
+
+        for attempt in range(self.cfg.retries + 1):
+            try:
+                offset: int = part.stat().st_size if part.exists() else 0
+                headers: Dict[str, str] = {"Range": f"bytes={offset}-"} if offset else {}
+                with self._session.get(url, headers=headers, stream=True, timeout=60) as resp:
+                    if resp.status_code != 416:  # 416: the part is already complete
+                        resp.raise_for_status()
+                        with open(part, "ab" if resp.status_code == 206 else "wb") as fout:
+                            for chunk in resp.iter_content(chunk_size=65_536):
+                                fout.write(chunk)
+
+                full: str = get_sha256_hash(part)
+                if not full.startswith(short_hash):
+                    part.unlink()  # corrupt (or resumed from a stale part) -> start over
+                    raise ValueError(f"hash mismatch for {url}: got {full}")
+
+                size: int = part.stat().st_size
+                self.object_store.put_file(part, full)
+                part.unlink()
+                MIRROR_DOWNLOADED_OBJECTS.inc()
+                MIRROR_DOWNLOADED_BYTES.inc(size)
+                return full, size
+            except (requests.RequestException, OSError, ValueError) as e:
+                if attempt >= self.cfg.retries:
+                    raise
+                delay: float = self.cfg.retry_backoff_seconds * (2**attempt) * random.uniform(0.5, 1.5)
+                self.logger.debug(f"{url} failed ({e}) -> retry in {delay:.2f}s")
+                time.sleep(delay)
+
+        raise AssertionError("unreachable")
+
+    # ---- helpers
+
+    def _get(self, url: str, headers: Optional[Dict[str, str]] = None) -> requests.Response:
+        """GET with retries (connection errors and 5xx) and exponential backoff with jitter"""
+        for attempt in range(self.cfg.retries + 1):
+            try:
+                resp = self._session.get(url, headers=headers, timeout=60)
+                if resp.status_code < 500 or attempt >= self.cfg.retries:
+                    return resp
+            except requests.RequestException:
+                if attempt >= self.cfg.retries:
+                    raise
+            time.sleep(self.cfg.retry_backoff_seconds * (2**attempt) * random.uniform(0.5, 1.5))
+        raise AssertionError("unreachable")
@@ -0,0 +1,71 @@
+import fcntl
+import os
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Generator, Optional
+
+from loguru import logger
+
+
+class LockTimeout(Exception):
+    """The lock is held by another thread/worker/process"""
+
+    def __init__(self, name: str, timeout: float):
+        super().__init__(f"lock {name!r} not acquired within {timeout}s")
+        self.name = name
+        self.timeout = timeout
+
+
+class LockManager:
+    """Named advisory locks (flock on <cache_root>/locks/<name>.lock)
+
+    flock locks belong to the open file -> they exclude other threads of this process as well as other worker
+    processes (and other hosts on a shared volume that supports flock). A crashed holder releases its lock
+    automatically, so there are no stale lease files to clean up.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    DIRNAME: str = "locks"
+
+    def __init__(self, cache_root: Path):
+        self.lock_dir: Path = Path(cache_root, self.DIRNAME)
+
+    def path_for(self, name: str) -> Path:
+        return Path(self.lock_dir, name.replace("/", "_") + ".lock")
+
+    @contextmanager
+    def lock(self, name: str, timeout: Optional[float] = None) -> Generator[None, None, None]:
+        """Exclusive lock; timeout None waits forever, 0 tries once -> LockTimeout"""
+        path: Path = self.path_for(name)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd: int = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if timeout is None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            else:
+                deadline: float = time.monotonic() + timeout
+                delay: float = 0.01
+                while True:
+                    try:
+                        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        break
+                    except BlockingIOError:
+                        if time.monotonic() >= deadline:
+                            raise LockTimeout(name, timeout)
+                        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+                        delay = min(delay * 2, 0.25)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def is_locked(self, name: str) -> bool:
+        try:
+            with self.lock(name, timeout=0):
+                return False
+        except LockTimeout:
+            return True
@@ -0,0 +1,706 @@
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from mipserver.datastructures.datatypes import MPYPath
+from mipserver.internal.objectstore import LooseObjectStore
+
+
+class BuildFile(BaseModel):
+    path: str
+    hash: str
+    size: int = 0
+
+
+class BuildRecord(BaseModel):
+    package_name: str
+    mpy_version: str
+    pversion: str  # "latest" or a branch
+    commit: Optional[str] = None
+    json_path: str  # relative to the cache root if below it
+    json_size: int = 0
+    built_at: float
+    checked_at: float  # last time upstream was checked (commit unchanged -> no rebuild)
+    last_access: float = 0.0
+    files: List[BuildFile] = Field(default_factory=list)
+
+
+class ObjectRecord(BaseModel):
+    hash: str
+    size: int
+    refcount: int
+    created_at: float
+    last_access: float
+
+
+class BuildJob(BaseModel):
+    id: int
+    package_name: str
+    mpy_version: str
+    pversion: str
+    state: str  # queued -> running -> done
+    result: Optional[str] = None  # built, unchanged, peer, git_failed, missing_ref, failed, denied, lost
+    commit: Optional[str] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    worker: Optional[str] = None
+    enqueued_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+
+class PackageStats(BaseModel):
+    package_name: str
+    requests: int = 0
+    cache_hits: int = 0
+    builds: int = 0
+    failures: int = 0
+    last_request: float = 0.0
+
+
+_SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS builds (
+    package_name TEXT NOT NULL,
+    mpy_version TEXT NOT NULL,
+    pversion TEXT NOT NULL,
+    commit_id TEXT,
+    json_path TEXT NOT NULL,
+    json_size INTEGER NOT NULL DEFAULT 0,
+    built_at REAL NOT NULL,
+    checked_at REAL NOT NULL,
+    last_access REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (package_name, mpy_version, pversion)
+);
+CREATE INDEX IF NOT EXISTS builds_last_access ON builds (last_access);
+
+CREATE TABLE IF NOT EXISTS build_files (
+    package_name TEXT NOT NULL,
+    mpy_version TEXT NOT NULL,
+    pversion TEXT NOT NULL,
+    path TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (package_name, mpy_version, pversion, path)
+);
+CREATE INDEX IF NOT EXISTS build_files_hash ON build_files (hash);
+
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    refcount INTEGER NOT NULL DEFAULT 0,
+    created_at REAL NOT NULL,
+    last_access REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS objects_unreferenced ON objects (refcount, last_access);
+
+CREATE TABLE IF NOT EXISTS package_stats (
+    package_name TEXT PRIMARY KEY,
+    requests INTEGER NOT NULL DEFAULT 0,
+    cache_hits INTEGER NOT NULL DEFAULT 0,
+    builds INTEGER NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    last_request REAL NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS build_jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    package_name TEXT NOT NULL,
+    mpy_version TEXT NOT NULL,
+    pversion TEXT NOT NULL,
+    state TEXT NOT NULL,
+    result TEXT,
+    commit_id TEXT,
+    error TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    enqueued_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS build_jobs_state ON build_jobs (state, id);
+CREATE INDEX IF NOT EXISTS build_jobs_key ON build_jobs (package_name, mpy_version, pversion, state);
+
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    origin TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+"""
+
+BuildKey = Tuple[str, str, str]  # (package_name, mpy_version, pversion)
+
+
+class MetadataStore:
+    """Persistent index (SQLite, WAL mode) of builds, objects and per-package request counters.
+
+    Hot-path bookkeeping (accesses, request counters) is buffered in memory and written in one transaction by
+    flush() - called periodically, when the buffer grows beyond max_pending and before queries that depend on it.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, db_path: Path, cache_root: Path, max_pending: int = 10_000):
+        self.db_path = db_path
+        self.cache_root = cache_root
+        self.max_pending = max_pending
+
+        self._connection: sqlite3.Connection | None = None  # opened on first use -> importing has no side effects
+
+        self._lock: threading.RLock = threading.RLock()
+        self._pending_build_access: Dict[BuildKey, float] = {}
+        self._pending_object_access: Dict[str, float] = {}
+        self._pending_stats: Dict[str, PackageStats] = {}
+
+    @property
+    def _conn(self) -> sqlite3.Connection:
+        if self._connection is None:
+            with self._lock:
+                if self._connection is None:
+                    self.db_path.parent.mkdir(parents=True, exist_ok=True)
+                    conn: sqlite3.Connection = sqlite3.connect(
+                        str(self.db_path), check_same_thread=False, isolation_level=None, timeout=30
+                    )
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.execute("PRAGMA synchronous=NORMAL")
+                    conn.executescript(_SCHEMA)
+                    self._connection = conn
+        return self._connection
+
+    def close(self) -> None:
+        self.flush()
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @contextmanager
+    def _transaction(self) -> Generator[sqlite3.Connection, None, None]:
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    # ---- paths
+
+    def relative_json_path(self, json_path: Path) -> str:
+        try:
+            return json_path.resolve().relative_to(self.cache_root.resolve()).as_posix()
+        except ValueError:
+            return str(json_path.resolve())
+
+    def absolute_json_path(self, record: BuildRecord) -> Path:
+        return Path(self.cache_root, record.json_path)  # absolute json_path wins over cache_root
+
+    # ---- builds
+
+    def record_build(self, record: BuildRecord) -> None:
+        """Replaces the build (package, target, ref) and adjusts the refcounts of the objects it references"""
+        key: BuildKey = (record.package_name, record.mpy_version, record.pversion)
+        with self._transaction() as conn:
+            self._delete_build(conn, key)
+            conn.execute(
+                "INSERT INTO builds (package_name, mpy_version, pversion, commit_id, json_path, json_size, built_at,"
+                " checked_at, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    *key,
+                    record.commit,
+                    record.json_path,
+                    record.json_size,
+                    record.built_at,
+                    record.checked_at,
+                    max(record.last_access, record.built_at),
+                ),
+            )
+            for f in record.files:
+                conn.execute(
+                    "INSERT OR REPLACE INTO build_files (package_name, mpy_version, pversion, path, hash)"
+                    " VALUES (?, ?, ?, ?, ?)",
+                    (*key, f.path, f.hash),
+                )
+                conn.execute(
+                    "INSERT INTO objects (hash, size, refcount, created_at, last_access) VALUES (?, ?, 1, ?, ?)"
+                    " ON CONFLICT(hash) DO UPDATE SET refcount = refcount + 1",
+                    (f.hash, f.size, record.built_at, record.built_at),
+                )
+
+    def mark_checked(self, package_name: str, mpy_version: str, pversion: str, at: Optional[float] = None) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE builds SET checked_at = ? WHERE package_name = ? AND mpy_version = ? AND pversion = ?",
+                (time.time() if at is None else at, package_name, mpy_version, pversion),
+            )
+
+    def invalidate_package(self, package_name: str) -> int:
+        """Forgets commit and check of every build of the package -> rebuilt on the next request"""
+        with self._transaction() as conn:
+            return conn.execute(
+                "UPDATE builds SET commit_id = NULL, checked_at = 0 WHERE package_name = ?", (package_name,)
+            ).rowcount
+
+    def get_build(
+        self, package_name: str, mpy_version: str, pversion: str, with_files: bool = False
+    ) -> BuildRecord | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT package_name, mpy_version, pversion, commit_id, json_path, json_size, built_at, checked_at,"
+                " last_access FROM builds WHERE package_name = ? AND mpy_version = ? AND pversion = ?",
+                (package_name, mpy_version, pversion),
+            ).fetchone()
+            if row is None:
+                return None
+            record: BuildRecord = self._build_from_row(row)
+            if with_files:
+                record.files = self._build_files((package_name, mpy_version, pversion))
+            return record
+
+    def list_builds(self, with_files: bool = False) -> List[BuildRecord]:
+        """All builds, least recently used first"""
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT package_name, mpy_version, pversion, commit_id, json_path, json_size, built_at, checked_at,"
+                " last_access FROM builds ORDER BY last_access ASC"
+            ).fetchall()
+            records: List[BuildRecord] = [self._build_from_row(r) for r in rows]
+            if with_files:
+                for r in records:
+                    r.files = self._build_files((r.package_name, r.mpy_version, r.pversion))
+            return records
+
+    def delete_build(self, package_name: str, mpy_version: str, pversion: str) -> List[str]:
+        """Removes the build -> returns the hashes of the objects that are no longer referenced by any build"""
+        with self._transaction() as conn:
+            return self._delete_build(conn, (package_name, mpy_version, pversion))
+
+    def _delete_build(self, conn: sqlite3.Connection, key: BuildKey) -> List[str]:
+        hashes: List[str] = [
+            r[0]
+            for r in conn.execute(
+                "SELECT hash FROM build_files WHERE package_name = ? AND mpy_version = ? AND pversion = ?", key
+            ).fetchall()
+        ]
+        for h in hashes:
+            conn.execute("UPDATE objects SET refcount = MAX(refcount - 1, 0) WHERE hash = ?", (h,))
+        conn.execute("DELETE FROM build_files WHERE package_name = ? AND mpy_version = ? AND pversion = ?", key)
+        conn.execute("DELETE FROM builds WHERE package_name = ? AND mpy_version = ? AND pversion = ?", key)
+
+        if not hashes:
+            return []
+        marks: str = ",".join("?" * len(hashes))
+        return [
+            r[0]
+            for r in conn.execute(
+                f"SELECT hash FROM objects WHERE refcount = 0 AND hash IN ({marks})", hashes
+            ).fetchall()
+        ]
+
+    def _build_files(self, key: BuildKey) -> List[BuildFile]:
+        rows = self._conn.execute(
+            "SELECT f.path, f.hash, COALESCE(o.size, 0) FROM build_files f LEFT JOIN objects o ON o.hash = f.hash"
+            " WHERE f.package_name = ? AND f.mpy_version = ? AND f.pversion = ? ORDER BY f.rowid",
+            key,
+        ).fetchall()
+        return [BuildFile(path=r[0], hash=r[1], size=r[2]) for r in rows]
+
+    @staticmethod
+    def _build_from_row(row: Tuple) -> BuildRecord:
+        return BuildRecord(
+            package_name=row[0],
+            mpy_version=row[1],
+            pversion=row[2],
+            commit=row[3],
+            json_path=row[4],
+            json_size=row[5],
+            built_at=row[6],
+            checked_at=row[7],
+            last_access=row[8],
+        )
+
+    # ---- objects
+
+    def add_object(self, obj_hash: str, size: int, at: Optional[float] = None) -> None:
+        """Registers an (unreferenced) object, e.g. mirrored or imported ones"""
+        at = at or time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO objects (hash, size, refcount, created_at, last_access) VALUES (?, ?, 0, ?, ?)",
+                (obj_hash, size, at, at),
+            )
+
+    def get_object(self, obj_hash: str) -> ObjectRecord | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT hash, size, refcount, created_at, last_access FROM objects WHERE hash = ?", (obj_hash,)
+            ).fetchone()
+        if row is None:
+            return None
+        return ObjectRecord(hash=row[0], size=row[1], refcount=row[2], created_at=row[3], last_access=row[4])
+
+    def unreferenced_objects(self, older_than: float) -> List[ObjectRecord]:
+        """Objects no build refers to (least recently used first) that were created before older_than"""
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT hash, size, refcount, created_at, last_access FROM objects"
+                " WHERE refcount = 0 AND created_at < ? ORDER BY last_access ASC",
+                (older_than,),
+            ).fetchall()
+        return [ObjectRecord(hash=r[0], size=r[1], refcount=r[2], created_at=r[3], last_access=r[4]) for r in rows]
+
+    def delete_object(self, obj_hash: str, older_than: float, remove: Callable[[str], int]) -> int | None:
+        """Drops an object that is still unreferenced and was not (re-)used since older_than -> bytes freed,
+        None if it was kept.
+
+        remove() deletes the file inside the write transaction -> a record_build/reuse_object of any process
+        either comes first (and keeps the object) or only sees it after it is gone completely.
+        """
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "DELETE FROM objects WHERE hash = ? AND refcount = 0 AND created_at < ?", (obj_hash, older_than)
+            )
+            if cur.rowcount != 1:
+                return None
+            return remove(obj_hash)
+
+    def reuse_object(self, obj_hash: str) -> None:
+        """A build is about to reference an object that is stored already -> fresh again for the gc"""
+        now: float = time.time()
+        with self._transaction() as conn:
+            conn.execute("UPDATE objects SET created_at = ?, last_access = ? WHERE hash = ?", (now, now, obj_hash))
+
+    def object_totals(self) -> Tuple[int, int]:
+        """(count, bytes) of all indexed objects"""
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects").fetchone()
+        return int(row[0]), int(row[1])
+
+    def json_totals(self) -> Tuple[int, int]:
+        """(count, bytes) of all indexed package jsons"""
+        with self._lock:
+            row = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(json_size), 0) FROM builds").fetchone()
+        return int(row[0]), int(row[1])
+
+    # ---- batched hot-path bookkeeping
+
+    # the buffers are swapped by flush() in other threads -> every update happens under the lock
+
+    def touch_build(self, package_name: str, mpy_version: str, pversion: str) -> None:
+        with self._lock:
+            self._pending_build_access[(package_name, mpy_version, pversion)] = time.time()
+            self._flush_if_full()
+
+    def touch_object(self, obj_hash: str) -> None:
+        with self._lock:
+            self._pending_object_access[obj_hash] = time.time()
+            self._flush_if_full()
+
+    def count_request(
+        self, package_name: str, cache_hit: bool = False, build: bool = False, failure: bool = False
+    ) -> None:
+        with self._lock:
+            ps: PackageStats = self._pending_stats.setdefault(package_name, PackageStats(package_name=package_name))
+            ps.requests += 1
+            ps.cache_hits += int(cache_hit)
+            ps.builds += int(build)
+            ps.failures += int(failure)
+            ps.last_request = time.time()
+            self._flush_if_full()
+
+    def pending_writes(self) -> int:
+        with self._lock:
+            return len(self._pending_build_access) + len(self._pending_object_access) + len(self._pending_stats)
+
+    def _flush_if_full(self) -> None:
+        if self.pending_writes() >= self.max_pending:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            if not (self._pending_build_access or self._pending_object_access or self._pending_stats):
+                return
+
+            build_access, self._pending_build_access = self._pending_build_access, {}
+            object_access, self._pending_object_access = self._pending_object_access, {}
+            stats, self._pending_stats = self._pending_stats, {}
+
+            with self._transaction() as conn:
+                conn.executemany(
+                    "UPDATE builds SET last_access = MAX(last_access, ?)"
+                    " WHERE package_name = ? AND mpy_version = ? AND pversion = ?",
+                    [(ts, *key) for key, ts in build_access.items()],
+                )
+                conn.executemany(
+                    "UPDATE objects SET last_access = MAX(last_access, ?) WHERE hash = ?",
+                    [(ts, h) for h, ts in object_access.items()],
+                )
+                conn.executemany(
+                    "INSERT INTO package_stats (package_name, requests, cache_hits, builds, failures, last_request)"
+                    " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(package_name) DO UPDATE SET"
+                    " requests = requests + excluded.requests, cache_hits = cache_hits + excluded.cache_hits,"
+                    " builds = builds + excluded.builds, failures = failures + excluded.failures,"
+                    " last_request = MAX(last_request, excluded.last_request)",
+                    [
+                        (ps.package_name, ps.requests, ps.cache_hits, ps.builds, ps.failures, ps.last_request)
+                        for ps in stats.values()
+                    ],
+                )
+
+    def package_stats(self) -> List[PackageStats]:
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT package_name, requests, cache_hits, builds, failures, last_request FROM package_stats"
+                " ORDER BY requests DESC"
+            ).fetchall()
+        return [
+            PackageStats(
+                package_name=r[0], requests=r[1], cache_hits=r[2], builds=r[3], failures=r[4], last_request=r[5]
+            )
+            for r in rows
+        ]
+
+    # ---- events between worker processes (see coordination.InvalidationBus)
+
+    def publish_event(self, origin: str, kind: str, payload: Dict[str, Any]) -> None:
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO events (origin, kind, payload, created_at) VALUES (?, ?, ?, ?)",
+                (origin, kind, json.dumps(payload), time.time()),
+            )
+
+    def events_after(self, last_id: int, exclude_origin: str) -> List[Tuple[int, str, Dict[str, Any]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, kind, payload FROM events WHERE id > ? AND origin != ? ORDER BY id",
+                (last_id, exclude_origin),
+            ).fetchall()
+        return [(r[0], r[1], json.loads(r[2])) for r in rows]
+
+    def last_event_id(self, before: float | None = None) -> int:
+        """Id of the newest event (published before the timestamp before)"""
+        with self._lock:
+            if before is None:
+                row = self._conn.execute("SELECT MAX(id) FROM events").fetchone()
+            else:
+                row = self._conn.execute("SELECT MAX(id) FROM events WHERE created_at < ?", (before,)).fetchone()
+        return int(row[0] or 0)
+
+    def prune_events(self, older_than: float) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM events WHERE created_at < ?", (older_than,))
+
+    # ---- build jobs (persistent queue between the http workers and the builders)
+
+    _JOB_COLUMNS: str = (
+        "id, package_name, mpy_version, pversion, state, result, commit_id, error, attempts, worker, enqueued_at,"
+        " started_at, finished_at"
+    )
+
+    @staticmethod
+    def _job(row: Tuple[Any, ...]) -> BuildJob:
+        return BuildJob(
+            id=row[0],
+            package_name=row[1],
+            mpy_version=row[2],
+            pversion=row[3],
+            state=row[4],
+            result=row[5],
+            commit=row[6],
+            error=row[7],
+            attempts=row[8],
+            worker=row[9],
+            enqueued_at=row[10],
+            started_at=row[11],
+            finished_at=row[12],
+        )
+
+    def enqueue_build_job(self, package_name: str, mpy_version: str, pversion: str) -> BuildJob:
+        """Queues a build -> the already queued/running job of the same build if there is one"""
+        key: BuildKey = (package_name, mpy_version, pversion)
+        with self._transaction() as conn:
+            row = conn.execute(
+                f"SELECT {self._JOB_COLUMNS} FROM build_jobs WHERE package_name = ? AND mpy_version = ?"
+                " AND pversion = ? AND state != 'done' ORDER BY id LIMIT 1",
+                key,
+            ).fetchone()
+            if row is None:
+                cur = conn.execute(
+                    "INSERT INTO build_jobs (package_name, mpy_version, pversion, state, enqueued_at)"
+                    " VALUES (?, ?, ?, 'queued', ?)",
+                    (*key, time.time()),
+                )
+                row = conn.execute(
+                    f"SELECT {self._JOB_COLUMNS} FROM build_jobs WHERE id = ?", (cur.lastrowid,)
+                ).fetchone()
+        return self._job(row)
+
+    def claim_build_job(self, worker: str, lease_seconds: float, max_attempts: int) -> BuildJob | None:
+        """Oldest queued job -> running for worker. Jobs of builders that vanished (lease over) are queued again,
+        or given up after max_attempts."""
+        now: float = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE build_jobs SET state = 'done', result = 'lost', error = 'builder stopped during the build',"
+                " finished_at = ? WHERE state = 'running' AND lease_until < ? AND attempts >= ?",
+                (now, now, max_attempts),
+            )
+            conn.execute(
+                "UPDATE build_jobs SET state = 'queued', worker = NULL WHERE state = 'running' AND lease_until < ?",
+                (now,),
+            )
+            row = conn.execute(
+                "SELECT id FROM build_jobs WHERE state = 'queued' ORDER BY id LIMIT 1",
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE build_jobs SET state = 'running', worker = ?, attempts = attempts + 1, started_at = ?,"
+                " lease_until = ? WHERE id = ?",
+                (worker, now, now + lease_seconds, row[0]),
+            )
+            job = conn.execute(f"SELECT {self._JOB_COLUMNS} FROM build_jobs WHERE id = ?", (row[0],)).fetchone()
+        return self._job(job)
+
+    def renew_build_job(self, job_id: int, worker: str, lease_seconds: float) -> bool:
+        """Extends the lease of a running job -> False if worker does not hold it any more"""
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE build_jobs SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                (time.time() + lease_seconds, job_id, worker),
+            )
+        return cur.rowcount == 1
+
+    def finish_build_job(
+        self, job_id: int, worker: str, result: str, commit: Optional[str], error: Optional[str] = None
+    ) -> bool:
+        """-> False if the job was handed to another builder meanwhile (that one finishes it)"""
+        with self._transaction() as conn:
+            cur = conn.execute(
+                "UPDATE build_jobs SET state = 'done', result = ?, commit_id = ?, error = ?, finished_at = ?,"
+                " lease_until = NULL WHERE id = ? AND worker = ?",
+                (result, commit, error, time.time(), job_id, worker),
+            )
+        return cur.rowcount == 1
+
+    def get_build_job(self, job_id: int) -> BuildJob | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {self._JOB_COLUMNS} FROM build_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row) if row is not None else None
+
+    def build_jobs(self, states: Tuple[str, ...] = ("queued", "running"), limit: int = 100) -> List[BuildJob]:
+        marks: str = ", ".join("?" * len(states))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT {self._JOB_COLUMNS} FROM build_jobs WHERE state IN ({marks}) ORDER BY id LIMIT ?",
+                (*states, limit),
+            ).fetchall()
+        return [self._job(r) for r in rows]
+
+    def build_job_counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT state, COUNT(*) FROM build_jobs GROUP BY state").fetchall()
+        return {r[0]: r[1] for r in rows}
+
+    def prune_build_jobs(self, older_than: float) -> None:
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM build_jobs WHERE state = 'done' AND finished_at < ?", (older_than,))
+
+    # ---- (re-)indexing of an existing cache directory
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM builds LIMIT 1").fetchone() is None and (
+                self._conn.execute("SELECT 1 FROM objects LIMIT 1").fetchone() is None
+            )
+
+    @staticmethod
+    def _iter_package_jsons(cache_root: Path) -> Iterator[Tuple[Path, str, str, str]]:
+        """(path, mpy_version, package_name, pversion) of all <mpy>/<pkg>/<version>.json below cache_root"""
+        for m in MPYPath:
+            mdir: Path = Path(cache_root, m.value)
+            if not mdir.is_dir():
+                continue
+            for p in mdir.glob("*/*.json"):
+                yield p, m.value, p.parent.name, p.stem
+
+    def import_from_filesystem(self, object_store: LooseObjectStore) -> Tuple[int, int]:
+        """Indexes objects and package jsons of a cache that was populated without (or before) this store.
+
+        Returns (builds, objects) that were added.
+        """
+        objects: int = 0
+        for obj_hash, size, mtime in object_store.iter_objects():
+            if self.get_object(obj_hash) is None:
+                self.add_object(obj_hash, size, at=mtime)
+                objects += 1
+
+        builds: int = 0
+        for p, mpy_version, package_name, pversion in self._iter_package_jsons(self.cache_root):
+            if self.get_build(package_name, mpy_version, pversion) is not None:
+                continue
+            try:
+                record: BuildRecord = build_record_from_package_json(
+                    self, object_store, p, package_name, mpy_version, pversion, commit=None
+                )
+            except Exception as e:
+                self.logger.warning(f"cannot index {p}: {e}")
+                continue
+
+            st = p.stat()
+            record.built_at = record.last_access = st.st_mtime
+            record.checked_at = 0.0  # unknown commit -> has to be checked upstream before it is served
+            self.record_build(record)
+            builds += 1
+
+        self.logger.info(f"indexed {builds} builds and {objects} objects from {self.cache_root}")
+        return builds, objects
+
+
+def build_record_from_package_json(
+    store: MetadataStore,
+    object_store: LooseObjectStore,
+    json_path: Path,
+    package_name: str,
+    mpy_version: str,
+    pversion: str,
+    commit: Optional[str],
+) -> BuildRecord:
+    """Reads a generated package json and collects what the index needs to know about it"""
+    with open(json_path, "r") as fin:
+        data: dict = json.load(fin)
+
+    files: List[BuildFile] = []
+    for entry in data.get("hashes", []):
+        path, obj_hash = entry[0], entry[1]
+        try:
+            size: int = object_store.size(obj_hash)
+        except FileNotFoundError:
+            size = 0
+        files.append(BuildFile(path=path, hash=obj_hash, size=size))
+
+    now: float = time.time()
+    return BuildRecord(
+        package_name=package_name,
+        mpy_version=mpy_version,
+        pversion=pversion,
+        commit=commit,
+        json_path=store.relative_json_path(json_path),
+        json_size=json_path.stat().st_size,
+        built_at=now,
+        checked_at=now,
+        last_access=now,
+        files=files,
+    )
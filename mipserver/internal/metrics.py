@@ -0,0 +1,180 @@
+import time
+from typing import TYPE_CHECKING, Dict, Iterator, Optional
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, REGISTRY
+from prometheus_client.core import GaugeMetricFamily
+from prometheus_client.registry import Collector
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+if TYPE_CHECKING:  # the instrumented modules import this one
+    from mipserver.internal.metadata import MetadataStore
+    from mipserver.internal.negativecache import NegativeResultCache
+
+# buckets for things that take anything from milliseconds (cache hit) to minutes (clone + compile of a big repo)
+_SLOW_BUCKETS: tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+_FAST_BUCKETS: tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+REQUEST_DURATION: Histogram = Histogram(
+    "mipserver_request_duration_seconds",
+    "Duration of http requests (until the response is sent completely)",
+    ["method", "route", "status"],
+    buckets=_SLOW_BUCKETS,
+)
+
+GIT_DURATION: Histogram = Histogram(
+    "mipserver_git_duration_seconds",
+    "Duration of git subprocesses",
+    ["operation"],  # clone, fetch, checkout, reset, ls-remote, rev-parse
+    buckets=_SLOW_BUCKETS,
+)
+GIT_FAILURES: Counter = Counter("mipserver_git_failures_total", "Failed git subprocesses", ["operation"])
+
+COMPILE_DURATION: Histogram = Histogram(
+    "mipserver_compile_duration_seconds", "Duration of mpy-cross per file", buckets=_SLOW_BUCKETS
+)
+COMPILE_FAILURES: Counter = Counter("mipserver_compile_failures_total", "Files mpy-cross failed to compile")
+
+HASH_DURATION: Histogram = Histogram(
+    "mipserver_hash_duration_seconds", "Duration of hashing one file", buckets=_FAST_BUCKETS
+)
+HASHED_BYTES: Counter = Counter("mipserver_hashed_bytes_total", "Bytes hashed")
+OBJECT_WRITE_DURATION: Histogram = Histogram(
+    "mipserver_object_write_duration_seconds", "Duration of publishing one object to the store", buckets=_FAST_BUCKETS
+)
+OBJECT_WRITTEN_BYTES: Counter = Counter("mipserver_object_written_bytes_total", "Bytes written to the object store")
+
+EVENT_LOOP_LAG: Histogram = Histogram(
+    "mipserver_event_loop_lag_seconds",
+    "How late the event loop runs a callback (blocking code in coroutines)",
+    buckets=_FAST_BUCKETS,
+)
+EVENT_LOOP_BLOCKED: Counter = Counter(
+    "mipserver_event_loop_blocked_total", "Times the event loop was blocked longer than the lag threshold"
+)
+
+PACKAGE_BUILD_DURATION: Histogram = Histogram(
+    "mipserver_package_build_duration_seconds",
+    "End-to-end duration of a package json build (waiting for a slot, git, compile, hash, index)",
+    ["result"],  # built, peer, unchanged, failed, missing_ref, git_failed
+    buckets=_SLOW_BUCKETS,
+)
+PACKAGE_JSON_REQUESTS: Counter = Counter(
+    "mipserver_package_json_requests_total",
+    "Package json requests by outcome",
+    ["result"],  # hit, mirror, negative, denied, built, peer, unchanged, failed, missing_ref, git_failed
+)
+MIRROR_DOWNLOADED_OBJECTS: Counter = Counter(
+    "mipserver_mirror_downloaded_objects_total", "Objects downloaded from the mirrored index"
+)
+MIRROR_DOWNLOADED_BYTES: Counter = Counter(
+    "mipserver_mirror_downloaded_bytes_total", "Bytes downloaded from the mirrored index"
+)
+RAW_DOWNLOADS: Counter = Counter(
+    "mipserver_raw_downloads_total", "Raw file downloads from upstream", ["result"]  # fetched, not_modified, ...
+)
+RAW_DOWNLOADED_BYTES: Counter = Counter("mipserver_raw_downloaded_bytes_total", "Bytes of raw file downloads")
+PEER_FETCHES: Counter = Counter(
+    "mipserver_peer_fetches_total",
+    "Objects and package jsons requested from peer replicas",
+    ["kind", "result"],  # kind: object, package_json; result: hit, miss, corrupt, error
+)
+PEER_FETCHED_BYTES: Counter = Counter("mipserver_peer_fetched_bytes_total", "Bytes of objects received from peers")
+FILE_REQUESTS: Counter = Counter("mipserver_file_requests_total", "Object requests", ["result"])  # hit, miss, peer
+FILE_RANGE_REQUESTS: Counter = Counter(
+    "mipserver_file_range_requests_total",
+    "Object requests for a part of the object (Range)",
+    ["resumed"],  # true: with If-Range -> continuing an interrupted download
+)
+
+BUILDS_IN_FLIGHT: Gauge = Gauge("mipserver_builds_in_flight", "Package builds currently holding a build slot")
+BUILDS_WAITING: Gauge = Gauge("mipserver_builds_waiting", "Package builds waiting for a build slot")
+BUILD_SLOT_WAIT: Histogram = Histogram(
+    "mipserver_build_slot_wait_seconds", "Time a build waited for a free build slot", buckets=_SLOW_BUCKETS
+)
+BUILD_BACKPRESSURE: Counter = Counter(
+    "mipserver_build_backpressure_total",
+    "Build requests answered with 503 + Retry-After instead of waiting",
+    ["reason"],  # package: too many requests wait for the same build; queue: the wait for a slot is too long
+)
+
+
+class CacheCollector(Collector):
+    """Gauges computed at scrape time from the metadata index and the negative cache -> nothing to maintain"""
+
+    def __init__(self, metadata: "MetadataStore", negative_cache: "NegativeResultCache"):
+        self.metadata = metadata
+        self.negative_cache = negative_cache
+
+    def describe(self) -> Iterator[GaugeMetricFamily]:
+        """Names only -> registering does not query the index (prometheus_client calls collect() otherwise)"""
+        for name in (
+            "mipserver_object_store_objects",
+            "mipserver_object_store_bytes",
+            "mipserver_package_jsons",
+            "mipserver_package_json_bytes",
+            "mipserver_metadata_pending_writes",
+            "mipserver_negative_cache_entries",
+        ):
+            yield GaugeMetricFamily(name, "")
+        yield GaugeMetricFamily("mipserver_build_jobs", "", labels=["state"])
+
+    def collect(self) -> Iterator[GaugeMetricFamily]:
+        objects, object_bytes = self.metadata.object_totals()
+        builds, json_bytes = self.metadata.json_totals()
+
+        yield GaugeMetricFamily("mipserver_object_store_objects", "Objects in the object store", value=objects)
+        yield GaugeMetricFamily("mipserver_object_store_bytes", "Size of the object store", value=object_bytes)
+        yield GaugeMetricFamily("mipserver_package_jsons", "Package jsons (builds) in the cache", value=builds)
+        yield GaugeMetricFamily("mipserver_package_json_bytes", "Size of all package jsons", value=json_bytes)
+        yield GaugeMetricFamily(
+            "mipserver_metadata_pending_writes",
+            "Buffered metadata updates not yet flushed",
+            value=self.metadata.pending_writes(),
+        )
+        yield GaugeMetricFamily(
+            "mipserver_negative_cache_entries", "Entries in the negative result cache", value=len(self.negative_cache)
+        )
+        jobs = GaugeMetricFamily("mipserver_build_jobs", "Build jobs in the queue by state", labels=["state"])
+        counts: Dict[str, int] = self.metadata.build_job_counts()
+        for state in ("queued", "running"):
+            jobs.add_metric([state], counts.get(state, 0))
+        yield jobs
+
+
+def register_cache_collector(
+    metadata: "MetadataStore", negative_cache: "NegativeResultCache", registry: Optional[CollectorRegistry] = None
+) -> CacheCollector:
+    collector: CacheCollector = CacheCollector(metadata, negative_cache)
+    (registry or REGISTRY).register(collector)
+    return collector
+
+
+class RequestMetricsMiddleware:
+    """Plain ASGI middleware (no BaseHTTPMiddleware overhead) observing the latency per route template"""
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started: float = time.perf_counter()
+        status: int = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            REQUEST_DURATION.labels(
+                method=scope["method"],
+                route=getattr(route, "path", "unmatched"),  # template -> bounded cardinality
+                status=str(status),
+            ).observe(time.perf_counter() - started)
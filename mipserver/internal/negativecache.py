@@ -0,0 +1,132 @@
+import threading
+import time
+from collections import OrderedDict
+from enum import StrEnum
+from typing import Dict, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from mipserver.config import NegativeCache
+
+
+class NegativeReason(StrEnum):
+    unknown_package = "unknown_package"
+    missing_ref = "missing_ref"
+    build_failed = "build_failed"
+
+
+# http status a cached failure is answered with
+NEGATIVE_REASON_STATUS: Dict[NegativeReason, int] = {
+    NegativeReason.unknown_package: 404,
+    NegativeReason.missing_ref: 404,
+    NegativeReason.build_failed: 422,
+}
+
+
+class NegativeEntry(BaseModel):
+    reason: NegativeReason
+    message: str
+    commit: Optional[str] = None  # upstream commit the failure applies to (if known)
+    expires_at: float  # time.monotonic() based
+
+    @property
+    def status_code(self) -> int:
+        return NEGATIVE_REASON_STATUS[self.reason]
+
+    def retry_after(self, now: Optional[float] = None) -> int:
+        now = time.monotonic() if now is None else now
+        return max(1, int(self.expires_at - now) + 1)
+
+    def is_expired(self, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        return self.expires_at <= now
+
+
+# (package_name, pversion, mpy_version) -> mpy_version is "*" for failures independent of the target
+NegativeKey = Tuple[str, str, str]
+
+
+class NegativeResultCache:
+    """TTL-bounded cache of failed package lookups/builds.
+
+    Expired entries are kept (until evicted by max_entries) so that the caller can compare the commit the failure
+    applied to with the current upstream commit and re-arm the entry without fetching/compiling again.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    ANY_TARGET: str = "*"
+
+    def __init__(self, cfg: NegativeCache):
+        self.cfg = cfg
+        self._entries: "OrderedDict[NegativeKey, NegativeEntry]" = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def ttl_for(self, reason: NegativeReason) -> int:
+        match reason:
+            case NegativeReason.unknown_package:
+                return self.cfg.unknown_package_ttl_seconds
+            case NegativeReason.missing_ref:
+                return self.cfg.missing_ref_ttl_seconds
+            case NegativeReason.build_failed:
+                return self.cfg.build_failed_ttl_seconds
+
+    def get(self, key: NegativeKey) -> NegativeEntry | None:
+        """Returns the entry for key (or for the target independent variant of key) - may be expired!"""
+        with self._lock:
+            entry: NegativeEntry | None = self._entries.get(key)
+            if entry is None and key[2] != self.ANY_TARGET:
+                entry = self._entries.get((key[0], key[1], self.ANY_TARGET))
+            return entry
+
+    def put(
+        self, key: NegativeKey, reason: NegativeReason, message: str, commit: Optional[str] = None
+    ) -> NegativeEntry | None:
+        ttl: int = self.ttl_for(reason)
+        if ttl <= 0:
+            return None
+
+        entry: NegativeEntry = NegativeEntry(
+            reason=reason, message=message, commit=commit, expires_at=time.monotonic() + ttl
+        )
+        self.logger.info(f"caching failure for {key=}: {reason.value} {commit=} {ttl=}s")
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.cfg.max_entries:
+                self._entries.popitem(last=False)
+
+        return entry
+
+    def rearm(self, key: NegativeKey, entry: NegativeEntry) -> NegativeEntry | None:
+        """Upstream did not change since the failure -> keep serving it for another ttl"""
+        return self.put(key, entry.reason, entry.message, entry.commit)
+
+    def invalidate(self, package_name: str, pversion: Optional[str] = None) -> int:
+        with self._lock:
+            keys = [k for k in self._entries if k[0] == package_name and (pversion is None or k[1] == pversion)]
+            for k in keys:
+                del self._entries[k]
+        return len(keys)
+
+    def invalidate_on_new_commit(self, package_name: str, pversion: str, commit: str) -> int:
+        """Drops all failures of package_name@pversion that were recorded for another (or an unknown) commit"""
+        with self._lock:
+            keys = [
+                k for k, e in self._entries.items() if k[0] == package_name and k[1] == pversion and e.commit != commit
+            ]
+            for k in keys:
+                del self._entries[k]
+
+        if keys:
+            self.logger.info(f"new upstream commit {commit} for {package_name}@{pversion} -> dropped {len(keys)}")
+        return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,118 @@
+import hashlib
+import os
+import socket
+from typing import Any, Dict, Optional
+
+from loguru import logger
+from pydantic import BaseModel
+
+from mipserver.config import Mqtt
+from mipserver.internal.metadata import BuildRecord
+
+
+class BuildNotification(BaseModel):
+    package_name: str
+    mpy_version: str
+    pversion: str
+    build_id: str  # commit/revision the build was made from, the digest if unknown
+    commit: Optional[str] = None
+    digest: str  # sha256 over the sorted (path, hash) list -> equal digest == identical install
+    files: int
+    changed_files: int  # added, removed or changed compared to the previous build
+    built_at: float
+    url: str  # what a device fetches next
+
+
+def hash_list_digest(build: BuildRecord) -> str:
+    h = hashlib.sha256()
+    for f in sorted(build.files, key=lambda f: f.path):
+        h.update(f"{f.path}\0{f.hash}\n".encode())
+    return h.hexdigest()
+
+
+def build_notification(current: BuildRecord, previous: Optional[BuildRecord]) -> BuildNotification | None:
+    """Notification for current (built with files) -> None if nothing changed for a device since previous"""
+    digest: str = hash_list_digest(current)
+    if previous is not None and previous.commit == current.commit and hash_list_digest(previous) == digest:
+        return None
+
+    before: Dict[str, str] = {f.path: f.hash for f in previous.files} if previous is not None else {}
+    after: Dict[str, str] = {f.path: f.hash for f in current.files}
+    changed: int = sum(1 for p in before.keys() | after.keys() if before.get(p) != after.get(p))
+    return BuildNotification(
+        package_name=current.package_name,
+        mpy_version=current.mpy_version,
+        pversion=current.pversion,
+        build_id=current.commit or digest,
+        commit=current.commit,
+        digest=digest,
+        files=len(after),
+        changed_files=changed,
+        built_at=current.built_at,
+        url=f"/package/{current.mpy_version}/{current.package_name}/{current.pversion}.json",
+    )
+
+
+class BuildNotifier:
+    """Publishes a retained message per package/target over MQTT whenever a build changes
+
+    Topic: <TOPIC_PREFIX>/package/<mpy_version>/<package_name>/<pversion>. Retained -> a device that subscribes
+    (again) immediately gets the current state and only fetches the package json if build_id/digest differ from
+    what it has installed. The client runs its own network thread, reconnects on its own and queues messages
+    (QOS > 0) while the broker is not reachable.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, cfg: Mqtt):
+        self.cfg = cfg
+        self._client: Any = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.cfg.NOTIFY_ENABLED
+
+    def topic_for(self, mpy_version: str, package_name: str, pversion: str) -> str:
+        return f"{self.cfg.TOPIC_PREFIX.rstrip('/')}/package/{mpy_version}/{package_name}/{pversion}"
+
+    def start(self) -> None:
+        if not self.enabled or self._client is not None:
+            return
+        try:  # optional: only needed with MQTT.NOTIFY_ENABLED -> not imported before (startup time)
+            import paho.mqtt.client as paho
+        except ImportError as e:  # pragma: no cover
+            raise RuntimeError("MQTT.NOTIFY_ENABLED requires the paho-mqtt package (pip install paho-mqtt)") from e
+
+        client_id: str = self.cfg.CLIENT_ID or f"mipserver-{socket.gethostname()}-{os.getpid()}"
+        client = paho.Client(paho.CallbackAPIVersion.VERSION2, client_id=client_id)
+        client.username_pw_set(self.cfg.USERNAME, self.cfg.PASSWORD)
+        if self.cfg.TLS:
+            client.tls_set()
+        client.reconnect_delay_set(min_delay=1, max_delay=60)
+        client.connect_async(self.cfg.HOST, self.cfg.PORT, keepalive=self.cfg.KEEPALIVE_SECONDS)
+        client.loop_start()
+        self._client = client
+        self.logger.info(f"publishing build notifications to {self.cfg.HOST}:{self.cfg.PORT} as {client_id}")
+
+    def stop(self) -> None:
+        if self._client is None:
+            return
+        self._client.disconnect()
+        self._client.loop_stop()
+        self._client = None
+
+    def publish(self, notification: BuildNotification) -> None:
+        if self._client is None:
+            return
+        topic: str = self.topic_for(notification.mpy_version, notification.package_name, notification.pversion)
+        try:
+            self._client.publish(topic, notification.model_dump_json(), qos=self.cfg.QOS, retain=True)
+        except Exception as e:  # a notification must never fail the build request
+            self.logger.opt(exception=e).warning(f"publishing to {topic} failed")
+            return
+        self.logger.debug(f"{topic} <- {notification.build_id} ({notification.changed_files} files changed)")
+
+    def build_changed(self, current: BuildRecord, previous: Optional[BuildRecord]) -> None:
+        notification: BuildNotification | None = build_notification(current, previous)
+        if notification is not None:
+            self.publish(notification)
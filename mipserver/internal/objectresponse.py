@@ -0,0 +1,86 @@
+import os
+import re
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+
+from mipserver.internal.metrics import FILE_RANGE_REQUESTS
+
+# an object never changes under its hash -> clients and proxies may keep it forever
+IMMUTABLE: str = "public, max-age=31536000, immutable"
+
+_SINGLE_RANGE = re.compile(r"^bytes=\s*(\d*)-(\d*)\s*$")
+
+
+def object_etag(obj_hash: str) -> str:
+    return f'"{obj_hash.lower()}"'
+
+
+class ObjectFileResponse(FileResponse):
+    """An object of the content-addressed store, resumable
+
+    The ETag is the sha256 of the content -> the same on every replica and after the object was stored again (gc,
+    peer fetch, snapshot import), so "If-Range" resumes a broken download instead of restarting it. Range, If-Range
+    and multi-range (multipart/byteranges) are answered by FileResponse; a whole object goes out via the
+    http.response.pathsend extension (zero copy) if the server offers it.
+    """
+
+    def __init__(self, path: Path, obj_hash: str, stat_result: Optional[os.stat_result] = None):
+        headers: Dict[str, str] = {"ETag": object_etag(obj_hash), "Cache-Control": IMMUTABLE, "Accept-Ranges": "bytes"}
+        super().__init__(path, media_type="application/octet-stream", headers=headers, stat_result=stat_result)
+
+
+def object_response(path: Path, obj_hash: str, stat_result: os.stat_result, request: Request) -> Response:
+    """304 if the client has the object already, otherwise (a part of) it"""
+    etag: str = object_etag(obj_hash)
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE})
+    if "range" in request.headers:
+        FILE_RANGE_REQUESTS.labels(resumed="true" if "if-range" in request.headers else "false").inc()
+    return ObjectFileResponse(path, obj_hash, stat_result)
+
+
+def _single_range(header: str, size: int) -> Tuple[int, int] | None:
+    """(start, end inclusive) of "bytes=a-b", "bytes=a-" or "bytes=-n" -> ValueError if not satisfiable,
+    None for anything else (several ranges, other units) -> the whole object, which a server may always send"""
+    m = _SINGLE_RANGE.match(header)
+    if m is None or m.group(1) == m.group(2) == "":
+        return None
+    if m.group(1) == "":  # suffix: the last n bytes
+        start, end = max(0, size - int(m.group(2))), size - 1
+    else:
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+
+def packed_object_response(view: memoryview, obj_hash: str, request: Request) -> Response:
+    """Like object_response() for an object inside a pack file: the body is a slice of the mapped pack (no copy)
+
+    Range and If-Range are honoured for a single range; several ranges get the whole object.
+    """
+    etag: str = object_etag(obj_hash)
+    headers: Dict[str, str] = {"ETag": etag, "Cache-Control": IMMUTABLE, "Accept-Ranges": "bytes"}
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": IMMUTABLE})
+
+    size: int = len(view)
+    range_header: str | None = request.headers.get("range")
+    if range_header is not None:
+        if_range: str | None = request.headers.get("if-range")
+        FILE_RANGE_REQUESTS.labels(resumed="true" if if_range is not None else "false").inc()
+        if if_range is None or if_range == etag:
+            try:
+                part: Tuple[int, int] | None = _single_range(range_header, size)
+            except ValueError:
+                return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+            if part is not None:
+                start, end = part
+                headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+                body: memoryview = view[start : end + 1]
+                return Response(body, status_code=206, headers=headers, media_type="application/octet-stream")
+    return Response(view, headers=headers, media_type="application/octet-stream")
@@ -0,0 +1,162 @@
+import io
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterator, Optional, Tuple
+
+from loguru import logger
+
+from mipserver.internal.metrics import OBJECT_WRITE_DURATION, OBJECT_WRITTEN_BYTES
+from mipserver.internal.packstore import PackStore
+from mipserver.internal.tracing import span
+
+# (shortened) hash of a package json entry: hex only and long enough to name a single object
+SHORT_HASH: re.Pattern[str] = re.compile(r"^[0-9a-f]{8,64}$")
+
+
+class LooseObjectStore:
+    """Content addressed store with one file per object: <root>/<hash[0:2]>/<hash>
+
+    With packs, small objects are moved into pack files in the background -> has/size/open/delete look there too,
+    new objects are always written loose first.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, root: Path, packs: Optional[PackStore] = None):
+        self.root = root
+        self.packs = packs
+        # marks a stored object as fresh in the index before a build references it (see reuse)
+        self.on_reuse: Callable[[str], object] | None = None
+
+    def path_for(self, obj_hash: str) -> Path:
+        """Where the object is (or would be) stored loose"""
+        return Path(self.root, obj_hash[0:2], obj_hash)
+
+    def has(self, obj_hash: str) -> bool:
+        return self.path_for(obj_hash).is_file() or (self.packs is not None and self.packs.has(obj_hash))
+
+    def reuse(self, obj_hash: str) -> bool:
+        """True if the object is stored and stays stored for the build that is about to reference it
+
+        The gc removes unreferenced objects -> on_reuse marks the object as fresh first (the gc keeps fresh ones),
+        then it is checked again: a gc that got in between has removed it completely, so it is written anew.
+        """
+        if not self.has(obj_hash):
+            return False
+        if self.on_reuse is None:
+            return True
+        self.on_reuse(obj_hash)
+        return self.has(obj_hash)
+
+    def size(self, obj_hash: str) -> int:
+        """Size of the object -> FileNotFoundError if it is not stored"""
+        try:
+            return self.path_for(obj_hash).stat().st_size
+        except FileNotFoundError:
+            size: int | None = self.packs.size(obj_hash) if self.packs is not None else None
+            if size is None:
+                raise
+            return size
+
+    def open(self, obj_hash: str) -> BinaryIO:
+        """The content of the object -> FileNotFoundError if it is not stored"""
+        try:
+            return open(self.path_for(obj_hash), "rb")
+        except FileNotFoundError:
+            view: memoryview | None = self.packs.read(obj_hash) if self.packs is not None else None
+            if view is None:
+                raise
+            return io.BytesIO(view)
+
+    def find_by_prefix(self, prefix: str) -> str | None:
+        """Full hash of an object whose hash starts with prefix (mip indexes may list shortened hashes)"""
+        prefix = prefix.lower()
+        if len(prefix) == 64:
+            return prefix if self.has(prefix) else None
+        if self.packs is not None and (packed := self.packs.find_by_prefix(prefix)) is not None:
+            return packed
+        try:
+            with os.scandir(Path(self.root, prefix[0:2])) as entries:
+                for e in entries:
+                    if e.name.startswith(prefix) and e.is_file(follow_symlinks=False):
+                        return e.name
+        except FileNotFoundError:
+            pass
+        return None
+
+    def put_file(self, srcfile: Path, obj_hash: str) -> Path:
+        """Copies srcfile into the store unless the object already exists"""
+
+        def _copy(fout: BinaryIO) -> None:
+            with open(srcfile, "rb") as fin:
+                while True:
+                    data: bytes = fin.read(65_536)
+                    if not data:
+                        break
+                    fout.write(data)
+
+        return self._publish(obj_hash, _copy)
+
+    def put_bytes(self, data: bytes, obj_hash: str) -> Path:
+        return self._publish(obj_hash, lambda fout: fout.write(data))
+
+    def _publish(self, obj_hash: str, write: Callable[[BinaryIO], object]) -> Path:
+        """Writes to a temp file next to the target and renames it -> readers never see partial objects"""
+        target: Path = self.path_for(obj_hash)
+        if self.reuse(obj_hash):
+            return target
+
+        started: float = time.perf_counter()
+        with span("store", hash=obj_hash):
+            target.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=target.parent, prefix=f".{obj_hash}.", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as fout:
+                    write(fout)
+                os.replace(tmpname, target)
+            except BaseException:
+                Path(tmpname).unlink(missing_ok=True)
+                raise
+
+        OBJECT_WRITE_DURATION.observe(time.perf_counter() - started)
+        OBJECT_WRITTEN_BYTES.inc(target.stat().st_size)
+
+        return target
+
+    def delete(self, obj_hash: str) -> int:
+        """Removes the object -> returns the number of bytes freed"""
+        size: int = self.packs.delete(obj_hash) if self.packs is not None else 0
+        p: Path = self.path_for(obj_hash)
+        try:
+            size = p.stat().st_size
+            p.unlink()
+        except FileNotFoundError:
+            pass
+        return size
+
+    def iter_objects(self) -> Iterator[Tuple[str, int, float]]:
+        """Yields (hash, size, mtime) for every object in the store, loose or packed"""
+        for obj_hash, st in self.iter_loose():
+            yield obj_hash, st.st_size, st.st_mtime
+        if self.packs is not None:
+            packed_at: float = time.time()
+            for obj_hash, size in self.packs.iter_objects():
+                yield obj_hash, size, packed_at
+
+    def iter_loose(self) -> Iterator[Tuple[str, os.stat_result]]:
+        """Yields (hash, stat) for every object stored as a file of its own"""
+        if not self.root.is_dir():
+            return
+
+        with os.scandir(self.root) as shards:
+            for shard in shards:
+                if not shard.is_dir(follow_symlinks=False):
+                    continue
+                with os.scandir(shard.path) as entries:
+                    for e in entries:
+                        if e.name.startswith(".") or not e.is_file(follow_symlinks=False):
+                            continue
+                        yield e.name, e.stat(follow_symlinks=False)
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Iterable, Tuple
+
+from fastapi import Request, Response
+from loguru import logger
+from pydantic import BaseModel
+
+from mipserver.internal.metadata import BuildKey, BuildRecord, MetadataStore
+
+
+def compact_json(data: Any) -> bytes:
+    """The bytes a package json is written and served as (no whitespace -> smaller, nothing to re-format)"""
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def render_package_json(hashes: Iterable[Tuple[str, str]]) -> bytes:
+    """{"hashes": [[path, sha256], ...]} straight from tuples -> no per-file models and serializers"""
+    return compact_json({"hashes": [[path, digest] for path, digest in hashes]})
+
+
+class PackageBody(BaseModel):
+    body: bytes
+    etag: str
+    # the build the body belongs to -> a rebuild (new json_path/built_at) replaces it
+    json_path: str
+    built_at: float
+
+    @classmethod
+    def from_bytes(cls, data: bytes, build: BuildRecord) -> "PackageBody":
+        return cls(
+            body=data,
+            etag=f'"{hashlib.sha256(data).hexdigest()[:32]}"',
+            json_path=build.json_path,
+            built_at=build.built_at,
+        )
+
+
+class PackageBodyCache:
+    """Final response bytes (plus ETag) of the package jsons, read once per build and kept LRU up to max_bytes
+
+    Requests are answered with the bytes as they are -> no file read, no model validation or serialization.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._bodies: "OrderedDict[BuildKey, PackageBody]" = OrderedDict()
+        self._bytes: int = 0
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, metadata: MetadataStore, build: BuildRecord) -> PackageBody | None:
+        """Body of build -> None if its json is gone (collected)"""
+        key: BuildKey = (build.package_name, build.mpy_version, build.pversion)
+        with self._lock:
+            cached: PackageBody | None = self._bodies.get(key)
+            if cached is not None and cached.json_path == build.json_path and cached.built_at == build.built_at:
+                self._bodies.move_to_end(key)
+                return cached
+
+        try:
+            data: bytes = metadata.absolute_json_path(build).read_bytes()
+        except OSError:
+            self.discard(key)
+            return None
+        if b"\n" in data:  # written indented by an older version -> compacted once
+            data = compact_json(json.loads(data))
+
+        body: PackageBody = PackageBody.from_bytes(data, build)
+        self._put(key, body)
+        return body
+
+    def _put(self, key: BuildKey, body: PackageBody) -> None:
+        if len(body.body) > self.max_bytes:
+            return
+        with self._lock:
+            previous: PackageBody | None = self._bodies.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous.body)
+            self._bodies[key] = body
+            self._bytes += len(body.body)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._bodies.popitem(last=False)
+                self._bytes -= len(evicted.body)
+
+    def discard(self, key: BuildKey) -> None:
+        with self._lock:
+            previous: PackageBody | None = self._bodies.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous.body)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._bodies.clear()
+            self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._bodies)
+
+
+def package_json_response(body: PackageBody, request: Request) -> Response:
+    """The precomputed body as it is; 304 if the client already has it (If-None-Match)"""
+    headers = {"ETag": body.etag}
+    if body.etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body.body, media_type="application/json", headers=headers)
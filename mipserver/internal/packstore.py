@@ -0,0 +1,365 @@
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from mipserver.config import Packs
+from mipserver.internal.locks import LockManager
+
+# one index/journal entry: sha256, pack number, offset, length (length TOMBSTONE -> deleted)
+_ENTRY: struct.Struct = struct.Struct(">32sIQI")
+TOMBSTONE: int = 0xFFFFFFFF
+
+# (pack number, offset, length)
+PackLocation = Tuple[int, int, int]
+
+
+class PackReport(BaseModel):
+    duration_seconds: float = 0.0
+    packed_objects: int = 0  # loose files moved into packs
+    packed_bytes: int = 0
+    indexed_objects: int = 0  # objects in the index after the compaction
+    rewritten_packs: int = 0
+    reclaimed_bytes: int = 0  # of deleted objects
+
+
+class _SortedIndex:
+    """Read-only view of pack.idx: fixed-size entries sorted by hash -> binary search directly on the mmap"""
+
+    def __init__(self, path: Path):
+        self._mm: mmap.mmap | None = None
+        self.ino: int = 0
+        try:
+            with open(path, "rb") as f:
+                st: os.stat_result = os.fstat(f.fileno())
+                self.ino = st.st_ino
+                if st.st_size >= _ENTRY.size:
+                    self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            pass
+        self.count: int = len(self._mm) // _ENTRY.size if self._mm is not None else 0
+
+    def _key(self, i: int) -> bytes:
+        assert self._mm is not None
+        return self._mm[i * _ENTRY.size : i * _ENTRY.size + 32]
+
+    def _lower_bound(self, key: bytes) -> int:
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid: int = (lo + hi) // 2
+            if self._key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def entry(self, i: int) -> Tuple[bytes, PackLocation]:
+        assert self._mm is not None
+        digest, pack, offset, length = _ENTRY.unpack_from(self._mm, i * _ENTRY.size)
+        return digest, (pack, offset, length)
+
+    def get(self, digest: bytes) -> PackLocation | None:
+        i: int = self._lower_bound(digest)
+        if i < self.count and self._key(i) == digest:
+            return self.entry(i)[1]
+        return None
+
+    def from_prefix(self, prefix: bytes) -> Iterator[Tuple[bytes, PackLocation]]:
+        for i in range(self._lower_bound(prefix), self.count):
+            digest, loc = self.entry(i)
+            if not digest.startswith(prefix):
+                return
+            yield digest, loc
+
+    def __iter__(self) -> Iterator[Tuple[bytes, PackLocation]]:
+        for i in range(self.count):
+            yield self.entry(i)
+
+
+class PackStore:
+    """Small objects in append-only pack files instead of one file (inode) per object
+
+    <root>/pack-<n>.pack  objects back to back, never modified once written (only rewritten as a whole)
+    <root>/pack.idx       sorted fixed-size entries -> memory mapped, a lookup is a binary search without syscalls
+    <root>/pack.journal   entries (and deletions) since the last compaction, replayed into memory
+
+    Loose objects are moved in and the journal is merged into the index by maintain() in the background, packs
+    with many deleted objects are rewritten then. Writers (any worker) take the "packs" lock; readers never lock
+    and pick up the changes of other workers when a lookup misses or a pack went away.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    INDEX: str = "pack.idx"
+    JOURNAL: str = "pack.journal"
+    LOCK: str = "packs"
+    _PACK_RE = re.compile(r"^pack-(\d+)\.pack$")
+
+    def __init__(self, root: Path, cfg: Packs, locks: LockManager):
+        self.root = root
+        self.cfg = cfg
+        self.locks = locks
+        self._lock: threading.Lock = threading.Lock()
+        self._maps: Dict[int, mmap.mmap] = {}
+        self._index: _SortedIndex = _SortedIndex(Path(root, self.INDEX))
+        self._journal: Dict[bytes, PackLocation] = {}
+        self._journal_pos: int = 0
+        self._journal_ino: int = 0
+        self._refresh()
+
+    # ---- paths
+
+    def pack_path(self, pack: int) -> Path:
+        return Path(self.root, f"pack-{pack:06d}.pack")
+
+    def pack_numbers(self) -> List[int]:
+        if not self.root.is_dir():
+            return []
+        return sorted(int(m.group(1)) for p in self.root.iterdir() if (m := self._PACK_RE.match(p.name)))
+
+    # ---- reading
+
+    def _refresh(self) -> None:
+        """Applies what other workers appended to the journal; reloads everything after a compaction
+
+        a compaction replaces the index before the journal -> one stat of the journal tells whether anything changed
+        """
+        journal_path: Path = Path(self.root, self.JOURNAL)
+        try:
+            jst: os.stat_result | None = journal_path.stat()
+        except FileNotFoundError:
+            jst = None
+        if jst is not None and jst.st_ino == self._journal_ino and jst.st_size == self._journal_pos:
+            return
+
+        with self._lock:
+            index_path: Path = Path(self.root, self.INDEX)
+            try:
+                index_ino: int = index_path.stat().st_ino
+            except FileNotFoundError:
+                index_ino = 0
+
+            if index_ino != self._index.ino or (jst is not None and jst.st_ino != self._journal_ino):
+                # not closed: lookups run without the lock and may still search the old one, unmapped once unused
+                self._index = _SortedIndex(index_path)
+                self._journal, self._journal_pos = {}, 0
+                self._journal_ino = jst.st_ino if jst is not None else 0
+                self._maps = {}  # not closed: responses may still send slices of them
+
+            if jst is None or jst.st_size - self._journal_pos < _ENTRY.size:
+                return
+            with open(journal_path, "rb") as f:
+                f.seek(self._journal_pos)
+                data: bytes = f.read((jst.st_size - self._journal_pos) // _ENTRY.size * _ENTRY.size)
+            for digest, pack, offset, length in _ENTRY.iter_unpack(data):
+                self._journal[digest] = (pack, offset, length)
+            self._journal_pos += len(data)
+
+    def _lookup(self, digest: bytes) -> PackLocation | None:
+        loc: PackLocation | None = self._journal.get(digest)
+        if loc is None:
+            loc = self._index.get(digest)
+        return None if loc is None or loc[2] == TOMBSTONE else loc
+
+    def locate(self, obj_hash: str) -> PackLocation | None:
+        digest: bytes = bytes.fromhex(obj_hash)
+        loc: PackLocation | None = self._lookup(digest)
+        if loc is None and digest not in self._journal:  # maybe packed by another worker since the last refresh
+            self._refresh()
+            loc = self._lookup(digest)
+        return loc
+
+    def has(self, obj_hash: str) -> bool:
+        return self.locate(obj_hash) is not None
+
+    def size(self, obj_hash: str) -> int | None:
+        loc: PackLocation | None = self.locate(obj_hash)
+        return loc[2] if loc is not None else None
+
+    def _map(self, pack: int) -> mmap.mmap:
+        m: mmap.mmap | None = self._maps.get(pack)
+        if m is None:
+            with open(self.pack_path(pack), "rb") as f:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with self._lock:
+                self._maps[pack] = m
+        return m
+
+    def read(self, obj_hash: str) -> memoryview | None:
+        """The object as a slice of the mapped pack (no copy) -> None if it is not packed"""
+        for attempt in range(2):
+            loc: PackLocation | None = self.locate(obj_hash)
+            if loc is None:
+                return None
+            pack, offset, length = loc
+            try:
+                m: mmap.mmap = self._map(pack)
+            except FileNotFoundError:  # rewritten by a compaction in another worker
+                self._refresh()
+                continue
+            if offset + length <= len(m):
+                return memoryview(m)[offset : offset + length]
+            self._maps.pop(pack, None)  # the pack grew since it was mapped
+        return None
+
+    def find_by_prefix(self, prefix: str) -> str | None:
+        if len(prefix) % 2:  # whole bytes only -> search the even part, filter the rest
+            candidates = self._candidates(prefix[:-1])
+        else:
+            candidates = self._candidates(prefix)
+        for obj_hash in candidates:
+            if obj_hash.startswith(prefix) and self.has(obj_hash):
+                return obj_hash
+        return None
+
+    def _candidates(self, prefix: str) -> Iterator[str]:
+        raw: bytes = bytes.fromhex(prefix)
+        for digest in list(self._journal):
+            if digest.startswith(raw):
+                yield digest.hex()
+        for digest, _ in self._index.from_prefix(raw):
+            yield digest.hex()
+
+    def iter_objects(self) -> Iterator[Tuple[str, int]]:
+        """(hash, size) of every packed object"""
+        self._refresh()
+        journal: Dict[bytes, PackLocation] = dict(self._journal)
+        for digest, loc in self._index:
+            loc = journal.pop(digest, loc)
+            if loc[2] != TOMBSTONE:
+                yield digest.hex(), loc[2]
+        for digest, loc in journal.items():
+            if loc[2] != TOMBSTONE:
+                yield digest.hex(), loc[2]
+
+    # ---- writing (callers hold the "packs" lock)
+
+    def _append_journal(self, entries: List[Tuple[bytes, PackLocation]]) -> None:
+        with open(Path(self.root, self.JOURNAL), "ab") as f:
+            f.write(b"".join(_ENTRY.pack(d, *loc) for d, loc in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        self._refresh()
+
+    def add_loose(self, paths: List[Tuple[str, Path]]) -> Tuple[int, int]:
+        """Appends the files to the newest pack (a new one when it is full) -> (objects, bytes) packed"""
+        numbers: List[int] = self.pack_numbers()
+        pack: int = numbers[-1] if numbers else 1
+        entries: List[Tuple[bytes, PackLocation]] = []
+        packed_bytes: int = 0
+        fout = open(self.pack_path(pack), "ab")
+        try:
+            for obj_hash, path in paths:
+                if self.has(obj_hash):
+                    continue
+                try:
+                    data: bytes = path.read_bytes()
+                except FileNotFoundError:  # collected meanwhile
+                    continue
+                if fout.tell() > 0 and fout.tell() + len(data) > self.cfg.max_pack_bytes:
+                    fout.flush()
+                    os.fsync(fout.fileno())
+                    fout.close()
+                    pack += 1
+                    fout = open(self.pack_path(pack), "ab")
+                entries.append((bytes.fromhex(obj_hash), (pack, fout.tell(), len(data))))
+                fout.write(data)
+                packed_bytes += len(data)
+            fout.flush()
+            os.fsync(fout.fileno())  # objects on disk before the entries pointing to them
+        finally:
+            fout.close()
+        if entries:
+            self._append_journal(entries)
+        return len(entries), packed_bytes
+
+    def delete(self, obj_hash: str) -> int:
+        """Marks the object deleted -> bytes freed once its pack is rewritten"""
+        with self.locks.lock(self.LOCK):
+            loc: PackLocation | None = self.locate(obj_hash)
+            if loc is None:
+                return 0
+            self._append_journal([(bytes.fromhex(obj_hash), (loc[0], loc[1], TOMBSTONE))])
+            return loc[2]
+
+    def compact(self, report: PackReport) -> None:
+        """Merges the journal into a new index; rewrites packs in which deleted objects waste too much space"""
+        self._refresh()
+        live: Dict[bytes, PackLocation] = {d: loc for d, loc in self._index}
+        for digest, loc in self._journal.items():
+            if loc[2] == TOMBSTONE:
+                live.pop(digest, None)
+            else:
+                live[digest] = loc
+
+        numbers: List[int] = self.pack_numbers()
+        live_bytes: Dict[int, int] = {n: 0 for n in numbers}
+        for pack, _, length in live.values():
+            live_bytes[pack] = live_bytes.get(pack, 0) + length
+        wasteful: List[int] = []
+        for n in numbers[:-1]:  # the newest pack is still being filled
+            size: int = self.pack_path(n).stat().st_size
+            if size and (size - live_bytes[n]) / size >= self.cfg.rewrite_dead_ratio:
+                wasteful.append(n)
+                report.reclaimed_bytes += size - live_bytes[n]
+
+        if wasteful:
+            target: int = (numbers[-1] if numbers else 0) + 1
+            fout = open(self.pack_path(target), "ab")
+            try:
+                for digest, (pack, offset, length) in sorted(live.items(), key=lambda kv: kv[1][:2]):
+                    if pack not in wasteful:
+                        continue
+                    if fout.tell() > 0 and fout.tell() + length > self.cfg.max_pack_bytes:
+                        fout.close()
+                        target += 1
+                        fout = open(self.pack_path(target), "ab")
+                    data: bytes = bytes(self._map(pack)[offset : offset + length])
+                    live[digest] = (target, fout.tell(), length)
+                    fout.write(data)
+                fout.flush()
+                os.fsync(fout.fileno())
+            finally:
+                fout.close()
+            report.rewritten_packs = len(wasteful)
+
+        tmp: Path = Path(self.root, f".{self.INDEX}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(b"".join(_ENTRY.pack(d, *live[d]) for d in sorted(live)))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, Path(self.root, self.INDEX))
+        tmp_journal: Path = Path(self.root, f".{self.JOURNAL}.{os.getpid()}.tmp")
+        tmp_journal.touch()
+        os.replace(tmp_journal, Path(self.root, self.JOURNAL))
+        self._refresh()
+        for n in wasteful:  # readers that still map them keep their mapping
+            self.pack_path(n).unlink(missing_ok=True)
+        report.indexed_objects = len(live)
+
+    def maintain(self, loose: Iterator[Tuple[str, Path, int]], timeout: Optional[float] = 0) -> PackReport:
+        """Moves small loose objects (hash, path, size) into packs and compacts -> LockTimeout if another worker is"""
+        started: float = time.monotonic()
+        report: PackReport = PackReport()
+        with self.locks.lock(self.LOCK, timeout=timeout):
+            self.root.mkdir(parents=True, exist_ok=True)
+            candidates: List[Tuple[str, Path]] = [(h, p) for h, p, size in loose if size <= self.cfg.max_object_bytes]
+            report.packed_objects, report.packed_bytes = self.add_loose(candidates)
+            for obj_hash, path in candidates:
+                if self.has(obj_hash):
+                    path.unlink(missing_ok=True)
+            self.compact(report)
+        report.duration_seconds = time.monotonic() - started
+        self.logger.info(
+            f"packed {report.packed_objects} objects ({report.packed_bytes} bytes), {report.indexed_objects} indexed,"
+            f" {report.rewritten_packs} packs rewritten ({report.reclaimed_bytes} bytes reclaimed)"
+            f" in {report.duration_seconds:.2f}s"
+        )
+        return report
@@ -0,0 +1,170 @@
+import bisect
+import hashlib
+import json
+import re
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from mipserver.config import Peers
+from mipserver.Helper import atomic_write
+from mipserver.internal.metadata import BuildRecord, MetadataStore, build_record_from_package_json
+from mipserver.internal.metrics import PEER_FETCHED_BYTES, PEER_FETCHES
+from mipserver.internal.objectstore import LooseObjectStore
+
+# set on requests between replicas -> answered from the own cache/build, never passed on to further peers
+PEER_HEADER: str = "X-MIPServer-Peer"
+# commit (revision) a package json served to a peer was built from
+COMMIT_HEADER: str = "X-MIPServer-Commit"
+
+_SHA256: re.Pattern[str] = re.compile(r"^[0-9a-f]{64}$")
+
+
+class PeerCache:
+    """Fills the local cache from sibling replicas before going upstream
+
+    Objects are requested via the regular /file endpoint of the peers, package jsons via /peer/package (only what
+    a peer already built, at the requested commit -> never triggers a build there). Everything received is
+    verified against its sha256 before it is stored. With build_ownership a consistent hash ring over all
+    replicas assigns every package to one of them; the others ask the owner to build and fetch the result.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, cfg: Peers, metadata: MetadataStore, object_store: LooseObjectStore):
+        self.cfg = cfg
+        self.metadata = metadata
+        self.object_store = object_store
+        self.self_url: str | None = self._normalize(cfg.self_url) if cfg.self_url else None
+
+        self._session: requests.Session = requests.Session()
+        adapter: HTTPAdapter = HTTPAdapter(pool_connections=max(1, len(cfg.urls)), pool_maxsize=8)
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        self._ring: List[Tuple[int, str]] = self._build_ring()
+        self._ring_points: List[int] = [point for point, _ in self._ring]
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.peers())
+
+    @staticmethod
+    def _normalize(url: str) -> str:
+        return url.rstrip("/")
+
+    @staticmethod
+    def _point(key: str) -> int:
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+    def peers(self, first: Optional[str] = None) -> List[str]:
+        """Configured peers without this replica, first (e.g. the owner of a package) at the front"""
+        urls: List[str] = [self._normalize(u) for u in self.cfg.urls if self._normalize(u) != self.self_url]
+        if first in urls:
+            urls.remove(first)
+            urls.insert(0, first)
+        return urls
+
+    # ---- build ownership
+
+    def _build_ring(self) -> List[Tuple[int, str]]:
+        if not self.cfg.build_ownership or self.self_url is None:
+            return []
+        members: Set[str] = {self._normalize(u) for u in self.cfg.urls} | {self.self_url}
+        return sorted((self._point(f"{m}#{i}"), m) for m in members for i in range(self.cfg.virtual_nodes))
+
+    def owner(self, package_name: str) -> str | None:
+        """Replica that builds package_name -> None without build ownership"""
+        if not self._ring:
+            return None
+        i: int = bisect.bisect_left(self._ring_points, self._point(package_name)) % len(self._ring)
+        return self._ring[i][1]
+
+    def owned_by_peer(self, package_name: str) -> str | None:
+        """Owner of package_name if that is another replica"""
+        owner: str | None = self.owner(package_name)
+        return owner if owner is not None and owner != self.self_url else None
+
+    def request_build(self, peer: str, package_name: str, mpy_version: str, pversion: str) -> bool:
+        """Lets the owning replica build the package via its regular endpoint -> True if the build succeeded"""
+        resp = self._get(f"{peer}/package/{mpy_version}/{package_name}/{pversion}.json", self.cfg.build_timeout_seconds)
+        return resp is not None and resp.status_code == 200
+
+    # ---- cache fill
+
+    def fetch_object(self, obj_hash: str, peers: Optional[List[str]] = None) -> bool:
+        """Asks the peers for an object missing locally -> True once it is (verified) in the store"""
+        if not _SHA256.match(obj_hash):
+            return False
+        for peer in peers if peers is not None else self.peers():
+            resp = self._get(f"{peer}/file/{obj_hash[:2]}/{obj_hash}")
+            if resp is None:
+                PEER_FETCHES.labels(kind="object", result="error").inc()
+                continue
+            if resp.status_code != 200:
+                PEER_FETCHES.labels(kind="object", result="miss").inc()
+                continue
+            if hashlib.sha256(resp.content).hexdigest() != obj_hash:
+                self.logger.warning(f"{peer} sent a corrupt object {obj_hash}")
+                PEER_FETCHES.labels(kind="object", result="corrupt").inc()
+                continue
+            self.object_store.put_bytes(resp.content, obj_hash)
+            PEER_FETCHES.labels(kind="object", result="hit").inc()
+            PEER_FETCHED_BYTES.inc(len(resp.content))
+            return True
+        return False
+
+    def fetch_package_json(
+        self, package_name: str, mpy_version: str, pversion: str, commit: Optional[str], target: Path
+    ) -> BuildRecord | None:
+        """Package json a peer built at commit (None: its current build) incl. all objects -> recorded as own build"""
+        params: Dict[str, str] = {"commit": commit} if commit else {}
+        for peer in self.peers(first=self.owner(package_name)):
+            resp = self._get(f"{peer}/peer/package/{mpy_version}/{package_name}/{pversion}.json", params=params)
+            if resp is None:
+                PEER_FETCHES.labels(kind="package_json", result="error").inc()
+                continue
+            peer_commit: str | None = resp.headers.get(COMMIT_HEADER) or None
+            if resp.status_code != 200 or (commit is not None and peer_commit != commit):
+                PEER_FETCHES.labels(kind="package_json", result="miss").inc()
+                continue
+
+            try:
+                hashes: List[str] = [str(entry[1]) for entry in json.loads(resp.content)["hashes"]]
+            except (ValueError, KeyError, TypeError, IndexError):
+                hashes = [""]
+            if not all(_SHA256.match(h) for h in hashes):
+                self.logger.warning(f"{peer} sent an invalid package json for {package_name}@{pversion}")
+                PEER_FETCHES.labels(kind="package_json", result="corrupt").inc()
+                continue
+
+            # objects from the same peer first, it has them for sure
+            fallback: List[str] = [peer] + [p for p in self.peers() if p != peer]
+            if not all(self.object_store.reuse(h) or self.fetch_object(h, fallback) for h in hashes):
+                PEER_FETCHES.labels(kind="package_json", result="error").inc()
+                continue
+
+            target.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write(target, resp.content)
+            record: BuildRecord = build_record_from_package_json(
+                self.metadata, self.object_store, target, package_name, mpy_version, pversion, peer_commit
+            )
+            self.metadata.record_build(record)
+            PEER_FETCHES.labels(kind="package_json", result="hit").inc()
+            self.logger.info(f"{package_name}@{pversion} ({mpy_version}) at {peer_commit} filled from {peer}")
+            return record
+        return None
+
+    def _get(
+        self, url: str, timeout: Optional[float] = None, params: Optional[Dict[str, str]] = None
+    ) -> requests.Response | None:
+        try:
+            return self._session.get(
+                url, params=params, headers={PEER_HEADER: "1"}, timeout=timeout or self.cfg.timeout_seconds
+            )
+        except requests.RequestException as e:
+            self.logger.debug(f"GET {url} failed: {e!r}")
+            return None
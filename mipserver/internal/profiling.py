@@ -0,0 +1,177 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from functools import lru_cache
+from types import FrameType
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from mipserver.config import Profiling
+from mipserver.internal.metrics import EVENT_LOOP_BLOCKED, EVENT_LOOP_LAG
+
+
+class ProfilerBusy(Exception):
+    """Another profile of this worker is running"""
+
+
+@lru_cache(maxsize=4096)
+def _short_path(filename: str) -> str:
+    """mipserver/app.py, fastapi/routing.py, ... instead of absolute paths"""
+    for root in sorted((p for p in sys.path if p), key=len, reverse=True):
+        if filename.startswith(root + os.sep):
+            return filename[len(root) + 1 :]
+    return filename
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    # ";" separates the frames in the collapsed format, " " before the count is the last one on a line
+    return f"{code.co_qualname} ({_short_path(code.co_filename)}:{frame.f_lineno})".replace(";", ":")
+
+
+def thread_stack(frame: Optional[FrameType]) -> List[str]:
+    """Frames of a running thread, outermost first"""
+    ret: List[str] = []
+    while frame is not None:
+        ret.append(_frame_label(frame))
+        frame = frame.f_back
+    ret.reverse()
+    return ret
+
+
+def task_stack(task: asyncio.Task) -> List[str]:
+    """Frames of a suspended task (where it awaits), outermost first"""
+    return [_frame_label(f) for f in task.get_stack()]
+
+
+def collapse(samples: Dict[tuple[str, ...], int]) -> str:
+    """Brendan Gregg's collapsed stacks ("root;frame;leaf count") -> flamegraph.pl, speedscope, inferno"""
+    return "".join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(samples.items()))
+
+
+class SamplingProfiler:
+    """Time bounded sampling of all thread stacks plus the asyncio tasks of the event loop
+
+    The threads are sampled from a thread of its own (sys._current_frames) -> also sees a blocked event loop,
+    the tasks from a coroutine on the loop (they only have a stack while suspended).
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, cfg: Profiling) -> None:
+        self.cfg: Profiling = cfg
+        self._running: threading.Lock = threading.Lock()
+
+    def _sample_threads(
+        self, samples: Counter, stop: threading.Event, interval: float, loop_thread: Optional[int]
+    ) -> None:
+        me: int = threading.get_ident()
+        names: Dict[int, str] = {}
+        while not stop.wait(interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = {t.ident: t.name for t in threading.enumerate() if t.ident is not None}
+                root: str = "event-loop" if ident == loop_thread else f"thread:{names.get(ident, ident)}"
+                samples[(root, *thread_stack(frame))] += 1
+
+    async def _sample_tasks(self, samples: Counter, stop: threading.Event, interval: float) -> None:
+        me: asyncio.Task | None = asyncio.current_task()
+        while not stop.is_set():
+            for task in asyncio.all_tasks():
+                if task is not me and not task.done():
+                    samples[(f"task:{task.get_name()}", *task_stack(task))] += 1
+            await asyncio.sleep(interval)
+
+    async def profile(self, seconds: float, interval_ms: float, tasks: bool = True) -> str:
+        """Samples for <seconds> every <interval_ms> -> collapsed stacks (one profile per worker at a time)"""
+        if not self._running.acquire(blocking=False):
+            raise ProfilerBusy("a profile is already running in this worker")
+        try:
+            seconds = min(seconds, self.cfg.max_seconds)
+            interval: float = interval_ms / 1000
+            samples: Counter = Counter()
+            stop: threading.Event = threading.Event()
+            sampler = threading.Thread(
+                target=self._sample_threads,
+                args=(samples, stop, interval, threading.get_ident()),
+                name="mipserver-profiler",
+                daemon=True,
+            )
+            self.logger.info(f"profiling for {seconds}s every {interval_ms}ms (tasks: {tasks})")
+            sampler.start()
+            task_samples: Counter = Counter()
+            sampling: asyncio.Task | None = (
+                asyncio.create_task(self._sample_tasks(task_samples, stop, interval)) if tasks else None
+            )
+            try:
+                await asyncio.sleep(seconds)
+            finally:
+                stop.set()
+                if sampling is not None:
+                    await sampling
+                sampler.join()
+            samples.update(task_samples)
+            return collapse(samples)
+        finally:
+            self._running.release()
+
+
+class LoopLagMonitor:
+    """Watchdog for the event loop: logs the loop's stack when a coroutine blocks it longer than the threshold
+
+    A heartbeat coroutine wakes up every check interval (its oversleep is the lag, see the histogram), a thread
+    checks the heartbeat and takes the loop thread's stack while it is still blocked -> the blocking call itself.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, cfg: Profiling) -> None:
+        self.threshold: float = cfg.loop_lag_threshold_ms / 1000
+        self.check: float = cfg.loop_lag_check_ms / 1000
+        self._beat: float = time.monotonic()
+        self._stop: threading.Event = threading.Event()
+        self._task: asyncio.Task | None = None
+        self._watchdog: threading.Thread | None = None
+
+    async def _heartbeat(self) -> None:
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.check)
+            EVENT_LOOP_LAG.observe(max(0.0, time.monotonic() - self._beat - self.check))
+
+    def _watch(self, loop_thread: int) -> None:
+        reported: float | None = None  # heartbeat of the blocking episode already logged
+        while not self._stop.wait(self.check):
+            beat: float = self._beat
+            blocked: float = time.monotonic() - beat - self.check
+            if blocked < self.threshold or reported == beat:
+                continue
+            reported = beat
+            EVENT_LOOP_BLOCKED.inc()
+            frame: FrameType | None = sys._current_frames().get(loop_thread)
+            stack: str = "".join(traceback.format_stack(frame)) if frame is not None else "(no frame)\n"
+            self.logger.warning(f"event loop blocked for {blocked * 1000:.0f}ms, blocking stack:\n{stack}")
+
+    def start(self) -> None:
+        """Call from the event loop (lifespan)"""
+        self._beat = time.monotonic()
+        self._stop.clear()
+        self._task = asyncio.create_task(self._heartbeat())
+        self._watchdog = threading.Thread(
+            target=self._watch, args=(threading.get_ident(),), name="mipserver-loop-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            self._task.cancel()
+        if self._watchdog is not None:
+            self._watchdog.join(timeout=1)
@@ -0,0 +1,149 @@
+import asyncio
+import json
+import os
+import random
+import tempfile
+from enum import StrEnum
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from loguru import logger
+
+from mipserver.config import Upstream
+from mipserver.internal.metrics import RAW_DOWNLOADED_BYTES, RAW_DOWNLOADS
+
+# answered with a retry (after backoff or Retry-After)
+_RETRY_STATUS: frozenset[int] = frozenset({429, 500, 502, 503, 504})
+
+
+class DownloadStatus(StrEnum):
+    fetched = "fetched"  # new or changed -> written to the target
+    not_modified = "not_modified"  # 304 on the conditional request -> cached target is current
+    missing = "missing"  # 404
+    failed = "failed"  # retries exhausted
+
+
+class RawDownloader:
+    """Shared async http client for raw upstream files
+
+    One keep-alive connection pool for all downloads, bounded parallelism per package, retries with exponential
+    backoff and jitter, conditional requests (ETag/Last-Modified stored next to the target) for files that are
+    already cached. Bodies are streamed into a temp file next to the target and renamed -> never buffered whole,
+    never visible half written.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, cfg: Upstream, transport: Optional[httpx.AsyncBaseTransport] = None):
+        self.cfg = cfg
+        self._transport = transport
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # created lazily -> bound to the event loop of the server, not the one of the importing thread
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.cfg.max_connections, max_keepalive_connections=self.cfg.max_connections
+                ),
+                timeout=httpx.Timeout(self.cfg.http_timeout_seconds),
+                follow_redirects=True,
+                transport=self._transport,
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @staticmethod
+    def validators_path(target: Path) -> Path:
+        return target.with_name(f".{target.name}.http.json")
+
+    def _conditional_headers(self, target: Path) -> Dict[str, str]:
+        if not target.is_file():
+            return {}
+        try:
+            validators: Dict[str, str] = json.loads(self.validators_path(target).read_text())
+        except (OSError, ValueError):
+            return {}
+        headers: Dict[str, str] = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        return headers
+
+    def _backoff(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.cfg.max_retry_after_seconds)
+        return self.cfg.retry_backoff_seconds * (2**attempt) * random.uniform(0.5, 1.5)
+
+    async def fetch(self, url: str, target: Path) -> DownloadStatus:
+        status: DownloadStatus = await self._fetch(url, target)
+        RAW_DOWNLOADS.labels(result=status.value).inc()
+        return status
+
+    async def _fetch(self, url: str, target: Path) -> DownloadStatus:
+        headers: Dict[str, str] = self._conditional_headers(target)
+
+        for attempt in range(self.cfg.retries + 1):
+            retry_after: Optional[str] = None
+            try:
+                async with self.client.stream("GET", url, headers=headers) as resp:
+                    if resp.status_code == 304:
+                        return DownloadStatus.not_modified
+                    if resp.status_code == 404:
+                        return DownloadStatus.missing
+                    if resp.status_code in _RETRY_STATUS:
+                        retry_after = resp.headers.get("Retry-After")
+                        self.logger.debug(f"GET {url} -> {resp.status_code} (attempt {attempt + 1})")
+                    else:
+                        resp.raise_for_status()
+                        await self._stream_to(resp, target)
+                        self.validators_path(target).write_text(
+                            json.dumps(
+                                {"etag": resp.headers.get("ETag"), "last_modified": resp.headers.get("Last-Modified")}
+                            )
+                        )
+                        return DownloadStatus.fetched
+            except httpx.HTTPStatusError as e:
+                self.logger.warning(f"GET {url} failed: {e}")
+                return DownloadStatus.failed
+            except (httpx.TransportError, OSError) as e:
+                self.logger.debug(f"GET {url} failed: {e!r} (attempt {attempt + 1})")
+
+            if attempt < self.cfg.retries:
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+        self.logger.warning(f"GET {url} failed after {self.cfg.retries + 1} attempts")
+        return DownloadStatus.failed
+
+    @staticmethod
+    async def _stream_to(resp: httpx.Response, target: Path) -> None:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=target.parent, prefix=f".{target.name}.", suffix=".tmp")
+        written: int = 0
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                async for chunk in resp.aiter_bytes(chunk_size=65_536):
+                    fout.write(chunk)
+                    written += len(chunk)
+            os.replace(tmpname, target)
+        except BaseException:
+            Path(tmpname).unlink(missing_ok=True)
+            raise
+        RAW_DOWNLOADED_BYTES.inc(written)
+
+    async def fetch_many(self, downloads: List[Tuple[str, Path]]) -> List[DownloadStatus]:
+        """(url, target) pairs of one package -> at most parallel_downloads_per_package in flight"""
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(self.cfg.parallel_downloads_per_package)
+
+        async def bounded(url: str, target: Path) -> DownloadStatus:
+            async with semaphore:
+                return await self.fetch(url, target)
+
+        return list(await asyncio.gather(*(bounded(url, target) for url, target in downloads)))
@@ -0,0 +1,271 @@
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Any, Callable, Dict, Generator, Iterator, List, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from mipserver.config import NegativeCache
+from mipserver.config import Redis as RedisConfig
+from mipserver.Helper import is_in_cluster
+from mipserver.internal.coordination import InvalidationBus
+from mipserver.internal.locks import LockManager, LockTimeout
+from mipserver.internal.metadata import MetadataStore
+from mipserver.internal.negativecache import NegativeEntry, NegativeKey, NegativeReason, NegativeResultCache
+
+if TYPE_CHECKING:  # optional: only needed with REDIS.ENABLED -> imported on first use (startup time)
+    import redis
+
+
+def redis_client(cfg: RedisConfig) -> "redis.Redis":
+    try:
+        import redis
+    except ImportError as e:  # pragma: no cover
+        raise RuntimeError("REDIS.ENABLED requires the redis package (pip install redis)") from e
+    host: str = cfg.HOST_IN_CLUSTER if cfg.HOST_IN_CLUSTER and is_in_cluster() else cfg.HOST
+    return redis.Redis(
+        host=host,
+        port=cfg.PORT,
+        db=cfg.DB,
+        password=cfg.PASSWORD,
+        decode_responses=True,
+        socket_timeout=cfg.SOCKET_TIMEOUT_SECONDS,
+        health_check_interval=30,
+    )
+
+
+def _str(value: str | bytes) -> str:
+    # clients are created with decode_responses -> str; the typing of redis-py does not know
+    return value if isinstance(value, str) else value.decode()
+
+
+def _compare_and(client: "redis.Redis", key: str, token: str, action: str, ttl_ms: int = 0) -> bool:
+    """Deletes/extends key only while it still holds token (WATCH/MULTI -> no server side scripting needed)"""
+    import redis  # there is a client -> loaded already
+
+    with client.pipeline() as pipe:
+        try:
+            pipe.watch(key)
+            if pipe.get(key) != token:
+                pipe.unwatch()
+                return False
+            pipe.multi()
+            if action == "delete":
+                pipe.delete(key)
+            else:
+                pipe.pexpire(key, ttl_ms)
+            pipe.execute()
+            return True
+        except redis.WatchError:
+            return False
+
+
+class RedisLockManager(LockManager):
+    """Named locks in Redis (SET NX with a ttl) -> exclusive across pods that do not share a flock-capable volume
+
+    The ttl is renewed by a watchdog thread while the lock is held, so a build may take longer than the ttl while
+    a crashed pod's locks expire after at most LOCK_TTL_SECONDS.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, client: "redis.Redis", cfg: RedisConfig):  # no lock dir -> no LockManager.__init__
+        self.client = client
+        self.prefix: str = f"{cfg.KEY_PREFIX}lock:"
+        self.ttl_ms: int = cfg.LOCK_TTL_SECONDS * 1000
+
+    def _acquire(self, key: str, token: str, timeout: Optional[float]) -> bool:
+        deadline: float | None = None if timeout is None else time.monotonic() + timeout
+        delay: float = 0.01
+        while True:
+            if self.client.set(key, token, nx=True, px=self.ttl_ms):
+                return True
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            remaining: float = 0.25 if deadline is None else max(0.0, deadline - time.monotonic())
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.25)
+
+    @contextmanager
+    def lock(self, name: str, timeout: Optional[float] = None) -> Generator[None, None, None]:
+        key: str = self.prefix + name
+        token: str = uuid.uuid4().hex
+        if not self._acquire(key, token, timeout):
+            raise LockTimeout(name, timeout or 0)
+
+        released: threading.Event = threading.Event()
+
+        def watchdog() -> None:
+            import redis  # there is a client -> loaded already
+
+            while not released.wait(self.ttl_ms / 3000):
+                try:
+                    if not _compare_and(self.client, key, token, "pexpire", self.ttl_ms):
+                        self.logger.warning(f"lock {name!r} was lost (expired while held)")
+                        return
+                except redis.RedisError as e:
+                    self.logger.warning(f"renewing lock {name!r} failed: {e}")
+
+        renewer: threading.Thread = threading.Thread(target=watchdog, name=f"lock-{name}", daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            released.set()
+            renewer.join()
+            _compare_and(self.client, key, token, "delete")
+
+    def is_locked(self, name: str) -> bool:
+        return bool(self.client.exists(self.prefix + name))
+
+
+class RedisNegativeCache(NegativeResultCache):
+    """Negative cache shared by all pods: one hash per package, field "<pversion>\\x1f<mpy_version>"
+
+    Entries carry their wall clock expiry and are kept for another ttl after it, like the in-memory variant keeps
+    expired entries -> the commit of a failed build can be compared with upstream before it is rebuilt.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    _SEP: str = "\x1f"
+
+    def __init__(self, cfg: NegativeCache, client: "redis.Redis", redis_cfg: RedisConfig):
+        super().__init__(cfg)
+        self.client = client
+        self.prefix: str = f"{redis_cfg.KEY_PREFIX}negative:"
+        # a package's hash lives as long as its longest possible entry (ttl + the same again for rearm)
+        self.retention_seconds: int = 2 * max(
+            cfg.unknown_package_ttl_seconds, cfg.missing_ref_ttl_seconds, cfg.build_failed_ttl_seconds, 1
+        )
+
+    def _field(self, key: NegativeKey) -> str:
+        return f"{key[1]}{self._SEP}{key[2]}"
+
+    @staticmethod
+    def _decode(raw: str | bytes) -> NegativeEntry:
+        data: Dict[str, Any] = json.loads(raw)
+        # stored with wall clock time -> back to this host's monotonic clock
+        data["expires_at"] = time.monotonic() + (data.pop("expires_at_wall") - time.time())
+        return NegativeEntry.model_validate(data)
+
+    def get(self, key: NegativeKey) -> NegativeEntry | None:
+        fields: List[str] = [self._field(key)]
+        if key[2] != self.ANY_TARGET:
+            fields.append(self._field((key[0], key[1], self.ANY_TARGET)))
+        for raw in self.client.hmget(self.prefix + key[0], fields):
+            if raw is not None:
+                return self._decode(raw)
+        return None
+
+    def put(
+        self, key: NegativeKey, reason: NegativeReason, message: str, commit: Optional[str] = None
+    ) -> NegativeEntry | None:
+        ttl: int = self.ttl_for(reason)
+        if ttl <= 0:
+            return None
+
+        entry: NegativeEntry = NegativeEntry(
+            reason=reason, message=message, commit=commit, expires_at=time.monotonic() + ttl
+        )
+        self.logger.info(f"caching failure for {key=}: {reason.value} {commit=} {ttl=}s (shared)")
+        stored: Dict[str, Any] = entry.model_dump(exclude={"expires_at"}) | {"expires_at_wall": time.time() + ttl}
+        hkey: str = self.prefix + key[0]
+        with self.client.pipeline() as pipe:
+            pipe.hset(hkey, self._field(key), json.dumps(stored))
+            pipe.expire(hkey, self.retention_seconds)
+            pipe.execute()
+        return entry
+
+    def _drop(self, package_name: str, keep: Callable[[str, Dict[str, Any]], bool]) -> int:
+        hkey: str = self.prefix + package_name
+        fields: List[str] = [
+            _str(f) for f, raw in self.client.hgetall(hkey).items() if not keep(_str(f), json.loads(raw))
+        ]
+        if fields:
+            self.client.hdel(hkey, *fields)
+        return len(fields)
+
+    def invalidate(self, package_name: str, pversion: Optional[str] = None) -> int:
+        return self._drop(package_name, lambda f, _: pversion is not None and f.split(self._SEP)[0] != pversion)
+
+    def invalidate_on_new_commit(self, package_name: str, pversion: str, commit: str) -> int:
+        dropped: int = self._drop(
+            package_name, lambda f, data: f.split(self._SEP)[0] != pversion or data.get("commit") == commit
+        )
+        if dropped:
+            self.logger.info(f"new upstream commit {commit} for {package_name}@{pversion} -> dropped {dropped}")
+        return dropped
+
+    def _keys(self) -> Iterator[str]:
+        return self.client.scan_iter(match=f"{self.prefix}*", count=500)
+
+    def clear(self) -> None:
+        for k in self._keys():
+            self.client.delete(k)
+
+    def __len__(self) -> int:
+        return sum(int(self.client.hlen(k)) for k in self._keys())
+
+
+class SharedRevision(BaseModel):
+    commit: str
+    checked_at: float  # unix time
+
+
+class SharedRevisions:
+    """Upstream commit per package@ref as last seen by any pod -> the others skip their own fetch/ls-remote"""
+
+    def __init__(self, client: "redis.Redis", cfg: RedisConfig):
+        self.client = client
+        self.key: str = f"{cfg.KEY_PREFIX}revisions"
+
+    def get(self, package_name: str, pversion: str, max_age: float) -> SharedRevision | None:
+        raw: str | bytes | None = self.client.hget(self.key, f"{package_name}@{pversion}")
+        if raw is None:
+            return None
+        rev: SharedRevision = SharedRevision.model_validate_json(raw)
+        return rev if rev.checked_at >= time.time() - max_age else None
+
+    def put(self, package_name: str, pversion: str, commit: str) -> None:
+        rev = SharedRevision(commit=commit, checked_at=time.time())
+        self.client.hset(self.key, f"{package_name}@{pversion}", rev.model_dump_json())
+
+    def forget(self, package_name: str) -> int:
+        fields: List[str] = [_str(f) for f, _ in self.client.hscan_iter(self.key, match=f"{package_name}@*")]
+        if fields:
+            self.client.hdel(self.key, *fields)
+        return len(fields)
+
+
+class RedisInvalidationBus(InvalidationBus):
+    """InvalidationBus over Redis pub/sub instead of the events table -> reaches pods without a shared index"""
+
+    def __init__(self, metadata: MetadataStore, client: "redis.Redis", cfg: RedisConfig):
+        super().__init__(metadata)
+        self.client = client
+        self.channel: str = f"{cfg.KEY_PREFIX}events"
+        self._pubsub = client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.channel)
+
+    def publish(self, kind: str, **payload: Any) -> None:
+        self.client.publish(self.channel, json.dumps({"origin": self.origin, "kind": kind, "payload": payload}))
+
+    def _messages(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        while (message := self._pubsub.get_message(timeout=0)) is not None:
+            event: Dict[str, Any] = json.loads(message["data"])
+            if event.get("origin") != self.origin:
+                yield event["kind"], event.get("payload", {})
+
+    def poll(self) -> int:
+        applied: int = 0
+        for kind, payload in self._messages():
+            self._dispatch(kind, payload)
+            applied += 1
+        return applied
+
+    def close(self) -> None:
+        self._pubsub.close()
@@ -0,0 +1,122 @@
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Sequence, Tuple
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from mipserver.config import PackageNameGithubRepo, load_settings
+
+RegistryListener = Callable[["RegistryDiff"], object]  # return value is ignored
+
+
+class RegistryError(Exception):
+    """The package list could not be (re)loaded -> the current registry stays in place"""
+
+
+class RegistryDiff(BaseModel):
+    added: List[str] = Field(default_factory=list)
+    removed: List[str] = Field(default_factory=list)
+    changed: List[str] = Field(default_factory=list)  # repo, source or branch restrictions differ
+
+    @property
+    def affected(self) -> List[str]:
+        return sorted(self.added + self.removed + self.changed)
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+def load_packages() -> List[PackageNameGithubRepo]:
+    """PACKAGENAME_TO_GITHUB_REPO as configured right now (yaml files and environment)"""
+    return load_settings().packagename_to_github_repo.root
+
+
+def diff_packages(before: Dict[str, PackageNameGithubRepo], after: Dict[str, PackageNameGithubRepo]) -> RegistryDiff:
+    return RegistryDiff(
+        added=sorted(after.keys() - before.keys()),
+        removed=sorted(before.keys() - after.keys()),
+        changed=sorted(n for n in before.keys() & after.keys() if before[n] != after[n]),
+    )
+
+
+class PackageRegistry:
+    """The served packages (name -> repo/source), replaceable while the server runs
+
+    A reload builds new maps and swaps the reference -> requests never wait for it and see either the old or the new
+    package list, never a mix. Listeners get the diff to invalidate what belongs to the affected packages only.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(
+        self,
+        packages: Sequence[PackageNameGithubRepo],
+        watch_paths: Sequence[Path] = (),
+        loader: Callable[[], List[PackageNameGithubRepo]] = load_packages,
+    ):
+        self.watch_paths: List[Path] = [Path(p) for p in watch_paths]
+        self.loader = loader
+        self._maps: Tuple[Dict[str, PackageNameGithubRepo], Dict[str, str]] = self._build_maps(packages)
+        self._listeners: List[RegistryListener] = []
+        self._reload_lock: threading.Lock = threading.Lock()  # serializes reloads, readers never take it
+        self._mtimes: Dict[Path, Tuple[int, int] | None] = self._stat()
+
+    @staticmethod
+    def _build_maps(
+        packages: Sequence[PackageNameGithubRepo],
+    ) -> Tuple[Dict[str, PackageNameGithubRepo], Dict[str, str]]:
+        configs: Dict[str, PackageNameGithubRepo] = {png.packagename: png for png in packages}
+        return configs, {name: png.githubrepo for name, png in configs.items()}
+
+    @property
+    def configs(self) -> Dict[str, PackageNameGithubRepo]:
+        return self._maps[0]
+
+    @property
+    def name_to_repo(self) -> Dict[str, str]:
+        return self._maps[1]
+
+    def subscribe(self, listener: RegistryListener) -> None:
+        self._listeners.append(listener)
+
+    def _stat(self) -> Dict[Path, Tuple[int, int] | None]:
+        ret: Dict[Path, Tuple[int, int] | None] = {}
+        for p in self.watch_paths:
+            try:
+                st: os.stat_result = p.stat()
+                ret[p] = (st.st_mtime_ns, st.st_size)
+            except FileNotFoundError:
+                ret[p] = None
+        return ret
+
+    def apply(self, packages: Sequence[PackageNameGithubRepo]) -> RegistryDiff:
+        """Replaces the package list -> diff against the previous one (listeners are only called if not empty)"""
+        with self._reload_lock:
+            maps = self._build_maps(packages)
+            diff: RegistryDiff = diff_packages(self._maps[0], maps[0])
+            if not diff:
+                return diff
+            self._maps = maps  # one reference -> atomic for the readers
+        self.logger.info(f"package registry reloaded: {diff.added=} {diff.removed=} {diff.changed=}")
+        for listener in self._listeners:
+            try:
+                listener(diff)
+            except Exception as e:
+                self.logger.opt(exception=e).error(f"registry listener failed for {diff.affected}")
+        return diff
+
+    def reload(self) -> RegistryDiff:
+        self._mtimes = self._stat()  # before loading -> a write during the load is picked up by the next check
+        try:
+            packages: List[PackageNameGithubRepo] = self.loader()
+        except Exception as e:  # broken yaml/validation error -> keep serving what is there
+            raise RegistryError(f"cannot load the package list: {e}") from e
+        return self.apply(packages)
+
+    def reload_if_changed(self) -> RegistryDiff | None:
+        """Reloads if a watched file was modified since the last (re)load -> None if none was"""
+        if self._stat() == self._mtimes:
+            return None
+        return self.reload()
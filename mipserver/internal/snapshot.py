@@ -0,0 +1,230 @@
+import hashlib
+import io
+import json
+import re
+import tarfile
+import time
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Literal, Optional, Set
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from mipserver.datastructures.datatypes import MPYPath
+from mipserver.Helper import atomic_write
+from mipserver.internal.locks import LockManager
+from mipserver.internal.metadata import BuildRecord, MetadataStore, build_record_from_package_json
+from mipserver.internal.objectstore import LooseObjectStore
+
+SNAPSHOT_FORMAT: int = 1
+MANIFEST_NAME: str = "manifest.json"
+
+_SHA256: re.Pattern[str] = re.compile(r"^[0-9a-f]{64}$")
+_NAME: re.Pattern[str] = re.compile(r"^[A-Za-z0-9._+-]+$")  # package names and refs -> one path component
+
+
+class SnapshotBuild(BaseModel):
+    package_name: str
+    mpy_version: str
+    pversion: str
+    commit: Optional[str] = None
+    json_sha256: str
+
+    @property
+    def member_name(self) -> str:
+        return f"json/{self.mpy_version}/{self.package_name}/{self.pversion}.json"
+
+
+class SnapshotManifest(BaseModel):
+    format: int = SNAPSHOT_FORMAT
+    created_at: float
+    builds: List[SnapshotBuild] = Field(default_factory=list)
+    objects: Dict[str, int] = Field(default_factory=dict)  # hash -> size, every referenced object exactly once
+
+
+class SnapshotImportReport(BaseModel):
+    builds: List[SnapshotBuild] = Field(default_factory=list)
+    objects_imported: int = 0
+    objects_present: int = 0
+    bytes_imported: int = 0
+    duration_seconds: float = 0.0
+
+
+class SnapshotError(Exception):
+    """Archive is not a snapshot, is of an unknown format or does not match its manifest"""
+
+
+class Snapshots:
+    """Export/import of prebuilt package jsons plus the objects they reference as one streamable tar archive
+
+    Layout: manifest.json first, then files/<h2>/<hash> (each object once), then json/<mpy>/<pkg>/<ref>.json
+    -> an import can skip objects it already has while reading the stream and only publishes a package json
+    once all of its objects arrived. Import needs neither git nor mpy-cross.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, cache_root: Path, metadata: MetadataStore, object_store: LooseObjectStore):
+        self.cache_root = cache_root
+        self.metadata = metadata
+        self.object_store = object_store
+        self.locks: LockManager = LockManager(cache_root)
+
+    def select(
+        self, packages: Optional[List[str]] = None, mpy_versions: Optional[List[str]] = None
+    ) -> List[BuildRecord]:
+        """Builds to export; packages: "name" (all refs) or "name@ref", None -> everything in the index"""
+        selected: List[BuildRecord] = []
+        for build in self.metadata.list_builds(with_files=True):
+            if mpy_versions and build.mpy_version not in mpy_versions:
+                continue
+            if packages and not (
+                build.package_name in packages or f"{build.package_name}@{build.pversion}" in packages
+            ):
+                continue
+            selected.append(build)
+        return selected
+
+    # ---- export
+
+    def export(
+        self,
+        fout: BinaryIO,
+        packages: Optional[List[str]] = None,
+        mpy_versions: Optional[List[str]] = None,
+        compression: Literal["gz", "xz"] = "gz",
+    ) -> SnapshotManifest:
+        """Writes the snapshot as (compressed) tar stream to fout -> fout may be a pipe"""
+        # no gc while the snapshot is taken -> referenced objects cannot vanish half way through
+        with self.locks.lock("gc"):
+            manifest = SnapshotManifest(created_at=time.time())
+            jsons: Dict[str, bytes] = {}
+            for build in self.select(packages, mpy_versions):
+                try:
+                    data: bytes = self.metadata.absolute_json_path(build).read_bytes()
+                    sizes: Dict[str, int] = {f.hash: self.object_store.size(f.hash) for f in build.files}
+                except FileNotFoundError as e:
+                    self.logger.warning(f"skipping {build.package_name}@{build.pversion} ({build.mpy_version}): {e}")
+                    continue
+                entry = SnapshotBuild(
+                    package_name=build.package_name,
+                    mpy_version=build.mpy_version,
+                    pversion=build.pversion,
+                    commit=build.commit,
+                    json_sha256=hashlib.sha256(data).hexdigest(),
+                )
+                manifest.builds.append(entry)
+                manifest.objects.update(sizes)
+                jsons[entry.member_name] = data
+
+            # xz: smaller (sneakernet), gz: faster
+            tar: tarfile.TarFile = (
+                tarfile.open(fileobj=fout, mode="w|xz")
+                if compression == "xz"
+                else tarfile.open(fileobj=fout, mode="w|gz")
+            )
+            with tar:
+                self._add_bytes(tar, MANIFEST_NAME, manifest.model_dump_json(indent=1).encode())
+                for obj_hash in sorted(manifest.objects):
+                    with self.object_store.open(obj_hash) as fin:
+                        tar.addfile(self._tarinfo(f"files/{obj_hash[:2]}/{obj_hash}", manifest.objects[obj_hash]), fin)
+                for name, data in jsons.items():
+                    self._add_bytes(tar, name, data)
+
+        self.logger.info(f"exported {len(manifest.builds)} builds with {len(manifest.objects)} objects")
+        return manifest
+
+    @staticmethod
+    def _tarinfo(name: str, size: int) -> tarfile.TarInfo:
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = int(time.time())
+        info.mode = 0o644
+        return info
+
+    def _add_bytes(self, tar: tarfile.TarFile, name: str, data: bytes) -> None:
+        tar.addfile(self._tarinfo(name, len(data)), io.BytesIO(data))
+
+    # ---- import
+
+    @staticmethod
+    def read_manifest(tar: tarfile.TarFile) -> SnapshotManifest:
+        first: tarfile.TarInfo | None = tar.next()
+        if first is None or first.name != MANIFEST_NAME:
+            raise SnapshotError(f"no {MANIFEST_NAME} at the start of the archive")
+        extracted = tar.extractfile(first)
+        assert extracted is not None
+        manifest = SnapshotManifest.model_validate_json(extracted.read())
+        if manifest.format != SNAPSHOT_FORMAT:
+            raise SnapshotError(f"unsupported snapshot format {manifest.format}")
+        for b in manifest.builds:
+            valid: bool = b.mpy_version in {m.value for m in MPYPath}
+            if not (valid and _NAME.match(b.package_name) and _NAME.match(b.pversion) and ".." not in b.pversion):
+                raise SnapshotError(f"invalid build in manifest: {b.package_name}@{b.pversion} ({b.mpy_version})")
+        return manifest
+
+    def import_(self, fin: BinaryIO) -> SnapshotImportReport:
+        """Reads a snapshot stream; objects already in the store are skipped, everything is verified"""
+        started: float = time.perf_counter()
+        report = SnapshotImportReport()
+        with tarfile.open(fileobj=fin, mode="r|*") as tar:
+            manifest: SnapshotManifest = self.read_manifest(tar)
+            builds: Dict[str, SnapshotBuild] = {b.member_name: b for b in manifest.builds}
+            received: Set[str] = {h for h in manifest.objects if self.object_store.reuse(h)}
+            report.objects_present = len(received)
+
+            while (member := tar.next()) is not None:  # iterating the TarFile would start over with the manifest
+                if not member.isfile():
+                    continue
+                if member.name.startswith("files/"):
+                    obj_hash: str = member.name.rsplit("/", 1)[-1]
+                    if obj_hash not in manifest.objects or not _SHA256.match(obj_hash):
+                        raise SnapshotError(f"unexpected archive member {member.name}")
+                    if obj_hash in received:
+                        continue  # tar streams cannot seek -> the member is read over, but not written
+                    data: bytes = self._read(tar, member)
+                    if hashlib.sha256(data).hexdigest() != obj_hash:
+                        raise SnapshotError(f"object {obj_hash} does not match its hash")
+                    self.object_store.put_bytes(data, obj_hash)
+                    received.add(obj_hash)
+                    report.objects_imported += 1
+                    report.bytes_imported += len(data)
+                elif member.name in builds:
+                    self._import_build(builds[member.name], self._read(tar, member), received)
+                    report.builds.append(builds[member.name])
+                else:
+                    raise SnapshotError(f"unexpected archive member {member.name}")
+
+        report.duration_seconds = time.perf_counter() - started
+        self.logger.info(
+            f"imported {len(report.builds)} builds, {report.objects_imported} objects"
+            f" ({report.objects_present} already present) in {report.duration_seconds:.2f}s"
+        )
+        return report
+
+    @staticmethod
+    def _read(tar: tarfile.TarFile, member: tarfile.TarInfo) -> bytes:
+        extracted = tar.extractfile(member)
+        assert extracted is not None
+        return extracted.read()
+
+    def _import_build(self, entry: SnapshotBuild, data: bytes, received: Set[str]) -> None:
+        if hashlib.sha256(data).hexdigest() != entry.json_sha256:
+            raise SnapshotError(f"{entry.member_name} does not match its hash")
+        missing: List[str] = [h for _, h in json.loads(data)["hashes"] if h not in received]
+        if missing:
+            raise SnapshotError(f"{entry.member_name} references objects not in the snapshot: {missing[:3]}")
+
+        target: Path = Path(self.cache_root, entry.mpy_version, entry.package_name, f"{entry.pversion}.json")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(target, data)
+        record: BuildRecord = build_record_from_package_json(
+            self.metadata,
+            self.object_store,
+            target,
+            entry.package_name,
+            entry.mpy_version,
+            entry.pversion,
+            entry.commit,
+        )
+        self.metadata.record_build(record)
@@ -0,0 +1,426 @@
+import hashlib
+import json
+import os
+import shutil
+import tarfile
+import tempfile
+import uuid
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from loguru import logger
+from pydantic import BaseModel
+
+from mipserver.config import PackageNameGithubRepo, SourceKind, settings
+from mipserver.datastructures.datatypes import MPYPath
+from mipserver.Helper import MIPServerHelper, RefNotFoundError, atomic_write, get_sha256_hash
+from mipserver.internal.objectstore import SHORT_HASH, LooseObjectStore
+from mipserver.internal.packagebodies import compact_json
+from mipserver.internal.tracing import span
+
+# written into prepared working trees -> revision they were prepared from (survives restarts)
+REVISION_MARKER: str = ".mipserver-revision"
+
+
+class PreparedSource(BaseModel):
+    path: Path  # working tree below the server cache root (-> lru/gc of the cache manager applies)
+    revision: Optional[str] = None  # commit, content fingerprint, etag, ... -> unchanged revision = no rebuild
+
+
+class SourceBackend(ABC):
+    """Where the files of a package come from
+
+    remote_revision() has to be cheap (no download of the package) -> used for change detection,
+    prepare() brings the working tree up to date, build() writes the package json + objects.
+    """
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, helper: MIPServerHelper, pkgcfg: PackageNameGithubRepo):
+        self.helper = helper
+        self.pkgcfg = pkgcfg
+
+    @property
+    def repo_name(self) -> str:
+        return self.pkgcfg.githubrepo
+
+    def workdir(self, ref: str) -> Path:
+        return self.helper.get_server_cache_root() / MIPServerHelper.get_checkout_dirname(self.repo_name, ref)
+
+    @abstractmethod
+    def remote_revision(self, ref: str, mpy_version: MPYPath) -> str | None:
+        """Current upstream revision of ref or None if it cannot be determined"""
+
+    @abstractmethod
+    def prepare(self, ref: str, mpy_version: MPYPath) -> PreparedSource | None:
+        """Brings the working tree of ref up to date -> None on (transient) failure, RefNotFoundError if ref is unknown"""
+
+    def build(self, prepared: PreparedSource, target_pkgjson: Path, mpy_version: MPYPath) -> Path:
+        return self.helper.generate_package_json_from_local_repo(
+            gitrepopath=prepared.path, target_pkgjson=target_pkgjson, mpy_version=mpy_version
+        )
+
+    # ---- helpers for the non-git backends
+
+    def _staging_dir(self, ref: str) -> Path:
+        # no "@" in the name -> never mistaken for a checkout by the cache manager
+        name: str = f".{self.workdir(ref).name.replace('@', '-')}.{uuid.uuid4().hex[:8]}.tmp"
+        return self.helper.get_server_cache_root() / name
+
+    @staticmethod
+    def _read_revision(workdir: Path) -> str | None:
+        try:
+            return (workdir / REVISION_MARKER).read_text().strip() or None
+        except OSError:
+            return None
+
+    @staticmethod
+    def _publish_dir(staging: Path, workdir: Path, revision: str) -> None:
+        """Swaps staging into place -> a build never sees a half updated tree"""
+        (staging / REVISION_MARKER).write_text(revision)
+        old: Path | None = None
+        if workdir.exists():
+            old = workdir.with_name(f".{workdir.name.replace('@', '-')}.{uuid.uuid4().hex[:8]}.old")
+            os.replace(workdir, old)
+        os.replace(staging, workdir)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def _only_latest(self, ref: str) -> None:
+        if ref != "latest":
+            raise RefNotFoundError(repo_name=self.repo_name, branch=ref)
+
+
+class GitSource(SourceBackend):
+    """Any git url (https, ssh, file://, an internal gitea, ...) -> ls-remote for change detection
+
+    With source.subpath (monorepos) the packages of a repo share one checkout: the first build after an upstream
+    change fetches, the others find the checkout at the remote commit already. Their revision is a digest of the
+    trees/files they consist of -> packages whose files did not change are not rebuilt.
+    """
+
+    @property
+    def url(self) -> str:
+        return self.pkgcfg.source.url or MIPServerHelper.get_repo_url(self.repo_name)
+
+    @property
+    def subpath(self) -> str | None:
+        return self.pkgcfg.source.subpath
+
+    def tree_revision(self, checkout: Path) -> str | None:
+        """Digest of the package directory and of the files it references outside of it at HEAD of checkout"""
+        assert self.subpath is not None
+        try:
+            files: List[str] = MIPServerHelper.package_files(
+                (checkout / self.subpath / "package.json").read_text(), self.subpath
+            )
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"no package.json in {checkout / self.subpath}: {e}")
+            return None
+        outside: List[str] = sorted({f for f in files if not f.startswith(f"{self.subpath}/")})
+        return self.helper.get_tree_revision(checkout, [self.subpath, *outside])
+
+    def _checkout_at(self, ref: str, commit: str | None) -> Path | None:
+        """The shared checkout if it is at commit already"""
+        workdir: Path = self.workdir(ref)
+        if commit is not None and workdir.is_dir() and self.helper.get_checkout_commit(workdir) == commit:
+            return workdir
+        return None
+
+    def remote_revision(self, ref: str, mpy_version: MPYPath) -> str | None:
+        commit: str | None = self.helper.get_remote_commit(self.repo_name, ref, repo_url=self.url)
+        if self.subpath is None:
+            return commit
+        # a tree revision needs the trees of the commit -> only known without a fetch if the checkout has them
+        checkout: Path | None = self._checkout_at(ref, commit)
+        return self.tree_revision(checkout) if checkout is not None else None
+
+    def prepare(self, ref: str, mpy_version: MPYPath) -> PreparedSource | None:
+        path: Path | None = None
+        if self.subpath is not None:
+            # another package of the repo fetched it moments ago -> no fetch of its own
+            path = self._checkout_at(ref, self.helper.get_remote_commit(self.repo_name, ref, repo_url=self.url))
+        if path is None:
+            path = self.helper.ensure_git_repo_up_to_date(repo_name=self.repo_name, branch=ref, repo_url=self.url)
+        if path is None:
+            return None
+        if self.subpath is None:
+            return PreparedSource(path=path, revision=self.helper.get_checkout_commit(path))
+        return PreparedSource(path=path, revision=self.tree_revision(path))
+
+    def build(self, prepared: PreparedSource, target_pkgjson: Path, mpy_version: MPYPath) -> Path:
+        if self.subpath is None:
+            return super().build(prepared, target_pkgjson, mpy_version)
+        return self.helper.generate_package_json_from_local_repo(
+            gitrepopath=prepared.path, target_pkgjson=target_pkgjson, mpy_version=mpy_version, subpath=self.subpath
+        )
+
+
+class LocalDirSource(SourceBackend):
+    """A directory on this host -> copied into the cache (mpy-cross writes next to the sources) when it changed"""
+
+    _IGNORE: tuple[str, ...] = (".git", "__pycache__", "*.mpy", REVISION_MARKER)
+
+    @property
+    def path(self) -> Path:
+        assert self.pkgcfg.source.path is not None
+        return Path(self.pkgcfg.source.path).expanduser().resolve()
+
+    def fingerprint(self) -> str | None:
+        """Hash over relative path, size and mtime of every file -> no file contents are read"""
+        if not (self.path / "package.json").is_file():
+            return None
+
+        ignore = shutil.ignore_patterns(*self._IGNORE)
+        digest = hashlib.sha256()
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            ignored = ignore(dirpath, dirnames + filenames)
+            dirnames[:] = sorted(d for d in dirnames if d not in ignored)
+            for name in sorted(f for f in filenames if f not in ignored):
+                p: Path = Path(dirpath, name)
+                st: os.stat_result = p.stat()
+                digest.update(f"{p.relative_to(self.path).as_posix()}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+        return digest.hexdigest()
+
+    def remote_revision(self, ref: str, mpy_version: MPYPath) -> str | None:
+        return self.fingerprint() if ref == "latest" else None
+
+    def prepare(self, ref: str, mpy_version: MPYPath) -> PreparedSource | None:
+        self._only_latest(ref)
+
+        revision: str | None = self.fingerprint()
+        if revision is None:
+            self.logger.error(f"no package.json in {self.path}")
+            return None
+
+        workdir: Path = self.workdir(ref)
+        if self._read_revision(workdir) != revision:
+            self.logger.info(f"copying {self.path} into {workdir}")
+            staging: Path = self._staging_dir(ref)
+            with span("local.copy", path=str(self.path)):
+                shutil.copytree(self.path, staging, ignore=shutil.ignore_patterns(*self._IGNORE))
+            self._publish_dir(staging, workdir, revision)
+
+        return PreparedSource(path=workdir, revision=revision)
+
+
+class TarballSource(SourceBackend):
+    """Release archives via http(s), file:// or a plain path -> ETag/Last-Modified (or mtime) for change detection"""
+
+    def url_for(self, ref: str) -> str:
+        assert self.pkgcfg.source.url is not None
+        url: str = self.pkgcfg.source.url
+        if "{ref}" not in url:
+            self._only_latest(ref)
+            return url
+        return url.replace("{ref}", MIPServerHelper.get_git_branch(ref))
+
+    @staticmethod
+    def _local_path(url: str) -> Path | None:
+        parsed = urlparse(url)
+        if parsed.scheme == "file":
+            return Path(parsed.path)
+        if parsed.scheme == "":
+            return Path(url).expanduser()
+        return None
+
+    def _revision_of(self, ref: str) -> str | None:
+        url: str = self.url_for(ref)
+        local: Path | None = self._local_path(url)
+        if local is not None:
+            if not local.is_file():
+                raise RefNotFoundError(repo_name=self.repo_name, branch=ref)
+            st: os.stat_result = local.stat()
+            return f"{st.st_size}-{st.st_mtime_ns}"
+
+        try:
+            resp = requests.head(url, allow_redirects=True, timeout=settings.upstream.http_timeout_seconds)
+        except requests.RequestException as e:
+            self.logger.opt(exception=e).warning(f"HEAD {url} failed")
+            return None
+        if resp.status_code == 404:
+            raise RefNotFoundError(repo_name=self.repo_name, branch=ref)
+        if resp.status_code != 200:
+            return None
+        return resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+
+    def remote_revision(self, ref: str, mpy_version: MPYPath) -> str | None:
+        try:
+            return self._revision_of(ref)
+        except RefNotFoundError:
+            return None
+
+    def _download(self, url: str, target: Path) -> None:
+        local: Path | None = self._local_path(url)
+        if local is not None:
+            shutil.copyfile(local, target)
+            return
+
+        with requests.get(url, stream=True, timeout=settings.upstream.http_timeout_seconds) as resp:
+            resp.raise_for_status()
+            with open(target, "wb") as fout:
+                for chunk in resp.iter_content(chunk_size=65_536):
+                    fout.write(chunk)
+
+    def prepare(self, ref: str, mpy_version: MPYPath) -> PreparedSource | None:
+        revision: str | None = self._revision_of(ref)
+        workdir: Path = self.workdir(ref)
+        if revision is not None and self._read_revision(workdir) == revision:
+            return PreparedSource(path=workdir, revision=revision)
+
+        url: str = self.url_for(ref)
+        staging: Path = self._staging_dir(ref)
+        staging.mkdir(parents=True)
+        try:
+            archive: Path = staging / ".archive"
+            with span("tarball.download", url=url):
+                self._download(url, archive)
+            if revision is None:  # no etag & co. -> content hash
+                revision = get_sha256_hash(archive)
+
+            with span("tarball.extract"), tarfile.open(archive, "r:*") as tf:
+                tf.extractall(staging, filter="data")  # no absolute paths, links out of the tree, devices, ...
+            archive.unlink()
+
+            # release archives usually have a single top level directory (repo-1.2.3/...)
+            entries: List[Path] = list(staging.iterdir())
+            if len(entries) == 1 and entries[0].is_dir() and not (staging / "package.json").exists():
+                inner: Path = entries[0]
+                for child in inner.iterdir():
+                    os.replace(child, staging / child.name)
+                inner.rmdir()
+
+            if not (staging / "package.json").is_file():
+                self.logger.error(f"no package.json in {url}")
+                shutil.rmtree(staging, ignore_errors=True)
+                return None
+
+            self._publish_dir(staging, workdir, revision)
+        except (requests.RequestException, OSError, tarfile.TarError) as e:
+            self.logger.opt(exception=e).error(f"fetching {url} failed")
+            shutil.rmtree(staging, ignore_errors=True)
+            return None
+
+        return PreparedSource(path=workdir, revision=revision)
+
+
+class MirrorSource(SourceBackend):
+    """Package from another mip index (a mipserver, micropython.org/pi/v2, ...) -> nothing to compile
+
+    The json of the index is the revision, objects are verified against the hashes of the index (which may be
+    shortened like on micropython.org) and stored under their full sha256.
+    """
+
+    UPSTREAM_JSON: str = "upstream.json"
+
+    def __init__(self, helper: MIPServerHelper, pkgcfg: PackageNameGithubRepo):
+        super().__init__(helper, pkgcfg)
+        # json fetched by remote_revision() -> reused by prepare() of the same build instead of a second download
+        self._fetched: Dict[tuple[str, MPYPath], bytes] = {}
+
+    @property
+    def base_url(self) -> str:
+        assert self.pkgcfg.source.url is not None
+        return self.pkgcfg.source.url.rstrip("/")
+
+    def package_url(self, ref: str, mpy_version: MPYPath) -> str:
+        return f"{self.base_url}/package/{mpy_version.value}/{self.repo_name}/{ref}.json"
+
+    def _fetch_package_json(self, ref: str, mpy_version: MPYPath) -> bytes:
+        url: str = self.package_url(ref, mpy_version)
+        resp = requests.get(url, timeout=settings.upstream.http_timeout_seconds)
+        if resp.status_code == 404:
+            raise RefNotFoundError(repo_name=self.repo_name, branch=ref)
+        resp.raise_for_status()
+        return resp.content
+
+    def remote_revision(self, ref: str, mpy_version: MPYPath) -> str | None:
+        try:
+            data: bytes = self._fetch_package_json(ref, mpy_version)
+        except (requests.RequestException, RefNotFoundError) as e:
+            self.logger.debug(f"no revision for {self.package_url(ref, mpy_version)}: {e}")
+            return None
+        self._fetched[(ref, mpy_version)] = data
+        return hashlib.sha256(data).hexdigest()
+
+    def prepare(self, ref: str, mpy_version: MPYPath) -> PreparedSource | None:
+        data: bytes | None = self._fetched.pop((ref, mpy_version), None)
+        try:
+            if data is None:
+                with span("mirror.fetch_json"):
+                    data = self._fetch_package_json(ref, mpy_version)
+        except requests.RequestException as e:
+            self.logger.opt(exception=e).error(f"fetching {self.package_url(ref, mpy_version)} failed")
+            return None
+
+        # the index serves a json per mpy version -> one directory per ref, one json per version inside
+        workdir: Path = self.workdir(ref)
+        workdir.mkdir(parents=True, exist_ok=True)
+        (workdir / f"{mpy_version.value}.{self.UPSTREAM_JSON}").write_bytes(data)
+        return PreparedSource(path=workdir, revision=hashlib.sha256(data).hexdigest())
+
+    def fetch_object(self, short_hash: str, object_store: LooseObjectStore) -> str:
+        """Streams /file/<h[:2]>/<h> of the index into the store -> full sha256 of the stored object"""
+        short_hash = short_hash.lower()
+        if not SHORT_HASH.fullmatch(short_hash):
+            raise ValueError(f"invalid object hash {short_hash!r} in {self.base_url}")
+        url: str = f"{self.base_url}/file/{short_hash[:2]}/{short_hash}"
+        object_store.root.mkdir(parents=True, exist_ok=True)
+        fd, tmpname = tempfile.mkstemp(dir=object_store.root, prefix=".mirror-", suffix=".tmp")
+        try:
+            h = hashlib.sha256()
+            with span("mirror.fetch_object", hash=short_hash), os.fdopen(fd, "wb") as fout:
+                with requests.get(url, stream=True, timeout=settings.upstream.http_timeout_seconds) as resp:
+                    resp.raise_for_status()
+                    for chunk in resp.iter_content(chunk_size=65_536):
+                        h.update(chunk)
+                        fout.write(chunk)
+            full: str = h.hexdigest()
+            if not full.startswith(short_hash):
+                raise ValueError(f"hash mismatch for {url}: got {full}")
+            object_store.put_file(Path(tmpname), full)
+        finally:
+            Path(tmpname).unlink(missing_ok=True)
+        return full
+
+    def build(self, prepared: PreparedSource, target_pkgjson: Path, mpy_version: MPYPath) -> Path:
+        upstream: Dict[str, Any] = json.loads(
+            (prepared.path / f"{mpy_version.value}.{self.UPSTREAM_JSON}").read_bytes()
+        )
+        object_store: LooseObjectStore = self.helper.object_store
+
+        # objects already in the store (earlier builds, other packages, packs) are not downloaded again
+        resolved: Dict[str, str] = {}
+        hashes: List[List[str]] = []
+        for path, short_hash in upstream.get("hashes", []):
+            short_hash = str(short_hash).lower()
+            if not SHORT_HASH.fullmatch(short_hash):  # a file name below, a prefix that matches anything, ...
+                raise ValueError(f"invalid hash {short_hash!r} for {path} in {self.base_url}")
+            if short_hash not in resolved:
+                full: str | None = object_store.find_by_prefix(short_hash)
+                if full is None or not object_store.reuse(full):
+                    full = self.fetch_object(short_hash, object_store)
+                resolved[short_hash] = full
+            hashes.append([path, resolved[short_hash]])
+
+        # deps, urls, version, ... are passed through as they are
+        upstream["hashes"] = hashes
+        with span("package_json.write", files=len(hashes)):
+            target_pkgjson.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write(target_pkgjson, compact_json(upstream))
+        return target_pkgjson
+
+
+_BACKENDS: Dict[SourceKind, type[SourceBackend]] = {
+    SourceKind.git: GitSource,
+    SourceKind.local: LocalDirSource,
+    SourceKind.tarball: TarballSource,
+    SourceKind.mirror: MirrorSource,
+}
+
+
+def source_for(pkgcfg: PackageNameGithubRepo, helper: MIPServerHelper) -> SourceBackend:
+    return _BACKENDS[pkgcfg.source.kind](helper, pkgcfg)
@@ -0,0 +1,237 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import cache
+from pathlib import Path
+from typing import Any, Deque, Dict, Generator, List, Optional
+
+from loguru import logger
+from pydantic import BaseModel, Field
+
+from mipserver.config import Tracing
+
+
+@cache
+def _otel_tracer() -> Any:
+    """Optional: mirror the spans into an opentelemetry setup of the deployment (no-op without an sdk)
+
+    Imported with the first span instead of at startup.
+    """
+    try:
+        from opentelemetry import trace as otel_trace
+    except ImportError:  # pragma: no cover
+        return None
+    return otel_trace.get_tracer("mipserver")
+
+
+AttributeValue = str | int | float | bool
+
+
+class Span(BaseModel):
+    name: str
+    trace_id: str  # 32 hex chars like opentelemetry
+    span_id: str  # 16 hex chars
+    parent_span_id: Optional[str] = None
+    start_ns: int  # unix epoch nanoseconds
+    end_ns: int = 0
+    attributes: Dict[str, AttributeValue] = Field(default_factory=dict)
+    error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        return (self.end_ns - self.start_ns) / 1_000_000
+
+
+class BuildTimeline(BaseModel):
+    trace_id: str
+    package_name: str
+    mpy_version: str
+    pversion: str
+    started_at: float
+    duration_ms: float
+    result: str
+    spans: List[Span]  # in start order, first one is the root span
+
+
+class _TraceRecorder:
+    def __init__(self) -> None:
+        self.trace_id: str = os.urandom(16).hex()
+        self.spans: List[Span] = []
+        self._lock: threading.Lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+
+_current_trace: ContextVar[Optional[_TraceRecorder]] = ContextVar("mipserver_trace", default=None)
+_current_span: ContextVar[Optional[Span]] = ContextVar("mipserver_span", default=None)
+
+
+@contextmanager
+def span(name: str, **attributes: AttributeValue) -> Generator[Optional[Span], None, None]:
+    """Records a span below the current one - does (almost) nothing outside of a traced build"""
+    recorder: Optional[_TraceRecorder] = _current_trace.get()
+
+    with ExitStack() as stack:
+        otel_tracer: Any = _otel_tracer()
+        if otel_tracer is not None:
+            stack.enter_context(otel_tracer.start_as_current_span(name, attributes=attributes))
+
+        if recorder is None:
+            yield None
+            return
+
+        parent: Optional[Span] = _current_span.get()
+        s: Span = Span(
+            name=name,
+            trace_id=recorder.trace_id,
+            span_id=os.urandom(8).hex(),
+            parent_span_id=parent.span_id if parent else None,
+            start_ns=time.time_ns(),
+            attributes=dict(attributes),
+        )
+        recorder.add(s)
+        token = _current_span.set(s)
+        try:
+            yield s
+        except BaseException as e:
+            s.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            s.end_ns = time.time_ns()
+            _current_span.reset(token)
+
+
+def set_attribute(key: str, value: AttributeValue) -> None:
+    """Sets an attribute on the innermost span of the current trace (if any)"""
+    s: Optional[Span] = _current_span.get()
+    if s is not None:
+        s.attributes[key] = value
+
+
+class BuildTracer:
+    """Keeps the timelines of the last builds per package and optionally appends them to a file as OTLP/JSON"""
+
+    logger = logger.bind(classname=__qualname__)
+
+    def __init__(self, cfg: Tracing):
+        self.cfg = cfg
+        self._timelines: "OrderedDict[str, Deque[BuildTimeline]]" = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+        self.export_path: Optional[Path] = Path(cfg.export_path) if cfg.export_path else None
+
+    @contextmanager
+    def trace_build(self, package_name: str, mpy_version: str, pversion: str) -> Generator[Optional[Span], None, None]:
+        if not self.cfg.enabled:
+            yield None
+            return
+
+        recorder: _TraceRecorder = _TraceRecorder()
+        trace_token = _current_trace.set(recorder)
+        try:
+            with span("build", package=package_name, mpy_version=mpy_version, pversion=pversion) as root:
+                yield root
+        finally:
+            _current_trace.reset(trace_token)
+            self._finish(recorder, package_name, mpy_version, pversion)
+
+    def _finish(self, recorder: _TraceRecorder, package_name: str, mpy_version: str, pversion: str) -> None:
+        spans: List[Span] = sorted(recorder.spans, key=lambda s: s.start_ns)
+        root: Span = spans[0]
+        timeline: BuildTimeline = BuildTimeline(
+            trace_id=recorder.trace_id,
+            package_name=package_name,
+            mpy_version=mpy_version,
+            pversion=pversion,
+            started_at=root.start_ns / 1e9,
+            duration_ms=root.duration_ms,
+            result=str(root.attributes.get("result", "error" if root.error else "unknown")),
+            spans=spans,
+        )
+
+        with self._lock:
+            per_package: Deque[BuildTimeline] | None = self._timelines.get(package_name)
+            if per_package is None:
+                per_package = deque(maxlen=self.cfg.timelines_per_package)
+                self._timelines[package_name] = per_package
+            per_package.append(timeline)
+            self._timelines.move_to_end(package_name)
+            while len(self._timelines) > self.cfg.max_packages:
+                self._timelines.popitem(last=False)
+
+        self.logger.info(
+            f"build {package_name}@{pversion} ({mpy_version}) took {timeline.duration_ms:.0f}ms "
+            f"result={timeline.result} spans={len(spans)}"
+        )
+
+        if self.export_path is not None:
+            try:
+                self._export(timeline)
+            except Exception as e:
+                self.logger.opt(exception=e).warning(f"cannot export trace to {self.export_path}")
+
+    def timelines(self, package_name: Optional[str] = None, limit: int = 10) -> List[BuildTimeline]:
+        """Last builds (newest first), of one package or of all packages"""
+        with self._lock:
+            if package_name is not None:
+                candidates: List[BuildTimeline] = list(self._timelines.get(package_name, ()))
+            else:
+                candidates = [t for per_package in self._timelines.values() for t in per_package]
+        return sorted(candidates, key=lambda t: t.started_at, reverse=True)[:limit]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._timelines.clear()
+
+    # ---- export
+
+    @staticmethod
+    def _otlp_value(v: AttributeValue) -> Dict[str, Any]:
+        if isinstance(v, bool):
+            return {"boolValue": v}
+        if isinstance(v, int):
+            return {"intValue": str(v)}
+        if isinstance(v, float):
+            return {"doubleValue": v}
+        return {"stringValue": str(v)}
+
+    @classmethod
+    def to_otlp_json(cls, timeline: BuildTimeline) -> Dict[str, Any]:
+        """One OTLP/JSON ExportTraceServiceRequest -> can be replayed into any OTLP/HTTP collector"""
+        spans: List[Dict[str, Any]] = []
+        for s in timeline.spans:
+            d: Dict[str, Any] = {
+                "traceId": s.trace_id,
+                "spanId": s.span_id,
+                "name": s.name,
+                "kind": 1,  # SPAN_KIND_INTERNAL
+                "startTimeUnixNano": str(s.start_ns),
+                "endTimeUnixNano": str(s.end_ns),
+                "attributes": [{"key": k, "value": cls._otlp_value(v)} for k, v in s.attributes.items()],
+                "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+            }
+            if s.parent_span_id:
+                d["parentSpanId"] = s.parent_span_id
+            spans.append(d)
+
+        return {
+            "resourceSpans": [
+                {
+                    "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "mipserver"}}]},
+                    "scopeSpans": [{"scope": {"name": "mipserver.build"}, "spans": spans}],
+                }
+            ]
+        }
+
+    def _export(self, timeline: BuildTimeline) -> None:
+        assert self.export_path is not None
+        line: str = json.dumps(self.to_otlp_json(timeline), separators=(",", ":"))
+        with self._lock:
+            self.export_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.export_path, "a") as fout:
+                fout.write(line + "\n")
@@ -0,0 +1,109 @@
+import os
+import time
+from typing import Annotated, Dict, List, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+
+from mipserver.dependencies import (
+    get_build_tracer,
+    get_cache_manager,
+    get_index_mirror,
+    get_invalidation_bus,
+    get_metadata_store,
+    get_package_registry,
+    get_profiler,
+    require_admin,
+)
+from mipserver.internal.cachemanager import AreaUsage, CacheArea, CacheManager, GCReport
+from mipserver.internal.coordination import EVENT_MIRROR_SYNCED, EVENT_REGISTRY_CHANGED, InvalidationBus
+from mipserver.internal.indexmirror import IndexMirror, MirrorSyncReport
+from mipserver.internal.metadata import BuildJob, BuildRecord, MetadataStore, PackageStats
+from mipserver.internal.profiling import ProfilerBusy, SamplingProfiler
+from mipserver.internal.registry import PackageRegistry, RegistryDiff, RegistryError
+from mipserver.internal.tracing import BuildTimeline, BuildTracer
+
+router = APIRouter(prefix="/admin", tags=["admin"], dependencies=[Depends(require_admin)])
+
+
+@router.get("/cache", response_model=Dict[CacheArea, AreaUsage])
+async def cache_usage(cache_manager: Annotated[CacheManager, Depends(get_cache_manager)]) -> Dict[CacheArea, AreaUsage]:
+    return await run_in_threadpool(cache_manager.usage)
+
+
+@router.post("/cache/gc", response_model=GCReport)
+async def cache_gc(cache_manager: Annotated[CacheManager, Depends(get_cache_manager)]) -> GCReport:
+    return await run_in_threadpool(cache_manager.collect_garbage)
+
+
+@router.get("/builds", response_model=List[BuildRecord])
+async def builds(metadata: Annotated[MetadataStore, Depends(get_metadata_store)]) -> List[BuildRecord]:
+    return await run_in_threadpool(metadata.list_builds)
+
+
+@router.get("/stats/packages", response_model=List[PackageStats])
+async def package_stats(metadata: Annotated[MetadataStore, Depends(get_metadata_store)]) -> List[PackageStats]:
+    return await run_in_threadpool(metadata.package_stats)
+
+
+@router.get("/builds/queue", response_model=List[BuildJob])
+async def build_queue(metadata: Annotated[MetadataStore, Depends(get_metadata_store)]) -> List[BuildJob]:
+    """Queued and running build jobs (BUILDER.mode: queue), oldest first"""
+    return await run_in_threadpool(metadata.build_jobs)
+
+
+@router.get("/builds/timelines", response_model=List[BuildTimeline])
+async def build_timelines(
+    tracer: Annotated[BuildTracer, Depends(get_build_tracer)],
+    package_name: Annotated[Optional[str], Query()] = None,
+    limit: Annotated[int, Query(ge=1, le=1000)] = 10,
+) -> List[BuildTimeline]:
+    """Span timelines of the last builds (newest first) -> which stage/module dominates a cold build"""
+    return tracer.timelines(package_name=package_name, limit=limit)
+
+
+@router.post("/mirror/sync", response_model=MirrorSyncReport)
+async def mirror_sync(
+    index_mirror: Annotated[IndexMirror, Depends(get_index_mirror)],
+    invalidation_bus: Annotated[InvalidationBus, Depends(get_invalidation_bus)],
+    force: Annotated[bool, Query()] = False,
+) -> MirrorSyncReport:
+    """Syncs the mirrored index now (force: even if index.json did not change)"""
+    report: MirrorSyncReport = await run_in_threadpool(index_mirror.sync, force)
+    invalidation_bus.publish(EVENT_MIRROR_SYNCED)
+    return report
+
+
+@router.post("/registry/reload", response_model=RegistryDiff)
+async def registry_reload(
+    registry: Annotated[PackageRegistry, Depends(get_package_registry)],
+    invalidation_bus: Annotated[InvalidationBus, Depends(get_invalidation_bus)],
+) -> RegistryDiff:
+    """Re-reads PACKAGENAME_TO_GITHUB_REPO -> added/removed/changed packages (the other workers follow)"""
+    try:
+        diff: RegistryDiff = await run_in_threadpool(registry.reload)
+    except RegistryError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    if diff:
+        invalidation_bus.publish(EVENT_REGISTRY_CHANGED, **diff.model_dump())
+    return diff
+
+
+@router.post("/profile", response_class=PlainTextResponse)
+async def profile(
+    profiler: Annotated[SamplingProfiler, Depends(get_profiler)],
+    seconds: Annotated[float, Query(gt=0)] = 10.0,
+    interval_ms: Annotated[float, Query(ge=1, le=1000)] = 10.0,
+    tasks: Annotated[bool, Query()] = True,
+) -> PlainTextResponse:
+    """Samples the threads and asyncio tasks of this worker for <seconds> (capped at PROFILING.max_seconds)
+
+    -> collapsed stacks, e.g. flamegraph.pl profile.txt > profile.svg or drop it into speedscope
+    """
+    try:
+        collapsed: str = await profiler.profile(seconds, interval_ms, tasks)
+    except ProfilerBusy as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    filename: str = f"mipserver-{os.getpid()}-{time.strftime('%Y%m%dT%H%M%S')}.collapsed.txt"
+    return PlainTextResponse(collapsed, headers={"Content-Disposition": f'attachment; filename="{filename}"'})
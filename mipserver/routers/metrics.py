@@ -0,0 +1,27 @@
+import os
+
+from fastapi import APIRouter, Response
+from fastapi.concurrency import run_in_threadpool
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest, multiprocess
+
+from mipserver import dependencies
+
+router = APIRouter(tags=["metrics"])
+
+
+def _generate() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return generate_latest()
+
+    # several workers -> aggregate the per-process files of prometheus_client's multiprocess mode
+    registry: CollectorRegistry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)  # type: ignore[no-untyped-call]
+    if dependencies.CACHE_COLLECTOR is not None:  # computed from the shared index -> same in every worker
+        registry.register(dependencies.CACHE_COLLECTOR)
+    return generate_latest(registry)
+
+
+@router.get("/metrics", include_in_schema=False)
+async def metrics() -> Response:
+    # collectors may hit the metadata index -> keep that off the event loop
+    return Response(content=await run_in_threadpool(_generate), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,32 @@
+from typing import Annotated, Dict, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Path as FPath, Query
+from fastapi.responses import FileResponse
+
+from mipserver.datastructures.datatypes import MPYPath
+from mipserver.dependencies import get_metadata_store
+from mipserver.internal.metadata import BuildRecord, MetadataStore
+from mipserver.internal.peers import COMMIT_HEADER
+
+router = APIRouter(prefix="/peer", tags=["peer"])
+
+
+@router.get("/package/{mpy_version:str}/{package_name:str}/{pversion}.json", include_in_schema=False)
+async def peer_package_json(
+    mpy_version: Annotated[MPYPath, FPath(...)],
+    package_name: Annotated[str, FPath(..., min_length=3, max_length=100)],
+    pversion: Annotated[str, FPath(..., min_length=3, max_length=64)],
+    metadata: Annotated[MetadataStore, Depends(get_metadata_store)],
+    commit: Annotated[Optional[str], Query(max_length=128)] = None,
+) -> FileResponse:
+    """Package json this replica already built (at commit) for another replica -> never triggers a build"""
+    build: BuildRecord | None = metadata.get_build(package_name, mpy_version.value, pversion)
+    if build is None or (commit is not None and build.commit != commit):
+        raise HTTPException(status_code=404, detail=f"{package_name}@{pversion} not built at {commit}")
+
+    json_path = metadata.absolute_json_path(build)
+    if not json_path.is_file():
+        raise HTTPException(status_code=404, detail=f"{package_name}@{pversion} collected")
+
+    headers: Dict[str, str] = {COMMIT_HEADER: build.commit} if build.commit else {}
+    return FileResponse(json_path, media_type="application/json", headers=headers)
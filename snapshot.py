@@ -0,0 +1,72 @@
+import argparse
+import sys
+import tarfile
+from pathlib import Path
+from typing import BinaryIO, List, Optional, cast
+
+from loguru import logger
+
+from mipserver.dependencies import CACHE_MANAGER, METADATA_STORE, SERVER_CACHE_ROOT
+from mipserver.internal.coordination import EVENT_NEW_REVISION, InvalidationBus
+from mipserver.internal.snapshot import SnapshotImportReport, SnapshotManifest, Snapshots
+
+
+def _open(path: str, mode: str) -> BinaryIO:
+    if path == "-":
+        return sys.stdout.buffer if "w" in mode else sys.stdin.buffer
+    return cast(BinaryIO, open(path, mode))
+
+
+def export(args: argparse.Namespace) -> None:
+    snapshots = Snapshots(SERVER_CACHE_ROOT, METADATA_STORE, CACHE_MANAGER.object_store)
+    with _open(args.output, "wb") as fout:
+        manifest: SnapshotManifest = snapshots.export(fout, args.package, args.mpy, args.compression)
+    logger.info(f"{len(manifest.builds)} builds, {len(manifest.objects)} objects -> {args.output}")
+
+
+def import_(args: argparse.Namespace) -> None:
+    snapshots = Snapshots(SERVER_CACHE_ROOT, METADATA_STORE, CACHE_MANAGER.object_store)
+    with _open(args.input, "rb") as fin:
+        report: SnapshotImportReport = snapshots.import_(fin)
+
+    # a server running on this cache drops cached failures of the imported packages
+    bus = InvalidationBus(METADATA_STORE)
+    for b in report.builds:
+        if b.commit is not None:
+            bus.publish(EVENT_NEW_REVISION, package_name=b.package_name, pversion=b.pversion, commit=b.commit)
+    logger.info(f"{len(report.builds)} builds, {report.objects_imported} new objects <- {args.input}")
+
+
+def show(args: argparse.Namespace) -> None:
+    with _open(args.input, "rb") as fin, tarfile.open(fileobj=fin, mode="r|*") as tar:
+        print(Snapshots.read_manifest(tar).model_dump_json(indent=1))
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="export/import prebuilt cache snapshots (./.cache/repos)")
+    sub = parser.add_subparsers(required=True)
+
+    p = sub.add_parser("export", help="write package jsons + referenced objects as one archive")
+    p.add_argument("-o", "--output", default="-", help="archive file or - for stdout (default)")
+    p.add_argument("--package", action="append", help='"name" or "name@ref", repeatable (default: all builds)')
+    p.add_argument("--mpy", action="append", help='target, e.g. "6" or "py", repeatable (default: all)')
+    p.add_argument("--compression", choices=["gz", "xz"], default="gz")
+    p.set_defaults(func=export)
+
+    p = sub.add_parser("import", help="add a snapshot to this cache (existing objects are skipped)")
+    p.add_argument("input", help="archive file or - for stdin")
+    p.set_defaults(func=import_)
+
+    p = sub.add_parser("show", help="print the manifest of a snapshot")
+    p.add_argument("input", help="archive file or - for stdin")
+    p.set_defaults(func=show)
+
+    args = parser.parse_args(argv)
+    try:
+        args.func(args)
+    finally:
+        METADATA_STORE.close()
+
+
+if __name__ == "__main__":
+    main()
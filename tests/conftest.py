@@ -1,7 +1,17 @@
+"""A package holding the tests."""
+
+from pathlib import Path
+from typing import Generator
+
 import pytest
 from fastapi.testclient import TestClient
 
+import mipserver.app as appmod
+import mipserver.dependencies as depmod
 from mipserver.app import app
+from mipserver.internal.coordination import InvalidationBus
+from mipserver.internal.locks import LockManager
+from mipserver.internal.metadata import MetadataStore
 
 print("Conftest... initializing fixture...")
 
@@ -9,3 +19,34 @@ print("Conftest... initializing fixture...")
 @pytest.fixture()
 def client() -> TestClient:
     return TestClient(app)
+
+
+@pytest.fixture(autouse=True)
+def clear_process_caches() -> Generator[None, None, None]:
+    # process-wide caches must not leak state from one test into the next
+    appmod.NEGATIVE_CACHE.clear()
+    depmod.PACKAGE_BODIES.clear()
+    yield
+    appmod.NEGATIVE_CACHE.clear()
+    depmod.PACKAGE_BODIES.clear()
+
+
+@pytest.fixture(autouse=True)
+def metadata_store(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Generator[MetadataStore, None, None]:
+    # tests must not write into the index of the real cache root
+    store: MetadataStore = MetadataStore(tmp_path / "test-metadata.sqlite3", tmp_path)
+    monkeypatch.setattr(depmod, "METADATA_STORE", store)
+    monkeypatch.setattr(depmod, "INVALIDATION_BUS", InvalidationBus(store))
+    monkeypatch.setattr(depmod.CACHE_MANAGER, "metadata", store)
+    if depmod.CACHE_COLLECTOR is not None:  # a /metrics scrape would open the real index otherwise
+        monkeypatch.setattr(depmod.CACHE_COLLECTOR, "metadata", store)
+    yield store
+    store.close()
+
+
+@pytest.fixture(autouse=True)
+def cache_locks(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    # build/gc locks of the shared cache manager must not end up in ./.cache of the working tree
+    monkeypatch.setattr(depmod.CACHE_MANAGER, "cache_root", tmp_path)
+    monkeypatch.setattr(depmod.CACHE_MANAGER, "locks", LockManager(tmp_path))
+    monkeypatch.setattr(depmod.CACHE_MANAGER.object_store, "root", tmp_path / "files")
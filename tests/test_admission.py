@@ -0,0 +1,157 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+from mipserver.config import AdmissionControl, NegativeCache, PackageNameGithubRepo
+from mipserver.Helper import GitRefNotFoundError, MIPServerHelper
+from mipserver.internal.admission import AdmissionController, AdmissionDenied
+from mipserver.internal.negativecache import NegativeResultCache
+
+
+def test_branch_allow_list_and_pattern() -> None:
+    unrestricted = PackageNameGithubRepo(packagename="demo", githubrepo="someone/repo")
+    assert AdmissionController.is_branch_allowed(unrestricted, "whatever")
+
+    restricted = PackageNameGithubRepo(
+        packagename="demo", githubrepo="someone/repo", allowed_branches=["develop"], branch_pattern=r"release-\d+"
+    )
+    assert AdmissionController.is_branch_allowed(restricted, "latest")
+    assert AdmissionController.is_branch_allowed(restricted, "develop")
+    assert AdmissionController.is_branch_allowed(restricted, "release-12")
+    assert not AdmissionController.is_branch_allowed(restricted, "release-12x")
+    assert not AdmissionController.is_branch_allowed(restricted, "random-branch")
+
+
+def test_client_budget_is_per_ip() -> None:
+    ac = AdmissionController(AdmissionControl(client_budget=2, client_budget_window_seconds=60))
+
+    ac.consume_client_budget("10.0.0.1")
+    ac.consume_client_budget("10.0.0.1")
+    with pytest.raises(AdmissionDenied) as excinfo:
+        ac.consume_client_budget("10.0.0.1")
+
+    assert excinfo.value.status_code == 429
+    assert excinfo.value.retry_after is not None and 0 < excinfo.value.retry_after <= 61
+
+    # other clients are not affected
+    ac.consume_client_budget("10.0.0.2")
+
+
+@pytest.fixture()
+def demo_app(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Any:
+    ac = AdmissionController(AdmissionControl(client_budget=2))
+    configs = {
+        "demo": PackageNameGithubRepo(packagename="demo", githubrepo="someone/repo", allowed_branches=["develop"])
+    }
+    appmod.app.dependency_overrides[appmod.get_package_name_to_repo] = lambda: {"demo": "someone/repo"}
+    appmod.app.dependency_overrides[appmod.get_package_configs] = lambda: configs
+    appmod.app.dependency_overrides[appmod.get_admission_controller] = lambda: ac
+    nc = NegativeResultCache(NegativeCache())
+    appmod.app.dependency_overrides[appmod.get_negative_cache] = lambda: nc
+
+    def fake_get_local_path_for_package_json_by_package_and_version(self: MIPServerHelper, mpy_version: Any, package_name: str, pversion: str) -> Path:  # type: ignore[override]
+        return tmp_path / str(mpy_version) / package_name / f"{pversion}.json"
+
+    monkeypatch.setattr(
+        MIPServerHelper,
+        "get_local_path_for_package_json_by_package_and_version",
+        fake_get_local_path_for_package_json_by_package_and_version,
+    )
+
+    yield ac
+
+    appmod.app.dependency_overrides.clear()
+
+
+def test_disallowed_branch_is_rejected_without_git(
+    client: TestClient, demo_app: AdmissionController, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    calls: List[str] = []
+
+    def fake_ensure_git_repo_up_to_date(self: MIPServerHelper, repo_name: str, branch: str, repo_url: str | None = None) -> Path | None:  # type: ignore[override]
+        calls.append(branch)
+        return None
+
+    monkeypatch.setattr(MIPServerHelper, "ensure_git_repo_up_to_date", fake_ensure_git_repo_up_to_date)
+
+    r = client.get("/package/6/demo/random-branch.json")
+    assert r.status_code == 403
+    assert calls == []
+
+
+def test_missing_ref_is_cached_and_budget_enforced(
+    client: TestClient, demo_app: AdmissionController, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    calls: List[str] = []
+
+    def fake_ensure_git_repo_up_to_date(self: MIPServerHelper, repo_name: str, branch: str, repo_url: str | None = None) -> Path | None:  # type: ignore[override]
+        calls.append(branch)
+        if branch == "develop":
+            raise GitRefNotFoundError(repo_name=repo_name, branch=branch)
+        return None
+
+    monkeypatch.setattr(MIPServerHelper, "ensure_git_repo_up_to_date", fake_ensure_git_repo_up_to_date)
+
+    r = client.get("/package/6/demo/develop.json")
+    assert r.status_code == 404
+
+    # negative cache -> no second clone attempt
+    r = client.get("/package/6/demo/develop.json")
+    assert r.status_code == 404
+    assert "Retry-After" in r.headers
+    assert calls == ["develop"]
+
+    # "latest" consumes the second (and last) cold build of this client
+    r = client.get("/package/6/demo/latest.json")
+    assert r.status_code == 500
+    r = client.get("/package/py/demo/latest.json")
+    assert r.status_code == 429
+    assert "Retry-After" in r.headers
+
+
+def test_retry_after_follows_measured_builds_with_per_client_jitter() -> None:
+    ac = AdmissionController(AdmissionControl(default_build_seconds=10, retry_jitter_ratio=1.0))
+    assert 10 <= ac.retry_after("demo", "10.0.0.1") <= 20  # nothing measured yet
+
+    ac.observe_build("demo", 100.0)
+    spread: List[int] = [ac.retry_after("demo", f"10.0.0.{i}") for i in range(50)]
+    assert all(100 <= s <= 200 for s in spread)
+    assert len(set(spread)) > 10  # clients turned away together come back at different times
+    assert ac.retry_after("demo", "10.0.0.7") == spread[7]  # ... but each at a stable offset
+
+    assert ac.retry_after("other", "10.0.0.1") >= 100  # unknown package -> average of all builds
+    ac.observe_build("demo", 200.0)
+    assert ac.expected_build_seconds("demo") == pytest.approx(130.0)
+
+
+def test_backpressure_per_package_and_queue() -> None:
+    cfg = AdmissionControl(
+        max_concurrent_builds=2, max_pending_per_package=2, max_wait_seconds=60, default_build_seconds=20
+    )
+    ac = AdmissionController(cfg)
+    with ac.pending_build("demo"), ac.pending_build("demo"):
+        with pytest.raises(AdmissionDenied) as excinfo:
+            ac.check_backpressure("demo", "10.0.0.1")
+        assert excinfo.value.status_code == 503 and excinfo.value.retry_after is not None
+        ac.check_backpressure("other", "10.0.0.1")  # other packages are not affected
+    ac.check_backpressure("demo", "10.0.0.1")
+
+    ac.check_backpressure("demo", "10.0.0.1", waiting=6)  # 3 rounds of 20s ahead
+    with pytest.raises(AdmissionDenied) as excinfo:
+        ac.check_backpressure("demo", "10.0.0.1", waiting=7)
+    assert excinfo.value.retry_after is not None and excinfo.value.retry_after >= 80 + 20
+    ac.check_backpressure("demo", "10.0.0.1", waiting=9, slots=3)  # builders: 3 at a time -> 3 rounds again
+
+
+def test_saturated_package_is_answered_right_away(client: TestClient, demo_app: AdmissionController) -> None:
+    demo_app.cfg.max_pending_per_package = 1
+    with demo_app.pending_build("demo"):  # a build of demo is running, one request waits for it
+        r = client.get("/package/6/demo/latest.json")
+    assert r.status_code == 503 and int(r.headers["Retry-After"]) >= 1
+    documented = client.get("/openapi.json").json()["paths"]["/package/{mpy_version}/{package_name}/{pversion}.json"]
+    assert "503" in documented["get"]["responses"]
@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import json
+import warnings
 from pathlib import Path
 from typing import Any, Dict
 
@@ -9,6 +10,8 @@ from fastapi.testclient import TestClient
 
 import mipserver.app as appmod
 from mipserver.Helper import MIPServerHelper
+from mipserver.internal.metadata import MetadataStore, build_record_from_package_json
+from mipserver.internal.objectstore import LooseObjectStore
 
 
 def test_root_returns_hello(client: TestClient) -> None:
@@ -52,14 +55,15 @@ def test_package_json_invalid_package_returns_error(client: TestClient, monkeypa
 
     try:
         r = client.get("/package/py/nonexistentpkg/latest.json")
-        assert r.status_code == 500
+        assert r.status_code == 404
+        assert "Retry-After" in r.headers
         assert r.json()["error"].startswith("cannot generate package -> invalid packagename")
     finally:
         app.dependency_overrides.clear()
 
 
 def test_package_json_uses_fresh_local_file(
-    client: TestClient, tmp_path: Path, monkeypatch: pytest.MonkeyPatch
+    client: TestClient, tmp_path: Path, monkeypatch: pytest.MonkeyPatch, metadata_store: MetadataStore
 ) -> None:
     # Map package name and force local_json path to exist and be fresh
 
@@ -75,6 +79,11 @@ def test_package_json_uses_fresh_local_file(
     local_json.parent.mkdir(parents=True, exist_ok=True)
     payload = {"hashes": [["demo.mpy", "a" * 64]]}
     local_json.write_text(json.dumps(payload))
+    metadata_store.record_build(
+        build_record_from_package_json(
+            metadata_store, LooseObjectStore(tmp_path / "files"), local_json, "demo", "py", "latest", "c0ffee"
+        )
+    )
 
     # Point helper to our tmp_path for package json
     def fake_get_local_path_for_package_json_by_package_and_version(self: MIPServerHelper, mpy_version: Any, package_name: str, pversion: str) -> Path:  # type: ignore[override]
@@ -109,7 +118,7 @@ def test_package_json_git_pull_failure(client: TestClient, tmp_path: Path, monke
         p = tmp_path / str(mpy_version) / package_name / f"{pversion}.json"
         return p
 
-    def fake_ensure_git_repo_up_to_date(self: MIPServerHelper, repo_name: str, branch: str) -> Path | None:  # type: ignore[override]
+    def fake_ensure_git_repo_up_to_date(self: MIPServerHelper, repo_name: str, branch: str, repo_url: str | None = None) -> Path | None:  # type: ignore[override]
         return None
 
     monkeypatch.setattr(
@@ -141,7 +150,7 @@ def test_package_json_generate_success(client: TestClient, tmp_path: Path, monke
     def fake_get_local_path_for_package_json_by_package_and_version(self: MIPServerHelper, mpy_version: Any, package_name: str, pversion: str) -> Path:  # type: ignore[override]
         return tmp_path / str(mpy_version) / package_name / f"{pversion}.json"
 
-    def fake_ensure_git_repo_up_to_date(self: MIPServerHelper, repo_name: str, branch: str) -> Path | None:  # type: ignore[override]
+    def fake_ensure_git_repo_up_to_date(self: MIPServerHelper, repo_name: str, branch: str, repo_url: str | None = None) -> Path | None:  # type: ignore[override]
         p = tmp_path / "gitrepo"
         p.mkdir(parents=True, exist_ok=True)
         return p
@@ -178,6 +187,7 @@ def test_package_json_generate_success(client: TestClient, tmp_path: Path, monke
     [
         ("ab", "c" * 63, 422),
         ("abc", "c" * 64, 422),
+        ("zz", "z" * 64, 422),
     ],
 )
 def test_file_param_validation(client: TestClient, short2: str, short64: str, status: int) -> None:
@@ -218,6 +228,17 @@ def test_file_happy_path_returns_bytes(client: TestClient, tmp_path: Path, monke
     assert r.headers.get("content-type") == "application/octet-stream"
     assert r.content == content
 
+    r = client.get(f"/file/{shard.upper()}/{short_hash.upper()}")  # hex is case insensitive
+    assert r.status_code == 200 and r.content == content
+
+
+def test_file_route_is_documented_once(client: TestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(appmod.app, "openapi_schema", None)  # generated anew -> its warnings are seen here
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")  # e.g. "Duplicate Operation ID"
+        paths = client.get("/openapi.json").json()["paths"]
+    assert list(paths["/file/{short_hash_2}/{short_hash}"]) == ["get"]
+
 
 def test_catch_all_unknown_returns_error(client: TestClient) -> None:
     r = client.get("/this/path/does/not/exist")
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from benchmarks.fakeupstream import create_fake_upstream, ensure_mpy_cross, push_new_commit
+from benchmarks.run import BenchmarkParams, BenchmarkResult, LatencyStats, compare
+
+
+def test_fake_upstream_is_cloneable_and_changes(tmp_path: Path) -> None:
+    upstream = create_fake_upstream(tmp_path / "upstream", packages=2, files_per_package=3, file_size=500)
+    assert upstream.package_name_to_repo() == {"benchpkg0": "bench/benchpkg0", "benchpkg1": "bench/benchpkg1"}
+
+    pkg = upstream.packages[0]
+    checkout: Path = tmp_path / "checkout"
+    url: str = f"{upstream.url_base}/{pkg.repo_name}.git"
+    subprocess.run(["git", "clone", "-q", "--depth", "1", "--branch", "main", url, str(checkout)], check=True)
+    assert sorted(p.relative_to(checkout).as_posix() for p in checkout.glob("benchpkg0/*.py")) == pkg.files
+    assert (checkout / "package.json").is_file()
+
+    before: str = subprocess.run(["git", "ls-remote", url, "refs/heads/main"], capture_output=True, text=True).stdout
+    new_commit: str = push_new_commit(upstream, pkg)
+    after: str = subprocess.run(["git", "ls-remote", url, "refs/heads/main"], capture_output=True, text=True).stdout
+    assert before != after and after.startswith(new_commit)
+
+
+def test_stub_mpy_cross(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PATH", os.environ["PATH"])  # the stub is prepended to PATH -> restore afterwards
+    stub: str = ensure_mpy_cross(tmp_path / "bin", force_stub=True)
+    src: Path = tmp_path / "mod.py"
+    src.write_text("x = 1\n")
+
+    subprocess.run([stub, "-O2", str(src), "-o", str(tmp_path / "mod.mpy"), "-s", "mod.py"], check=True)
+    assert (tmp_path / "mod.mpy").read_bytes().endswith(b"x = 1\n")
+
+
+def test_stats_and_compare() -> None:
+    stats = LatencyStats.from_samples([i / 1000 for i in range(1, 101)], errors=1, duration_seconds=2.0)
+    assert (stats.count, stats.errors, stats.throughput_rps) == (100, 1, 50.0)
+    assert round(stats.p50_ms) == 50 and round(stats.p99_ms) == 99 and round(stats.max_ms) == 100
+
+    def result(p50: float) -> BenchmarkResult:
+        return BenchmarkResult(
+            version="v",
+            python="3",
+            platform="p",
+            created_at="now",
+            mpy_cross="stub",
+            params=BenchmarkParams(),
+            results={"file": LatencyStats(p50_ms=p50, p99_ms=p50, throughput_rps=100)},
+        )
+
+    [_, line] = compare(result(10), result(5))
+    assert line.startswith("file") and "-50%" in line
+
+
+def test_serialization_benchmark(tmp_path: Path) -> None:
+    from benchmarks.serialization import run_serialization
+
+    result = run_serialization([20], repeat=3, workdir=tmp_path)
+    assert result.body_bytes["compact@20"] < result.body_bytes["indented@20"]
+    assert {k.split("@")[0] for k in result.results} == {
+        "build_models",
+        "build_compact",
+        "serve_validated",
+        "serve_file",
+        "serve_precomputed",
+    }
+    assert all(stats.count == 3 for stats in result.results.values())
+
+
+def test_packstore_benchmark(tmp_path: Path) -> None:
+    from benchmarks.packstore import run_packstore
+
+    result = run_packstore(objects=200, object_bytes=512, lookups=50, workdir=tmp_path)
+    assert result.footprint["loose"].files == 200
+    assert result.footprint["packed"].files < 10  # pack + index + journal
+    assert all(stats.count == 50 for stats in result.results.values())
+
+
+def test_startup_benchmark(tmp_path: Path) -> None:
+    from benchmarks.startup import run_startup
+
+    result = run_startup(runs=1, modules=["mipserver.app"], workdir=tmp_path)
+    assert result.imports["mipserver.app"].count == 1 and result.first_request.count == 1
+    assert result.optional_loaded["mipserver.app"] == []  # redis, mqtt, otel sdk only when configured
+    assert not result.cache_created["mipserver.app"]  # importing has no side effects on disk
+    assert "mipserver" in result.top_imports_ms
+
+
+def test_config_models_import_without_loading_settings(tmp_path: Path) -> None:
+    code: str = (
+        "import mipserver.config as c\n"
+        "from mipserver.config import Profiling\n"
+        "assert 'settings' not in vars(c)\n"  # the yaml is parsed on the first use of settings only
+        "from mipserver.config import settings\n"
+        "assert vars(c)['settings'] is settings\n"
+    )
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent.parent))
+    subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env, check=True, capture_output=True)
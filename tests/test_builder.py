@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+import json
+import time
+from pathlib import Path
+from typing import Any, Generator, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+import mipserver.dependencies as depmod
+from mipserver.config import Builder, CacheManagement, PackageNameGithubRepo, Source, SourceKind, Tracing, settings
+from mipserver.internal.builder import BuildWorker
+from mipserver.internal.cachemanager import CacheManager
+from mipserver.internal.coordination import InvalidationBus
+from mipserver.internal.metadata import BuildJob, MetadataStore
+from mipserver.internal.registry import PackageRegistry
+from mipserver.internal.tracing import BuildTracer
+
+
+def test_jobs_are_deduplicated_and_survive_a_lost_builder(metadata_store: MetadataStore) -> None:
+    job: BuildJob = metadata_store.enqueue_build_job("demo", "6", "latest")
+    assert metadata_store.enqueue_build_job("demo", "6", "latest").id == job.id  # queued once
+    other: BuildJob = metadata_store.enqueue_build_job("demo", "py", "latest")
+
+    claimed = metadata_store.claim_build_job("builder-a", lease_seconds=0.01, max_attempts=2)
+    assert claimed is not None and claimed.id == job.id and claimed.state == "running" and claimed.attempts == 1
+    assert metadata_store.enqueue_build_job("demo", "6", "latest").id == job.id  # running counts as well
+
+    time.sleep(0.02)  # builder-a crashed -> lease over, handed out again (before younger jobs)
+    again = metadata_store.claim_build_job("builder-b", lease_seconds=0.01, max_attempts=2)
+    assert again is not None and again.id == job.id and again.worker == "builder-b" and again.attempts == 2
+    assert not metadata_store.finish_build_job(job.id, "builder-a", "built", "stale")  # lost its lease
+    assert not metadata_store.renew_build_job(job.id, "builder-a", 60)
+    assert metadata_store.renew_build_job(job.id, "builder-b", 0.01)
+
+    time.sleep(0.02)  # crashed again -> given up
+    nxt = metadata_store.claim_build_job("builder-c", lease_seconds=60, max_attempts=2)
+    assert nxt is not None and nxt.id == other.id
+    lost = metadata_store.get_build_job(job.id)
+    assert lost is not None and lost.state == "done" and lost.result == "lost"
+
+    metadata_store.finish_build_job(other.id, "builder-c", "built", "c1")
+    assert metadata_store.claim_build_job("builder-c", lease_seconds=60, max_attempts=2) is None
+    assert metadata_store.build_job_counts() == {"done": 2}
+    assert metadata_store.enqueue_build_job("demo", "6", "latest").id != job.id  # done -> a new job
+
+
+def _worker(tmp_path: Path, registry: PackageRegistry, metadata_store: MetadataStore, **cfg: Any) -> BuildWorker:
+    return BuildWorker(
+        Builder(mode="queue", **cfg),
+        tmp_path,
+        registry,
+        CacheManager(tmp_path, CacheManagement(), registry.name_to_repo, metadata_store),
+        metadata_store,
+        BuildTracer(Tracing()),
+        InvalidationBus(metadata_store),
+        depmod.BUILD_NOTIFIER,
+        None,
+        lock_timeout=5,
+        freshness_seconds=1800,
+    )
+
+
+def test_lease_is_renewed_while_the_build_runs(tmp_path: Path, metadata_store: MetadataStore) -> None:
+    worker: BuildWorker = _worker(tmp_path, PackageRegistry([]), metadata_store, lease_seconds=0.06)
+    metadata_store.enqueue_build_job("demo", "6", "latest")
+    job = metadata_store.claim_build_job(worker.worker_id, lease_seconds=0.06, max_attempts=3)
+    assert job is not None
+
+    with worker._lease(job):
+        time.sleep(0.3)  # a cold build that takes longer than the lease
+        assert metadata_store.claim_build_job("builder-b", lease_seconds=60, max_attempts=3) is None
+    assert metadata_store.finish_build_job(job.id, worker.worker_id, "built", "c1")
+
+
+@pytest.fixture()
+def queue_mode(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Generator[PackageRegistry, None, None]:
+    lab: Path = tmp_path / "lab"
+    (lab / "demo").mkdir(parents=True)
+    (lab / "demo" / "mod.py").write_text("x = 1\n")
+    (lab / "package.json").write_text(json.dumps({"urls": [["demo/mod.py", "demo/mod.py"]], "version": "1.0"}))
+    pkg = PackageNameGithubRepo(
+        packagename="demo", githubrepo="lab/demo", source=Source(kind=SourceKind.local, path=str(lab))
+    )
+    registry = PackageRegistry([pkg])
+
+    monkeypatch.setattr(appmod, "SERVER_CACHE_ROOT", tmp_path)
+    monkeypatch.setattr(settings, "builder", Builder(mode="queue", wait_seconds=0))
+    appmod.app.dependency_overrides[appmod.get_package_name_to_repo] = lambda: registry.name_to_repo
+    appmod.app.dependency_overrides[appmod.get_package_configs] = lambda: registry.configs
+    yield registry
+    appmod.app.dependency_overrides.clear()
+
+
+def test_http_worker_only_queues_and_serves(
+    client: TestClient, tmp_path: Path, metadata_store: MetadataStore, queue_mode: PackageRegistry
+) -> None:
+    r = client.get("/package/py/demo/latest.json")
+    assert r.status_code == 503 and "retry-after" in r.headers  # nothing built yet, nobody builds in here
+    [job] = metadata_store.build_jobs()
+    assert (job.package_name, job.mpy_version, job.state) == ("demo", "py", "queued")
+
+    worker: BuildWorker = _worker(tmp_path, queue_mode, metadata_store)
+    assert worker.run_once() and not worker.run_once()
+    done = metadata_store.get_build_job(job.id)
+    assert done is not None and done.result == "built" and done.commit is not None
+
+    r = client.get("/package/py/demo/latest.json")
+    assert r.status_code == 200 and [p for p, _ in r.json()["hashes"]] == ["demo/mod.py"]
+
+
+def test_once_publishes_notifications(metadata_store: MetadataStore, monkeypatch: pytest.MonkeyPatch) -> None:
+    import builder as buildermod
+
+    calls: List[str] = []
+    monkeypatch.setattr(buildermod, "METADATA_STORE", metadata_store)
+    monkeypatch.setattr(buildermod.BUILD_NOTIFIER, "start", lambda: calls.append("start"))
+    monkeypatch.setattr(buildermod.BUILD_NOTIFIER, "stop", lambda: calls.append("stop"))
+    buildermod.main(["--once"])
+    assert calls == ["start", "stop"]  # otherwise build_changed() has no client and drops the notifications
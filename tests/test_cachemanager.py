@@ -0,0 +1,174 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+from mipserver.config import CacheManagement, CacheQuota, settings
+from mipserver.internal.cachemanager import CacheArea, CacheManager
+from mipserver.internal.metadata import MetadataStore
+
+REPOS: Dict[str, str] = {"demo": "someone/demo", "other": "someone/other"}
+
+
+def _age(p: Path, seconds: float) -> None:
+    t: float = time.time() - seconds
+    os.utime(p, (t, t))
+
+
+def _object(root: Path, content: bytes, age: float = 3600) -> str:
+    h: str = hashlib.sha256(content).hexdigest()
+    p: Path = root / "files" / h[:2] / h
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_bytes(content)
+    _age(p, age)
+    return h
+
+
+def _package_json(root: Path, package_name: str, version: str, hashes: List[str], age: float = 3600) -> Path:
+    p: Path = root / "6" / package_name / f"{version}.json"
+    p.parent.mkdir(parents=True, exist_ok=True)
+    p.write_text(json.dumps({"hashes": [[f"{h[:6]}.mpy", h] for h in hashes]}))
+    _age(p, age)
+    return p
+
+
+def _checkout(root: Path, dirname: str, size: int, mpy_size: int = 0, age: float = 3600) -> Path:
+    p: Path = root / dirname
+    (p / ".git").mkdir(parents=True, exist_ok=True)
+    (p / "module.py").write_bytes(b"x" * size)
+    if mpy_size:
+        (p / "module.mpy").write_bytes(b"y" * mpy_size)
+    _age(p, age)
+    return p
+
+
+def _manager(root: Path, cfg: CacheManagement) -> CacheManager:
+    # index what the test laid out on disk - like the server does on first start
+    cm = CacheManager(root, cfg, REPOS, MetadataStore(root / "metadata.sqlite3", root))
+    cm.metadata.import_from_filesystem(cm.object_store)
+    return cm
+
+
+def test_usage_per_area(tmp_path: Path) -> None:
+    h = _object(tmp_path, b"object-1")
+    _package_json(tmp_path, "demo", "latest", [h])
+    _checkout(tmp_path, "demo@latest", size=100, mpy_size=10)
+
+    cm = _manager(tmp_path, CacheManagement())
+    usage = cm.usage()
+
+    assert usage[CacheArea.objects].files == 1 and usage[CacheArea.objects].bytes == len(b"object-1")
+    assert usage[CacheArea.json].files == 1
+    assert usage[CacheArea.git].bytes == 100
+    assert usage[CacheArea.build].bytes == 10
+
+
+def test_gc_sweeps_unreferenced_objects_only(tmp_path: Path) -> None:
+    live = _object(tmp_path, b"live")
+    dead = _object(tmp_path, b"dead")
+    young = _object(tmp_path, b"young-but-unreferenced", age=0)
+    _package_json(tmp_path, "demo", "latest", [live])
+
+    cm = _manager(tmp_path, CacheManagement(grace_period_seconds=600))
+    report = cm.collect_garbage()
+
+    assert report.removed_objects == 1
+    assert cm.object_store.has(live)
+    assert not cm.object_store.has(dead)
+    assert cm.object_store.has(young)
+
+
+def test_gc_keeps_objects_a_build_reuses(tmp_path: Path) -> None:
+    reused = _object(tmp_path, b"reused")
+    dead = _object(tmp_path, b"dead")
+    live = _object(tmp_path, b"live")
+    _package_json(tmp_path, "demo", "latest", [live])
+    cm = _manager(tmp_path, CacheManagement(grace_period_seconds=600))
+
+    # a build found both stored before the gc ran -> only the one it marked as reused survives
+    assert cm.object_store.reuse(reused)
+    report = cm.collect_garbage()
+
+    assert report.removed_objects == 1
+    assert cm.object_store.has(reused) and not cm.object_store.has(dead)
+    assert not cm.object_store.reuse(dead)  # removed completely -> the build writes it anew
+    # a reference recorded between the listing and the delete keeps an object as well
+    assert cm.metadata.delete_object(live, time.time() + 1, cm.object_store.delete) is None
+    assert cm.object_store.has(live)
+
+
+def test_gc_evicts_lru_checkouts_but_keeps_pinned(tmp_path: Path) -> None:
+    _checkout(tmp_path, "demo@latest", size=1000, age=7200)
+    _checkout(tmp_path, "demo@develop", size=1000, age=3600)
+    _checkout(tmp_path, "other@latest", size=1000, age=9000)
+
+    cfg = CacheManagement(quotas=CacheQuota(git_max_bytes=1500), pinned=["other@latest"])
+    cm = _manager(tmp_path, cfg)
+    cm.touch(tmp_path / "demo@develop")
+
+    report = cm.collect_garbage()
+
+    assert report.removed_checkouts == 1
+    assert not (tmp_path / "demo@latest").exists()
+    assert (tmp_path / "demo@develop").exists()
+    assert (tmp_path / "other@latest").exists()
+
+
+def test_gc_strips_build_outputs_before_evicting_checkouts(tmp_path: Path) -> None:
+    _checkout(tmp_path, "demo@latest", size=100, mpy_size=500)
+
+    cm = _manager(tmp_path, CacheManagement(quotas=CacheQuota(build_max_bytes=100)))
+    report = cm.collect_garbage()
+
+    assert report.removed_build_outputs == 1
+    assert report.removed_checkouts == 0
+    assert not (tmp_path / "demo@latest" / "module.mpy").exists()
+    assert (tmp_path / "demo@latest" / "module.py").exists()
+
+
+def test_gc_evicts_lru_package_json_when_objects_over_quota(tmp_path: Path) -> None:
+    old = _object(tmp_path, b"o" * 1000)
+    new = _object(tmp_path, b"n" * 1000)
+    pinned = _object(tmp_path, b"p" * 1000)
+    _package_json(tmp_path, "demo", "old", [old], age=7200)
+    _package_json(tmp_path, "demo", "latest", [new], age=3600)
+    _package_json(tmp_path, "other", "latest", [pinned], age=9000)
+
+    cfg = CacheManagement(quotas=CacheQuota(objects_max_bytes="2k"), pinned=["other@latest"])
+    cm = _manager(tmp_path, cfg)
+    report = cm.collect_garbage()
+
+    assert report.removed_json == 1
+    assert not (tmp_path / "6" / "demo" / "old.json").exists()
+    assert not cm.object_store.has(old)
+    assert cm.object_store.has(new) and cm.object_store.has(pinned)
+    assert report.usage_after[CacheArea.objects].bytes == 2000
+
+
+def test_admin_endpoints_require_token(client: TestClient, monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    monkeypatch.setattr(settings.admin, "TOKEN", None)
+    assert client.get("/admin/cache").status_code == 403
+
+    monkeypatch.setattr(settings.admin, "TOKEN", "s3cret")
+    assert client.get("/admin/cache", headers={"Authorization": "Bearer wrong"}).status_code == 401
+
+    cm = _manager(tmp_path, CacheManagement())
+    appmod.app.dependency_overrides[appmod.get_cache_manager] = lambda: cm
+    try:
+        r = client.get("/admin/cache", headers={"Authorization": "Bearer s3cret"})
+        assert r.status_code == 200
+        assert set(r.json().keys()) == {a.value for a in CacheArea}
+
+        r = client.post("/admin/cache/gc", headers={"Authorization": "Bearer s3cret"})
+        assert r.status_code == 200
+        assert r.json()["freed_bytes"] == 0
+    finally:
+        appmod.app.dependency_overrides.clear()
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import subprocess
+import sys
+import threading
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pytest
+
+from mipserver.config import CacheManagement, CacheQuota
+from mipserver.internal.cachemanager import CacheManager
+from mipserver.internal.coordination import EVENT_NEW_REVISION, InvalidationBus
+from mipserver.internal.locks import LockManager, LockTimeout
+from mipserver.internal.metadata import MetadataStore
+
+from .test_cachemanager import REPOS, _checkout
+
+HOLD_LOCK: str = """
+import sys, time
+from pathlib import Path
+from mipserver.internal.locks import LockManager
+with LockManager(Path(sys.argv[1])).lock(sys.argv[2]):
+    print("locked", flush=True)
+    sys.stdin.readline()
+"""
+
+
+def test_lock_excludes_threads_and_processes(tmp_path: Path) -> None:
+    locks = LockManager(tmp_path)
+    held = threading.Event()
+    release = threading.Event()
+
+    def holder() -> None:
+        with locks.lock("build-demo@latest"):
+            held.set()
+            release.wait()
+
+    thread = threading.Thread(target=holder)
+    thread.start()
+    held.wait()
+    with pytest.raises(LockTimeout):
+        with locks.lock("build-demo@latest", timeout=0.05):
+            pass
+    release.set()
+    thread.join()
+
+    proc = subprocess.Popen(
+        [sys.executable, "-c", HOLD_LOCK, str(tmp_path), "gc"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert proc.stdout is not None and proc.stdout.readline().strip() == "locked"
+        assert locks.is_locked("gc")
+    finally:
+        proc.communicate("\n", timeout=10)
+    assert not locks.is_locked("gc")  # released with the process
+
+
+def test_bus_delivers_events_of_other_workers(tmp_path: Path) -> None:
+    # two workers -> two connections to the same index
+    a = MetadataStore(tmp_path / "metadata.sqlite3", tmp_path)
+    b = MetadataStore(tmp_path / "metadata.sqlite3", tmp_path)
+    bus_a, bus_b = InvalidationBus(a), InvalidationBus(b)
+    received: List[Dict[str, Any]] = []
+    bus_a.subscribe(EVENT_NEW_REVISION, received.append)
+    bus_b.subscribe(EVENT_NEW_REVISION, received.append)
+
+    bus_b.publish(EVENT_NEW_REVISION, package_name="demo", pversion="latest", commit="abc")
+    assert bus_b.poll() == 0  # own events are applied by the publisher directly
+    assert bus_a.poll() == 1
+    assert received == [{"package_name": "demo", "pversion": "latest", "commit": "abc"}]
+    assert bus_a.poll() == 0
+
+    # a worker started later does not replay history
+    assert InvalidationBus(MetadataStore(tmp_path / "metadata.sqlite3", tmp_path)).poll() == 0
+
+
+def test_gc_skips_checkout_being_built(tmp_path: Path) -> None:
+    _checkout(tmp_path, "demo@latest", size=1000, age=7200)
+    _checkout(tmp_path, "other@latest", size=1000, age=3600)
+    cfg = CacheManagement(quotas=CacheQuota(git_max_bytes=500))
+    cm = CacheManager(tmp_path, cfg, REPOS, MetadataStore(tmp_path / "metadata.sqlite3", tmp_path))
+
+    with cm.locks.lock(CacheManager.build_lock_name("demo@latest")):
+        report = cm.collect_garbage()
+
+    assert report.removed_checkouts == 1
+    assert (tmp_path / "demo@latest").exists()
+    assert not (tmp_path / "other@latest").exists()
+
+    with cm.locks.lock("gc"):  # another worker collecting
+        with pytest.raises(LockTimeout):
+            cm.collect_garbage(lock_timeout=0)
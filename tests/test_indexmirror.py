@@ -0,0 +1,189 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Generator, List, Optional, Tuple
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+from mipserver.config import IndexMirror as IndexMirrorConfig
+from mipserver.internal.indexmirror import IndexMirror
+from mipserver.internal.metadata import MetadataStore
+from mipserver.internal.objectstore import LooseObjectStore
+
+
+class FakeIndex:
+    """A mip v2 index like micropython.org/pi/v2 (short hashes, ETag on index.json, Range on files)"""
+
+    def __init__(self) -> None:
+        self.files: Dict[str, bytes] = {}
+        self.requests: List[Tuple[str, Optional[str]]] = []  # (path, range header)
+        self.objects: Dict[str, bytes] = {}
+
+    def add_package(self, name: str, version: str, modules: Dict[str, bytes], deps: List[List[str]]) -> None:
+        hashes: List[List[str]] = []
+        for path, content in modules.items():
+            short: str = hashlib.sha256(content).hexdigest()[:8]
+            self.files[f"/file/{short[:2]}/{short}"] = content
+            self.objects[path] = content
+            hashes.append([path, short])
+        body: bytes = json.dumps({"hashes": hashes, "deps": deps, "version": version}).encode()
+        for mpy_version in ("6", "py"):
+            for ref in ("latest", version):
+                self.files[f"/package/{mpy_version}/{name}/{ref}.json"] = body
+
+        index: dict = json.loads(self.files.get("/index.json", b'{"v": 2, "packages": []}'))
+        index["packages"].append({"name": name, "version": version})
+        self.files["/index.json"] = json.dumps(index).encode()
+
+
+@pytest.fixture()
+def fake_index() -> Generator[Tuple[FakeIndex, str], None, None]:
+    index = FakeIndex()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args: object) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            index.requests.append((self.path, self.headers.get("Range")))
+            body: bytes | None = index.files.get(self.path)
+            if body is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+
+            etag: str = '"' + hashlib.sha256(body).hexdigest()[:16] + '"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.end_headers()
+                return
+
+            status: int = 200
+            range_header: str | None = self.headers.get("Range")
+            if range_header:
+                body = body[int(range_header.removeprefix("bytes=").rstrip("-")) :]
+                status = 206
+            self.send_response(status)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield index, f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+
+
+def _mirror(tmp_path: Path, metadata: MetadataStore, url: str, packages: Optional[List[str]]) -> IndexMirror:
+    cfg = IndexMirrorConfig(enabled=True, url=url, packages=packages, parallel_downloads=4, retry_backoff_seconds=0)
+    return IndexMirror(cfg, tmp_path, metadata, LooseObjectStore(tmp_path / "files"))
+
+
+def test_sync_follows_deps_and_is_incremental(
+    tmp_path: Path, metadata_store: MetadataStore, fake_index: Tuple[FakeIndex, str]
+) -> None:
+    index, url = fake_index
+    index.add_package("base", "1.0", {"base.mpy": b"base module"}, deps=[])
+    index.add_package("app", "0.2", {"app/__init__.mpy": b"app", "app/x.mpy": b"x"}, deps=[["base", "latest"]])
+    index.add_package("unrelated", "3.0", {"unrelated.mpy": b"nope"}, deps=[])
+
+    mirror = _mirror(tmp_path, metadata_store, url, packages=["app"])
+    report = mirror.sync()
+    assert not report.failures
+    assert mirror.package_names() == ["app", "base"]
+    assert (report.objects_downloaded, report.package_jsons_updated) == (3, 8)
+
+    built = json.loads((tmp_path / "6" / "app" / "0.2.json").read_text())
+    for path, full in built["hashes"]:
+        assert len(full) == 64 and (tmp_path / "files" / full[:2] / full).read_bytes() == index.objects[path]
+    assert built["deps"] == [["base", "latest"]]
+    assert metadata_store.get_build("base", "py", "latest") is not None
+
+    assert mirror.sync().index_unchanged  # 304 on index.json
+
+    index.requests.clear()
+    again = mirror.sync(force=True)
+    assert (again.package_jsons_unchanged, again.objects_downloaded) == (8, 0)
+    assert not [p for p, _ in index.requests if p.startswith("/file/")]
+
+    # restart -> the mirrored packages (incl. dependencies) are known without a sync
+    assert _mirror(tmp_path, metadata_store, url, packages=["app"]).package_names() == ["app", "base"]
+
+
+def test_download_resumes_partial_and_verifies(
+    tmp_path: Path, metadata_store: MetadataStore, fake_index: Tuple[FakeIndex, str]
+) -> None:
+    index, url = fake_index
+    content: bytes = b"0123456789" * 1000
+    short: str = hashlib.sha256(content).hexdigest()[:8]
+    index.files[f"/file/{short[:2]}/{short}"] = content
+
+    mirror = _mirror(tmp_path, metadata_store, url, packages=None)
+    mirror.partial_dir.mkdir(parents=True)
+    (mirror.partial_dir / f"{short}.part").write_bytes(content[:4000])
+
+    full, size = mirror.download_object(short)
+    assert size == len(content) and full == hashlib.sha256(content).hexdigest()
+    assert index.requests == [(f"/file/{short[:2]}/{short}", "bytes=4000-")]
+    assert not list(mirror.partial_dir.iterdir())
+
+    index.files[f"/file/ab/abcdef12"] = b"does not match its name"
+    with pytest.raises(ValueError, match="hash mismatch"):
+        mirror.download_object("abcdef12")
+
+
+@pytest.mark.parametrize("bad", ["", "ab", "../../../etc", "abcdefgz"])
+def test_invalid_hash_fails_only_its_package(
+    tmp_path: Path, metadata_store: MetadataStore, fake_index: Tuple[FakeIndex, str], bad: str
+) -> None:
+    index, url = fake_index
+    index.add_package("good", "1.0", {"good.mpy": b"good module"}, deps=[])
+    index.add_package("evil", "1.0", {"evil.mpy": b"evil module"}, deps=[])
+    body: bytes = json.dumps({"hashes": [["evil.mpy", bad]], "version": "1.0"}).encode()
+    for p in [p for p in index.files if p.startswith("/package/") and "/evil/" in p]:
+        index.files[p] = body
+
+    mirror = _mirror(tmp_path, metadata_store, url, packages=["good", "evil"])
+    report = mirror.sync()
+
+    assert report.failures and all("/evil/" in f for f in report.failures)
+    assert report.package_jsons_updated == 4 and (tmp_path / "6" / "good" / "1.0.json").is_file()
+    assert not (tmp_path / "6" / "evil").exists()
+    good: str = hashlib.sha256(b"good module").hexdigest()[:8]
+    assert [p for p, _ in index.requests if p.startswith("/file/")] == [f"/file/{good[:2]}/{good}"]
+    with pytest.raises(ValueError, match="invalid object hash"):
+        mirror.download_object(bad)
+
+
+def test_mirrored_package_served_and_fetched_on_demand(
+    client: TestClient, tmp_path: Path, metadata_store: MetadataStore, fake_index: Tuple[FakeIndex, str]
+) -> None:
+    index, url = fake_index
+    index.add_package("aiorepl", "0.2", {"aiorepl.mpy": b"repl"}, deps=[])
+    mirror = _mirror(tmp_path, metadata_store, url, packages=None)
+    mirror.sync()
+    index.files["/package/6/aiorepl/0.1.json"] = index.files["/package/6/aiorepl/0.2.json"]
+
+    appmod.app.dependency_overrides[appmod.get_index_mirror] = lambda: mirror
+    try:
+        r = client.get("/package/6/aiorepl/latest.json")
+        assert r.status_code == 200
+        [[path, full]] = r.json()["hashes"]
+        assert path == "aiorepl.mpy" and full == hashlib.sha256(b"repl").hexdigest()
+
+        assert client.get("/package/6/aiorepl/0.1.json").status_code == 200  # not the current version -> on demand
+
+        r = client.get("/package/6/aiorepl/9.9.json")
+        assert r.status_code == 404 and "Retry-After" in r.headers
+    finally:
+        appmod.app.dependency_overrides.clear()
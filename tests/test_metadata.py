@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from mipserver.internal.metadata import BuildFile, BuildRecord, MetadataStore, build_record_from_package_json
+from mipserver.internal.objectstore import LooseObjectStore
+
+
+def _record(package_name: str, pversion: str, hashes: List[str], commit: str = "c1") -> BuildRecord:
+    now: float = time.time()
+    return BuildRecord(
+        package_name=package_name,
+        mpy_version="6",
+        pversion=pversion,
+        commit=commit,
+        json_path=f"6/{package_name}/{pversion}.json",
+        json_size=100,
+        built_at=now,
+        checked_at=now,
+        files=[BuildFile(path=f"{h[:6]}.mpy", hash=h, size=10) for h in hashes],
+    )
+
+
+def test_refcounts_follow_builds(tmp_path: Path) -> None:
+    store = MetadataStore(tmp_path / "m.sqlite3", tmp_path)
+    shared, only_old = "a" * 64, "b" * 64
+
+    store.record_build(_record("demo", "latest", [shared, only_old]))
+    store.record_build(_record("demo", "develop", [shared]))
+    assert store.get_object(shared).refcount == 2  # type: ignore[union-attr]
+
+    # rebuild of the same (package, target, ref) replaces the old references
+    store.record_build(_record("demo", "latest", [shared], commit="c2"))
+    assert store.get_object(only_old).refcount == 0  # type: ignore[union-attr]
+    assert store.get_build("demo", "6", "latest").commit == "c2"  # type: ignore[union-attr]
+
+    assert store.delete_build("demo", "6", "latest") == []
+    assert store.delete_build("demo", "6", "develop") == [shared]
+    assert store.json_totals() == (0, 0)
+    assert {o.hash for o in store.unreferenced_objects(older_than=time.time() + 1)} == {shared, only_old}
+
+
+def test_bookkeeping_is_batched_until_flush(tmp_path: Path) -> None:
+    store = MetadataStore(tmp_path / "m.sqlite3", tmp_path)
+    store.record_build(_record("demo", "latest", []))
+    before: float = store.get_build("demo", "6", "latest").last_access  # type: ignore[union-attr]
+
+    store.count_request("demo", cache_hit=True)
+    store.count_request("demo", build=True, failure=True)
+    store.touch_build("demo", "6", "latest")
+    assert store.get_build("demo", "6", "latest").last_access == before  # type: ignore[union-attr]
+
+    [stats] = store.package_stats()  # flushes
+    assert (stats.requests, stats.cache_hits, stats.builds, stats.failures) == (2, 1, 1, 1)
+    assert store.get_build("demo", "6", "latest").last_access >= before  # type: ignore[union-attr]
+
+    # persisted -> a new connection sees the counters
+    store.close()
+    assert MetadataStore(tmp_path / "m.sqlite3", tmp_path).package_stats()[0].requests == 2
+
+
+def test_counts_survive_concurrent_flushes(tmp_path: Path) -> None:
+    store = MetadataStore(tmp_path / "m.sqlite3", tmp_path, max_pending=1)  # every count flushes
+
+    def count() -> None:
+        for _ in range(200):
+            store.count_request("demo", cache_hit=True)
+
+    threads: List[threading.Thread] = [threading.Thread(target=count) for _ in range(4)]
+    interval: float = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)  # switch threads between the lookup and the increment
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+    [stats] = store.package_stats()
+    assert (stats.requests, stats.cache_hits) == (800, 800)
+
+
+def test_import_from_filesystem(tmp_path: Path) -> None:
+    objects = LooseObjectStore(tmp_path / "files")
+    h: str = hashlib.sha256(b"content").hexdigest()
+    objects.put_bytes(b"content", h)
+    orphan: str = hashlib.sha256(b"orphan").hexdigest()
+    objects.put_bytes(b"orphan", orphan)
+
+    pkgjson: Path = tmp_path / "6" / "demo" / "latest.json"
+    pkgjson.parent.mkdir(parents=True)
+    pkgjson.write_text(json.dumps({"hashes": [["demo.mpy", h]], "version": "latest"}))
+
+    store = MetadataStore(tmp_path / "m.sqlite3", tmp_path)
+    assert store.is_empty()
+    assert store.import_from_filesystem(objects) == (1, 2)
+    assert store.import_from_filesystem(objects) == (0, 0)
+
+    build = store.get_build("demo", "6", "latest", with_files=True)
+    assert build is not None and build.checked_at == 0.0  # commit unknown -> must be revalidated
+    assert store.absolute_json_path(build) == pkgjson
+    assert [(f.hash, f.size) for f in build.files] == [(h, len(b"content"))]
+    assert store.get_object(orphan).refcount == 0  # type: ignore[union-attr]
+
+    record = build_record_from_package_json(store, objects, pkgjson, "demo", "6", "latest", "c1")
+    assert record.json_path == "6/demo/latest.json"
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import hashlib
+from pathlib import Path
+
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from mipserver.config import NegativeCache
+from mipserver.Helper import get_sha256_hash
+from mipserver.internal.metadata import MetadataStore
+from mipserver.internal.metrics import CacheCollector
+from mipserver.internal.negativecache import NegativeResultCache
+
+
+def _sample(name: str, **labels: str) -> float:
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+def test_metrics_endpoint_exposes_request_latency_per_route(client: TestClient) -> None:
+    before: float = _sample("mipserver_request_duration_seconds_count", method="GET", route="/", status="200")
+    assert client.get("/").status_code == 200
+
+    r = client.get("/metrics")
+    assert r.status_code == 200
+    assert r.headers["content-type"].startswith("text/plain")
+    assert "mipserver_request_duration_seconds_bucket" in r.text
+    assert _sample("mipserver_request_duration_seconds_count", method="GET", route="/", status="200") == before + 1
+
+
+def test_package_json_outcomes_are_counted(client: TestClient) -> None:
+    before: float = _sample("mipserver_package_json_requests_total", result="negative")
+    assert client.get("/package/6/definitely-not-configured/latest.json").status_code == 404
+    assert _sample("mipserver_package_json_requests_total", result="negative") == before + 1
+
+
+def test_hashing_is_measured(tmp_path: Path) -> None:
+    f: Path = tmp_path / "x.py"
+    f.write_bytes(b"x" * 1000)
+    before: float = _sample("mipserver_hashed_bytes_total")
+
+    assert get_sha256_hash(f) == hashlib.sha256(b"x" * 1000).hexdigest()
+    assert _sample("mipserver_hashed_bytes_total") == before + 1000
+
+
+def test_cache_collector_reports_index_totals(metadata_store: MetadataStore) -> None:
+    metadata_store.add_object("a" * 64, 123)
+    metadata_store.count_request("demo")
+
+    collected = {
+        m.name: m.samples[0].value
+        for m in CacheCollector(metadata_store, NegativeResultCache(NegativeCache())).collect()
+    }
+
+    assert collected["mipserver_object_store_bytes"] == 123
+    assert collected["mipserver_object_store_objects"] == 1
+    assert collected["mipserver_metadata_pending_writes"] == 1
+    assert collected["mipserver_negative_cache_entries"] == 0
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+from mipserver.config import NegativeCache
+from mipserver.Helper import MIPServerHelper
+from mipserver.internal.negativecache import NegativeReason, NegativeResultCache
+
+
+def test_put_get_and_ttl() -> None:
+    nc = NegativeResultCache(NegativeCache(build_failed_ttl_seconds=30))
+
+    entry = nc.put(("demo", "latest", "6"), NegativeReason.build_failed, "boom", commit="c1")
+    assert entry is not None and entry.status_code == 422
+    assert not entry.is_expired()
+    assert 0 < entry.retry_after() <= 31
+
+    assert nc.get(("demo", "latest", "6")) == entry
+    assert nc.get(("demo", "latest", "py")) is None
+
+
+def test_target_independent_entries_and_zero_ttl() -> None:
+    nc = NegativeResultCache(NegativeCache(missing_ref_ttl_seconds=30, build_failed_ttl_seconds=0))
+
+    nc.put(("demo", "nope", NegativeResultCache.ANY_TARGET), NegativeReason.missing_ref, "missing")
+    entry = nc.get(("demo", "nope", "py"))
+    assert entry is not None and entry.status_code == 404
+
+    # ttl 0 disables caching
+    assert nc.put(("demo", "latest", "6"), NegativeReason.build_failed, "boom") is None
+    assert nc.get(("demo", "latest", "6")) is None
+
+
+def test_invalidate_on_new_commit_and_max_entries() -> None:
+    nc = NegativeResultCache(NegativeCache(max_entries=2))
+
+    nc.put(("demo", "latest", "6"), NegativeReason.build_failed, "boom", commit="c1")
+    nc.put(("demo", "latest", "py"), NegativeReason.build_failed, "boom", commit="c2")
+    assert nc.invalidate_on_new_commit("demo", "latest", "c2") == 1
+    assert nc.get(("demo", "latest", "6")) is None
+    assert nc.get(("demo", "latest", "py")) is not None
+
+    nc.put(("a", "latest", "6"), NegativeReason.build_failed, "boom")
+    nc.put(("b", "latest", "6"), NegativeReason.build_failed, "boom")
+    assert len(nc) == 2
+    assert nc.get(("demo", "latest", "py")) is None
+
+
+@pytest.fixture()
+def failing_build(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Any:
+    calls: List[str] = []
+    state = {"remote_commit": "c1"}
+
+    appmod.app.dependency_overrides[appmod.get_package_name_to_repo] = lambda: {"demo": "someone/repo"}
+
+    def fake_get_local_path_for_package_json_by_package_and_version(self: MIPServerHelper, mpy_version: Any, package_name: str, pversion: str) -> Path:  # type: ignore[override]
+        return tmp_path / str(mpy_version) / package_name / f"{pversion}.json"
+
+    def fake_ensure_git_repo_up_to_date(self: MIPServerHelper, repo_name: str, branch: str, repo_url: str | None = None) -> Path | None:  # type: ignore[override]
+        calls.append("fetch")
+        p = tmp_path / "gitrepo"
+        p.mkdir(parents=True, exist_ok=True)
+        return p
+
+    def fake_get_checkout_commit(checkout_dir: Path) -> str | None:
+        return state["remote_commit"]
+
+    def fake_get_remote_commit(self: MIPServerHelper, repo_name: str, branch: str, repo_url: str | None = None) -> str | None:  # type: ignore[override]
+        calls.append("ls-remote")
+        return state["remote_commit"]
+
+    def fake_generate_package_json_from_local_repo(self: MIPServerHelper, gitrepopath: Path, target_pkgjson: Path, mpy_version: Any) -> Path:  # type: ignore[override]
+        calls.append("compile")
+        if state["remote_commit"] == "c1":
+            raise Exception("mpy-cross failed")
+        target_pkgjson.parent.mkdir(parents=True, exist_ok=True)
+        target_pkgjson.write_text(json.dumps({"hashes": [["demo.mpy", "b" * 64]]}))
+        return target_pkgjson
+
+    monkeypatch.setattr(
+        MIPServerHelper,
+        "get_local_path_for_package_json_by_package_and_version",
+        fake_get_local_path_for_package_json_by_package_and_version,
+    )
+    monkeypatch.setattr(MIPServerHelper, "ensure_git_repo_up_to_date", fake_ensure_git_repo_up_to_date)
+    monkeypatch.setattr(MIPServerHelper, "get_checkout_commit", staticmethod(fake_get_checkout_commit))
+    monkeypatch.setattr(MIPServerHelper, "get_remote_commit", fake_get_remote_commit)
+    monkeypatch.setattr(
+        MIPServerHelper, "generate_package_json_from_local_repo", fake_generate_package_json_from_local_repo
+    )
+
+    yield calls, state
+
+    appmod.app.dependency_overrides.clear()
+
+
+def test_failed_build_is_served_from_negative_cache(client: TestClient, failing_build: Any) -> None:
+    calls, state = failing_build
+
+    r = client.get("/package/6/demo/latest.json")
+    assert r.status_code == 422
+    assert "Retry-After" in r.headers
+    assert "build failed" in r.json()["error"]
+
+    r = client.get("/package/6/demo/latest.json")
+    assert r.status_code == 422
+    assert calls == ["fetch", "compile"]
+
+
+def test_expired_failure_is_rearmed_or_invalidated_by_upstream_commit(client: TestClient, failing_build: Any) -> None:
+    calls, state = failing_build
+
+    r = client.get("/package/6/demo/latest.json")
+    assert r.status_code == 422
+
+    entry = appmod.NEGATIVE_CACHE.get(("demo", "latest", "6"))
+    assert entry is not None and entry.commit == "c1"
+    entry.expires_at = 0.0
+
+    # upstream did not move -> no fetch/compile, failure is re-armed
+    r = client.get("/package/6/demo/latest.json")
+    assert r.status_code == 422
+    assert calls == ["fetch", "compile", "ls-remote"]
+
+    entry = appmod.NEGATIVE_CACHE.get(("demo", "latest", "6"))
+    assert entry is not None and not entry.is_expired()
+    entry.expires_at = 0.0
+
+    # new upstream commit -> rebuild
+    state["remote_commit"] = "c2"
+    r = client.get("/package/6/demo/latest.json")
+    assert r.status_code == 200
+    assert calls == ["fetch", "compile", "ls-remote", "ls-remote", "fetch", "compile"]
+    assert appmod.NEGATIVE_CACHE.get(("demo", "latest", "6")) is None
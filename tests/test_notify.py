@@ -0,0 +1,145 @@
+from __future__ import annotations
+
+import json
+import socketserver
+import threading
+import time
+from typing import Any, Dict, Generator, List, Tuple
+
+import pytest
+
+pytest.importorskip("paho.mqtt")
+
+from mipserver.config import Mqtt  # noqa: E402
+from mipserver.internal.metadata import BuildFile, BuildRecord  # noqa: E402
+from mipserver.internal.notify import BuildNotifier, build_notification  # noqa: E402
+
+
+class FakeBroker(socketserver.ThreadingTCPServer):
+    """Mosquitto stand-in: MQTT 3.1.1 CONNECT/PUBLISH (QoS 0/1)/PINGREQ/DISCONNECT, keeps retained messages"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self) -> None:
+        self.retained: Dict[str, bytes] = {}
+        self.published: List[Tuple[str, bytes, bool]] = []
+        self.credentials: List[Tuple[str, str]] = []
+        super().__init__(("127.0.0.1", 0), _BrokerHandler)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    server: FakeBroker
+
+    def _read(self, n: int) -> bytes:
+        data: bytes = b""
+        while len(data) < n:
+            chunk: bytes = self.request.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError
+            data += chunk
+        return data
+
+    def _packet(self) -> Tuple[int, bytes]:
+        header: int = self._read(1)[0]
+        length, shift = 0, 0
+        while True:
+            b: int = self._read(1)[0]
+            length += (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        return header, self._read(length)
+
+    @staticmethod
+    def _string(body: bytes, pos: int) -> Tuple[str, int]:
+        n: int = int.from_bytes(body[pos : pos + 2], "big")
+        return body[pos + 2 : pos + 2 + n].decode(), pos + 2 + n
+
+    def handle(self) -> None:
+        try:
+            while True:
+                header, body = self._packet()
+                kind: int = header >> 4
+                if kind == 1:  # CONNECT: protocol name, level, flags, keepalive, client id, user, password
+                    _, pos = self._string(body, 0)
+                    flags: int = body[pos + 1]
+                    _, pos = self._string(body, pos + 4)
+                    user, pos = self._string(body, pos) if flags & 0x80 else ("", pos)
+                    password, pos = self._string(body, pos) if flags & 0x40 else ("", pos)
+                    self.server.credentials.append((user, password))
+                    self.request.sendall(bytes([0x20, 2, 0, 0]))
+                elif kind == 3:  # PUBLISH
+                    qos: int = (header >> 1) & 0x03
+                    topic, pos = self._string(body, 0)
+                    if qos:
+                        self.request.sendall(bytes([0x40, 2]) + body[pos : pos + 2])
+                        pos += 2
+                    retain: bool = bool(header & 0x01)
+                    self.server.published.append((topic, body[pos:], retain))
+                    if retain:
+                        self.server.retained[topic] = body[pos:]
+                elif kind == 12:  # PINGREQ
+                    self.request.sendall(bytes([0xD0, 0]))
+                elif kind == 14:  # DISCONNECT
+                    return
+        except ConnectionError:
+            return
+
+
+@pytest.fixture()
+def broker() -> Generator[FakeBroker, None, None]:
+    server = FakeBroker()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def _build(commit: str, files: Dict[str, str]) -> BuildRecord:
+    return BuildRecord(
+        package_name="demo",
+        mpy_version="6",
+        pversion="latest",
+        commit=commit,
+        json_path="6/demo/latest.json",
+        built_at=time.time(),
+        checked_at=time.time(),
+        files=[BuildFile(path=p, hash=h) for p, h in files.items()],
+    )
+
+
+def test_notification_counts_changed_files() -> None:
+    old = _build("c1", {"a.mpy": "1" * 64, "b.mpy": "2" * 64, "gone.mpy": "3" * 64})
+    new = _build("c2", {"a.mpy": "1" * 64, "b.mpy": "4" * 64, "new.mpy": "5" * 64})
+
+    n = build_notification(new, old)
+    assert n is not None and n.build_id == "c2" and (n.files, n.changed_files) == (3, 3)
+    assert n.url == "/package/6/demo/latest.json"
+    assert build_notification(new, new) is None  # same commit, same files -> devices have nothing to do
+
+    first = build_notification(old, None)
+    assert first is not None and first.changed_files == 3
+    assert build_notification(_build("c3", {"a.mpy": "1" * 64}), None) is not None
+
+
+def test_retained_message_published_to_broker(broker: FakeBroker) -> None:
+    port: int = broker.server_address[1]
+    cfg = Mqtt(HOST="127.0.0.1", PORT=port, USERNAME="dev", PASSWORD="secret", NOTIFY_ENABLED=True, TOPIC_PREFIX="t")
+    notifier = BuildNotifier(cfg)
+    notifier.start()
+    try:
+        notifier.build_changed(_build("c2", {"a.mpy": "1" * 64}), _build("c1", {"a.mpy": "0" * 64}))
+        deadline: float = time.monotonic() + 5
+        while "t/package/6/demo/latest" not in broker.retained and time.monotonic() < deadline:
+            time.sleep(0.02)
+    finally:
+        notifier.stop()
+
+    payload: Dict[str, Any] = json.loads(broker.retained["t/package/6/demo/latest"])
+    assert (payload["build_id"], payload["changed_files"], payload["files"]) == ("c2", 1, 1)
+    assert broker.credentials == [("dev", "secret")]
+    assert broker.published[0][2]  # retain flag
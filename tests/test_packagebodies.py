@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import json
+import time
+from pathlib import Path
+from typing import Generator
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+from mipserver.internal.metadata import BuildRecord, MetadataStore
+from mipserver.internal.packagebodies import PackageBodyCache, render_package_json
+
+
+def _build(store: MetadataStore, root: Path, name: str, data: bytes, built_at: float | None = None) -> BuildRecord:
+    target: Path = root / "6" / name / "latest.json"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target.write_bytes(data)
+    now: float = time.time()
+    record = BuildRecord(
+        package_name=name,
+        mpy_version="6",
+        pversion="latest",
+        commit="c1",
+        json_path=f"6/{name}/latest.json",
+        json_size=len(data),
+        built_at=built_at or now,
+        checked_at=now,
+    )
+    store.record_build(record)
+    return record
+
+
+def test_body_is_read_once_per_build(tmp_path: Path, metadata_store: MetadataStore) -> None:
+    bodies = PackageBodyCache(max_bytes=1 << 20)
+    data: bytes = render_package_json([("demo/__init__.mpy", "a" * 64)])
+    assert data == b'{"hashes":[["demo/__init__.mpy","' + b"a" * 64 + b'"]]}'
+
+    build: BuildRecord = _build(metadata_store, tmp_path, "demo", data, built_at=1.0)
+    first = bodies.get(metadata_store, build)
+    metadata_store.absolute_json_path(build).unlink()
+    assert first is not None and bodies.get(metadata_store, build) is first  # from memory, not from disk
+
+    rebuilt: BuildRecord = _build(metadata_store, tmp_path, "demo", json.dumps({"hashes": []}, indent=4).encode(), 2.0)
+    second = bodies.get(metadata_store, rebuilt)
+    assert second is not None and second.body == b'{"hashes":[]}'  # indented by an older version -> compacted
+    assert second.etag != first.etag
+
+    metadata_store.absolute_json_path(rebuilt).unlink()
+    assert bodies.get(metadata_store, rebuilt.model_copy(update={"built_at": 3.0})) is None
+    assert len(bodies) == 0
+
+
+def test_bodies_are_bounded_by_size(tmp_path: Path, metadata_store: MetadataStore) -> None:
+    bodies = PackageBodyCache(max_bytes=100)
+    for name in ("one", "two", "three"):
+        bodies.get(metadata_store, _build(metadata_store, tmp_path, name, b'{"hashes":[]}' + b" " * 30))
+    assert len(bodies) == 2  # least recently served dropped
+
+
+@pytest.fixture()
+def demo_package() -> Generator[None, None, None]:
+    appmod.app.dependency_overrides[appmod.get_package_name_to_repo] = lambda: {"demo": "someone/demo"}
+    yield
+    appmod.app.dependency_overrides.clear()
+
+
+def test_hit_is_served_with_etag(
+    client: TestClient, tmp_path: Path, metadata_store: MetadataStore, demo_package: None
+) -> None:
+    data: bytes = render_package_json([(f"demo/m{i}.mpy", f"{i:064x}") for i in range(300)])
+    _build(metadata_store, tmp_path, "demo", data)
+
+    r = client.get("/package/6/demo/latest.json")
+    assert r.status_code == 200 and r.content == data
+    assert r.headers["content-type"] == "application/json"
+    assert r.headers["content-length"] == str(len(data))
+
+    again = client.get("/package/6/demo/latest.json", headers={"If-None-Match": r.headers["etag"]})
+    assert again.status_code == 304 and again.content == b""
@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Dict, Generator, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+from mipserver.config import Packs
+from mipserver.internal.locks import LockManager
+from mipserver.internal.objectstore import LooseObjectStore
+from mipserver.internal.packstore import PackReport, PackStore
+
+
+def _objects(n: int, size: int = 300) -> Dict[str, bytes]:
+    ret: Dict[str, bytes] = {}
+    for _ in range(n):
+        data: bytes = os.urandom(size)
+        ret[hashlib.sha256(data).hexdigest()] = data
+    return ret
+
+
+def _packed(root: Path, objects: Dict[str, bytes], **cfg: object) -> LooseObjectStore:
+    packs = PackStore(root / "packs", Packs(enabled=True, **cfg), LockManager(root))  # type: ignore[arg-type]
+    store = LooseObjectStore(root / "files", packs)
+    for h, data in objects.items():
+        store.put_bytes(data, h)
+    packs.maintain(((h, store.path_for(h), st.st_size) for h, st in store.iter_loose()))
+    return store
+
+
+def test_small_objects_move_into_packs(tmp_path: Path) -> None:
+    objects: Dict[str, bytes] = _objects(50)
+    big: bytes = os.urandom(5000)
+    objects[hashlib.sha256(big).hexdigest()] = big
+    store: LooseObjectStore = _packed(tmp_path, objects, max_object_bytes=1000, max_pack_bytes=4000)
+    assert store.packs is not None
+
+    loose: List[str] = [h for h, _ in store.iter_loose()]
+    assert loose == [hashlib.sha256(big).hexdigest()]  # too large -> stays a file of its own
+    assert len(store.packs.pack_numbers()) > 1  # several packs of at most max_pack_bytes
+
+    for h, data in objects.items():
+        assert store.has(h) and store.size(h) == len(data)
+        with store.open(h) as f:
+            assert f.read() == data
+    some: str = next(iter(objects))
+    assert store.find_by_prefix(some[:9]) == some
+    assert sorted(h for h, _, _ in store.iter_objects()) == sorted(objects)
+
+    # another worker sees the packs through the index on disk
+    other = PackStore(tmp_path / "packs", store.packs.cfg, LockManager(tmp_path))
+    assert all(bytes(other.read(h) or b"") == data for h, data in objects.items() if len(data) < 1000)
+    assert not other.has("0" * 64)
+
+
+def test_deleted_objects_are_reclaimed_by_rewriting_packs(tmp_path: Path) -> None:
+    objects: Dict[str, bytes] = _objects(40)
+    store: LooseObjectStore = _packed(tmp_path, objects, max_pack_bytes=3000, rewrite_dead_ratio=0.5)
+    assert store.packs is not None
+    reader = PackStore(tmp_path / "packs", store.packs.cfg, LockManager(tmp_path))
+    hashes: List[str] = list(objects)
+    dead, live = hashes[:30], hashes[30:]
+    assert reader.read(dead[0]) is not None  # mapped before the rewrite
+    searching = reader._index  # a lookup of another thread in flight while the reader reloads
+
+    assert sum(store.delete(h) for h in dead) == 30 * 300
+    assert not any(store.has(h) for h in dead)
+    before: List[int] = store.packs.pack_numbers()
+
+    report: PackReport = PackReport()
+    store.packs.compact(report)
+    assert report.rewritten_packs > 0 and report.reclaimed_bytes > 0 and report.indexed_objects == len(live)
+    assert len(store.packs.pack_numbers()) < len(before)
+    assert all(bytes(reader.read(h) or b"") == objects[h] for h in live)  # old packs gone -> reader follows
+    assert not reader.has(dead[1])
+    assert reader._index is not searching and searching.get(bytes.fromhex(live[0])) is not None  # not closed under it
+
+
+@pytest.fixture()
+def packed_object(tmp_path: Path) -> Generator[tuple[str, bytes], None, None]:
+    data: bytes = os.urandom(10_000)
+    h: str = hashlib.sha256(data).hexdigest()
+    store: LooseObjectStore = _packed(tmp_path, {h: data})
+    assert not store.path_for(h).exists()
+    appmod.app.dependency_overrides[appmod.get_pack_store] = lambda: store.packs
+    yield h, data
+    appmod.app.dependency_overrides.clear()
+
+
+def test_file_served_from_pack(client: TestClient, packed_object: tuple[str, bytes]) -> None:
+    h, data = packed_object
+    url: str = f"/file/{h[:2]}/{h}"
+    r = client.get(url)
+    assert r.status_code == 200 and r.content == data and r.headers["etag"] == f'"{h}"'
+
+    part = client.get(url, headers={"Range": "bytes=100-199", "If-Range": f'"{h}"'})
+    assert part.status_code == 206 and part.content == data[100:200]
+    assert part.headers["content-range"] == f"bytes 100-199/{len(data)}"
+    assert client.get(url, headers={"Range": "bytes=-10"}).content == data[-10:]
+    assert client.get(url, headers={"Range": "bytes=0-1", "If-Range": '"other"'}).content == data
+    assert client.get(url, headers={"Range": "bytes=0-1,5-6"}).status_code == 200  # several -> the whole object
+    assert client.get(url, headers={"Range": f"bytes={len(data)}-"}).status_code == 416
+    assert client.get(url, headers={"If-None-Match": f'"{h}"'}).status_code == 304
+    head = client.head(url)
+    assert head.status_code == 200 and head.headers["content-length"] == str(len(data)) and head.content == b""
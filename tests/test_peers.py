@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import hashlib
+import json
+import socket
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Generator, List
+
+import pytest
+import uvicorn
+
+import mipserver.app as appmod
+from mipserver.config import Peers
+from mipserver.internal.metadata import MetadataStore, build_record_from_package_json
+from mipserver.internal.objectstore import LooseObjectStore
+from mipserver.internal.peers import PeerCache
+
+
+@pytest.fixture()
+def replica_a(
+    tmp_path: Path, metadata_store: MetadataStore, monkeypatch: pytest.MonkeyPatch
+) -> Generator[str, None, None]:
+    """The real app on localhost with tmp_path as cache root (the peer that already built)"""
+    monkeypatch.setattr(appmod, "SERVER_CACHE_ROOT", tmp_path)
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port: int = s.getsockname()[1]
+    server = uvicorn.Server(
+        uvicorn.Config(appmod.app, host="127.0.0.1", port=port, log_level="warning", lifespan="off")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+def _build(root: Path, metadata: MetadataStore, modules: dict[str, bytes], commit: str) -> List[str]:
+    store = LooseObjectStore(root / "files")
+    hashes: List[str] = []
+    for content in modules.values():
+        h: str = hashlib.sha256(content).hexdigest()
+        store.put_bytes(content, h)
+        hashes.append(h)
+    json_path: Path = root / "6" / "demo" / "latest.json"
+    json_path.parent.mkdir(parents=True, exist_ok=True)
+    json_path.write_text(json.dumps({"hashes": [[p, h] for p, h in zip(modules, hashes)], "version": "1.0"}))
+    metadata.record_build(build_record_from_package_json(metadata, store, json_path, "demo", "6", "latest", commit))
+    return hashes
+
+
+def _replica_b(root: Path, *urls: str) -> PeerCache:
+    metadata = MetadataStore(root / "metadata.sqlite3", root)
+    return PeerCache(Peers(urls=list(urls), timeout_seconds=2), metadata, LooseObjectStore(root / "files"))
+
+
+def test_fill_from_peer_at_commit_with_verification(
+    tmp_path: Path, metadata_store: MetadataStore, replica_a: str
+) -> None:
+    hashes = _build(tmp_path, metadata_store, {"demo/__init__.mpy": b"init", "demo/x.mpy": b"x" * 5000}, "c1")
+    b_root: Path = tmp_path / "b"
+    b = _replica_b(b_root, "http://127.0.0.1:1", replica_a)  # first peer unreachable -> next one
+    target: Path = b_root / "6" / "demo" / "latest.json"
+
+    assert b.fetch_package_json("demo", "6", "latest", "c0", target) is None  # peer built another commit
+    record = b.fetch_package_json("demo", "6", "latest", "c1", target)
+    assert record is not None and record.commit == "c1"
+    assert json.loads(target.read_text())["hashes"][1][1] == hashes[1]
+    assert all(b.object_store.path_for(h).read_bytes() in (b"init", b"x" * 5000) for h in hashes)
+    assert b.metadata.get_build("demo", "6", "latest") is not None
+
+    # corrupt object on the peer -> rejected, nothing stored
+    bogus: str = hashlib.sha256(b"expected").hexdigest()
+    LooseObjectStore(tmp_path / "files").put_bytes(b"something else", bogus)
+    assert not b.fetch_object(bogus)
+    assert not b.object_store.has(bogus)
+
+
+def test_build_ownership_is_consistent_and_stable() -> None:
+    urls: List[str] = [f"http://replica-{i}:18791" for i in range(3)]
+
+    def ring(self_url: str, members: List[str]) -> PeerCache:
+        cfg = Peers(urls=members, build_ownership=True, self_url=self_url)
+        return PeerCache(cfg, None, None)  # type: ignore[arg-type]  # only the ring is used
+
+    replicas: List[PeerCache] = [ring(u, urls) for u in urls]
+    names: List[str] = [f"package{i}" for i in range(600)]
+    owners: List[str | None] = [replicas[0].owner(n) for n in names]
+    assert all([r.owner(n) for n in names] == owners for r in replicas[1:])  # every replica agrees
+    assert min(Counter(owners).values()) > 100  # roughly balanced
+    assert replicas[0].owned_by_peer(names[owners.index(urls[0])]) is None
+
+    grown: PeerCache = ring(urls[0], urls + ["http://replica-3:18791"])
+    moved: int = sum(1 for n, o in zip(names, owners) if grown.owner(n) != o)
+    assert moved < len(names) / 2  # only the share of the new replica moves
+
+
+def test_build_ownership_needs_self_url() -> None:
+    with pytest.raises(ValueError, match="self_url"):
+        Peers(urls=["http://other:18791"], build_ownership=True)
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import asyncio
+import subprocess
+import threading
+import time
+from typing import List
+
+import pytest
+from fastapi.testclient import TestClient
+from loguru import logger
+
+from mipserver.config import Profiling, settings
+from mipserver.internal.metrics import EVENT_LOOP_BLOCKED
+from mipserver.internal.profiling import LoopLagMonitor, ProfilerBusy, SamplingProfiler
+
+
+def _busy_worker(stop: threading.Event) -> None:
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profile_endpoint_returns_collapsed_stacks(client: TestClient, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(settings.admin, "TOKEN", "s3cret")
+    assert client.post("/admin/profile", params={"seconds": 0.1}).status_code == 401
+
+    stop = threading.Event()
+    worker = threading.Thread(target=_busy_worker, args=(stop,), name="busy", daemon=True)
+    worker.start()
+    try:
+        r = client.post(
+            "/admin/profile", params={"seconds": 0.3, "interval_ms": 5}, headers={"Authorization": "Bearer s3cret"}
+        )
+    finally:
+        stop.set()
+        worker.join()
+    assert r.status_code == 200 and "attachment" in r.headers["content-disposition"]
+
+    lines: List[str] = r.text.splitlines()
+    assert lines and all(line.rsplit(" ", 1)[1].isdigit() for line in lines)  # "frame;frame;... count"
+    roots = {line.split(";", 1)[0] for line in lines}
+    assert "thread:busy" in roots and "event-loop" in roots
+    assert any(line.startswith("thread:busy;") and "_busy_worker (" in line for line in lines)
+    assert any(root.startswith("task:") for root in roots)  # the portal task of the test client at least
+
+
+def test_one_profile_per_worker_at_a_time() -> None:
+    profiler = SamplingProfiler(Profiling(max_seconds=0.2))
+
+    async def run() -> List[BaseException | str]:
+        return await asyncio.gather(profiler.profile(10, 5), profiler.profile(10, 5), return_exceptions=True)
+
+    started: float = time.monotonic()
+    first, second = asyncio.run(run())
+    assert time.monotonic() - started < 5  # capped at max_seconds
+    assert isinstance(first, str) and isinstance(second, ProfilerBusy)
+
+
+def test_blocked_event_loop_logs_the_blocking_call() -> None:
+    messages: List[str] = []
+    sink: int = logger.add(messages.append, level="WARNING", format="{message}")
+    blocked_before: float = EVENT_LOOP_BLOCKED._value.get()
+
+    async def blocking_route() -> None:
+        monitor = LoopLagMonitor(Profiling(loop_lag_threshold_ms=50, loop_lag_check_ms=10))
+        monitor.start()
+        await asyncio.sleep(0.05)
+        subprocess.run(["sleep", "0.3"], check=True)  # a sync git call in a coroutine
+        await asyncio.sleep(0.05)
+        monitor.stop()
+
+    try:
+        asyncio.run(blocking_route())
+    finally:
+        logger.remove(sink)
+    [message] = [m for m in messages if "event loop blocked" in m]  # logged once per blocking episode
+    assert "subprocess.run" in message and "blocking_route" in message
+    assert EVENT_LOOP_BLOCKED._value.get() == blocked_before + 1
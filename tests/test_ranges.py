@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+
+DATA: bytes = os.urandom(10_000)
+DIGEST: str = hashlib.sha256(DATA).hexdigest()
+URL: str = f"/file/{DIGEST[:2]}/{DIGEST}"
+
+
+@pytest.fixture(autouse=True)
+def stored_object(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(appmod, "SERVER_CACHE_ROOT", tmp_path)
+    target: Path = tmp_path / "files" / DIGEST[:2] / DIGEST
+    target.parent.mkdir(parents=True)
+    target.write_bytes(DATA)
+
+
+def test_whole_object_advertises_ranges(client: TestClient) -> None:
+    r = client.get(URL)
+    assert r.status_code == 200 and r.content == DATA
+    assert r.headers["accept-ranges"] == "bytes"
+    assert r.headers["etag"] == f'"{DIGEST}"'
+    assert "immutable" in r.headers["cache-control"]
+
+    head = client.head(URL)
+    assert head.status_code == 200 and head.headers["content-length"] == str(len(DATA)) and head.content == b""
+
+    assert client.get(URL, headers={"If-None-Match": f'"{DIGEST}"'}).status_code == 304
+
+
+def test_resume_with_range_and_if_range(client: TestClient) -> None:
+    r = client.get(URL, headers={"Range": "bytes=4000-"})
+    assert r.status_code == 206 and r.content == DATA[4000:]
+    assert r.headers["content-range"] == f"bytes 4000-9999/{len(DATA)}"
+
+    resumed = client.get(URL, headers={"Range": "bytes=9000-", "If-Range": f'"{DIGEST}"'})
+    assert resumed.status_code == 206 and resumed.content == DATA[9000:]
+
+    # validator of something else -> the whole object instead of a part that would not fit
+    other = client.get(URL, headers={"Range": "bytes=9000-", "If-Range": '"0123"'})
+    assert other.status_code == 200 and other.content == DATA
+
+    assert client.get(URL, headers={"Range": f"bytes={len(DATA)}-"}).status_code == 416
+
+
+def test_multiple_ranges(client: TestClient) -> None:
+    r = client.get(URL, headers={"Range": "bytes=0-9,100-109"})
+    assert r.status_code == 206
+    assert r.headers["content-type"].startswith("multipart/byteranges; boundary=")
+    assert DATA[0:10] in r.content and DATA[100:110] in r.content
+    assert f"bytes 100-109/{len(DATA)}".encode() in r.content
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+import asyncio
+from pathlib import Path
+from typing import Any, Dict, List
+
+import httpx
+import pytest
+
+from mipserver.config import Upstream
+from mipserver.Helper import MIPServerHelper
+from mipserver.internal.rawdownload import DownloadStatus, RawDownloader
+
+RAW: str = "https://raw.example"
+
+
+class FakeRaw:
+    """Raw file host with ETags, flaky responses and a counter of concurrent requests"""
+
+    def __init__(self) -> None:
+        self.files: Dict[str, bytes] = {}
+        self.fail_next: Dict[str, int] = {}
+        self.seen: List[httpx.Request] = []
+        self.in_flight: int = 0
+        self.max_in_flight: int = 0
+
+    async def handler(self, request: httpx.Request) -> httpx.Response:
+        self.seen.append(request)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            path: str = request.url.path
+            if self.fail_next.get(path, 0) > 0:
+                self.fail_next[path] -= 1
+                return httpx.Response(503)
+            if path not in self.files:
+                return httpx.Response(404)
+            etag: str = f'"{hash(self.files[path]) & 0xFFFF:x}"'
+            if request.headers.get("If-None-Match") == etag:
+                return httpx.Response(304)
+            return httpx.Response(200, content=self.files[path], headers={"ETag": etag})
+        finally:
+            self.in_flight -= 1
+
+
+def _downloader(raw: FakeRaw, **cfg: Any) -> RawDownloader:
+    upstream = Upstream(raw_base_url=RAW, retry_backoff_seconds=0, **cfg)
+    return RawDownloader(upstream, transport=httpx.MockTransport(raw.handler))
+
+
+def test_conditional_requests_and_retries(tmp_path: Path) -> None:
+    raw = FakeRaw()
+    raw.files["/f.py"] = b"x = 1\n"
+    raw.fail_next["/f.py"] = 2
+    downloader = _downloader(raw, retries=2)
+    target: Path = tmp_path / "f.py"
+
+    async def run() -> List[DownloadStatus]:
+        try:
+            statuses = [await downloader.fetch(f"{RAW}/f.py", target)]
+            statuses.append(await downloader.fetch(f"{RAW}/f.py", target))
+            raw.files["/f.py"] = b"x = 2\n"
+            statuses.append(await downloader.fetch(f"{RAW}/f.py", target))
+            statuses.append(await downloader.fetch(f"{RAW}/gone.py", tmp_path / "gone.py"))
+            raw.fail_next["/f.py"] = 5
+            statuses.append(await downloader.fetch(f"{RAW}/f.py", target))
+            return statuses
+        finally:
+            await downloader.aclose()
+
+    assert asyncio.run(run()) == [
+        DownloadStatus.fetched,
+        DownloadStatus.not_modified,
+        DownloadStatus.fetched,
+        DownloadStatus.missing,
+        DownloadStatus.failed,
+    ]
+    assert target.read_bytes() == b"x = 2\n"
+    assert "If-None-Match" in raw.seen[3].headers  # the conditional request after the first download
+    assert not [p for p in tmp_path.iterdir() if p.name.endswith(".tmp")]
+
+
+def test_upstream_retry_after_is_capped() -> None:
+    downloader = _downloader(FakeRaw(), max_retry_after_seconds=5)
+    assert downloader._backoff(0, "3") == 3
+    assert downloader._backoff(0, "3600") == 5  # would park the package request for an hour
+
+
+def test_package_download_is_bounded_and_keeps_cached_copies(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    raw = FakeRaw()
+    paths: List[str] = [f"pkg/mod{i}.py" for i in range(12)]
+    for p in paths:
+        raw.files[f"/owner/repo/refs/heads/main/{p}"] = p.encode()
+
+    downloader = _downloader(raw, parallel_downloads_per_package=3, retries=0)
+    msh = MIPServerHelper(server_cache_root=tmp_path, package_name_to_repo={"pkg": "owner/repo"})
+    monkeypatch.setattr(MIPServerHelper, "GITHUB_RAW_BASE", RAW)
+
+    async def run() -> List[Dict[str, Path | None]]:
+        try:
+            first = await msh.download_raw_files(downloader, "owner/repo", paths + ["../escape.py"])
+            raw.fail_next = {f"/owner/repo/refs/heads/main/{p}": 1 for p in paths}  # upstream down
+            second = await msh.download_raw_files(downloader, "owner/repo", paths[:2] + ["pkg/new.py"])
+            return [first, second]
+        finally:
+            await downloader.aclose()
+
+    first, second = asyncio.run(run())
+
+    assert raw.max_in_flight == 3
+    assert first["../escape.py"] is None
+    assert all(first[p] == (tmp_path / p).resolve() and (tmp_path / p).read_text() == p for p in paths)
+    assert second["pkg/mod0.py"] == (tmp_path / "pkg/mod0.py").resolve() and second["pkg/new.py"] is None
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List
+
+import pytest
+
+fakeredis = pytest.importorskip("fakeredis")
+
+from mipserver.config import NegativeCache, Redis as RedisConfig  # noqa: E402
+from mipserver.internal.coordination import EVENT_NEW_REVISION  # noqa: E402
+from mipserver.internal.locks import LockTimeout  # noqa: E402
+from mipserver.internal.metadata import MetadataStore  # noqa: E402
+from mipserver.internal.negativecache import NegativeReason  # noqa: E402
+from mipserver.internal.redisstate import (  # noqa: E402
+    RedisInvalidationBus,
+    RedisLockManager,
+    RedisNegativeCache,
+    SharedRevisions,
+)
+
+CFG = RedisConfig(ENABLED=True, LOCK_TTL_SECONDS=1)
+
+
+@pytest.fixture()
+def server() -> Any:
+    return fakeredis.FakeServer()
+
+
+def _pod(server: Any) -> Any:
+    """One client per pod, all talking to the same redis"""
+    return fakeredis.FakeRedis(server=server, decode_responses=True)
+
+
+def test_lock_is_exclusive_across_pods_and_renewed(server: Any) -> None:
+    a, b = RedisLockManager(_pod(server), CFG), RedisLockManager(_pod(server), CFG)
+
+    with a.lock("build-demo@latest"):
+        time.sleep(1.5)  # longer than the ttl -> only the watchdog keeps it
+        assert b.is_locked("build-demo@latest")
+        with pytest.raises(LockTimeout):
+            with b.lock("build-demo@latest", timeout=0.1):
+                pass
+    assert not b.is_locked("build-demo@latest")
+
+    acquired: List[float] = []
+
+    def waiter() -> None:
+        with b.lock("gc", timeout=5):
+            acquired.append(time.monotonic())
+
+    with a.lock("gc"):
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.2)
+        released: float = time.monotonic()
+    thread.join()
+    assert acquired and acquired[0] >= released
+
+
+def test_negative_cache_is_shared(server: Any) -> None:
+    cfg = NegativeCache()
+    a, b = RedisNegativeCache(cfg, _pod(server), CFG), RedisNegativeCache(cfg, _pod(server), CFG)
+
+    a.put(("demo", "latest", "6"), NegativeReason.build_failed, "mpy-cross failed", commit="c1")
+    a.put(("demo", "gone", RedisNegativeCache.ANY_TARGET), NegativeReason.missing_ref, "no such branch")
+
+    entry = b.get(("demo", "latest", "6"))
+    assert entry is not None and entry.commit == "c1" and not entry.is_expired()
+    assert 0 < entry.retry_after() <= cfg.build_failed_ttl_seconds + 1
+    assert b.get(("demo", "gone", "py")) is not None  # target independent failure
+    assert len(b) == 2
+
+    assert b.invalidate_on_new_commit("demo", "latest", "c1") == 0
+    assert b.invalidate_on_new_commit("demo", "latest", "c2") == 1
+    assert a.get(("demo", "latest", "6")) is None
+    assert a.invalidate("demo") == 1 and len(a) == 0
+
+
+def test_shared_revisions_and_invalidation_pubsub(server: Any, tmp_path: Path) -> None:
+    revisions = SharedRevisions(_pod(server), CFG)
+    revisions.put("demo", "latest", "c1")
+    rev = SharedRevisions(_pod(server), CFG).get("demo", "latest", max_age=60)
+    assert rev is not None and rev.commit == "c1"
+    assert SharedRevisions(_pod(server), CFG).get("demo", "latest", max_age=-1) is None  # too old
+
+    # pods with separate caches -> separate indexes, only redis in common
+    bus_a = RedisInvalidationBus(MetadataStore(tmp_path / "a.sqlite3", tmp_path), _pod(server), CFG)
+    bus_b = RedisInvalidationBus(MetadataStore(tmp_path / "b.sqlite3", tmp_path), _pod(server), CFG)
+    received: List[Dict[str, Any]] = []
+    bus_a.subscribe(EVENT_NEW_REVISION, received.append)
+
+    bus_b.publish(EVENT_NEW_REVISION, package_name="demo", pversion="latest", commit="c2")
+    bus_a.publish(EVENT_NEW_REVISION, package_name="own", pversion="latest", commit="c3")
+    deadline: float = time.monotonic() + 2
+    while not received and time.monotonic() < deadline:
+        bus_a.poll()
+        time.sleep(0.01)
+    bus_a.poll()
+    assert received == [{"package_name": "demo", "pversion": "latest", "commit": "c2"}]
+
+
+def test_pod_skips_fetch_when_another_pod_saw_the_same_commit(
+    server: Any, client: Any, tmp_path: Path, metadata_store: MetadataStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    import mipserver.app as appmod
+    from mipserver.Helper import MIPServerHelper
+    from mipserver.internal.metadata import BuildRecord
+
+    json_path: Path = tmp_path / "6" / "demo" / "latest.json"
+    json_path.parent.mkdir(parents=True)
+    json_path.write_text('{"hashes": []}')
+    metadata_store.record_build(
+        BuildRecord(
+            package_name="demo",
+            mpy_version="6",
+            pversion="latest",
+            commit="c1",
+            json_path="6/demo/latest.json",
+            built_at=1.0,
+            checked_at=1.0,  # long ago -> upstream has to be checked
+        )
+    )
+    revisions = SharedRevisions(_pod(server), CFG)
+    revisions.put("demo", "latest", "c1")
+
+    def no_fetch(*args: Any, **kwargs: Any) -> Path | None:
+        raise AssertionError("fetched although another pod just checked upstream")
+
+    monkeypatch.setattr(MIPServerHelper, "ensure_git_repo_up_to_date", no_fetch)
+    appmod.app.dependency_overrides[appmod.get_package_name_to_repo] = lambda: {"demo": "someone/demo"}
+    appmod.app.dependency_overrides[appmod.get_shared_revisions] = lambda: revisions
+    try:
+        r = client.get("/package/6/demo/latest.json")
+        assert r.status_code == 200 and r.json() == {"hashes": []}
+        checked = metadata_store.get_build("demo", "6", "latest")
+        assert checked is not None and checked.checked_at > 1.0
+    finally:
+        appmod.app.dependency_overrides.clear()
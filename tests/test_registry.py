@@ -0,0 +1,93 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import List
+
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+
+import mipserver.dependencies as depmod
+from mipserver.config import PackageNameGithubRepo, PackageNameGithubRepoList, settings
+from mipserver.internal.metadata import MetadataStore
+from mipserver.internal.negativecache import NegativeReason, NegativeResultCache
+from mipserver.internal.registry import PackageRegistry, RegistryDiff, RegistryError
+
+from .test_metadata import _record
+
+
+def _write(path: Path, packages: dict[str, str]) -> None:
+    path.write_text(
+        yaml.safe_dump(
+            {"PACKAGENAME_TO_GITHUB_REPO": [{"packagename": n, "githubrepo": r} for n, r in packages.items()]}
+        )
+    )
+
+
+def _registry(config: Path) -> PackageRegistry:
+    def loader() -> List[PackageNameGithubRepo]:
+        raw = yaml.safe_load(config.read_text())
+        return PackageNameGithubRepoList.model_validate(raw["PACKAGENAME_TO_GITHUB_REPO"]).root
+
+    return PackageRegistry(loader(), [config], loader)
+
+
+def test_reload_applies_diff_when_config_changes(tmp_path: Path) -> None:
+    config: Path = tmp_path / "config.local.yaml"
+    _write(config, {"keep": "me/keep", "moved": "me/moved", "gone": "me/gone"})
+    registry: PackageRegistry = _registry(config)
+    seen: List[RegistryDiff] = []
+    registry.subscribe(seen.append)
+    before = registry.name_to_repo
+
+    assert registry.reload_if_changed() is None  # untouched -> not even parsed
+
+    _write(config, {"keep": "me/keep", "moved": "fork/moved", "new": "me/new"})
+    diff: RegistryDiff | None = registry.reload_if_changed()
+
+    assert diff == RegistryDiff(added=["new"], removed=["gone"], changed=["moved"])
+    assert seen == [diff]
+    assert registry.name_to_repo == {"keep": "me/keep", "moved": "fork/moved", "new": "me/new"}
+    assert before["moved"] == "me/moved"  # a request holding the old map keeps a consistent view
+    assert not registry.reload()  # nothing changed -> empty diff, no listener call
+    assert len(seen) == 1
+
+    config.write_text("PACKAGENAME_TO_GITHUB_REPO: [{packagename: broken}]")
+    with pytest.raises(RegistryError):
+        registry.reload_if_changed()
+    assert "new" in registry.configs  # still serving the last good list
+    assert registry.reload_if_changed() is None  # the broken file is not re-parsed on every poll
+
+
+def test_admin_reload_invalidates_only_affected_packages(
+    client: TestClient, metadata_store: MetadataStore, monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    config: Path = tmp_path / "config.local.yaml"
+    _write(config, {"keep": "me/keep", "moved": "me/moved"})
+    registry: PackageRegistry = _registry(config)
+    registry.subscribe(depmod.invalidate_registry_changes)
+    monkeypatch.setattr(depmod, "PACKAGE_REGISTRY", registry)
+    monkeypatch.setattr(depmod.CACHE_MANAGER, "package_name_to_repo", registry.name_to_repo)
+    monkeypatch.setattr(settings.admin, "TOKEN", "s3cret")
+
+    negative_cache: NegativeResultCache = depmod.NEGATIVE_CACHE
+    any_target: str = NegativeResultCache.ANY_TARGET
+    negative_cache.put(("new", any_target, any_target), NegativeReason.unknown_package, "unknown")
+    negative_cache.put(("keep", "latest", "6"), NegativeReason.build_failed, "broken", commit="c1")
+    metadata_store.record_build(_record("keep", "latest", ["a" * 64]))
+    metadata_store.record_build(_record("moved", "latest", ["b" * 64]))
+
+    _write(config, {"keep": "me/keep", "moved": "fork/moved", "new": "me/new"})
+    r = client.post("/admin/registry/reload", headers={"Authorization": "Bearer s3cret"})
+
+    assert r.status_code == 200
+    assert r.json() == {"added": ["new"], "removed": [], "changed": ["moved"]}
+    assert depmod.get_package_name_to_repo()["moved"] == "fork/moved"
+    assert depmod.CACHE_MANAGER.package_name_to_repo is registry.name_to_repo
+    assert negative_cache.get(("new", any_target, any_target)) is None
+    assert negative_cache.get(("keep", "latest", "6")) is not None  # not affected -> untouched
+
+    moved = metadata_store.get_build("moved", "6", "latest")
+    kept = metadata_store.get_build("keep", "6", "latest")
+    assert moved is not None and moved.commit is None and moved.checked_at == 0
+    assert kept is not None and kept.commit == "c1" and kept.checked_at > 0
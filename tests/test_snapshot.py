@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import tarfile
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+from fastapi.testclient import TestClient
+
+from mipserver.config import settings
+from mipserver.internal.metadata import MetadataStore, build_record_from_package_json
+from mipserver.internal.objectstore import LooseObjectStore
+from mipserver.internal.snapshot import SnapshotError, Snapshots
+
+
+def _node(root: Path) -> Snapshots:
+    return Snapshots(root, MetadataStore(root / "metadata.sqlite3", root), LooseObjectStore(root / "files"))
+
+
+def _build(node: Snapshots, package_name: str, mpy_version: str, modules: Dict[str, bytes]) -> List[str]:
+    hashes: List[str] = []
+    for content in modules.values():
+        h: str = hashlib.sha256(content).hexdigest()
+        node.object_store.put_bytes(content, h)
+        hashes.append(h)
+    json_path: Path = node.cache_root / mpy_version / package_name / "latest.json"
+    json_path.parent.mkdir(parents=True, exist_ok=True)
+    json_path.write_text(json.dumps({"hashes": [[p, h] for p, h in zip(modules, hashes)], "version": "1.0"}))
+    node.metadata.record_build(
+        build_record_from_package_json(
+            node.metadata, node.object_store, json_path, package_name, mpy_version, "latest", f"{package_name}-c1"
+        )
+    )
+    return hashes
+
+
+def test_export_selected_and_import_incrementally(tmp_path: Path) -> None:
+    a = _node(tmp_path / "a")
+    shared: bytes = b"shared helper"
+    demo = _build(a, "demo", "6", {"demo.mpy": b"demo 6", "helper.mpy": shared})
+    _build(a, "demo", "py", {"demo.py": b"demo py"})
+    _build(a, "other", "6", {"other.mpy": b"other", "helper.mpy": shared})
+
+    archive = io.BytesIO()
+    manifest = a.export(archive, packages=["demo", "other@latest"], mpy_versions=["6"])
+    assert sorted(b.package_name for b in manifest.builds) == ["demo", "other"]
+    assert len(manifest.objects) == 3  # the shared object once, nothing of the py target
+
+    b = _node(tmp_path / "b")
+    report = b.import_(io.BytesIO(archive.getvalue()))
+    assert (len(report.builds), report.objects_imported, report.objects_present) == (2, 3, 0)
+    build = b.metadata.get_build("demo", "6", "latest", with_files=True)
+    assert build is not None and build.commit == "demo-c1"
+    assert sorted(f.hash for f in build.files) == sorted(demo)
+    assert b.object_store.path_for(demo[1]).read_bytes() == shared
+
+    again = b.import_(io.BytesIO(archive.getvalue()))
+    assert (again.objects_imported, again.objects_present) == (0, 3)
+
+
+def test_import_rejects_corrupt_objects(tmp_path: Path) -> None:
+    a = _node(tmp_path / "a")
+    [h] = _build(a, "demo", "6", {"demo.mpy": b"original"})
+    a.object_store.path_for(h).write_bytes(b"tampered")  # same size would not matter either
+
+    archive = io.BytesIO()
+    a.export(archive)
+    b = _node(tmp_path / "b")
+    with pytest.raises(SnapshotError, match="does not match"):
+        b.import_(io.BytesIO(archive.getvalue()))
+    assert not b.object_store.has(h)
+    assert b.metadata.get_build("demo", "6", "latest") is None
+
+    with tarfile.open(fileobj=(plain := io.BytesIO()), mode="w|gz") as tar:
+        tar.addfile(tarfile.TarInfo("something.txt"), io.BytesIO(b""))
+    with pytest.raises(SnapshotError, match="manifest"):
+        b.import_(io.BytesIO(plain.getvalue()))
+
+
+def test_offline_node_serves_imported_packages(
+    client: TestClient, tmp_path: Path, metadata_store: MetadataStore, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    a = _node(tmp_path / "a")
+    _build(a, "unconfigured", "6", {"x.mpy": b"x"})
+    archive = io.BytesIO()
+    a.export(archive)
+
+    Snapshots(tmp_path, metadata_store, LooseObjectStore(tmp_path / "files")).import_(io.BytesIO(archive.getvalue()))
+    monkeypatch.setattr(settings.offline, "enabled", True)
+
+    r = client.get("/package/6/unconfigured/latest.json")
+    assert r.status_code == 200 and r.json()["hashes"][0][0] == "x.mpy"
+    assert client.get("/package/py/unconfigured/latest.json").status_code == 404
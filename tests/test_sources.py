@@ -0,0 +1,334 @@
+from __future__ import annotations
+
+import hashlib
+import io
+import json
+import os
+import tarfile
+from pathlib import Path
+from typing import Any, Dict, Iterator, List
+
+import pytest
+from pydantic import ValidationError
+
+import mipserver.internal.sources as sourcesmod
+from benchmarks.fakeupstream import _git, create_fake_upstream, ensure_mpy_cross, push_new_commit
+from mipserver.config import PackageNameGithubRepo, Source, SourceKind
+from mipserver.datastructures.datatypes import MPYPath
+from mipserver.Helper import MIPServerHelper, RefNotFoundError
+from mipserver.internal.sources import GitSource, LocalDirSource, MirrorSource, TarballSource, source_for
+
+
+def _helper(root: Path, repo: str) -> MIPServerHelper:
+    return MIPServerHelper(server_cache_root=root, package_name_to_repo={"demo": repo})
+
+
+def _pkg(repo: str, **source: Any) -> PackageNameGithubRepo:
+    return PackageNameGithubRepo(packagename="demo", githubrepo=repo, source=Source(**source))
+
+
+def _write_package(root: Path, content: str = "x = 1\n") -> None:
+    (root / "demo").mkdir(parents=True, exist_ok=True)
+    (root / "demo" / "mod.py").write_text(content)
+    (root / "package.json").write_text(json.dumps({"urls": [["demo/mod.py", "demo/mod.py"]], "version": "1.0"}))
+
+
+def _hashes(pkgjson: Path) -> Dict[str, str]:
+    return dict(json.loads(pkgjson.read_text())["hashes"])
+
+
+def test_source_config_validation() -> None:
+    assert isinstance(source_for(_pkg("o/r"), _helper(Path("/tmp"), "o/r")), GitSource)
+    with pytest.raises(ValidationError):
+        _pkg("o/r", kind=SourceKind.local)
+    with pytest.raises(ValidationError):
+        _pkg("o/r", kind=SourceKind.mirror)
+
+
+def test_git_source_with_file_url(tmp_path: Path) -> None:
+    upstream = create_fake_upstream(tmp_path / "upstream", packages=1, files_per_package=2, file_size=200)
+    fake = upstream.packages[0]
+    cache: Path = tmp_path / "cache"
+    source = GitSource(_helper(cache, fake.repo_name), _pkg(fake.repo_name, url=f"file://{fake.bare_repo}"))
+
+    revision = source.remote_revision("latest", MPYPath.py)
+    prepared = source.prepare("latest", MPYPath.py)
+    assert prepared is not None and prepared.revision == revision
+    assert prepared.path == cache / "benchpkg0@latest"
+
+    built: Path = source.build(prepared, cache / "py" / "demo" / "latest.json", MPYPath.py)
+    assert sorted(_hashes(built)) == fake.files
+
+    new_commit: str = push_new_commit(upstream, fake)
+    assert source.remote_revision("latest", MPYPath.py) == new_commit
+
+    with pytest.raises(RefNotFoundError):
+        source.prepare("nosuchbranch", MPYPath.py)
+
+
+def test_local_dir_source_copies_only_on_change(tmp_path: Path) -> None:
+    lab: Path = tmp_path / "lab"
+    _write_package(lab)
+    cache: Path = tmp_path / "cache"
+    source = LocalDirSource(_helper(cache, "lab/demo"), _pkg("lab/demo", kind=SourceKind.local, path=str(lab)))
+
+    first = source.prepare("latest", MPYPath.py)
+    assert first is not None and first.revision == source.remote_revision("latest", MPYPath.py)
+    built: Path = source.build(first, cache / "py" / "demo" / "latest.json", MPYPath.py)
+    digest: str = _hashes(built)["demo/mod.py"]
+    assert (cache / "files" / digest[:2] / digest).read_text() == "x = 1\n"
+    assert not list(lab.rglob("*.mpy"))  # the lab directory itself is never written to
+
+    (first.path / "marker").write_text("still the same copy")
+    assert source.prepare("latest", MPYPath.py) == first
+    assert (first.path / "marker").exists()
+
+    (lab / "demo" / "mod.py").write_text("x = 22\n")
+    second = source.prepare("latest", MPYPath.py)
+    assert second is not None and second.revision != first.revision
+    assert (second.path / "demo" / "mod.py").read_text() == "x = 22\n"
+    assert not (second.path / "marker").exists()
+
+    with pytest.raises(RefNotFoundError):
+        source.prepare("v1", MPYPath.py)
+
+
+def test_tarball_source_strips_top_level_dir(tmp_path: Path) -> None:
+    tree: Path = tmp_path / "demo-1.0"
+    _write_package(tree)
+    archive: Path = tmp_path / "demo-main.tar.gz"
+    with tarfile.open(archive, "w:gz") as tf:
+        tf.add(tree, arcname="demo-1.0")
+
+    cache: Path = tmp_path / "cache"
+    url: str = f"file://{tmp_path}/demo-{{ref}}.tar.gz"
+    source = TarballSource(_helper(cache, "rel/demo"), _pkg("rel/demo", kind=SourceKind.tarball, url=url))
+
+    prepared = source.prepare("latest", MPYPath.py)
+    assert prepared is not None and prepared.revision == source.remote_revision("latest", MPYPath.py)
+    assert (prepared.path / "package.json").is_file() and (prepared.path / "demo" / "mod.py").is_file()
+    assert "demo/mod.py" in _hashes(source.build(prepared, cache / "py" / "demo" / "latest.json", MPYPath.py))
+
+    os.utime(archive, ns=(0, 0))
+    assert source.remote_revision("latest", MPYPath.py) != prepared.revision
+
+    with pytest.raises(RefNotFoundError):
+        source.prepare("v9", MPYPath.py)
+
+
+class _FakeResponse:
+    def __init__(self, status_code: int, content: bytes = b""):
+        self.status_code = status_code
+        self.content = content
+
+    def raise_for_status(self) -> None:
+        if self.status_code >= 400:
+            raise sourcesmod.requests.HTTPError(str(self.status_code))
+
+    def iter_content(self, chunk_size: int = 1) -> Iterator[bytes]:
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i : i + chunk_size]
+
+    def __enter__(self) -> "_FakeResponse":
+        return self
+
+    def __exit__(self, *exc: object) -> None:
+        pass
+
+
+def test_mirror_source_rewrites_short_hashes(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    content: bytes = b"print('hello')\n"
+    full: str = hashlib.sha256(content).hexdigest()
+    index: Dict[str, bytes] = {
+        "https://index.example/package/6/aiorepl/latest.json": json.dumps(
+            {"hashes": [["aiorepl.mpy", full[:8]]], "deps": [], "version": "0.2"}
+        ).encode(),
+        f"https://index.example/file/{full[:2]}/{full[:8]}": content,
+    }
+
+    fetched: List[str] = []
+
+    def fake_get(url: str, **kwargs: Any) -> _FakeResponse:
+        fetched.append(url)
+        return _FakeResponse(200, index[url]) if url in index else _FakeResponse(404)
+
+    monkeypatch.setattr(sourcesmod.requests, "get", fake_get)
+
+    cache: Path = tmp_path / "cache"
+    pkgcfg = _pkg("aiorepl", kind=SourceKind.mirror, url="https://index.example/")
+    source = MirrorSource(_helper(cache, "aiorepl"), pkgcfg)
+
+    revision = source.remote_revision("latest", MPYPath.six)
+    prepared = source.prepare("latest", MPYPath.six)
+    assert prepared is not None and prepared.revision == revision
+    assert len(fetched) == 1  # prepare reuses the json of the revision check
+    built = json.loads(source.build(prepared, cache / "6" / "aiorepl" / "latest.json", MPYPath.six).read_text())
+    assert built == {"hashes": [["aiorepl.mpy", full]], "deps": [], "version": "0.2"}
+    assert (cache / "files" / full[:2] / full).read_bytes() == content
+
+    fetched.clear()  # rebuild -> the object is in the store already
+    source.build(prepared, cache / "6" / "aiorepl" / "latest.json", MPYPath.six)
+    assert fetched == []
+
+    with pytest.raises(RefNotFoundError):
+        source.prepare("nope", MPYPath.six)
+
+    (cache / "files" / full[:2] / full).unlink()
+    index[f"https://index.example/file/{full[:2]}/{full[:8]}"] = b"tampered"
+    with pytest.raises(ValueError, match="hash mismatch"):
+        source.build(prepared, cache / "6" / "aiorepl" / "latest.json", MPYPath.six)
+    assert not list((cache / "files").glob("*.tmp"))
+
+    # a path, an empty or too short prefix -> rejected before any lookup or download
+    for bad in ["../../etc/passwd", "", full[:2]]:
+        (prepared.path / f"{MPYPath.six.value}.{MirrorSource.UPSTREAM_JSON}").write_text(
+            json.dumps({"hashes": [["aiorepl.mpy", bad]]})
+        )
+        fetched.clear()
+        with pytest.raises(ValueError, match="invalid hash"):
+            source.build(prepared, cache / "6" / "aiorepl" / "latest.json", MPYPath.six)
+        assert fetched == []
+
+
+def _worktree(checkout: Path) -> list[str]:
+    return sorted(str(p.relative_to(checkout)) for p in checkout.rglob("*") if p.is_file() and ".git" not in p.parts)
+
+
+def _git_dir_bytes(checkout: Path) -> int:
+    return sum(p.stat().st_size for p in (checkout / ".git").rglob("*") if p.is_file())
+
+
+def test_git_source_checks_out_only_referenced_files(tmp_path: Path) -> None:
+    upstream = create_fake_upstream(tmp_path / "upstream", packages=1, files_per_package=2, file_size=200)
+    fake = upstream.packages[0]
+    work: Path = upstream.root / ".work" / fake.package_name
+    (work / "docs").mkdir()
+    (work / "docs" / "manual.pdf").write_bytes(os.urandom(200_000))
+    _git("add", "-A", cwd=work)
+    _git("commit", "-q", "-m", "docs", cwd=work)
+    _git("push", "-q", str(fake.bare_repo), "main", cwd=work)
+    _git("config", "uploadpack.allowFilter", "true", cwd=fake.bare_repo)
+
+    cache: Path = tmp_path / "cache"
+    source = GitSource(_helper(cache, fake.repo_name), _pkg(fake.repo_name, url=f"file://{fake.bare_repo}"))
+    prepared = source.prepare("latest", MPYPath.py)
+    assert prepared is not None
+    assert _worktree(prepared.path) == sorted(fake.files + ["package.json"])
+    assert _git_dir_bytes(prepared.path) < 100_000  # the manual was never downloaded
+    assert sorted(_hashes(source.build(prepared, cache / "py" / "demo" / "latest.json", MPYPath.py))) == fake.files
+
+    # package.json now ships the manual as well -> the sparse checkout follows
+    pkgjson: Dict[str, Any] = json.loads((work / "package.json").read_text())
+    pkgjson["urls"].append(["docs/manual.pdf", "manual.pdf"])
+    (work / "package.json").write_text(json.dumps(pkgjson))
+    _git("commit", "-q", "-am", "ship the manual", cwd=work)
+    _git("push", "-q", str(fake.bare_repo), "main", cwd=work)
+
+    prepared = source.prepare("latest", MPYPath.py)
+    assert prepared is not None and "docs/manual.pdf" in _worktree(prepared.path)
+    built: Path = source.build(prepared, cache / "py" / "demo" / "latest.json", MPYPath.py)
+    assert "manual.pdf" in _hashes(built)
+
+
+def test_sparse_checkout_patterns() -> None:
+    urls = [["a/b.py", "b.py"], ["./c[1].py", "c.py"], ["../x.py", "x.py"], ["https://h/y.py", "y.py"]]
+    pkgjson: str = json.dumps({"urls": urls, "version": "1"})
+    assert MIPServerHelper.sparse_checkout_patterns({"package.json": pkgjson}) == [
+        "/a/b.py",
+        "/c\\[1\\].py",
+        "/package.json",
+    ]
+    assert MIPServerHelper.sparse_checkout_patterns({"package.json": "{not json"}) is None
+
+    # monorepo: paths relative to the package directory, npm & co. package.json files are left out
+    sub: Dict[str, str] = {"pkg/package.json": pkgjson, "web/package.json": '{"name": "site"}'}
+    assert MIPServerHelper.sparse_checkout_patterns(sub) == [
+        "/pkg/a/b.py",
+        "/pkg/c\\[1\\].py",
+        "/pkg/package.json",
+        "/x.py",
+    ]
+
+
+def _monorepo(root: Path) -> Path:
+    work: Path = root / "work"
+    for name in ("pkga", "pkgb"):
+        (work / name).mkdir(parents=True)
+        (work / name / f"{name}.py").write_text(f"NAME = {name!r}\n")
+        urls = [[f"{name}.py", f"{name}.py"], ["../common/shared.py", "shared.py"]]
+        (work / name / "package.json").write_text(json.dumps({"urls": urls, "version": "1.0"}))
+    (work / "common").mkdir()
+    (work / "common" / "shared.py").write_text("SHARED = 1\n")
+    (work / "docs").mkdir()
+    (work / "docs" / "big.bin").write_bytes(os.urandom(10_000))
+    _git("init", "-q", "-b", "main", cwd=work)
+    _git("add", "-A", cwd=work)
+    _git("commit", "-q", "-m", "initial", cwd=work)
+    bare: Path = root / "mono.git"
+    _git("clone", "-q", "--bare", str(work), str(bare))
+    _git("config", "uploadpack.allowFilter", "true", cwd=bare)
+    return work
+
+
+def _push(work: Path, rel: str, content: str) -> None:
+    (work / rel).write_text(content)
+    _git("commit", "-q", "-am", f"change {rel}", cwd=work)
+    _git("push", "-q", str(work.parent / "mono.git"), "main", cwd=work)
+
+
+def test_monorepo_packages_share_one_checkout(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setenv("PATH", os.environ.get("PATH", ""))  # -> the stub is gone after the test
+    ensure_mpy_cross(tmp_path / "bin", force_stub=True)
+    work: Path = _monorepo(tmp_path)
+    url: str = f"file://{tmp_path / 'mono.git'}"
+    cache: Path = tmp_path / "cache"
+    helper = MIPServerHelper(server_cache_root=cache, package_name_to_repo={"pkga": "lab/mono", "pkgb": "lab/mono"})
+    sources = {
+        name: source_for(
+            PackageNameGithubRepo(packagename=name, githubrepo="lab/mono", source=Source(url=url, subpath=f"/{name}/")),
+            helper,
+        )
+        for name in ("pkga", "pkgb")
+    }
+
+    fetches: list[str] = []
+    compiles: list[str] = []
+    fetch, compile_mpy = MIPServerHelper.ensure_git_repo_up_to_date, MIPServerHelper.compile_mpy
+    monkeypatch.setattr(
+        MIPServerHelper,
+        "ensure_git_repo_up_to_date",
+        lambda self, **kw: fetches.append(kw["branch"]) or fetch(self, **kw),
+    )
+    monkeypatch.setattr(
+        MIPServerHelper, "compile_mpy", lambda **kw: compiles.append(kw["py_src_name"]) or compile_mpy(**kw)
+    )
+
+    def build_all() -> Dict[str, str | None]:
+        revisions: Dict[str, str | None] = {}
+        for name, source in sources.items():
+            prepared = source.prepare("latest", MPYPath.six)
+            assert prepared is not None and prepared.path == cache / "mono@latest"
+            assert source.remote_revision("latest", MPYPath.six) == prepared.revision
+            built = source.build(prepared, cache / "6" / name / "latest.json", MPYPath.six)
+            assert sorted(_hashes(built)) == [f"{name}.mpy", "shared.mpy"]
+            revisions[name] = prepared.revision
+        return revisions
+
+    first = build_all()
+    assert fetches == ["latest"]  # pkgb found the checkout at the remote commit
+    assert sorted(compiles) == ["../common/shared.py", "pkga.py", "pkgb.py"]  # shared.py once for both
+    assert not (cache / "mono@latest" / "docs").exists()
+
+    _push(work, "pkga/pkga.py", "NAME = 'changed'\n")
+    fetches.clear()
+    compiles.clear()
+    second = build_all()
+    assert fetches == ["latest"] and compiles == ["pkga.py"]
+    assert second["pkga"] != first["pkga"] and second["pkgb"] == first["pkgb"]  # -> pkgb is not rebuilt
+
+    _push(work, "common/shared.py", "SHARED = 2\n")
+    third = build_all()
+    assert third["pkga"] != second["pkga"] and third["pkgb"] != second["pkgb"]
+
+    with pytest.raises(ValidationError):
+        PackageNameGithubRepo(packagename="x", githubrepo="lab/mono", source=Source(subpath="../x"))
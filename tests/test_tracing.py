@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+import json
+from pathlib import Path
+from typing import Any
+
+import pytest
+from fastapi.testclient import TestClient
+
+import mipserver.app as appmod
+from mipserver.config import Tracing, settings
+from mipserver.Helper import MIPServerHelper
+from mipserver.internal.tracing import BuildTracer, set_attribute, span
+
+
+def test_spans_nest_and_timelines_are_bounded(tmp_path: Path) -> None:
+    tracer = BuildTracer(Tracing(timelines_per_package=2, export_path=str(tmp_path / "traces.jsonl")))
+
+    with span("outside-of-a-build") as s:
+        assert s is None
+
+    for i in range(3):
+        with tracer.trace_build("demo", "6", "latest"):
+            with span("git.fetch"):
+                with span("compile", file=f"mod{i}.py"):
+                    pass
+            set_attribute("result", "built")
+
+    [newest, older] = tracer.timelines("demo")
+    assert newest.started_at >= older.started_at
+    assert newest.result == "built"
+    root, fetch, compile_ = newest.spans
+    assert root.parent_span_id is None
+    assert fetch.parent_span_id == root.span_id and compile_.parent_span_id == fetch.span_id
+    assert compile_.attributes["file"] == "mod2.py"
+    assert {s.trace_id for s in newest.spans} == {newest.trace_id}
+
+    lines = (tmp_path / "traces.jsonl").read_text().splitlines()
+    assert len(lines) == 3
+    otlp = json.loads(lines[-1])["resourceSpans"][0]["scopeSpans"][0]["spans"]
+    assert [s["name"] for s in otlp] == ["build", "git.fetch", "compile"]
+    assert otlp[2]["parentSpanId"] == otlp[1]["spanId"]
+
+
+def test_failed_span_is_marked() -> None:
+    tracer = BuildTracer(Tracing())
+    with pytest.raises(RuntimeError):
+        with tracer.trace_build("demo", "py", "latest"):
+            with span("compile"):
+                raise RuntimeError("boom")
+
+    [timeline] = tracer.timelines()
+    assert timeline.result == "error"
+    assert timeline.spans[1].error == "RuntimeError: boom"
+
+
+def test_build_timeline_endpoint(client: TestClient, tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    checkout: Path = tmp_path / "demo@latest"
+    checkout.mkdir()
+    (checkout / "demo.py").write_text("print('hi')\n")
+    (checkout / "package.json").write_text(json.dumps({"urls": [["demo.py", "demo.py"]], "version": "0.1"}))
+
+    def fake_get_local_path_for_package_json_by_package_and_version(self: MIPServerHelper, mpy_version: Any, package_name: str, pversion: str) -> Path:  # type: ignore[override]
+        return tmp_path / str(mpy_version) / package_name / f"{pversion}.json"
+
+    def fake_ensure_git_repo_up_to_date(self: MIPServerHelper, repo_name: str, branch: str, repo_url: str | None = None) -> Path | None:  # type: ignore[override]
+        return checkout
+
+    monkeypatch.setattr(
+        MIPServerHelper,
+        "get_local_path_for_package_json_by_package_and_version",
+        fake_get_local_path_for_package_json_by_package_and_version,
+    )
+    monkeypatch.setattr(MIPServerHelper, "ensure_git_repo_up_to_date", fake_ensure_git_repo_up_to_date)
+    monkeypatch.setattr(MIPServerHelper, "get_checkout_commit", staticmethod(lambda checkout_dir: "c1"))
+    monkeypatch.setattr(settings.admin, "TOKEN", "s3cret")
+
+    tracer = BuildTracer(Tracing())
+    appmod.app.dependency_overrides[appmod.get_package_name_to_repo] = lambda: {"demo": "someone/demo"}
+    appmod.app.dependency_overrides[appmod.get_build_tracer] = lambda: tracer
+    try:
+        assert client.get("/package/py/demo/latest.json").status_code == 200
+
+        r = client.get(
+            "/admin/builds/timelines", params={"package_name": "demo"}, headers={"Authorization": "Bearer s3cret"}
+        )
+        assert r.status_code == 200
+        [timeline] = r.json()
+        assert timeline["result"] == "built"
+        names = [s["name"] for s in timeline["spans"]]
+        for stage in ("build", "build_slot.wait", "package_json.parse", "hash", "store", "package_json.write"):
+            assert stage in names
+    finally:
+        appmod.app.dependency_overrides.clear()